@@ -2,6 +2,8 @@ import hail as hl
 import pandas as pd
 import re
 from .aou_paths import *
+from gnomad_mitochondria.utils.flat_files import read_flat_file_parquet
+from gnomad_mitochondria.utils.partitioning import naive_coalesce_to_target, repartition_to_target
 from .run_per_ancestry_pca import get_custom_pc_path, make_iteration_suffix
 
 
@@ -116,7 +118,7 @@ def get_covariates(iteration, overwrite=False, use_custom_pca=False):
             sample_covariates = sample_covariates.annotate(**ancestry_ht[sample_covariates.s])
         
         sample_covariates = hap_to_dummy(sample_covariates)
-        sample_covariates = sample_covariates.repartition(100).checkpoint(covar_path, overwrite=True)
+        sample_covariates = repartition_to_target(sample_covariates, path=FINAL_SAMPLE_STATS).checkpoint(covar_path, overwrite=True)
     
     return sample_covariates
 
@@ -138,6 +140,19 @@ def get_case_only_mtdna_callset(num_to_keep=310, overwrite=False):
     if hl.hadoop_exists(f"{get_final_case_only_hl_path(num_to_keep, 'ht')}/_SUCCESS") and not overwrite:
         ht = hl.read_table(get_final_case_only_hl_path(num_to_keep, 'ht'))
     
+    elif hl.hadoop_exists(f"{FINAL_VARIANT_CALLSET_PARQUET_PATH}/_SUCCESS"):
+        # Only the columns and rows needed at each step are read from the Parquet export
+        df_for_enumeration = read_flat_file_parquet(FINAL_VARIANT_CALLSET_PARQUET_PATH, columns=['variant', 'HL'], max_hl=0.95,
+                                                    column_values={'common_low_heteroplasmy': [True]}, dictionary_columns=[])
+        counted_variants = df_for_enumeration.groupby('variant')['HL'].count().sort_values(ascending=False)
+        variants_to_extract = list(counted_variants[counted_variants > num_to_keep].index)
+
+        variants_to_analyze = read_flat_file_parquet(FINAL_VARIANT_CALLSET_PARQUET_PATH, max_hl=0.95,
+                                                     column_values={'variant': variants_to_extract}, dictionary_columns=[])
+        variants_to_analyze = variants_to_analyze.drop(columns=['position', 'position_bin'])
+        all_samples = read_flat_file_parquet(FINAL_VARIANT_CALLSET_PARQUET_PATH, columns=['s'], dictionary_columns=[])
+        ht = _pivot_case_only_callset(variants_to_analyze, set(all_samples['s']), variants_to_extract, num_to_keep)
+
     else:
         df = pd.read_csv(FINAL_VARIANT_CALLSET_PATH, sep='\t', 
                          compression='gzip',
@@ -164,22 +179,29 @@ def get_case_only_mtdna_callset(num_to_keep=310, overwrite=False):
         variants_to_extract = list(counted_variants[counted_variants > num_to_keep].index)
 
         variants_to_analyze = df[df['variant'].isin(variants_to_extract) & (~df['HL'].isna()) & (df['HL'] < 0.95)]
-        variants_to_analyze.to_csv(get_final_case_only_hl_path(num_to_keep, 'tsv'), sep='\t', index=False)
-        
-        pivoted_vars = variants_to_analyze.pivot(index='s', columns='variant',values='HL').reset_index()
-        alls = pd.DataFrame({'s': list(set(df['s']))})
-        data_HL = pd.merge(pivoted_vars, alls, on='s', how='right')
-        backbone = data_HL[['s']].copy()
-        for vari in variants_to_extract:
-            this_name = re.sub('[:,]','_', vari)
-            backbone.loc[:,this_name] = data_HL[vari]
-
-        backbone.to_csv(f'{TEMP}pivoted_flat_file_lowHLqc.tsv', sep='\t', index=False)
-
-        ht = hl.import_table(f'{TEMP}pivoted_flat_file_lowHLqc.tsv', impute=True, missing='')
-        ht = ht.annotate(s = hl.str(ht.s)).key_by('s')
-        ht = ht.repartition(15).checkpoint(get_final_case_only_hl_path(num_to_keep, 'ht'))
+        ht = _pivot_case_only_callset(variants_to_analyze, set(df['s']), variants_to_extract, num_to_keep)
+    
+    return ht
+
+
+def _pivot_case_only_callset(variants_to_analyze, all_samples, variants_to_extract, num_to_keep):
+    """Pivot the extracted variants to one row per sample (samples without a call for a variant get a missing HL)."""
+    variants_to_analyze.to_csv(get_final_case_only_hl_path(num_to_keep, 'tsv'), sep='\t', index=False)
     
+    pivoted_vars = variants_to_analyze.pivot(index='s', columns='variant',values='HL').reset_index()
+    alls = pd.DataFrame({'s': list(all_samples)})
+    data_HL = pd.merge(pivoted_vars, alls, on='s', how='right')
+    backbone = data_HL[['s']].copy()
+    for vari in variants_to_extract:
+        this_name = re.sub('[:,]','_', vari)
+        backbone.loc[:,this_name] = data_HL[vari]
+
+    backbone.to_csv(f'{TEMP}pivoted_flat_file_lowHLqc.tsv', sep='\t', index=False)
+
+    ht = hl.import_table(f'{TEMP}pivoted_flat_file_lowHLqc.tsv', impute=True, missing='')
+    ht = ht.annotate(s = hl.str(ht.s)).key_by('s')
+    ht = repartition_to_target(ht, path=f'{TEMP}pivoted_flat_file_lowHLqc.tsv').checkpoint(get_final_case_only_hl_path(num_to_keep, 'ht'))
+
     return ht
 
 
@@ -308,7 +330,7 @@ def apply_irnt(ht, cols):
     return ht
 
 
-def get_genotypes(AF_cutoff=0.001, n_partitions=5000, overwrite=False, use_global_hwe=True):
+def get_genotypes(AF_cutoff=0.001, n_partitions=None, overwrite=False, use_global_hwe=True):
     intermediate_path = f'{GWAS_DIR}filtered_gt_2.mt'
     final_path = f'{GWAS_DIR}filtered_gt_3.mt'
 
@@ -332,7 +354,8 @@ def get_genotypes(AF_cutoff=0.001, n_partitions=5000, overwrite=False, use_globa
             mt = mt.annotate_rows(MAF = mt.info.AF[mt.a_index-1])
             mt = mt.annotate_rows(MAF = hl.min([mt.MAF, 1-mt.MAF]))
             mt = mt.filter_rows(mt.MAF > AF_cutoff, keep = True)
-            mt = mt.naive_coalesce(n_partitions*2).checkpoint(f'{GWAS_DIR}filtered_gt_1.mt', overwrite=True)
+            # sized from the full callset, an upper bound on the size of the filtered MT
+            mt = naive_coalesce_to_target(mt, None if n_partitions is None else n_partitions*2, path=os.getenv("WGS_HAIL_STORAGE_PATH")).checkpoint(f'{GWAS_DIR}filtered_gt_1.mt', overwrite=True)
 
             related_remove = hl.import_table(REL_SAMP_PATH,
                                              types={"sample_id.s":"tstr"},
@@ -353,12 +376,12 @@ def get_genotypes(AF_cutoff=0.001, n_partitions=5000, overwrite=False, use_globa
             mt = mt.filter_rows(mt.hwe.p_value > 1e-10, keep=True)
             # mt = mt.filter_rows(mt.variant_qc.p_value_hwe > 1e-10, keep = True)
         mt = mt.filter_rows(mt.variant_qc.call_rate > 0.95, keep = True)
-        mt = mt.drop('variant_qc', 'hwe').repartition(n_partitions).checkpoint(final_path, overwrite=True)
+        mt = repartition_to_target(mt.drop('variant_qc', 'hwe'), n_partitions, path=intermediate_path).checkpoint(final_path, overwrite=True)
     
     return mt
 
 
-def run_regressions(mt, phenos, covars, pass_through, gwas_name, thresh=0, model='additive', overwrite=False, n_partition=1000):
+def run_regressions(mt, phenos, covars, pass_through, gwas_name, thresh=0, model='additive', overwrite=False, n_partition=None):
     """
     Much of the heavy lifiting for converting the ht to mt is pulled from UKB round 2.
     Performs covariate correction for all elements in the covariates struct.
@@ -385,7 +408,8 @@ def run_regressions(mt, phenos, covars, pass_through, gwas_name, thresh=0, model
                 x=entry,
                 covariates=[1, *[mt['covariates'][item] for item in covars]],
                 pass_through=pass_through)
-            ht_out = ht_out.repartition(n_partition)
+            if n_partition is not None:
+                ht_out = ht_out.repartition(n_partition)
             ht_out = ht_out.checkpoint(ht_dir, overwrite=True)
 
         ht_res = ht_out.annotate_globals(columns=hl.map(lambda i: hl.struct(phenotype=hl.literal(phenos)[i]), 
@@ -402,7 +426,8 @@ def run_regressions(mt, phenos, covars, pass_through, gwas_name, thresh=0, model
             hl.range(0, hl.len(phenos))))
         ht_res = ht_res.select(*(pass_through + ['entries']))
         mt = ht_res._unlocalize_entries('entries', 'columns', ['phenotype'])
-        mt = mt.repartition(n_partition)
+        if n_partition is not None:
+            mt = mt.repartition(n_partition)
         mt = mt.checkpoint(mt_dir+filename_raw, overwrite=True)
 
         mt = mt.select_entries(N = mt.n,
@@ -434,7 +459,7 @@ def export_for_manhattan(mt, phenos, entry_keep, model, fold, suffix, overwrite,
             extra_cols = ['rsid']
         extra_cols = [x for x in extra_cols if x in mt.row]
         if overwrite or not hl.hadoop_exists(file_out):
-            ht_f = mt.filter_cols(mt.phenotype == pheno).entries().select(*(entry_keep + extra_cols)).repartition(100)
+            ht_f = mt.filter_cols(mt.phenotype == pheno).entries().select(*(entry_keep + extra_cols))
             ht_f = ht_f.key_by()
             if include_cols_for_mung:
                 ht_f = ht_f.rename({'minor_AF':'MAF', 'rsid':'SNP', 'n':'N', 
@@ -484,7 +509,7 @@ def get_snv_count_phenotype():
                             'OriginalSelfRefAlleles':hl.tstr, 'SwappedFieldIDs':hl.tstr, 'FT':hl.tstr, 'FT_LIFT':hl.tstr,
                             'artifact_prone':hl.tbool, 'lifted':hl.tbool, 'fail_gt':hl.tbool, 'missing_call':hl.tbool}, min_partitions=50)
     all_s_table = ht.select('s').key_by('s').distinct()
-    ht_heteroplasmies = ht.filter(hl.is_defined(ht.HL) & (ht.HL < 0.95)).repartition(40)
+    ht_heteroplasmies = naive_coalesce_to_target(ht.filter(hl.is_defined(ht.HL) & (ht.HL < 0.95)), path=FINAL_VARIANT_CALLSET_PATH)
     ht_heteroplasmies = ht_heteroplasmies.annotate(alleles = ht_heteroplasmies.alleles.split(','))
     ht_heteroplasmies = ht_heteroplasmies.filter(~hl.is_indel(ht_heteroplasmies.alleles[0], ht_heteroplasmies.alleles[1]))
     ht_snv_count = ht_heteroplasmies.group_by(ht_heteroplasmies.s).aggregate(N = hl.agg.count())
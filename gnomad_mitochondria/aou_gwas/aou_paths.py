@@ -19,6 +19,7 @@ ANCESTRY_INFO_PATH = f"{CDR_v6_WGS}vcf/aux/ancestry/ancestry_preds.tsv"
 REL_SAMP_PATH = f"{CDR_v6_WGS}vcf/aux/relatedness/relatedness_flagged_samples.tsv"
 FLAGGED_SAMP_PATH = f"{CDR_v6_WGS}vcf/aux/qc/flagged_samples.tsv"
 FINAL_VARIANT_CALLSET_PATH = f'{BUCKET}/final_callset_220920/vcf/221012_filt_annotated/annotated_combined_processed_flat.tsv.bgz'
+FINAL_VARIANT_CALLSET_PARQUET_PATH = f'{BUCKET}/final_callset_220920/vcf/221012_filt_annotated/annotated_combined_processed_flat.parquet'
 FINAL_SAMPLE_STATS = f'{BUCKET}/final_callset_220920/221012_filtered_aou_tab_per_sample_stats.tsv'
 SANITY_PHENOS_PATH = f'{GWAS_DIR}sanity_phenotypes/sanity_check_demographic_phenos.ht'
 SANITY_PHENOS_COVARS_PATH = f'{GWAS_DIR}sanity_phenotypes/sanity_check_demographic_phenos_covars.ht'
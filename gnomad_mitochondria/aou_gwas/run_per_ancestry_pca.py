@@ -1,5 +1,6 @@
 from gnomad_methods.gnomad.sample_qc.ancestry import pc_project
 from .aou_paths import *
+from gnomad_mitochondria.utils.partitioning import naive_coalesce_to_target, repartition_to_target
 import hail as hl
 import os
 
@@ -8,7 +9,7 @@ GNOMAD_VAR_PATH = f'{PCA_DIR}/gnomad_hq_variants_without_washu_preldprune.ht'
 POPS = ('eur', 'amr', 'afr', 'eas', 'sas') # dropping MID as sample size is too small
 
 # parameters
-n_partitions = 2000
+n_partitions = None # None chooses partition counts from the size of the written inputs (see utils/partitioning.py)
 min_maf_hq = 0.001
 ld_r2 = 0.1
 iteration = 1
@@ -87,10 +88,11 @@ def import_ld_pruned_hq_variants(mt, overwrite=False):
             ht_pre = hl.read_table(pre_pruning_ht_path)
             
         else:
-            ht_pre = hl.import_table(f'{PCA_DIR}resources/pre_ld_pruning_combined_variants_without_washu_gnomad.tsv.bgz', 
+            pre_pruning_tsv_path = f'{PCA_DIR}resources/pre_ld_pruning_combined_variants_without_washu_gnomad.tsv.bgz'
+            ht_pre = hl.import_table(pre_pruning_tsv_path, 
                                      types={'locus':hl.tstr, 'alleles':hl.tarray(hl.tstr)}, impute=True)
             ht_pre = ht_pre.annotate(locus = hl.parse_locus(ht_pre.locus, reference_genome='GRCh38')).key_by('locus','alleles')
-            ht_pre = ht_pre.repartition(100).checkpoint(pre_pruning_ht_path, overwrite=overwrite)
+            ht_pre = repartition_to_target(ht_pre, path=pre_pruning_tsv_path).checkpoint(pre_pruning_ht_path, overwrite=overwrite)
 
         # filter the genotype mt to those variants found in the HQ variant table
         ld_clump_gt_path = f'{PCA_DIR}/filtered_gt_for_LD_clump_gnomadqc.mt'
@@ -99,7 +101,8 @@ def import_ld_pruned_hq_variants(mt, overwrite=False):
 
         else:
             mt_pre_clump = mt.semi_join_rows(ht_pre)
-            mt_pre_clump = mt_pre_clump.naive_coalesce(n_partitions*2).checkpoint(ld_clump_gt_path, overwrite=overwrite)
+            # the row count of the written HQ variant table is an upper bound on that of the filtered MT
+            mt_pre_clump = naive_coalesce_to_target(mt_pre_clump, None if n_partitions is None else n_partitions*2, n_rows=ht_pre.count(), n_cols=mt.count_cols()).checkpoint(ld_clump_gt_path, overwrite=overwrite)
             # this saved successfully with 258457 rows, a subset of the starting 259482 and 98k samples.
         
         ht_post_clump = mt_pre_clump.rows()
@@ -154,7 +157,8 @@ def import_aou_gt_for_pca(overwrite=False):
             mt = mt.annotate_rows(AF = mt.info.AF[mt.a_index-1])
             mt = mt.filter_rows(hl.min([mt.AF, 1-mt.AF]) > 0, keep = True)
             mt = mt.filter_rows(hl.is_missing(mt.filters) | (hl.len(mt.filters) == 0) | (mt.filters == {'PASS'}))
-            mt = mt.naive_coalesce(n_partitions*10).checkpoint(prelim_filt_mt, overwrite=overwrite)
+            # sized from the full callset, an upper bound on the size of the filtered MT
+            mt = naive_coalesce_to_target(mt, None if n_partitions is None else n_partitions*10, path=os.getenv("WGS_HAIL_STORAGE_PATH")).checkpoint(prelim_filt_mt, overwrite=overwrite)
 
         # filter full MT and add ancestry information
         ancestry_pred = hl.import_table(ANCESTRY_INFO_PATH,
@@ -181,7 +185,7 @@ def import_aou_gt_for_pca(overwrite=False):
         mt = mt.semi_join_rows(ht_hq) # filter to HQ variants and add per-ancestry inclusion variables
         mt = mt.annotate_globals(pop_index=ht_hq.pop.collect()[0])
         mt = mt.annotate_rows(include_in_pca_by_anc = ht_hq[mt.row_key].found_in_clumped_set)
-        mt = mt.naive_coalesce(n_partitions).checkpoint(final_mt_path, overwrite=True)
+        mt = naive_coalesce_to_target(mt, n_partitions, n_rows=ht_hq.count(), n_cols=mt.count_cols()).checkpoint(final_mt_path, overwrite=True)
 
     return mt
 
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+import argparse
+import json
+import logging
+import os
+
+import hail as hl
+
+from gnomad_mitochondria.benchmarks.benchmark_storage import time_operation
+from gnomad_mitochondria.pipeline.combine_vcfs import determine_hom_refs
+from gnomad_mitochondria.utils.coverage_table import (
+    CHRM_LENGTH,
+    read_coverage_table,
+    write_coverage_table,
+)
+from gnomad_mitochondria.utils.partitioning import get_path_bytes
+from gnomad_mitochondria.utils.startup import init_hail
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("benchmark coverage table")
+logger.setLevel(logging.INFO)
+
+FORMATS = ["locus_mt", "coverage_table"]
+
+
+def write_legacy_coverage_mt(
+    n_samples: int, n_partitions: int, mean_coverage: float, output_path: str
+) -> None:
+    """
+    Write a synthetic sample-level coverage MatrixTable with the locus-keyed layout written by earlier versions of annotate_coverage.py.
+
+    :param n_samples: Number of samples
+    :param n_partitions: Number of partitions
+    :param mean_coverage: Mean coverage of every sample
+    :param output_path: Path of the MatrixTable
+    :return: None
+    """
+    mt = hl.utils.range_matrix_table(CHRM_LENGTH, n_samples, n_partitions)
+    mt = mt.key_rows_by(
+        locus=hl.locus("chrM", mt.row_idx + 1, reference_genome="GRCh38")
+    ).drop("row_idx")
+    mt = mt.key_cols_by(s=hl.str(mt.col_idx)).drop("col_idx")
+    mt = mt.select_entries(coverage=hl.int32(hl.rand_pois(mean_coverage)))
+    mt.write(output_path, overwrite=True)
+
+
+def write_variant_mt(
+    n_samples: int, n_variants: int, n_partitions: int, output_path: str
+) -> None:
+    """
+    Write a synthetic combined variant MatrixTable (GRCh37 MT contig) with mostly missing HL, as determine_hom_refs receives it.
+
+    :param n_samples: Number of samples
+    :param n_variants: Number of variants, spread evenly over the genome
+    :param n_partitions: Number of partitions
+    :param output_path: Path of the MatrixTable
+    :return: None
+    """
+    mt = hl.utils.range_matrix_table(n_variants, n_samples, n_partitions)
+    mt = mt.key_rows_by(
+        locus=hl.locus(
+            "MT",
+            mt.row_idx * (CHRM_LENGTH // n_variants) + 1,
+            reference_genome="GRCh37",
+        ),
+        alleles=["A", "G"],
+    ).drop("row_idx")
+    mt = mt.key_cols_by(s=hl.str(mt.col_idx)).drop("col_idx")
+    mt = mt.select_entries(
+        HL=hl.or_missing(hl.rand_bool(0.05), hl.rand_unif(0, 1)),
+        DP=hl.missing(hl.tint32),
+        FT=hl.or_missing(hl.rand_bool(0.05), hl.set(["PASS"])),
+    )
+    mt.write(output_path, overwrite=True)
+
+
+def benchmark_format(coverage_path: str, variant_mt_path: str, n_repeats: int) -> dict:
+    """
+    Time the coverage summary of subset_cov_to_release.py, the homref join of combine_vcfs.py, and a join of two coverage tables.
+
+    :param coverage_path: Path of the coverage MatrixTable or coverage table
+    :param variant_mt_path: Path of the variant MatrixTable
+    :param n_repeats: Number of times to run each operation
+    :return: Dictionary with the timings of each operation
+    """
+
+    def summarize_coverage():
+        cov_mt = read_coverage_table(coverage_path)
+        cov_mt = cov_mt.annotate_rows(
+            mean=hl.float(hl.agg.mean(cov_mt.coverage)),
+            median=hl.median(hl.agg.collect(cov_mt.coverage)),
+        )
+        cov_ht = cov_mt.rows()
+        cov_ht.aggregate(hl.agg.sum(cov_ht.mean + cov_ht.median))
+        return CHRM_LENGTH
+
+    def join_hom_refs():
+        mt = determine_hom_refs(hl.read_matrix_table(variant_mt_path), coverage_path)
+        return mt.aggregate_entries(hl.agg.count_where(mt.HL == 0))
+
+    def join_coverage_tables():
+        cov_mt = read_coverage_table(coverage_path)
+        other_mt = read_coverage_table(coverage_path)
+        cov_mt = cov_mt.annotate_entries(
+            difference=cov_mt.coverage
+            - other_mt[cov_mt.row_key, cov_mt.col_key].coverage
+        )
+        return cov_mt.aggregate_entries(hl.agg.count_where(cov_mt.difference == 0))
+
+    return {
+        "bytes": get_path_bytes(coverage_path),
+        "summarize": time_operation(summarize_coverage, n_repeats),
+        "join_hom_refs": time_operation(join_hom_refs, n_repeats),
+        "join_coverage_tables": time_operation(join_coverage_tables, n_repeats),
+    }
+
+
+def main(args):  # noqa: D103
+    init_hail(tmp_dir=args.temp_dir, master=f"local[{args.n_cores}]")
+
+    paths = {
+        x: os.path.join(args.temp_dir, f"benchmark_coverage_{x}.mt") for x in FORMATS
+    }
+    variant_mt_path = os.path.join(args.temp_dir, "benchmark_coverage_variants.mt")
+
+    logger.info("Writing synthetic coverage for %i samples...", args.n_samples)
+    write_legacy_coverage_mt(
+        args.n_samples, args.n_partitions, args.mean_coverage, paths["locus_mt"]
+    )
+    write_coverage_table(
+        hl.read_matrix_table(paths["locus_mt"]),
+        paths["coverage_table"],
+        args.n_partitions,
+        overwrite=True,
+    )
+    write_variant_mt(
+        args.n_samples, args.n_variants, args.n_partitions, variant_mt_path
+    )
+
+    results = {
+        "n_samples": args.n_samples,
+        "n_variants": args.n_variants,
+        "formats": {
+            x: benchmark_format(paths[x], variant_mt_path, args.n_repeats)
+            for x in FORMATS
+        },
+    }
+
+    for x, result in results["formats"].items():
+        logger.info(
+            "%-15s %10.1f MB  summarize %8.2fs  homref join %8.2fs  coverage join %8.2fs",
+            x,
+            result["bytes"] / 1e6,
+            result["summarize"]["median_s"],
+            result["join_hom_refs"]["median_s"],
+            result["join_coverage_tables"]["median_s"],
+        )
+
+    if args.output_json:
+        with open(args.output_json, "w") as out:
+            out.write(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script compares the read and join times of the position-keyed coverage table against the locus-keyed coverage MatrixTable on synthetic coverage in Hail local mode"
+    )
+    parser.add_argument("--n-samples", help="Number of samples", type=int, default=1000)
+    parser.add_argument(
+        "--n-variants",
+        help="Number of variants in the variant MatrixTable",
+        type=int,
+        default=2000,
+    )
+    parser.add_argument(
+        "--n-partitions",
+        help="Number of partitions of each MatrixTable",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--mean-coverage",
+        help="Mean coverage of every sample",
+        type=float,
+        default=2500,
+    )
+    parser.add_argument(
+        "--n-repeats", help="Number of times to run each operation", type=int, default=3
+    )
+    parser.add_argument(
+        "--n-cores",
+        help="Number of cores used by Hail in local mode",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "-t",
+        "--temp-dir",
+        help="Temporary directory to use for intermediate outputs",
+        default="/tmp",
+    )
+    parser.add_argument("-o", "--output-json", help="Path to write the results as JSON")
+
+    args = parser.parse_args()
+    main(args)
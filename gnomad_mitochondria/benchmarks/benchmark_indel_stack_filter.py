@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import time
+
+import hail as hl
+
+from gnomad_mitochondria.pipeline.add_annotations import (
+    apply_indel_stack_filter,
+    format_filters,
+    get_indel_expr,
+)
+from gnomad_mitochondria.utils.startup import init_hail
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("benchmark indel stack filter")
+logger.setLevel(logging.INFO)
+
+
+def legacy_apply_indel_stack_filter(input_mt: hl.MatrixTable) -> hl.MatrixTable:
+    """
+    Apply the indel_stack filter using a per-sample counter of indel positions (the previous implementation, kept for comparison).
+
+    :param input_mt: MatrixTable
+    :return: MatrixTable with the indel_stack filter added
+    """
+    indel_expr = get_indel_expr(input_mt)
+    input_mt = input_mt.annotate_cols(
+        indel_pos_counter=hl.agg.filter(
+            indel_expr, hl.agg.counter(input_mt.locus.position)
+        )
+    )
+    indel_expr = get_indel_expr(input_mt)
+    input_mt = input_mt.annotate_entries(
+        indel_occurences=(
+            hl.case()
+            .when(
+                (
+                    indel_expr
+                    & (input_mt.indel_pos_counter.get(input_mt.locus.position) >= 2)
+                ),
+                "stack",
+            )
+            .when(
+                (
+                    indel_expr
+                    & (input_mt.indel_pos_counter.get(input_mt.locus.position) == 1)
+                ),
+                "solo",
+            )
+            .or_missing()
+        )
+    )
+    input_mt = input_mt.annotate_rows(
+        filters=hl.if_else(
+            hl.agg.any(input_mt.indel_occurences == "stack")
+            & ~hl.agg.any(input_mt.indel_occurences == "solo"),
+            input_mt.filters.add("indel_stack"),
+            input_mt.filters,
+        )
+    )
+
+    return format_filters(input_mt)
+
+
+def generate_indel_mt(
+    n_samples: int,
+    n_positions: int,
+    alleles_per_position: int = 3,
+    carrier_rate: float = 0.02,
+    n_partitions: int = 16,
+    seed: int = 42,
+) -> hl.MatrixTable:
+    """
+    Generate a MatrixTable of indel calls with several indel alleles per position so that both solo and stacked indels occur.
+
+    :param n_samples: Number of samples
+    :param n_positions: Number of positions with indels
+    :param alleles_per_position: Number of indel alleles at each position
+    :param carrier_rate: Probability that a sample carries a given indel allele
+    :param n_partitions: Number of partitions
+    :param seed: Random seed
+    :return: MatrixTable with locus, alleles, filters, HL, FT, and FT_LIFT fields
+    """
+    mt = hl.utils.range_matrix_table(
+        n_positions * alleles_per_position, n_samples, n_partitions=n_partitions
+    )
+    mt = mt.annotate_rows(
+        locus=hl.locus(
+            "chrM", 1 + mt.row_idx // alleles_per_position, reference_genome="GRCh38"
+        ),
+        alleles=hl.array(
+            [
+                "A",
+                "A"
+                + hl.delimit(
+                    hl.range(mt.row_idx % alleles_per_position + 1).map(lambda x: "C"),
+                    "",
+                ),
+            ]
+        ),
+        filters=hl.empty_set(hl.tstr),
+    )
+    mt = mt.key_rows_by("locus", "alleles")
+    mt = mt.key_cols_by(s=hl.str(mt.col_idx))
+    mt = mt.annotate_entries(
+        HL=hl.if_else(
+            hl.rand_bool(carrier_rate, seed=seed),
+            hl.rand_unif(0.01, 0.95, seed=seed + 1),
+            0.0,
+        ),
+        FT=hl.set(["PASS"]),
+        FT_LIFT=hl.set(["PASS"]),
+    )
+
+    return mt.drop("row_idx", "col_idx")
+
+
+def time_filter(mt: hl.MatrixTable, filter_function, output_path: str) -> tuple:
+    """
+    Run an indel stack filter implementation and write the resulting row filters.
+
+    :param mt: MatrixTable
+    :param filter_function: Function that applies the indel_stack filter
+    :param output_path: Path to which the row filters should be written
+    :return: Tuple of the elapsed time in seconds and the Table of row filters
+    """
+    start = time.time()
+    filtered_mt = filter_function(mt)
+    ht = filtered_mt.rows().select("filters").checkpoint(output_path, overwrite=True)
+    elapsed = time.time() - start
+
+    return elapsed, ht
+
+
+def main(args):  # noqa: D103
+    init_hail(default_reference="GRCh38", tmp_dir=args.temp_dir)
+
+    for n_samples in [int(x) for x in args.n_samples.split(",")]:
+        logger.info(
+            "Generating %i samples at %i indel positions...",
+            n_samples,
+            args.n_positions,
+        )
+        mt = generate_indel_mt(
+            n_samples, args.n_positions, n_partitions=args.n_partitions
+        )
+        mt = mt.checkpoint(
+            f"{args.temp_dir}/indel_benchmark_{n_samples}.mt", overwrite=True
+        )
+
+        legacy_time, legacy_ht = time_filter(
+            mt,
+            legacy_apply_indel_stack_filter,
+            f"{args.temp_dir}/legacy_{n_samples}.ht",
+        )
+        indexed_time, indexed_ht = time_filter(
+            mt, apply_indel_stack_filter, f"{args.temp_dir}/indexed_{n_samples}.ht"
+        )
+
+        n_mismatched = legacy_ht.aggregate(
+            hl.agg.count_where(legacy_ht.filters != indexed_ht[legacy_ht.key].filters)
+        )
+        n_stacks = indexed_ht.aggregate(
+            hl.agg.count_where(indexed_ht.filters.contains("indel_stack"))
+        )
+        logger.info(
+            "%i samples: legacy %.1fs, indexed %.1fs (%.2fx), %i indel_stack rows, %i mismatched rows",
+            n_samples,
+            legacy_time,
+            indexed_time,
+            legacy_time / indexed_time,
+            n_stacks,
+            n_mismatched,
+        )
+        if n_mismatched > 0:
+            raise ValueError(
+                f"Indexed indel_stack filter differs from the legacy filter at {n_mismatched} rows"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script benchmarks the indexed indel_stack filter against the previous counter-based implementation and checks that both produce the same filters"
+    )
+    parser.add_argument(
+        "--n-samples",
+        help="Comma-separated list of sample counts to benchmark",
+        default="10000,100000",
+    )
+    parser.add_argument(
+        "--n-positions", help="Number of positions with indels", type=int, default=200
+    )
+    parser.add_argument(
+        "--n-partitions",
+        help="Number of partitions of the generated MatrixTable",
+        type=int,
+        default=16,
+    )
+    parser.add_argument(
+        "-t",
+        "--temp-dir",
+        help="Temporary directory to use for intermediate outputs",
+        default="/tmp",
+    )
+
+    args = parser.parse_args()
+    main(args)
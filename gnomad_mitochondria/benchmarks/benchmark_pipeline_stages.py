@@ -0,0 +1,578 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+import hail as hl
+
+from gnomad_mitochondria.benchmarks.generate_synthetic_cohort import (
+    LOW_COVERAGE_REGIONS,
+)
+from gnomad_mitochondria.pipeline import add_annotations
+from gnomad_mitochondria.pipeline.add_annotations import (
+    add_age_and_pop,
+    add_annotations_by_hap_and_pop,
+    add_filter_annotations,
+    add_genotype,
+    add_hap_defining,
+    add_quality_histograms,
+    add_terra_metadata,
+    add_trna_predictions,
+    add_variant_context,
+    filter_by_contamination,
+    filter_by_copy_number,
+    filter_by_hom_overlap,
+    filter_genotypes,
+    format_vcf,
+    generate_expressions,
+    modify_ft_liftover,
+    report_stats,
+)
+from gnomad_mitochondria.pipeline.annotation_descriptions import add_descriptions
+from gnomad_mitochondria.pipeline.combine_vcfs import (
+    apply_mito_artifact_filter,
+    determine_hom_refs,
+    import_mitochondria_vcf,
+    join_mitochondria_vcfs_into_mt,
+    multi_way_union_mts,
+    remove_genotype_filters,
+)
+from gnomad_mitochondria.utils.partitioning import get_path_bytes
+from gnomad_mitochondria.utils.startup import init_hail
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("benchmark pipeline stages")
+logger.setLevel(logging.INFO)
+
+
+def get_jvm_pid() -> int:
+    """
+    Get the process ID of the JVM backing the local Hail session.
+
+    :return: Process ID
+    """
+    jvm = hl.utils.java.Env.jvm()
+
+    return int(
+        jvm.java.lang.management.ManagementFactory.getRuntimeMXBean()
+        .getName()
+        .split("@")[0]
+    )
+
+
+def reset_peak_rss(pid: int) -> None:
+    """
+    Reset the peak resident set size (VmHWM) of a process so that the next reading covers only the following stage.
+
+    Resetting requires Linux 4.0 or later; on other systems the peak covers the whole run up to the reading.
+
+    :param pid: Process ID
+    """
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss_bytes(pid: int) -> int:
+    """
+    Read the peak resident set size (VmHWM) of a process.
+
+    :param pid: Process ID
+    :return: Peak resident set size in bytes, or None if it cannot be read
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def get_dir_bytes(path: str) -> int:
+    """
+    Sum the sizes of all files under a directory, treating a missing directory as empty.
+
+    :param path: Path of a directory
+    :return: Total number of bytes
+    """
+    return get_path_bytes(path) if hl.hadoop_exists(path) else 0
+
+
+class StageRecorder:
+    """Run pipeline stages and record the wall time, peak memory, and bytes written of each."""
+
+    def __init__(self, n_samples: int, run_dir: str):
+        """
+        Set up the recorder for one cohort size.
+
+        :param n_samples: Number of samples in the cohort
+        :param run_dir: Directory that all stage outputs are written to
+        """
+        self.n_samples = n_samples
+        self.run_dir = run_dir
+        self.jvm_pid = get_jvm_pid()
+        self.results = []
+
+    def run(self, stage: str, stage_function, *args, **kwargs):
+        """
+        Run a stage and record its metrics.
+
+        The stage function must force evaluation (for example by checkpointing) so that the work is attributed to it.
+
+        :param stage: Name of the stage
+        :param stage_function: Function running the stage
+        :param args: Positional arguments passed to stage_function
+        :param kwargs: Keyword arguments passed to stage_function
+        :return: Return value of stage_function
+        """
+        logger.info("%i samples: running %s...", self.n_samples, stage)
+        bytes_before = get_dir_bytes(self.run_dir)
+        reset_peak_rss(self.jvm_pid)
+
+        start = time.time()
+        result = stage_function(*args, **kwargs)
+        wall_time = time.time() - start
+
+        self.results.append(
+            {
+                "n_samples": self.n_samples,
+                "stage": stage,
+                "wall_time_s": wall_time,
+                "jvm_peak_rss_bytes": get_peak_rss_bytes(self.jvm_pid),
+                # ru_maxrss is in kilobytes on Linux and cannot be reset, so this is the driver peak up to this stage
+                "driver_peak_rss_bytes": resource.getrusage(
+                    resource.RUSAGE_SELF
+                ).ru_maxrss
+                * 1024,
+                "bytes_written": get_dir_bytes(self.run_dir) - bytes_before,
+            }
+        )
+        logger.info("%i samples: %s took %.1fs", self.n_samples, stage, wall_time)
+
+        return result
+
+
+def generate_cohort(cohort_dir: str, n_samples: int, seed: int, n_workers: int) -> None:
+    """
+    Generate a synthetic cohort with generate_synthetic_cohort.py, unless one already exists in cohort_dir.
+
+    :param cohort_dir: Output directory of the cohort
+    :param n_samples: Number of samples
+    :param seed: Random seed
+    :param n_workers: Number of processes used to generate samples
+    """
+    if os.path.exists(os.path.join(cohort_dir, "participant_data.tsv")):
+        logger.info("Reusing the synthetic cohort in %s", cohort_dir)
+        return
+
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "gnomad_mitochondria.benchmarks.generate_synthetic_cohort",
+            "-o",
+            cohort_dir,
+            "-n",
+            str(n_samples),
+            "--seed",
+            str(seed),
+            "--n-workers",
+            str(n_workers),
+        ],
+        check=True,
+    )
+
+
+def read_participant_paths(participant_data: str) -> tuple:
+    """
+    Read the VCF and coverage paths of each sample from the participant data of a synthetic cohort.
+
+    :param participant_data: Path to participant_data.tsv written by generate_synthetic_cohort.py
+    :return: Tuple of dictionaries with sample name as key and path to the VCF or coverage TSV as value
+    """
+    vcf_paths = {}
+    coverage_paths = {}
+    with open(participant_data) as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            vcf_paths[row["s"]] = row["vcf"]
+            coverage_paths[row["s"]] = row["coverage"]
+
+    return vcf_paths, coverage_paths
+
+
+def write_coverage_mt(coverage_paths: dict, output_path: str) -> hl.MatrixTable:
+    """
+    Combine the per-sample coverage TSVs into a MatrixTable with the layout written by annotate_coverage.py.
+
+    :param coverage_paths: Dictionary with sample name as key and path to coverage TSV as value
+    :param output_path: Path of the coverage MatrixTable to write
+    :return: MatrixTable keyed by locus (rows) and s (columns) with a coverage entry
+    """
+    ht = hl.import_table(
+        list(coverage_paths.values()),
+        types={"pos": hl.tint32, "coverage": hl.tint32},
+        source_file_field="source_file",
+    )
+    # The source file field holds the fully qualified path, so samples are matched on the file name
+    sample_by_file = hl.literal(
+        {os.path.basename(v): k for k, v in coverage_paths.items()}
+    )
+    ht = ht.select(
+        locus=hl.locus("chrM", ht.pos, reference_genome="GRCh38"),
+        s=sample_by_file[ht.source_file.split("/")[-1]],
+        coverage=ht.coverage,
+    )
+    mt = ht.to_matrix_table(row_key=["locus"], col_key=["s"])
+
+    return mt.checkpoint(output_path, overwrite=True)
+
+
+def write_artifact_prone_sites(output_path: str) -> None:
+    """
+    Write the low-coverage regions of the synthetic cohort as a BED file of artifact-prone sites.
+
+    :param output_path: Path of the BED file
+    """
+    with open(output_path, "w") as out:
+        for start, end, _ in LOW_COVERAGE_REGIONS:
+            out.write(f"chrM\t{start - 1}\t{end}\n")
+
+
+def run_union(
+    vcf_paths: dict, temp_dir: str, chunk_size: int, output_path: str
+) -> hl.MatrixTable:
+    """
+    Import the per-sample VCFs and join them with multi_way_union_mts.
+
+    :param vcf_paths: Dictionary with sample name as key and path to VCF as value
+    :param temp_dir: Directory for the intermediate Tables of each merge stage
+    :param chunk_size: Number of MatrixTables to join per chunk
+    :param output_path: Path of the joined MatrixTable
+    :return: Joined MatrixTable
+    """
+    mts = [import_mitochondria_vcf(vcf_paths[s], s) for s in sorted(vcf_paths)]
+    mt = multi_way_union_mts(mts, temp_dir, chunk_size, prefix="")
+
+    return mt.checkpoint(output_path, overwrite=True)
+
+
+def prepare_annotation_input(mt_path: str, cohort_dir: str, output_dir: str) -> tuple:
+    """
+    Run the add_annotations.py steps before add_filter_annotations (without VEP and dbSNP).
+
+    rsid is set to missing, since dbSNP is not read in local mode.
+
+    :param mt_path: Path to the combined MatrixTable (output of the combine stages)
+    :param cohort_dir: Directory of the synthetic cohort
+    :param output_dir: Directory for the outputs of the annotation steps
+    :return: Tuple of the MatrixTable and the numbers of samples removed by the overlap, copy number, and contamination filters
+    """
+    participant_data = os.path.join(cohort_dir, "participant_data.tsv")
+    mt = add_genotype(mt_path)
+    mt = modify_ft_liftover(mt)
+    mt = add_terra_metadata(mt, participant_data)
+    mt = add_hap_defining(mt)
+    mt = add_trna_predictions(mt)
+    mt = add_age_and_pop(mt, participant_data)
+    mt = add_variant_context(mt)
+    mt, n_removed_overlap = filter_by_hom_overlap(
+        mt, False, os.path.join(cohort_dir, "sample_stats.tsv")
+    )
+    mt, n_removed_below_cn, n_removed_above_cn = filter_by_copy_number(mt)
+    mt, n_contaminated = filter_by_contamination(mt, output_dir, False)
+    mt = mt.key_rows_by(
+        locus=hl.locus("chrM", mt.locus.position, reference_genome="GRCh38"),
+        alleles=mt.alleles,
+    )
+    mt = mt.annotate_rows(rsid=hl.missing(hl.tset(hl.tstr)))
+    mt = mt.annotate_globals(dbsnp_version="none")
+    mt = mt.checkpoint(f"{output_dir}/prior_to_filter_annotations.mt", overwrite=True)
+
+    return mt, n_removed_overlap, n_removed_below_cn, n_removed_above_cn, n_contaminated
+
+
+def run_filter_annotations(mt: hl.MatrixTable, output_path: str) -> tuple:
+    """
+    Run add_filter_annotations and checkpoint the result.
+
+    :param mt: MatrixTable
+    :param output_path: Path of the annotated MatrixTable
+    :return: Tuple of the MatrixTable and the number of genotypes below the minimum heteroplasmy threshold
+    """
+    mt, n_het_below_min_het_threshold = add_filter_annotations(mt)
+
+    return mt.checkpoint(output_path, overwrite=True), n_het_below_min_het_threshold
+
+
+def run_generate_expressions(mt: hl.MatrixTable, output_path: str) -> hl.MatrixTable:
+    """
+    Filter genotypes and annotate the variant-level expressions from generate_expressions.
+
+    :param mt: MatrixTable
+    :param output_path: Path of the annotated MatrixTable
+    :return: Annotated MatrixTable
+    """
+    mt = filter_genotypes(mt)
+    mt = mt.annotate_rows(**dict(generate_expressions(mt)))
+
+    return mt.checkpoint(output_path, overwrite=True)
+
+
+def run_hap_and_pop_annotations(mt: hl.MatrixTable, output_dir: str) -> hl.MatrixTable:
+    """
+    Add the quality histograms, haplogroup and population annotations, and descriptions.
+
+    :param mt: MatrixTable
+    :param output_dir: Directory for the outputs of the annotation steps
+    :return: Annotated MatrixTable
+    """
+    mt = add_quality_histograms(mt)
+    mt = add_annotations_by_hap_and_pop(mt, output_dir=output_dir, overwrite=True)
+    mt = add_descriptions(mt)
+
+    return mt.checkpoint(f"{output_dir}/annotated_combined.mt", overwrite=True)
+
+
+def run_format_vcf(mt: hl.MatrixTable, output_dir: str) -> None:
+    """
+    Format the MatrixTable with format_vcf and export the sample VCF.
+
+    :param mt: Annotated MatrixTable
+    :param output_dir: Directory for the VCF and its header
+    """
+    vcf_mt, vcf_meta, vcf_header_file = format_vcf(mt, output_dir, skip_vep=True)
+    hl.export_vcf(
+        vcf_mt,
+        f"{output_dir}/sample_vcf.vcf.bgz",
+        metadata=vcf_meta,
+        append_to_header=vcf_header_file,
+        tabix=True,
+    )
+
+
+def benchmark_cohort(n_samples: int, args) -> list:
+    """
+    Generate a synthetic cohort of n_samples samples and run each benchmarked stage on it.
+
+    :param n_samples: Number of samples
+    :param args: Parsed command line arguments
+    :return: List of dictionaries of per-stage metrics
+    """
+    cohort_dir = os.path.join(args.cohort_dir, f"cohort_{n_samples}")
+    run_dir = os.path.join(args.temp_dir, f"pipeline_benchmark_{n_samples}")
+    # Start from an empty directory so that bytes written are not offset by a previous run
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+
+    logger.info("Generating a synthetic cohort of %i samples...", n_samples)
+    generate_cohort(cohort_dir, n_samples, args.seed, args.n_workers)
+    vcf_paths, coverage_paths = read_participant_paths(
+        os.path.join(cohort_dir, "participant_data.tsv")
+    )
+    coverage_mt_path = os.path.join(cohort_dir, "coverage.mt")
+    if not hl.hadoop_exists(f"{coverage_mt_path}/_SUCCESS"):
+        write_coverage_mt(coverage_paths, coverage_mt_path)
+    artifact_prone_sites_path = os.path.join(cohort_dir, "artifact_prone_sites.bed")
+    write_artifact_prone_sites(artifact_prone_sites_path)
+
+    recorder = StageRecorder(n_samples, run_dir)
+    recorder.run(
+        "multi_way_union_mts",
+        run_union,
+        vcf_paths,
+        f"{run_dir}/union_tmp",
+        args.chunk_size,
+        f"{run_dir}/multi_way_union.mt",
+    )
+    mt = recorder.run(
+        "join_mitochondria_vcfs_into_mt",
+        lambda: join_mitochondria_vcfs_into_mt(
+            vcf_paths,
+            f"{run_dir}/join_tmp",
+            args.chunk_size,
+            n_final_partitions=args.n_cores,
+        ).checkpoint(f"{run_dir}/raw_combined.mt", overwrite=True),
+    )
+    mt = recorder.run(
+        "determine_hom_refs",
+        lambda: determine_hom_refs(
+            remove_genotype_filters(mt), coverage_mt_path
+        ).checkpoint(f"{run_dir}/raw_combined_2.mt", overwrite=True),
+    )
+    combined_mt_path = f"{run_dir}/combined.mt"
+    recorder.run(
+        "apply_mito_artifact_filter",
+        lambda: apply_mito_artifact_filter(
+            mt, artifact_prone_sites_path, "GRCh38"
+        ).checkpoint(combined_mt_path, overwrite=True),
+    )
+
+    if args.combine_only:
+        return recorder.results
+
+    (
+        mt,
+        n_removed_overlap,
+        n_removed_below_cn,
+        n_removed_above_cn,
+        n_contaminated,
+    ) = recorder.run(
+        "prepare_annotations",
+        prepare_annotation_input,
+        combined_mt_path,
+        cohort_dir,
+        run_dir,
+    )
+    mt, n_het_below_min_het_threshold = recorder.run(
+        "add_filter_annotations",
+        run_filter_annotations,
+        mt,
+        f"{run_dir}/prior_to_filter_genotypes.mt",
+    )
+    mt = recorder.run(
+        "generate_expressions", run_generate_expressions, mt, f"{run_dir}/temp.mt"
+    )
+    mt = recorder.run(
+        "add_annotations_by_hap_and_pop", run_hap_and_pop_annotations, mt, run_dir
+    )
+    recorder.run(
+        "report_stats",
+        report_stats,
+        mt,
+        run_dir,
+        False,
+        n_removed_below_cn,
+        n_removed_above_cn,
+        n_contaminated,
+        n_het_below_min_het_threshold,
+        n_removed_overlap,
+    )
+    recorder.run("format_vcf", run_format_vcf, mt, run_dir)
+
+    return recorder.results
+
+
+def main(args):  # noqa: D103
+    init_hail(
+        default_reference="GRCh38",
+        tmp_dir=args.temp_dir,
+        master=f"local[{args.n_cores}]",
+    )
+
+    if args.resource_dir:
+        # Read local copies of the public annotation resources instead of the gnomAD bucket
+        add_annotations.RESOURCES.update(
+            {
+                k: os.path.join(args.resource_dir, os.path.basename(v))
+                for k, v in add_annotations.RESOURCES.items()
+            }
+        )
+
+    results = []
+    for n_samples in [int(x) for x in args.n_samples.split(",")]:
+        results.extend(benchmark_cohort(n_samples, args))
+
+        # Results are rewritten after each cohort size so that the smaller sizes are kept if a larger one fails
+        with open(args.output_json, "w") as out:
+            json.dump(
+                {
+                    "hail_version": hl.version(),
+                    "python_version": platform.python_version(),
+                    "host": platform.node(),
+                    "n_cores": args.n_cores,
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "results": results,
+                },
+                out,
+                indent=2,
+            )
+
+    for result in results:
+        logger.info(
+            "%6i samples  %-32s %8.1fs  %8.1f MB peak  %8.1f MB written",
+            result["n_samples"],
+            result["stage"],
+            result["wall_time_s"],
+            (result["jvm_peak_rss_bytes"] or 0) / 1e6,
+            result["bytes_written"] / 1e6,
+        )
+    logger.info("Wrote results to %s", args.output_json)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script benchmarks the combine and annotation stages of the mitochondria pipeline end to end on synthetic cohorts in Hail local mode, recording the wall time, peak memory, and bytes written of each stage"
+    )
+    parser.add_argument(
+        "--n-samples",
+        help="Comma-separated list of cohort sizes to benchmark",
+        default="100,1000,10000",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-json",
+        help="Path of the JSON file of per-stage results (compare against a baseline with compare_benchmarks.py)",
+        default="pipeline_benchmark.json",
+    )
+    parser.add_argument(
+        "-c",
+        "--cohort-dir",
+        help="Directory for the synthetic cohorts, which are reused across runs",
+        default="/tmp/synthetic_cohorts",
+    )
+    parser.add_argument(
+        "-t",
+        "--temp-dir",
+        help="Temporary directory to use for intermediate outputs",
+        default="/tmp",
+    )
+    parser.add_argument(
+        "--resource-dir",
+        help="Optional directory with local copies of the annotation resources (variant context, phylotree, and tRNA predictions), read from the gnomAD bucket if not supplied",
+    )
+    parser.add_argument(
+        "--combine-only",
+        help="Only run the combine_vcfs.py stages, which do not need the annotation resources",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        help="Number of MatrixTables to join per chunk in multi_way_union_mts",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--n-cores",
+        help="Number of cores used by Hail in local mode",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--n-workers",
+        help="Number of processes used to generate the synthetic cohorts",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--seed", help="Random seed of the synthetic cohorts", type=int, default=42
+    )
+
+    args = parser.parse_args()
+    main(args)
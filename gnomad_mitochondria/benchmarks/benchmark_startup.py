@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import statistics
+import subprocess
+import sys
+import time
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("benchmark startup")
+logger.setLevel(logging.INFO)
+
+ENTRY_POINTS = [
+    "gnomad_mitochondria.pipeline.add_annotations",
+    "gnomad_mitochondria.pipeline.annotate_coverage",
+    "gnomad_mitochondria.pipeline.combine_vcfs",
+    "gnomad_mitochondria.pipeline.merge_aggregate_states",
+    "gnomad_mitochondria.pipeline.merge_cohort_summaries",
+    "gnomad_mitochondria.pipeline.sample_major_callset",
+    "gnomad_mitochondria.pipeline.subset_cov_to_release",
+]
+# Invocations timed for each entry point (printing the help, and an invalid argument as a misconfigured run), with the
+# exit code argparse gives for each
+INVOCATIONS = {
+    "help": (["--help"], 0),
+    "invalid_argument": (["--not-a-valid-argument"], 2),
+}
+
+
+def time_invocation(module: str, arguments: list, n_repeats: int) -> tuple:
+    """
+    Run an entry point as a module in a new interpreter and time how long it takes to exit.
+
+    :param module: Module name of the entry point
+    :param arguments: Command line arguments
+    :param n_repeats: Number of times to run the entry point
+    :return: Tuple of the list of wall times in seconds and the exit code of the last run
+    """
+    times = []
+    for _ in range(n_repeats):
+        start = time.time()
+        returncode = subprocess.run(
+            [sys.executable, "-m", module, *arguments],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode
+        times.append(time.time() - start)
+
+    return times, returncode
+
+
+def main(args):  # noqa: D103
+    entry_points = args.entry_points.split(",") if args.entry_points else ENTRY_POINTS
+
+    n_slow = 0
+    n_failed = 0
+    for module in entry_points:
+        for invocation, (arguments, expected_returncode) in INVOCATIONS.items():
+            times, returncode = time_invocation(module, arguments, args.n_repeats)
+            if returncode != expected_returncode:
+                # For example an import error, which also exits quickly but is not a startup time
+                logger.error(
+                    "%s %s exited with code %i instead of %i",
+                    module,
+                    invocation,
+                    returncode,
+                    expected_returncode,
+                )
+                n_failed += 1
+                continue
+            median = statistics.median(times)
+            slow = median > args.max_seconds
+            n_slow += slow
+            logger.info(
+                "%-55s %-18s median %.2fs, max %.2fs%s",
+                module,
+                invocation,
+                median,
+                max(times),
+                " (above %.2fs)" % args.max_seconds if slow else "",
+            )
+
+    if n_slow > 0:
+        logger.error(
+            "%i invocations took longer than %.2fs to exit", n_slow, args.max_seconds
+        )
+    if n_slow > 0 or n_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script times how long each pipeline entry point takes to print its help or reject an invalid argument, which should not start Hail, Spark, or import gnomad"
+    )
+    parser.add_argument(
+        "--entry-points",
+        help="Comma-separated list of entry point modules to time (defaults to the pipeline scripts)",
+    )
+    parser.add_argument(
+        "--n-repeats",
+        help="Number of times to run each invocation",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--max-seconds",
+        help="Median time to exit above which an invocation is reported as too slow",
+        type=float,
+        default=1.0,
+    )
+
+    args = parser.parse_args()
+    main(args)
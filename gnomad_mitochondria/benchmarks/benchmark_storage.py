@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from gnomad_mitochondria.utils.storage import get_storage, use_local_standin
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("benchmark storage")
+logger.setLevel(logging.INFO)
+
+BUCKET = "benchmark-bucket"
+RUN_FOLDER = "run"
+PASSING_LOG = "Starting delocalization.\nDone delocalization.\n"
+
+
+def write_file(path: str, data: bytes) -> None:
+    """
+    Write a file of the synthetic run through the storage backend of its path.
+
+    :param path: Path of the file
+    :param data: Contents of the file
+    :return: None
+    """
+    get_storage(path).write_atomic(path, data)
+
+
+def write_cromwell_run(root: str, n_batches: int, n_shards: int, seed: int) -> list:
+    """
+    Write a synthetic Cromwell execution directory laid out as the mtDNA pipeline writes it.
+
+    Half of the batches have finished merging; the others are still running, with rc and log files in the latest task
+    of each shard, which is what cromwell_run_monitor.py lists and reads the most.
+
+    :param root: Root of the bucket (for example gs://bucket)
+    :param n_batches: Number of batches (workflows)
+    :param n_shards: Number of shards (samples) per batch
+    :param seed: Random seed
+    :return: List of the batch IDs
+    """
+    rng = random.Random(seed)
+    batches = [f"batch-{i:05d}" for i in range(n_batches)]
+    for i, batch in enumerate(batches):
+        run_prefix = f"{root}/{RUN_FOLDER}/MitochondriaPipelineWrapper/{batch}"
+        if i % 2 == 0:
+            merge_dir = f"{run_prefix}/call-MergeMitoMultiSampleOutputsInternal"
+            write_file(f"{merge_dir}/rc", b"0\n")
+            write_file(
+                f"{merge_dir}/MergeMitoMultiSampleOutputsInternal.log",
+                PASSING_LOG.encode("utf8"),
+            )
+            for name in [
+                "batch_merged_mt_calls.vcf.bgz",
+                "batch_merged_mt_coverage.tsv.bgz",
+                "batch_analysis_statistics.tsv",
+            ]:
+                write_file(f"{merge_dir}/{name}", rng.randbytes(1024))
+        for shard in range(n_shards):
+            task_dir = f"{run_prefix}/call-MitochondriaPipeline_v2_5/shard-{shard}/MitochondriaPipeline/{batch}-{shard}/call-LiftoverSelfCoverage"
+            write_file(f"{task_dir}/rc", b"0\n")
+            write_file(
+                f"{task_dir}/LiftoverSelfCoverage.log", PASSING_LOG.encode("utf8")
+            )
+            write_file(f"{task_dir}/stdout", rng.randbytes(rng.randint(256, 4096)))
+
+    return batches
+
+
+def time_operation(function, n_repeats: int) -> dict:
+    """
+    Time an operation.
+
+    :param function: Function taking no arguments and returning the number of items it processed
+    :param n_repeats: Number of times to run the operation
+    :return: Dictionary with the median wall time and the number of items processed per second
+    """
+    times = []
+    n_items = 0
+    for _ in range(n_repeats):
+        start = time.time()
+        n_items = function()
+        times.append(time.time() - start)
+    median = statistics.median(times)
+
+    return {
+        "median_s": median,
+        "n_items": n_items,
+        "items_per_s": n_items / median if median > 0 else None,
+    }
+
+
+def benchmark_primitives(root: str, n_repeats: int) -> dict:
+    """
+    Time the storage operations over every file of the synthetic run.
+
+    :param root: Root of the bucket
+    :param n_repeats: Number of times to run each operation
+    :return: Dictionary with the timings of each operation
+    """
+    storage = get_storage(root)
+    files = [x["path"] for x in storage.list(root, recursive=True)]
+    directories = sorted(set(os.path.dirname(x) for x in files))
+
+    def list_directories():
+        return sum(len(storage.list(x)) for x in directories)
+
+    def stat_files():
+        return len([storage.stat(x) for x in files])
+
+    def read_files():
+        return len([storage.read(x) for x in files])
+
+    def read_first_bytes():
+        return len([storage.read_range(x, 0, 16) for x in files])
+
+    def write_files():
+        for x in files:
+            storage.write_atomic(f"{x}.copy", b"0\n")
+        return len(files)
+
+    return {
+        "recursive_list": time_operation(
+            lambda: len(storage.list(root, recursive=True)), n_repeats
+        ),
+        "list": time_operation(list_directories, n_repeats),
+        "stat": time_operation(stat_files, n_repeats),
+        "read": time_operation(read_files, n_repeats),
+        "read_range": time_operation(read_first_bytes, n_repeats),
+        "write_atomic": time_operation(write_files, n_repeats),
+    }
+
+
+def benchmark_run_monitor(root: str, batches: list, n_repeats: int) -> dict:
+    """
+    Time the status check of cromwell_run_monitor.py over every batch of the synthetic run.
+
+    :param root: Root of the bucket
+    :param batches: Batch IDs
+    :param n_repeats: Number of times to run the check
+    :return: Dictionary with the timing of the check
+    """
+    from gnomad_mitochondria.pipeline.cromwell_run_monitor import check_success_single
+
+    storage = get_storage(root)
+
+    def check_batches():
+        for batch in batches:
+            check_success_single(storage, root, batch, RUN_FOLDER, success_only=False)
+        return len(batches)
+
+    return time_operation(check_batches, n_repeats)
+
+
+def main(args):  # noqa: D103
+    with tempfile.TemporaryDirectory() as standin_dir:
+        use_local_standin(args.standin_dir or standin_dir)
+        root = f"gs://{BUCKET}"
+        logger.info(
+            "Writing a synthetic run of %i batches of %i shards...",
+            args.n_batches,
+            args.n_shards,
+        )
+        batches = write_cromwell_run(root, args.n_batches, args.n_shards, args.seed)
+
+        results = {
+            "n_batches": args.n_batches,
+            "n_shards": args.n_shards,
+            "run_monitor": benchmark_run_monitor(root, batches, args.n_repeats),
+            "primitives": benchmark_primitives(root, args.n_repeats),
+        }
+
+    logger.info(
+        "Run monitor: %.2fs for %i batches",
+        results["run_monitor"]["median_s"],
+        args.n_batches,
+    )
+    for operation, x in results["primitives"].items():
+        logger.info(
+            "%-15s %8.3fs %8i items %10.0f items/s",
+            operation,
+            x["median_s"],
+            x["n_items"],
+            x["items_per_s"] or 0,
+        )
+
+    if args.output_json:
+        with open(args.output_json, "w") as out:
+            out.write(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script times the storage operations and the Cromwell run monitor against a local directory standing in for a bucket, so that listing- and small-file-heavy code can be measured without cloud access"
+    )
+    parser.add_argument("--n-batches", help="Number of batches", type=int, default=20)
+    parser.add_argument(
+        "--n-shards", help="Number of shards per batch", type=int, default=100
+    )
+    parser.add_argument(
+        "--n-repeats", help="Number of times to run each operation", type=int, default=3
+    )
+    parser.add_argument("--seed", help="Random seed", type=int, default=42)
+    parser.add_argument(
+        "--standin-dir",
+        help="Local directory standing in for cloud storage (a temporary directory is used if not supplied); point it at a directory on a FUSE mount or network filesystem to measure that filesystem",
+    )
+    parser.add_argument("-o", "--output-json", help="Path to write the results as JSON")
+
+    args = parser.parse_args()
+    main(args)
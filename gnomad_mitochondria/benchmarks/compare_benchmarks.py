@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+import argparse
+import json
+import logging
+import sys
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("compare benchmarks")
+logger.setLevel(logging.INFO)
+
+# Metrics compared between runs, with the minimum baseline value below which differences are treated as noise
+METRIC_FLOORS = {
+    "wall_time_s": 5.0,
+    "jvm_peak_rss_bytes": 256 * 1024 * 1024,
+    "bytes_written": 1024 * 1024,
+}
+
+
+def read_results(path: str) -> dict:
+    """
+    Read a results file written by benchmark_pipeline_stages.py.
+
+    :param path: Path to the JSON results file
+    :return: Dictionary with (n_samples, stage) as key and the metrics of that stage as value
+    """
+    with open(path) as f:
+        results = json.load(f)["results"]
+
+    return {(x["n_samples"], x["stage"]): x for x in results}
+
+
+def compare_results(baseline: dict, current: dict, tolerance: float) -> list:
+    """
+    Compare the metrics of each stage and cohort size present in both runs.
+
+    :param baseline: Baseline results returned by read_results
+    :param current: Current results returned by read_results
+    :param tolerance: Fractional increase over the baseline above which a metric is flagged as a regression
+    :return: List of dictionaries with the baseline and current values, ratio, and whether the metric regressed
+    """
+    comparisons = []
+    for key in sorted(set(baseline) & set(current)):
+        for metric, floor in METRIC_FLOORS.items():
+            baseline_value = baseline[key].get(metric)
+            current_value = current[key].get(metric)
+            if baseline_value is None or current_value is None:
+                continue
+
+            ratio = current_value / baseline_value if baseline_value > 0 else None
+            comparisons.append(
+                {
+                    "n_samples": key[0],
+                    "stage": key[1],
+                    "metric": metric,
+                    "baseline": baseline_value,
+                    "current": current_value,
+                    "ratio": ratio,
+                    "regression": (
+                        max(baseline_value, current_value) >= floor
+                        and current_value > baseline_value * (1 + tolerance)
+                    ),
+                }
+            )
+
+    return comparisons
+
+
+def main(args):  # noqa: D103
+    baseline = read_results(args.baseline)
+    current = read_results(args.current)
+
+    for key in sorted(set(baseline) - set(current)):
+        logger.warning("%i samples %s is in the baseline but not the current run", *key)
+    for key in sorted(set(current) - set(baseline)):
+        logger.warning("%i samples %s is in the current run but not the baseline", *key)
+
+    comparisons = compare_results(baseline, current, args.tolerance)
+    for x in comparisons:
+        print(
+            "{:>6} {:<32} {:<20} {:>16.1f} {:>16.1f} {:>7} {}".format(
+                x["n_samples"],
+                x["stage"],
+                x["metric"],
+                x["baseline"],
+                x["current"],
+                "-" if x["ratio"] is None else f"{x['ratio']:.2f}x",
+                "REGRESSION" if x["regression"] else "",
+            )
+        )
+
+    regressions = [x for x in comparisons if x["regression"]]
+    if regressions:
+        logger.error(
+            "%i metrics regressed by more than %.0f%% against %s",
+            len(regressions),
+            args.tolerance * 100,
+            args.baseline,
+        )
+        sys.exit(1)
+    logger.info("No regressions against %s", args.baseline)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script compares a results file from benchmark_pipeline_stages.py against a stored baseline and exits with an error if any stage regressed"
+    )
+    parser.add_argument(
+        "-b", "--baseline", help="Path to the baseline JSON results file", required=True
+    )
+    parser.add_argument(
+        "-c",
+        "--current",
+        help="Path to the JSON results file of the current run",
+        required=True,
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="Fractional increase over the baseline (of wall time, peak memory, or bytes written) flagged as a regression",
+        type=float,
+        default=0.2,
+    )
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import logging
+import math
+import os
+import random
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("generate synthetic cohort")
+logger.setLevel(logging.INFO)
+
+CHRM_LENGTH = 16569
+BASES = "ACGT"
+POPS = ["afr", "amr", "asj", "eas", "fin", "mid", "nfe", "sas", "oth"]
+# Illustrative haplogroup-defining variants (relative to rCRS) used when no phylotree-style file is supplied
+DEFAULT_HAPLOGROUP_VARIANTS = {
+    "H": ["A2706G"],
+    "J": ["A2706G", "T4216C", "G13708A", "C16069T"],
+    "K": ["A2706G", "A11467G", "A12308G", "G12372A", "A10550G", "T9698C"],
+    "L3": ["A2706G", "T10873C", "C7028T", "A769G"],
+    "M": ["A2706G", "T10873C", "C7028T", "C10400T", "T14783C", "G15043A"],
+    "T": ["A2706G", "G709A", "G1888A", "A4917G", "T16294C"],
+    "U": ["A2706G", "A11467G", "A12308G", "G12372A"],
+}
+# Regions with lower coverage (start, end, relative coverage), such as the poly-C tracts and the N at 3107
+LOW_COVERAGE_REGIONS = [
+    (300, 317, 0.5),
+    (513, 526, 0.7),
+    (3105, 3108, 0.3),
+    (16182, 16194, 0.5),
+]
+VCF_HEADER = """##fileformat=VCFv4.2
+##FILTER=<ID=PASS,Description="All filters passed">
+##FILTER=<ID=weak_evidence,Description="Mutation does not meet likelihood threshold">
+##FILTER=<ID=strand_bias,Description="Evidence for alt allele comes from one read direction only">
+##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths for the ref and alt alleles in the order listed">
+##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele fractions of alternate alleles in the tumor">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth (reads with MQ=255 or with bad mates are filtered)">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##INFO=<ID=AS_SB_TABLE,Number=1,Type=String,Description="Allele-specific forward/reverse read counts for strand bias tests. Includes the reference and alleles separated by |.">
+##INFO=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth; some reads may have been filtered">
+##INFO=<ID=MMQ,Number=R,Type=Integer,Description="median mapping quality">
+##INFO=<ID=TLOD,Number=A,Type=Float,Description="Log 10 likelihood ratio score of variant existing versus not existing">
+##contig=<ID=chrM,length=16569>
+"""
+
+
+def read_haplogroup_variants(path: str) -> dict:
+    """
+    Read a phylotree-style file of haplogroup-defining variants.
+
+    :param path: Path to a tab-delimited file with haplogroup and variant columns (variants formatted as ref, position, alt, for example A73G)
+    :return: Dictionary with haplogroups as keys and lists of variants as values
+    """
+    haplogroup_variants = {}
+    with open(path) as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            haplogroup_variants.setdefault(row["haplogroup"], []).append(row["variant"])
+
+    return haplogroup_variants
+
+
+def parse_variant(variant: str) -> tuple:
+    """
+    Parse a variant formatted as ref, position, alt (for example A73G).
+
+    :param variant: Variant string
+    :return: Tuple of position, ref, and alt
+    """
+    position_start = next(i for i, x in enumerate(variant) if x.isdigit())
+    position_end = position_start + next(
+        i for i, x in enumerate(variant[position_start:] + "X") if not x.isdigit()
+    )
+
+    return (
+        int(variant[position_start:position_end]),
+        variant[:position_start],
+        variant[position_end:],
+    )
+
+
+def read_reference(path: str) -> str:
+    """
+    Read the chrM sequence from a single-contig FASTA file.
+
+    :param path: Path to FASTA file
+    :return: Sequence in upper case
+    """
+    with open(path) as f:
+        return "".join(x.strip() for x in f if not x.startswith(">")).upper()
+
+
+def generate_reference(seed: int, haplogroup_variants: dict) -> str:
+    """
+    Generate a pseudo-reference sequence, using the reference alleles of the haplogroup-defining variants at their positions.
+
+    :param seed: Random seed
+    :param haplogroup_variants: Dictionary with haplogroups as keys and lists of variants as values
+    :return: Sequence of length CHRM_LENGTH
+    """
+    rng = random.Random(seed)
+    sequence = [rng.choice(BASES) for _ in range(CHRM_LENGTH)]
+    for variants in haplogroup_variants.values():
+        for position, ref, _ in map(parse_variant, variants):
+            sequence[position - 1 : position - 1 + len(ref)] = list(ref)
+
+    return "".join(sequence)[:CHRM_LENGTH]
+
+
+def generate_coverage_profile(seed: int) -> list:
+    """
+    Generate the relative coverage at each position, shared by all samples.
+
+    The profile varies smoothly along the genome, drops in LOW_COVERAGE_REGIONS, and tapers at both ends of the linearized genome.
+
+    :param seed: Random seed
+    :return: List of relative coverage values (mean of about 1) for positions 1 to CHRM_LENGTH
+    """
+    rng = random.Random(seed)
+    phase_1, phase_2 = rng.uniform(0, 2 * math.pi), rng.uniform(0, 2 * math.pi)
+    profile = []
+    for position in range(1, CHRM_LENGTH + 1):
+        value = (
+            1
+            + 0.25 * math.sin(2 * math.pi * position / 5000 + phase_1)
+            + 0.1 * math.sin(2 * math.pi * position / 700 + phase_2)
+        )
+        edge_distance = min(position, CHRM_LENGTH + 1 - position)
+        if edge_distance < 50:
+            value *= 0.6 + 0.4 * edge_distance / 50
+        for start, end, relative_coverage in LOW_COVERAGE_REGIONS:
+            if start <= position <= end:
+                value *= relative_coverage
+        profile.append(value)
+
+    return profile
+
+
+def poisson(rng: random.Random, mean: float) -> int:
+    """
+    Draw from a Poisson distribution (Knuth's method, suitable for small means).
+
+    :param rng: Random number generator
+    :param mean: Mean of the distribution
+    :return: Random count
+    """
+    threshold = math.exp(-mean)
+    count, product = 0, rng.random()
+    while product > threshold:
+        count += 1
+        product *= rng.random()
+
+    return count
+
+
+def generate_random_variant(
+    rng: random.Random, reference: str, indel_fraction: float
+) -> tuple:
+    """
+    Generate a random SNV, insertion, or deletion.
+
+    :param rng: Random number generator
+    :param reference: Reference sequence
+    :param indel_fraction: Fraction of variants that are indels
+    :return: Tuple of position, ref, and alt
+    """
+    position = rng.randint(1, CHRM_LENGTH - 1)
+    ref = reference[position - 1]
+    if rng.random() < indel_fraction:
+        if rng.random() < 0.5:
+            return position, ref, ref + rng.choice(BASES)
+        return position, reference[position - 1 : position + 1], ref
+
+    return position, ref, rng.choice([x for x in BASES if x != ref])
+
+
+def generate_sample(
+    sample_index: int,
+    args: argparse.Namespace,
+    reference: str,
+    profile: list,
+    haplogroup_variants: dict,
+) -> dict:
+    """
+    Write the Mutect2-style VCF and per-base coverage TSV of one sample and return its metadata.
+
+    Every sample has its own random number generator seeded from the cohort seed and its index, so samples can be generated in any order.
+
+    :param sample_index: Index of the sample
+    :param args: Generator arguments
+    :param reference: Reference sequence
+    :param profile: Relative coverage profile
+    :param haplogroup_variants: Dictionary with haplogroups as keys and lists of variants as values
+    :return: Dictionary of sample metadata (a row of the participant data file)
+    """
+    rng = random.Random(args.seed * 1000003 + sample_index)
+    s = f"SYN{sample_index:07d}"
+    haplogroup = rng.choice(sorted(haplogroup_variants))
+
+    mean_coverage = rng.lognormvariate(math.log(args.mean_coverage), 0.4)
+    coverage = [
+        max(0, int(round(mean_coverage * x * rng.gauss(1, 0.05)))) for x in profile
+    ]
+
+    # Haplogroup-defining and private variants are homoplasmic, the remaining variants are heteroplasmies
+    variants = {}
+    for variant in haplogroup_variants[haplogroup]:
+        position, ref, alt = parse_variant(variant)
+        variants[position] = (ref, alt, rng.uniform(0.97, 1.0))
+    for _ in range(poisson(rng, args.private_hom_rate)):
+        position, ref, alt = generate_random_variant(
+            rng, reference, args.indel_fraction
+        )
+        variants.setdefault(position, (ref, alt, rng.uniform(0.95, 1.0)))
+    for _ in range(poisson(rng, args.het_rate)):
+        position, ref, alt = generate_random_variant(
+            rng, reference, args.indel_fraction
+        )
+        hl = args.min_hl + (0.95 - args.min_hl) * rng.betavariate(
+            args.hl_alpha, args.hl_beta
+        )
+        variants.setdefault(position, (ref, alt, hl))
+
+    vcf_path = os.path.join(args.output_dir, "vcfs", f"{s}.vcf")
+    with open(vcf_path, "w") as out:
+        out.write(VCF_HEADER)
+        out.write(
+            "\t".join(
+                [
+                    "#CHROM",
+                    "POS",
+                    "ID",
+                    "REF",
+                    "ALT",
+                    "QUAL",
+                    "FILTER",
+                    "INFO",
+                    "FORMAT",
+                    s,
+                ]
+            )
+            + "\n"
+        )
+        for position in sorted(variants):
+            ref, alt, hl = variants[position]
+            dp = max(coverage[position - 1], 1)
+            alt_reads = max(1, int(round(dp * hl)))
+            ref_reads = max(0, dp - alt_reads)
+            tlod = round(alt_reads * rng.uniform(2.5, 3.5), 2)
+            alt_forward = (
+                rng.randint(0, alt_reads)
+                if rng.random() < args.strand_bias_rate
+                else alt_reads // 2
+            )
+            ref_forward = ref_reads // 2
+            if tlod < 6.3:
+                filters = "weak_evidence"
+            elif alt_forward in (0, alt_reads) and alt_reads > 5:
+                filters = "strand_bias"
+            else:
+                filters = "PASS"
+            info = (
+                f"AS_SB_TABLE={ref_forward},{ref_reads - ref_forward}|{alt_forward},{alt_reads - alt_forward};"
+                f"DP={dp};MMQ=60,60;TLOD={tlod}"
+            )
+            genotype = "1/1" if hl >= 0.95 else "0/1"
+            sample_fields = f"{genotype}:{ref_reads},{alt_reads}:{hl:.3f}:{dp}"
+            out.write(
+                "\t".join(
+                    [
+                        "chrM",
+                        str(position),
+                        ".",
+                        ref,
+                        alt,
+                        ".",
+                        filters,
+                        info,
+                        "GT:AD:AF:DP",
+                        sample_fields,
+                    ]
+                )
+                + "\n"
+            )
+
+    coverage_path = os.path.join(args.output_dir, "coverage", f"{s}.tsv")
+    with open(coverage_path, "w") as out:
+        out.write("chrom\tpos\ttarget\tcoverage\n")
+        out.writelines(
+            f"chrM\t{position}\tchrM\t{value}\n"
+            for position, value in enumerate(coverage, start=1)
+        )
+
+    return {
+        "entity:participant_id": s,
+        "s": s,
+        "vcf": os.path.abspath(vcf_path),
+        "coverage": os.path.abspath(coverage_path),
+        "contamination": round(abs(rng.gauss(0, 0.005)), 5),
+        "freemix_percentage": round(abs(rng.gauss(0, 0.5)), 3),
+        "major_haplogroup": haplogroup,
+        "wgs_median_coverage": round(rng.gauss(30, 4), 1),
+        "mt_mean_coverage": round(sum(coverage) / len(coverage), 2),
+        "age": rng.randint(18, 90),
+        "pop": rng.choice(POPS),
+        "mtdna_consensus_overlaps": 0,
+    }
+
+
+def write_tsv(path: str, rows: list, columns: list) -> None:
+    """
+    Write a list of dictionaries as a tab-delimited file.
+
+    :param path: Output path
+    :param rows: List of dictionaries
+    :param columns: Columns to write
+    :return: None
+    """
+    with open(path, "w", newline="") as out:
+        writer = csv.DictWriter(
+            out, columns, delimiter="\t", extrasaction="ignore", lineterminator="\n"
+        )
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(args):  # noqa: D103
+    os.makedirs(os.path.join(args.output_dir, "vcfs"), exist_ok=True)
+    os.makedirs(os.path.join(args.output_dir, "coverage"), exist_ok=True)
+
+    haplogroup_variants = (
+        DEFAULT_HAPLOGROUP_VARIANTS
+        if args.haplogroup_variants is None
+        else read_haplogroup_variants(args.haplogroup_variants)
+    )
+    reference = (
+        generate_reference(args.seed, haplogroup_variants)
+        if args.reference_fasta is None
+        else read_reference(args.reference_fasta)
+    )
+    profile = generate_coverage_profile(args.seed)
+
+    logger.info("Generating %i samples in %s...", args.n_samples, args.output_dir)
+    with ProcessPoolExecutor(args.n_workers) as executor:
+        rows = list(
+            executor.map(
+                generate_sample,
+                range(args.n_samples),
+                [args] * args.n_samples,
+                [reference] * args.n_samples,
+                [profile] * args.n_samples,
+                [haplogroup_variants] * args.n_samples,
+                chunksize=max(1, args.n_samples // (args.n_workers * 4)),
+            )
+        )
+
+    # Participant data read by combine_vcfs.py (-v vcf), annotate_coverage.py (s and coverage columns), and add_annotations.py (-a)
+    write_tsv(
+        os.path.join(args.output_dir, "participant_data.tsv"),
+        rows,
+        [
+            "entity:participant_id",
+            "s",
+            "vcf",
+            "coverage",
+            "contamination",
+            "freemix_percentage",
+            "major_haplogroup",
+            "wgs_median_coverage",
+            "mt_mean_coverage",
+            "age",
+            "pop",
+        ],
+    )
+    # Sample statistics read by add_annotations.py (--sample-stats)
+    write_tsv(
+        os.path.join(args.output_dir, "sample_stats.tsv"),
+        rows,
+        ["s", "mtdna_consensus_overlaps"],
+    )
+    write_tsv(
+        os.path.join(args.output_dir, "haplogroup_variants.tsv"),
+        [
+            {"haplogroup": x, "variant": y}
+            for x in sorted(haplogroup_variants)
+            for y in haplogroup_variants[x]
+        ],
+        ["haplogroup", "variant"],
+    )
+    logger.info("Wrote %i samples", len(rows))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script deterministically generates a synthetic cohort of per-sample Mutect2-style chrM VCFs, per-base coverage TSVs, and sample metadata in the formats read by combine_vcfs.py, annotate_coverage.py, and add_annotations.py"
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        help="Directory to which the cohort should be written",
+        required=True,
+    )
+    parser.add_argument(
+        "-n", "--n-samples", help="Number of samples", type=int, default=100
+    )
+    parser.add_argument("--seed", help="Random seed", type=int, default=42)
+    parser.add_argument(
+        "--haplogroup-variants",
+        help="Optional phylotree-style tab-delimited file with haplogroup and variant (for example A73G) columns, defaults to a small built-in set",
+    )
+    parser.add_argument(
+        "--reference-fasta",
+        help="Optional chrM FASTA (for example rCRS) providing reference alleles, defaults to a pseudo-random sequence",
+    )
+    parser.add_argument(
+        "--mean-coverage",
+        help="Median of the per-sample mean chrM coverage",
+        type=float,
+        default=2500,
+    )
+    parser.add_argument(
+        "--het-rate",
+        help="Mean number of heteroplasmies per sample",
+        type=float,
+        default=2.0,
+    )
+    parser.add_argument(
+        "--private-hom-rate",
+        help="Mean number of homoplasmic variants per sample that are not haplogroup-defining",
+        type=float,
+        default=3.0,
+    )
+    parser.add_argument(
+        "--min-hl",
+        help="Minimum heteroplasmy level of heteroplasmies",
+        type=float,
+        default=0.01,
+    )
+    parser.add_argument(
+        "--hl-alpha",
+        help="Alpha of the beta distribution of heteroplasmy levels (scaled to between --min-hl and 0.95)",
+        type=float,
+        default=0.6,
+    )
+    parser.add_argument(
+        "--hl-beta",
+        help="Beta of the beta distribution of heteroplasmy levels (scaled to between --min-hl and 0.95)",
+        type=float,
+        default=3.0,
+    )
+    parser.add_argument(
+        "--indel-fraction",
+        help="Fraction of non-haplogroup variants that are indels",
+        type=float,
+        default=0.05,
+    )
+    parser.add_argument(
+        "--strand-bias-rate",
+        help="Fraction of variants whose alt reads have a random strand split",
+        type=float,
+        default=0.01,
+    )
+    parser.add_argument(
+        "--n-workers",
+        help="Number of processes used to write samples",
+        type=int,
+        default=4,
+    )
+
+    args = parser.parse_args()
+    main(args)
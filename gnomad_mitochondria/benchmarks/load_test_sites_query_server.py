@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+import argparse
+import http.client
+import json
+import logging
+import random
+import statistics
+import threading
+import time
+
+from gnomad_mitochondria.utils.sites_query_server import SitesIndex, serve
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("load test sites query server")
+logger.setLevel(logging.INFO)
+
+
+def generate_queries(index: SitesIndex, n_queries: int, seed: int = 42) -> list:
+    """
+    Generate a random mix of variant, region, and haplogroup queries against the indexed sites.
+
+    :param index: SitesIndex that is being served
+    :param n_queries: Number of queries to generate
+    :param seed: Random seed
+    :return: List of tuples of endpoint name and request path
+    """
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(n_queries):
+        variant = rng.choice(index.variants)
+        notation = f"{variant['ref']}{variant['position']}{variant['alt']}"
+        query_type = rng.choice(
+            ["variant", "region", "haplogroup"]
+            if index.hap_order
+            else ["variant", "region"]
+        )
+        if query_type == "variant":
+            queries.append(("variant", f"/variant?id={notation}"))
+        elif query_type == "region":
+            start = rng.randint(1, 16569)
+            queries.append(("region", f"/region?start={start}&end={start + 100}"))
+        else:
+            hap = rng.choice(index.hap_order)
+            queries.append(("haplogroup", f"/haplogroup?hap={hap}&variant={notation}"))
+
+    return queries
+
+
+def run_client(host: str, port: int, queries: list, results: list) -> None:
+    """
+    Send queries over one persistent connection, recording the client-side and server-side latency of each.
+
+    :param host: Server host
+    :param port: Server port
+    :param queries: List of tuples of endpoint name and request path
+    :param results: List to which tuples of endpoint name, client latency, and query latency (in seconds) are appended
+    :return: None
+    """
+    connection = http.client.HTTPConnection(host, port)
+    for endpoint, path in queries:
+        start = time.perf_counter()
+        connection.request("GET", path)
+        response = connection.getresponse()
+        json.loads(response.read())
+        elapsed = time.perf_counter() - start
+        if response.status != 200:
+            raise ValueError(f"Query {path} failed with status {response.status}")
+        results.append(
+            (endpoint, elapsed, float(response.getheader("X-Query-Time-Us")) / 1e6)
+        )
+    connection.close()
+
+
+def percentiles(values: list) -> tuple:
+    """
+    Compute the 50th and 99th percentiles of a list of latencies.
+
+    :param values: List of latencies in seconds
+    :return: Tuple of p50 and p99 in milliseconds
+    """
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+
+    return quantiles[49] * 1000, quantiles[98] * 1000
+
+
+def main(args):  # noqa: D103
+    index = SitesIndex.from_sites_txt(args.sites_txt, args.sites_globals)
+    server = serve(index, "127.0.0.1", 0)
+    host, port = server.server_address[:2]
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    queries = generate_queries(index, args.n_queries)
+    results = []
+    clients = [
+        threading.Thread(
+            target=run_client, args=(host, port, queries[i :: args.n_clients], results)
+        )
+        for i in range(args.n_clients)
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    logger.info(
+        "%i queries from %i clients in %.2fs (%.0f queries/s)",
+        len(results),
+        args.n_clients,
+        elapsed,
+        len(results) / elapsed,
+    )
+    for endpoint in sorted({x[0] for x in results}):
+        client_latencies = [x[1] for x in results if x[0] == endpoint]
+        query_latencies = [x[2] for x in results if x[0] == endpoint]
+        logger.info(
+            "%s: n=%i, request p50=%.3fms p99=%.3fms, query p50=%.3fms p99=%.3fms",
+            endpoint,
+            len(client_latencies),
+            *percentiles(client_latencies),
+            *percentiles(query_latencies),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script load tests the sites query server and reports p50/p99 latencies per endpoint (request latency includes HTTP handling, query latency is the time spent answering the query)"
+    )
+    parser.add_argument(
+        "-s",
+        "--sites-txt",
+        help="Local path of the sites-only text file written by add_annotations.py",
+        required=True,
+    )
+    parser.add_argument(
+        "-g",
+        "--sites-globals",
+        help="Local path of the sites globals JSON written by add_annotations.py",
+    )
+    parser.add_argument(
+        "--n-queries", help="Total number of queries to send", type=int, default=10000
+    )
+    parser.add_argument(
+        "--n-clients", help="Number of concurrent clients", type=int, default=4
+    )
+
+    args = parser.parse_args()
+    main(args)
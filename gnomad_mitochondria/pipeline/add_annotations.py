@@ -1,36 +1,42 @@
 #!/usr/bin/env python
+from __future__ import annotations
+
 import argparse
-import hail as hl
+import functools
+import json
 import logging
 import re
 import sys
 
-import sys
-sys.path.append('/home/jupyter/')
-sys.path.append('/home/rahul/')
-sys.path.append('/home/rahulgupta/')
-
 from collections import Counter
 from textwrap import dedent
+from typing import TYPE_CHECKING, Optional, Union
 
-from gnomad.utils.annotations import age_hists_expr
-from gnomad.utils.reference_genome import add_reference_sequence
-from gnomad.utils.slack import slack_notifications
-from gnomad.utils.vep import vep_struct_to_csq
-from gnomad_qc.v3.resources.meta import meta  # pylint: disable=import-error
-from gnomad.resources.grch38.gnomad import POPS
-from gnomad.resources.grch38.reference_data import dbsnp, _import_dbsnp
 from gnomad_mitochondria.pipeline.annotation_descriptions import (
     add_descriptions,
     adjust_descriptions,
 )
+from gnomad_mitochondria.utils.coverage_table import key_rows_by_locus, read_coverage_table
+from gnomad_mitochondria.utils.flat_files import (
+    export_flat_file_parquet,
+    export_indexed_flat_file,
+)
+from gnomad_mitochondria.utils.instrumentation import (
+    DEFAULT_IR_NODE_THRESHOLD,
+    RunReport,
+)
+from gnomad_mitochondria.utils.startup import check_local_inputs, init_hail
+from gnomad_mitochondria.utils.vcf_export import export_sharded_vcf, export_sites_vcf
+
+if TYPE_CHECKING:
+    import hail as hl
+
 
 # Github repo locations for imports:
 # gnomad: https://github.com/broadinstitute/gnomad_methods
 # gnomad_qc: https://github.com/broadinstitute/gnomad_qc
-
-# Include NA in POPS to account for cases where population annotations are missing
-POPS.append("NA")
+# gnomad and gnomad_qc are imported inside the functions that use them, so that argument parsing and validation do not
+# pay for importing them
 
 RESOURCE_PATH = 'gcp-public-data--gnomad/resources/mitochondria'
 RESOURCES = {
@@ -47,6 +53,14 @@ CUSTOMLIFTOVERFILTERS = set(['FailedPicardLiftoverVcf', 'InsertionSharesForceCal
                              'DeletionSpannedHomoplasmicInsertion', 'LiftoverSuccessEntrySwap', 'ForceCalledHomoplasmy',
                              'LeftShiftedIndel', 'FailedDuplicateVariant'])
 
+# Histogram parameters (start, end, number of bins) shared by the annotation functions and the mergeable aggregate states
+HL_HIST_PARAMS = (0, 1, 10)
+DP_HIST_PARAMS = (0, 2000, 10)
+AGE_HIST_PARAMS = (30, 80, 10)
+DP_MEAN_HIST_PARAMS = (0, 4000, 40)
+MQ_MEAN_HIST_PARAMS = (0, 80, 40)
+TLOD_MEAN_HIST_PARAMS = (0, 40000, 40)
+
 
 logging.basicConfig(
     format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
@@ -55,12 +69,6 @@ logging.basicConfig(
 logger = logging.getLogger("add annotations")
 logger.setLevel(logging.INFO)
 
-if int(hl.version().split('-')[0].split('.')[2]) >= 75: # only use this if using hail 0.2.75 or greater
-    logger.info("Setting hail flag to avoid array index out of bounds error...")
-    # Setting this flag isn't generally recommended, but is needed (since at least Hail version 0.2.75) to avoid an array index out of bounds error until changes are made in future versions of Hail
-    # TODO: reassess if this flag is still needed for future versions of Hail
-    hl._set_flags(no_whole_stage_codegen="1")
-
 
 def add_genotype(mt_path: str, min_hom_threshold: float = 0.95) -> hl.MatrixTable:
     """
@@ -74,6 +82,8 @@ def add_genotype(mt_path: str, min_hom_threshold: float = 0.95) -> hl.MatrixTabl
     :param min_hom_threshold: Minimum heteroplasmy level to define a variant as homoplasmic
     :return: MatrixTable with GT field added
     """
+    import hail as hl
+
     logger.info("Reading in MT...")
     mt = hl.read_matrix_table(mt_path)
 
@@ -100,6 +110,8 @@ def add_variant_context(input_mt: hl.MatrixTable) -> hl.MatrixTable:
     :param input_mt: MatrixTable
     :return: MatrixTable with variant context information added
     """
+    import hail as hl
+
     # Read in variant context data
     vc_ht = hl.import_table(RESOURCES["variant_context"], impute=True)
 
@@ -138,6 +150,10 @@ def add_gnomad_metadata(input_mt: hl.MatrixTable) -> hl.MatrixTable:
     :param input_mt: MatrixTable
     :return: MatrixTable with select gnomAD metadata added
     """
+    import hail as hl
+
+    from gnomad_qc.v3.resources.meta import meta  # pylint: disable=import-error
+
     # TODO: Add option here to accomodate non-gnomAD metadata
     genome_meta_ht = meta.versions["3.1"].ht()
 
@@ -171,6 +187,8 @@ def add_age_and_pop(input_mt: hl.MatrixTable, participant_data: str) -> hl.Matri
     :param participant_data: Path to metadata file downloaded from Terra that contains sample age and pop information
     :return: MatrixTable with select age and pop annotations added
     """
+    import hail as hl
+
     ht = hl.import_table(
         participant_data, types={"age": hl.tint32, "pop": hl.tstr},
     ).key_by("s")
@@ -188,6 +206,8 @@ def add_age_and_pop(input_mt: hl.MatrixTable, participant_data: str) -> hl.Matri
 
 
 def filter_by_hom_overlap(input_mt: hl.MatrixTable, keep_all_samples: bool, sample_stats: str):
+    import hail as hl
+
     stat_ht = hl.import_table(sample_stats, impute=True, key='s', types={'s':hl.tstr})
     input_mt = input_mt.annotate_cols(num_mt_overlaps = stat_ht[input_mt.col_key].mtdna_consensus_overlaps)
     n_removed = input_mt.aggregate_cols(hl.agg.count_where(input_mt.num_mt_overlaps > 0))
@@ -209,6 +229,8 @@ def filter_by_copy_number(
     :param keep_all_samples: If True, keep all samples (calculate mitochondrial copy number, but do not filter any samples based on this metric)
     :return: MatrixTable filtered to samples with a copy number of at least 50 and less than 500, number samples below 50 removed, number samples above 500 removed
     """
+    import hail as hl
+
     # Calculate mitochondrial copy number, if median autosomal coverage is not present default to a wgs_median_coverage of 30x
     input_mt = input_mt.annotate_cols(
         mito_cn=2
@@ -252,6 +274,8 @@ def filter_by_contamination(
     :param keep_all_samples: If True, keep all samples (calculate contamination, but do not filter any samples based on this metric)
     :return: MatrixTable filtered to samples without contamination, number of contaminated samples removed
     """
+    import hail as hl
+
     # Generate expression for genotypes with >= 85% heteroplasmy and no FT filters at haplogroup-defining sites that are not filtered as artifact-prone sites
     over_85_expr = (
         (input_mt.HL >= 0.85)
@@ -358,6 +382,8 @@ def add_terra_metadata(
     :param participant_data: Path to metadata file downloaded from Terra
     :return: MatrixTable with Terra metadata annotations added
     """
+    import hail as hl
+
     # Add haplogroup and Mutect2/Terra output annotations
     ht = hl.import_table(
         participant_data,
@@ -404,6 +430,8 @@ def add_hap_defining(input_mt: hl.MatrixTable) -> hl.MatrixTable:
     :param input_mt: MatrixTable
     :return: MatrixTable with annotation on whether or not the variant is haplogroup-defining added
     """
+    import hail as hl
+
     # TODO: move dataset location
     hap_defining_variants = hl.import_table(RESOURCES["phylotree"])
 
@@ -427,6 +455,10 @@ def add_trna_predictions(input_mt: hl.MatrixTable) -> hl.MatrixTable:
     :param input_mt: MatrixTable
     :return: MatrixTable with tRNA predictions of pathogenicity added
     """
+    import hail as hl
+
+    from gnomad.utils.reference_genome import add_reference_sequence
+
     # Add PON-mt-tRNA predictions
     pon_predictions = hl.import_table(RESOURCES["pon_mt_trna"])
 
@@ -503,6 +535,8 @@ def get_indel_expr(input_mt: hl.MatrixTable) -> hl.expr.BooleanExpression:
     :param input_mt: MatrixTable
     :return: Expression to be used for determining if a variant is an indel that should to be used to evaluate indel stacks
     """
+    import hail as hl
+
     indel_expr = (
         hl.is_indel(input_mt.alleles[0], input_mt.alleles[1])
         & (input_mt.HL <= 0.95)
@@ -519,13 +553,15 @@ def generate_expressions(
     """
     Create expressions to use for annotating the MatrixTable.
 
-    The expressions include AC, AN, AF, filtering allele frequency (FAF) split by homplasmic/heteroplasmic, haplgroup, and population.
+    The expressions include AC, AN, AF split by homplasmic/heteroplasmic, haplgroup, and population.
     Also includes calcuations of mean DP, MQ, and TLOD.
 
     :param input_mt: MatrixTable
     :param min_hom_threshold: Minimum heteroplasmy level to define a variant as homoplasmic
     :return: Tuple of hail expressions
     """
+    import hail as hl
+
     # Calculate AC and AN
     AC = hl.agg.count_where((input_mt.HL > 0.0))
     AN = hl.agg.count_where(hl.is_defined(input_mt.HL))
@@ -535,11 +571,11 @@ def generate_expressions(
     # Calculate AC for het and hom variants, and histogram for HL
     AC_hom = hl.agg.count_where(input_mt.HL >= min_hom_threshold)
     AC_het = hl.agg.count_where((input_mt.HL < min_hom_threshold) & (input_mt.HL > 0.0))
-    HL_hist = hl.agg.filter(input_mt.HL > 0, hl.agg.hist(input_mt.HL, 0, 1, 10))
+    HL_hist = hl.agg.filter(input_mt.HL > 0, hl.agg.hist(input_mt.HL, *HL_HIST_PARAMS))
     DP_hist_alt = hl.agg.filter(
-        input_mt.GT.is_non_ref(), hl.agg.hist(input_mt.DP, 0, 2000, 10)
+        input_mt.GT.is_non_ref(), hl.agg.hist(input_mt.DP, *DP_HIST_PARAMS)
     )
-    DP_hist_all = hl.agg.hist(input_mt.DP, 0, 2000, 10)
+    DP_hist_all = hl.agg.hist(input_mt.DP, *DP_HIST_PARAMS)
     DP_mean = hl.agg.mean(input_mt.DP)
     MQ_mean = hl.agg.mean(input_mt.MQ)
     TLOD_mean = hl.agg.mean(input_mt.TLOD)
@@ -561,16 +597,7 @@ def generate_expressions(
     pre_hap_AF_hom = hl.agg.group_by(input_mt.hap, AF_hom)
     pre_hap_AF_het = hl.agg.group_by(input_mt.hap, AF_het)
     pre_hap_HL_hist = hl.agg.group_by(input_mt.hap, HL_hist.bin_freq)
-    pre_hap_FAF = hl.agg.group_by(
-        input_mt.hap,
-        hl.experimental.filtering_allele_frequency(hl.int32(AC), hl.int32(AN), 0.95),
-    )
-    pre_hap_FAF_hom = hl.agg.group_by(
-        input_mt.hap,
-        hl.experimental.filtering_allele_frequency(
-            hl.int32(AC_hom), hl.int32(AN), 0.95
-        ),
-    )
+    # NOTE: haplogroup FAFs are computed from the haplogroup AC and AN arrays in add_annotations_by_hap_and_pop (see memoized_faf_exprs)
 
     # population annotations
     pre_pop_AC = hl.agg.group_by(input_mt.pop, AC)
@@ -605,8 +632,6 @@ def generate_expressions(
         pre_hap_AC_hom=pre_hap_AC_hom,
         pre_hap_AF_hom=pre_hap_AF_hom,
         pre_hap_hl_hist=pre_hap_HL_hist,
-        pre_hap_faf=pre_hap_FAF,
-        pre_hap_faf_hom=pre_hap_FAF_hom,
         pre_pop_AN=pre_pop_AN,
         pre_pop_AC_het=pre_pop_AC_het,
         pre_pop_AF_het=pre_pop_AF_het,
@@ -616,6 +641,292 @@ def generate_expressions(
     )
 
 
+def memoized_faf_exprs(
+    t: Union[hl.MatrixTable, hl.Table], ac_an_exprs: dict, confidence: float = 0.95
+) -> dict:
+    """
+    Create filtering allele frequency (FAF) expressions that look up values computed once per distinct (AC, AN) pair.
+
+    hl.experimental.filtering_allele_frequency is a numerical root-find, but the number of distinct (AC, AN) pairs across all
+    rows and strata is small. The FAF of each distinct pair is computed in a single evaluation and broadcast back as a dictionary,
+    so the values are identical to calling hl.experimental.filtering_allele_frequency(hl.int32(AC), hl.int32(AN), confidence) on every row.
+
+    :param t: MatrixTable or Table containing the AC and AN row annotations
+    :param ac_an_exprs: Dictionary with output annotation names as keys and tuples of (AC array expression, AN array expression) as values
+    :param confidence: Confidence level of the FAF
+    :return: Dictionary with output annotation names as keys and arrays of FAFs as values
+    """
+    import hail as hl
+
+    pair_type = hl.ttuple(hl.tint32, hl.tint32)
+
+    def _pairs(ac_expr, an_expr):
+        return hl.zip(ac_expr, an_expr).map(
+            lambda x: hl.tuple([hl.int32(x[0]), hl.int32(x[1])])
+        )
+
+    all_pairs_expr = hl.flatten(
+        [_pairs(ac_expr, an_expr) for ac_expr, an_expr in ac_an_exprs.values()]
+    ).filter(lambda x: hl.is_defined(x[0]) & hl.is_defined(x[1]))
+    aggregate = t.aggregate_rows if isinstance(t, hl.MatrixTable) else t.aggregate
+    distinct_pairs = sorted(
+        aggregate(
+            hl.agg.explode(lambda x: hl.agg.collect_as_set(x), all_pairs_expr)
+        )
+    )
+    logger.info(
+        "Computing filtering allele frequencies for %i distinct (AC, AN) pairs...",
+        len(distinct_pairs),
+    )
+
+    fafs = hl.eval(
+        hl.literal(distinct_pairs, dtype=hl.tarray(pair_type)).map(
+            lambda x: hl.experimental.filtering_allele_frequency(x[0], x[1], confidence)
+        )
+    )
+    faf_lookup = hl.literal(
+        dict(zip(distinct_pairs, fafs)), dtype=hl.tdict(pair_type, hl.tfloat64)
+    )
+
+    return {
+        annotation: _pairs(ac_expr, an_expr).map(lambda x: faf_lookup.get(x))
+        for annotation, (ac_expr, an_expr) in ac_an_exprs.items()
+    }
+
+
+def hist_bin_edges_expr(hist_params: tuple) -> hl.expr.ArrayExpression:
+    """
+    Generate the bin edges of a histogram in the same way as hl.agg.hist, without aggregating.
+
+    :param hist_params: Tuple of start, end, and number of bins of the histogram
+    :return: Array of bin edges
+    """
+    import hail as hl
+
+    start = hl.float64(hist_params[0])
+    end = hl.float64(hist_params[1])
+    bin_size = (end - start) / hist_params[2]
+
+    return hl.range(hist_params[2] + 1).map(lambda i: start + i * bin_size)
+
+
+def _hist_state(hist_expr: hl.expr.StructExpression) -> hl.expr.StructExpression:
+    """
+    Keep only the mergeable counts of a histogram (bin edges are fixed by the histogram parameters).
+
+    :param hist_expr: Struct output by hl.agg.hist
+    :return: Struct of bin_freq, n_smaller, and n_larger
+    """
+    import hail as hl
+
+    return hl.struct(
+        bin_freq=hist_expr.bin_freq,
+        n_smaller=hist_expr.n_smaller,
+        n_larger=hist_expr.n_larger,
+    )
+
+
+def _empty_hist_state(hist_params: tuple) -> hl.expr.StructExpression:
+    """
+    Generate a histogram state with all counts set to zero.
+
+    :param hist_params: Tuple of start, end, and number of bins of the histogram
+    :return: Struct of bin_freq, n_smaller, and n_larger set to zero
+    """
+    import hail as hl
+
+    return hl.struct(
+        bin_freq=hl.range(hist_params[2]).map(lambda i: hl.int64(0)),
+        n_smaller=hl.int64(0),
+        n_larger=hl.int64(0),
+    )
+
+
+def _stratum_state_expr(
+    input_mt: hl.MatrixTable, min_hom_threshold: float = 0.95
+) -> hl.expr.StructExpression:
+    """
+    Generate the mergeable counts that are computed for the full callset and within each haplogroup and population.
+
+    :param input_mt: MatrixTable
+    :param min_hom_threshold: Minimum heteroplasmy level to define a variant as homoplasmic
+    :return: Struct of aggregation expressions for AN, AC, AC_hom, AC_het, and the heteroplasmy histogram
+    """
+    import hail as hl
+
+    return hl.struct(
+        AN=hl.agg.count_where(hl.is_defined(input_mt.HL)),
+        AC=hl.agg.count_where(input_mt.HL > 0.0),
+        AC_hom=hl.agg.count_where(input_mt.HL >= min_hom_threshold),
+        AC_het=hl.agg.count_where(
+            (input_mt.HL < min_hom_threshold) & (input_mt.HL > 0.0)
+        ),
+        hl_hist=_hist_state(
+            hl.agg.filter(input_mt.HL > 0, hl.agg.hist(input_mt.HL, *HL_HIST_PARAMS))
+        ),
+    )
+
+
+def generate_aggregate_state_expr(
+    input_mt: hl.MatrixTable, min_hom_threshold: float = 0.95
+) -> hl.expr.StructExpression:
+    """
+    Create the mergeable per-batch state of the row aggregations in generate_expressions, add_quality_histograms, and add_annotations_by_hap_and_pop.
+
+    The state only holds decomposable values (counts, sums, maxima, and histogram bin counts) so that states of separate batches can be merged by summation.
+    Ratios (AF, means), FAF, and hapmax are re-derived from merged states (see merge_aggregate_states.py).
+
+    :param input_mt: MatrixTable with genotypes filtered (output of filter_genotypes) and hap, pop, and age column annotations
+    :param min_hom_threshold: Minimum heteroplasmy level to define a variant as homoplasmic
+    :return: Struct of aggregation expressions to be annotated onto the rows
+    """
+    import hail as hl
+
+    return _stratum_state_expr(input_mt, min_hom_threshold).annotate(
+        dp_hist_all=_hist_state(hl.agg.hist(input_mt.DP, *DP_HIST_PARAMS)),
+        dp_hist_alt=_hist_state(
+            hl.agg.filter(
+                input_mt.GT.is_non_ref(), hl.agg.hist(input_mt.DP, *DP_HIST_PARAMS)
+            )
+        ),
+        dp_sum=hl.agg.sum(input_mt.DP),
+        dp_n=hl.agg.count_where(hl.is_defined(input_mt.DP)),
+        mq_sum=hl.agg.sum(input_mt.MQ),
+        mq_n=hl.agg.count_where(hl.is_defined(input_mt.MQ)),
+        tlod_sum=hl.agg.sum(input_mt.TLOD),
+        tlod_n=hl.agg.count_where(hl.is_defined(input_mt.TLOD)),
+        max_hl=hl.agg.max(input_mt.HL),
+        age_hist_hom=_hist_state(
+            hl.agg.filter(
+                input_mt.GT.is_hom_var(), hl.agg.hist(input_mt.age, *AGE_HIST_PARAMS)
+            )
+        ),
+        age_hist_het=_hist_state(
+            hl.agg.filter(
+                input_mt.GT.is_het(), hl.agg.hist(input_mt.age, *AGE_HIST_PARAMS)
+            )
+        ),
+        hap=hl.agg.group_by(
+            input_mt.hap, _stratum_state_expr(input_mt, min_hom_threshold)
+        ),
+        pop=hl.agg.group_by(
+            input_mt.pop, _stratum_state_expr(input_mt, min_hom_threshold)
+        ),
+    )
+
+
+def generate_reference_state(
+    coverage_mt_path: str, samples_ht: hl.Table, minimum_homref_coverage: int = 100
+) -> hl.Table:
+    """
+    Generate the aggregate state that a site would have in this batch if no sample carried the alternate allele.
+
+    Sites that are absent from a batch are homoplasmic reference (or missing because of low coverage) for every sample of that batch,
+    so their contribution to AN and the DP histogram only depends on coverage. The reference state is keyed by locus and is used
+    in place of the site state when merging batches in which a site was not observed.
+
+    :param coverage_mt_path: Coverage table of sample level coverage at each position (can be generated by running annotate_coverage.py)
+    :param samples_ht: Table keyed by sample containing the hap, pop, and age annotations of the samples in the batch
+    :param minimum_homref_coverage: Minimum depth of coverage required to call a genotype homoplasmic reference rather than missing (should match combine_vcfs.py)
+    :return: Table keyed by locus with the aggregate state of a site without alternate alleles
+    """
+    import hail as hl
+
+    cov_mt = key_rows_by_locus(read_coverage_table(coverage_mt_path))
+    cov_mt = cov_mt.semi_join_cols(samples_ht)
+    # Nested rather than annotated as hap and pop, which would collide with the hap and pop row fields of the state
+    cov_mt = cov_mt.annotate_cols(sample_annotations=samples_ht[cov_mt.s])
+
+    # Matches determine_hom_refs in combine_vcfs.py: DP is only kept (and HL set to 0) above the minimum homref coverage
+    dp_expr = hl.or_missing(
+        cov_mt.coverage > minimum_homref_coverage, cov_mt.coverage
+    )
+
+    def _reference_stratum_state():
+        return hl.struct(
+            AN=hl.agg.count_where(hl.is_defined(dp_expr)),
+            AC=hl.int64(0),
+            AC_hom=hl.int64(0),
+            AC_het=hl.int64(0),
+            hl_hist=_empty_hist_state(HL_HIST_PARAMS),
+        )
+
+    cov_mt = cov_mt.annotate_rows(
+        **_reference_stratum_state().annotate(
+            dp_hist_all=_hist_state(hl.agg.hist(dp_expr, *DP_HIST_PARAMS)),
+            dp_hist_alt=_empty_hist_state(DP_HIST_PARAMS),
+            dp_sum=hl.agg.sum(dp_expr),
+            dp_n=hl.agg.count_where(hl.is_defined(dp_expr)),
+            mq_sum=hl.float64(0),
+            mq_n=hl.int64(0),
+            tlod_sum=hl.float64(0),
+            tlod_n=hl.int64(0),
+            max_hl=hl.or_missing(hl.agg.any(hl.is_defined(dp_expr)), 0.0),
+            age_hist_hom=_empty_hist_state(AGE_HIST_PARAMS),
+            age_hist_het=_empty_hist_state(AGE_HIST_PARAMS),
+            hap=hl.agg.group_by(cov_mt.sample_annotations.hap, _reference_stratum_state()),
+            pop=hl.agg.group_by(cov_mt.sample_annotations.pop, _reference_stratum_state()),
+        )
+    )
+
+    return cov_mt.rows()
+
+
+def write_aggregate_state(
+    input_mt: hl.MatrixTable,
+    state_dir: str,
+    coverage_mt_path: str,
+    min_hom_threshold: float = 0.95,
+    minimum_homref_coverage: int = 100,
+    overwrite: bool = False,
+) -> None:
+    """
+    Write the mergeable aggregate state of a batch.
+
+    The state directory contains:
+        - sites.ht: the aggregate_state row annotation (see generate_aggregate_state_expr), keyed by locus and alleles
+        - reference.ht: the state of a site without alternate alleles, keyed by locus (see generate_reference_state)
+        - samples.ht: the hap, pop, and age annotations of the samples in the batch
+
+    :param input_mt: MatrixTable with an aggregate_state row annotation
+    :param state_dir: Directory to which the state should be written
+    :param coverage_mt_path: MatrixTable of sample level coverage at each position
+    :param min_hom_threshold: Minimum heteroplasmy level to define a variant as homoplasmic (recorded so that only compatible states are merged)
+    :param minimum_homref_coverage: Minimum depth of coverage required to call a genotype homoplasmic reference rather than missing
+    :param overwrite: Whether or not to overwrite existing files
+    :return: None
+    """
+    import hail as hl
+
+    samples_ht = input_mt.cols().select("hap", "pop", "age")
+    samples_ht = samples_ht.checkpoint(f"{state_dir}/samples.ht", overwrite=overwrite)
+
+    sites_ht = input_mt.rows().select("aggregate_state")
+    sites_ht = sites_ht.transmute(**sites_ht.aggregate_state)
+    sites_ht = sites_ht.select_globals(
+        state_params=hl.struct(
+            min_hom_threshold=min_hom_threshold,
+            minimum_homref_coverage=minimum_homref_coverage,
+            hl_hist_params=list(HL_HIST_PARAMS),
+            dp_hist_params=list(DP_HIST_PARAMS),
+            age_hist_params=list(AGE_HIST_PARAMS),
+        ),
+        n_samples=samples_ht.aggregate(hl.agg.count(), _localize=False),
+        age_hist_all_samples=samples_ht.aggregate(
+            _hist_state(hl.agg.hist(samples_ht.age, *AGE_HIST_PARAMS)),
+            _localize=False,
+        ),
+    )
+    sites_ht.write(f"{state_dir}/sites.ht", overwrite=overwrite)
+
+    reference_ht = generate_reference_state(
+        coverage_mt_path, samples_ht, minimum_homref_coverage
+    )
+    # Field order must match the site state so that the two can be coalesced when merging
+    reference_ht = reference_ht.select(*sites_ht.row_value)
+    reference_ht.write(f"{state_dir}/reference.ht", overwrite=overwrite)
+
+
 def standardize_haps(
     input_mt: hl.MatrixTable, annotation: str, haplogroup_order: list
 ) -> list:
@@ -657,10 +968,14 @@ def add_quality_histograms(input_mt: hl.MatrixTable) -> hl.MatrixTable:
     :param input_mt: MatrixTable
     :return: MatrixTable annotated with quality metric histograms
     """
+    import hail as hl
+
+    from gnomad.utils.annotations import age_hists_expr
+
     # Generate histogram for site quality metrics across all variants
     # TODO: decide on bin edges
     dp_hist_all_variants = input_mt.aggregate_rows(
-        hl.agg.hist(input_mt.dp_mean, 0, 4000, 40)
+        hl.agg.hist(input_mt.dp_mean, *DP_MEAN_HIST_PARAMS)
     )
     input_mt = input_mt.annotate_globals(
         dp_hist_all_variants_bin_freq=dp_hist_all_variants.bin_freq,
@@ -669,7 +984,7 @@ def add_quality_histograms(input_mt: hl.MatrixTable) -> hl.MatrixTable:
     )
 
     mq_hist_all_variants = input_mt.aggregate_rows(
-        hl.agg.hist(input_mt.mq_mean, 0, 80, 40)
+        hl.agg.hist(input_mt.mq_mean, *MQ_MEAN_HIST_PARAMS)
     )  # is 80 the actual max value here?
     input_mt = input_mt.annotate_globals(
         mq_hist_all_variants_bin_freq=mq_hist_all_variants.bin_freq,
@@ -678,7 +993,7 @@ def add_quality_histograms(input_mt: hl.MatrixTable) -> hl.MatrixTable:
     )
 
     tlod_hist_all_variants = input_mt.aggregate_rows(
-        hl.agg.hist(input_mt.tlod_mean, 0, 40000, 40)
+        hl.agg.hist(input_mt.tlod_mean, *TLOD_MEAN_HIST_PARAMS)
     )
     input_mt = input_mt.annotate_globals(
         tlod_hist_all_variants_bin_freq=tlod_hist_all_variants.bin_freq,
@@ -688,7 +1003,7 @@ def add_quality_histograms(input_mt: hl.MatrixTable) -> hl.MatrixTable:
 
     # Generate histogram for overall age distribution
     age_hist_all_samples = input_mt.aggregate_cols(
-        hl.agg.hist(input_mt.age, 30, 80, 10)
+        hl.agg.hist(input_mt.age, *AGE_HIST_PARAMS)
     )
     input_mt = input_mt.annotate_globals(
         age_hist_all_samples_bin_freq=age_hist_all_samples.bin_freq,
@@ -703,6 +1018,17 @@ def add_quality_histograms(input_mt: hl.MatrixTable) -> hl.MatrixTable:
         age_hist_hom=age_data.age_hist_hom, age_hist_het=age_data.age_hist_het
     )
 
+    # Record the bin edges of the per-variant histograms as a global so that headers and descriptions do not need to read any rows
+    input_mt = input_mt.annotate_globals(
+        hist_bin_edges=hl.struct(
+            hl_hist=hist_bin_edges_expr(HL_HIST_PARAMS),
+            dp_hist_all=hist_bin_edges_expr(DP_HIST_PARAMS),
+            dp_hist_alt=hist_bin_edges_expr(DP_HIST_PARAMS),
+            age_hist_hom=hist_bin_edges_expr(AGE_HIST_PARAMS),
+            age_hist_het=hist_bin_edges_expr(AGE_HIST_PARAMS),
+        )
+    )
+
     return input_mt
 
 
@@ -713,6 +1039,8 @@ def add_annotations_by_hap_and_pop(input_mt: hl.MatrixTable, output_dir, overwri
     :param input_mt: MatrixTable
     :return: MatrixTable with variant annotations
     """
+    import hail as hl
+
     # Order the haplogroup-specific annotations
     list_hap_order = list(set(input_mt.hap.collect()))
     input_mt = input_mt.annotate_globals(hap_order=sorted(list_hap_order))
@@ -737,11 +1065,19 @@ def add_annotations_by_hap_and_pop(input_mt: hl.MatrixTable, output_dir, overwri
         "pre_hap_AF_hom",
         "pre_hap_AF_het",
         "pre_hap_hl_hist",
-        "pre_hap_faf",
-        "pre_hap_faf_hom",
     ]
     for_annot = {re.sub("pre_", "", i): standardize_haps(input_mt, i, sorted(list_hap_order)) for i in pre_hap_annotation_labels_2}
     input_mt = input_mt.annotate_rows(**for_annot)
+    # FAF is computed once per distinct (AC, AN) pair rather than once per row and haplogroup
+    input_mt = input_mt.annotate_rows(
+        **memoized_faf_exprs(
+            input_mt,
+            {
+                "hap_faf": (input_mt.hap_AC, input_mt.hap_AN),
+                "hap_faf_hom": (input_mt.hap_AC_hom, input_mt.hap_AN),
+            },
+        )
+    )
     input_mt = input_mt.checkpoint(f"{output_dir}/temp4.mt", overwrite=overwrite)
 
     # Get a list of indexes where AC of the haplogroup is greater than 0, then get the list of haplogroups with that index
@@ -765,7 +1101,8 @@ def add_annotations_by_hap_and_pop(input_mt: hl.MatrixTable, output_dir, overwri
     )
 
     # Add populatation annotations
-    final_pops = set(input_mt.pop.collect())
+    # Sorted so that pop_order is an ordered array global that matches the order of the population annotations
+    final_pops = sorted(set(input_mt.pop.collect()))
 
     # Order according to POPS
     #final_pops = [x for x in POPS if x in found_pops]
@@ -800,8 +1137,6 @@ def add_annotations_by_hap_and_pop(input_mt: hl.MatrixTable, output_dir, overwri
         "pre_hap_AF_hom",
         "pre_hap_AF_het",
         "pre_hap_hl_hist",
-        "pre_hap_faf",
-        "pre_hap_faf_hom",
         "AC_mid_het",
         "AF_mid_het",
         "pre_pop_AN",
@@ -841,6 +1176,8 @@ def apply_common_low_het_flag(input_mt: hl.MatrixTable) -> hl.MatrixTable:
     :param input_mt: MatrixTable
     :return: MatrixTable with the common_low_heteroplasmy flag added
     """
+    import hail as hl
+
     input_mt = format_filters(input_mt)
     input_mt = input_mt.annotate_rows(
         AC_mid_het=hl.agg.count_where(
@@ -875,6 +1212,8 @@ def remove_low_allele_frac_genotypes(
     :param vaf_filter_threshold: Should match vaf_filter_threshold supplied to Mutect2, variants below this value will be set to homoplasmic reference after calculating the common_low_heteroplasmy filter
     :return: MatrixTable with genotypes below the vaf_filter_threshold set to homoplasmic reference
     """
+    import hail as hl
+
     # Set HL to 0 if < vaf_filter_threshold and remove variants that no longer have at least one alt call
     input_mt = input_mt.annotate_entries(
         HL=hl.if_else(
@@ -915,32 +1254,27 @@ def apply_indel_stack_filter(input_mt: hl.MatrixTable) -> hl.MatrixTable:
     :param input_mt: MatrixTable
     :return: MatrixTable with the indel_stack filter added
     """
+    import hail as hl
+
     # Add variant-level indel_stack at any indel allele where all samples with a variant call had at least 2 different indels called at that position
     # If any sample had a solo indel at that position, do not filter
+    # Index the positions of each sample's indels as a sorted array (one entry per indel, so positions with several indels are repeated)
     indel_expr = get_indel_expr(input_mt)
     input_mt = input_mt.annotate_cols(
-        indel_pos_counter=hl.agg.filter(
-            indel_expr, hl.agg.counter(input_mt.locus.position)
+        indel_positions=hl.sorted(
+            hl.agg.filter(indel_expr, hl.agg.collect(input_mt.locus.position))
         )
     )
+    # The number of indels at a position is the distance between the insertion points of the position and the next position
     indel_expr = get_indel_expr(input_mt)
+    indel_count = hl.binary_search(
+        input_mt.indel_positions, input_mt.locus.position + 1
+    ) - hl.binary_search(input_mt.indel_positions, input_mt.locus.position)
     input_mt = input_mt.annotate_entries(
         indel_occurences=(
             hl.case()
-            .when(
-                (
-                    indel_expr
-                    & (input_mt.indel_pos_counter.get(input_mt.locus.position) >= 2)
-                ),
-                "stack",
-            )
-            .when(
-                (
-                    indel_expr
-                    & (input_mt.indel_pos_counter.get(input_mt.locus.position) == 1)
-                ),
-                "solo",
-            )
+            .when((indel_expr & (indel_count >= 2)), "stack")
+            .when((indel_expr & (indel_count == 1)), "solo")
             .or_missing()
         )
     )
@@ -971,6 +1305,8 @@ def filter_genotypes_below_min_het_threshold(
     :param min_het_threshold: Minimum heteroplasmy level to define a variant as a PASS heteroplasmic variant, genotypes below this threshold will count towards the heteroplasmy_below_min_het_threshold filter and be set to missing
     :return: MatrixTable with the heteroplasmy_below_min_het_threshold in the FT field added where applicable
     """
+    import hail as hl
+
     input_mt = input_mt.annotate_entries(
         FT=hl.if_else(
             (input_mt.HL < min_het_threshold) & (input_mt.GT.is_het()),
@@ -992,6 +1328,8 @@ def apply_npg_filter(input_mt: hl.MatrixTable) -> hl.MatrixTable:
     :param input_mt: MatrixTable
     :return: MatrixTable with the npg filter added
     """
+    import hail as hl
+
     input_mt = format_filters(input_mt)
     input_mt = input_mt.annotate_rows(
         filters=hl.if_else(
@@ -1004,21 +1342,35 @@ def apply_npg_filter(input_mt: hl.MatrixTable) -> hl.MatrixTable:
     return format_filters(input_mt)
 
 
-def generate_filter_histogram(
-    input_mt: hl.MatrixTable, filter_name: str
-) -> hl.ArrayExpression:
+def generate_filter_histograms(
+    input_mt: hl.MatrixTable, filter_names: list
+) -> hl.expr.StructExpression:
     """
-    Generate histogram for number of indiviudals with the specified sample-level filter at different heteroplasmy levels.
+    Generate histograms of the number of individuals with each of several sample-level filters at different heteroplasmy levels, along with excluded_AC, in a single aggregation.
+
+    The string representation of FT is computed once per entry and converted to an array of flags (one per filter name),
+    which is aggregated element-wise so that every filter histogram is computed in the same pass over the entries.
 
     :param input_mt: MatrixTable
-    :param filter_name: Name of sample-filter for which to generate a histogram
-    :return: Histogram containing the counts of individuals with a variant filtered by the specified filter name across binned heteroplasmy levels
+    :param filter_names: Names of sample-filters for which to generate histograms
+    :return: Struct of aggregation expressions containing an array of histogram bin counts (in the order of filter_names) and excluded_AC
     """
-    filter_histogram = hl.agg.filter(
-        hl.str(input_mt.FT).contains(filter_name), hl.agg.hist(input_mt.HL, 0, 1, 10)
-    ).bin_freq
+    import hail as hl
+
+    filter_flags = hl.rbind(
+        hl.str(input_mt.FT), lambda ft: hl.array([ft.contains(x) for x in filter_names])
+    )
+    filter_histograms = hl.agg.array_agg(
+        lambda has_filter: hl.agg.filter(
+            has_filter, hl.agg.hist(input_mt.HL, *HL_HIST_PARAMS)
+        ).bin_freq,
+        filter_flags,
+    )
 
-    return filter_histogram
+    return hl.struct(
+        filter_histograms=filter_histograms,
+        excluded_AC=hl.agg.count_where(input_mt.FT != {"PASS"}),
+    )
 
 
 def format_filters(mt, row_f = ['filters'], entry_f = ['FT','FT_LIFT']):
@@ -1028,6 +1380,8 @@ def format_filters(mt, row_f = ['filters'], entry_f = ['FT','FT_LIFT']):
     If a field is length 0, then it is processed here and does not become missing.
     This function prevents any filters of length 0.
     """
+    import hail as hl
+
     mt = mt.annotate_rows(**{x: mt[x].difference({'PASS'}) for x in row_f})
     mt = mt.annotate_rows(**{x: hl.if_else(hl.len(mt[x]) == 0, {'PASS'}, mt[x]) for x in row_f})
     
@@ -1049,6 +1403,8 @@ def add_filter_annotations(
     :param min_het_threshold: Minimum heteroplasmy level to define a variant as a PASS heteroplasmic variant, genotypes below this threshold will count towards the heteroplasmy_below_min_het_threshold filter and be set to missing
     :return: MatrixTable with added annotations for sample and variant level filters and number of genotypes with heteroplasmy_below_min_het_threshold
     """
+    import hail as hl
+
     # TODO: pull these from header instead?
     filters = [
         "base_qual",
@@ -1083,14 +1439,17 @@ def add_filter_annotations(
     input_mt = apply_npg_filter(input_mt)
 
     logger.info("Generating filter histograms and calculating excluded_AC...")
-    for i in filters:
-        annotation_name = i + "_hist"
-        input_mt = input_mt.annotate_rows(
-            **{annotation_name: generate_filter_histogram(input_mt, i)}
-        )
     input_mt = input_mt.annotate_rows(
-        excluded_AC=hl.agg.count_where(input_mt.FT != {"PASS"})
+        filter_agg=generate_filter_histograms(input_mt, filters)
     )
+    input_mt = input_mt.annotate_rows(
+        **{
+            i + "_hist": input_mt.filter_agg.filter_histograms[idx]
+            for idx, i in enumerate(filters)
+        },
+        excluded_AC=input_mt.filter_agg.excluded_AC,
+    )
+    input_mt = input_mt.drop("filter_agg")
 
     return format_filters(input_mt), n_het_below_min_het_threshold
 
@@ -1102,6 +1461,8 @@ def filter_genotypes(input_mt: hl.MatrixTable, pass_set: set = {}) -> hl.MatrixT
     :param input_mt: MatrixTable
     :return: MatrixTable with filtered genotype fields set to missing
     """
+    import hail as hl
+
     if len(pass_set) > 0:
         pass_expr = (input_mt.FT == {"PASS"}) | input_mt.FT.is_subset(hl.literal(pass_set))
     else:
@@ -1136,6 +1497,8 @@ def add_sample_annotations(
     :param min_hom_threshold: Minimum heteroplasmy level to define a variant as homoplasmic
     :return: MatrixTable with sample annotations added
     """
+    import hail as hl
+
     # Count number of variants
     num_rows = input_mt.count_rows()
 
@@ -1202,6 +1565,8 @@ def add_vep(input_mt: hl.MatrixTable, run_vep: bool, vep_output: str) -> hl.Matr
     :param vep_output: Path to the MatrixTable output vep results (either the existing results or where to ouput new vep results)
     :return: MatrixTable with vep annotations
     """
+    import hail as hl
+
     if run_vep:
         vep_mt = hl.vep(input_mt)
         vep_mt = vep_mt.checkpoint(vep_output, overwrite=True)
@@ -1260,6 +1625,8 @@ def add_rsids(input_mt: hl.MatrixTable, band_aid_fix: bool) -> hl.MatrixTable:
     :param input_mt: MatrixTable
     :return: MatrixTable with rsid annotations added
     """
+    from gnomad.resources.grch38.reference_data import dbsnp, _import_dbsnp
+
     dbsnp_import_args = dbsnp.versions["b154"].import_args
     # Replace the contig recoding with just the chrM mapping
     dbsnp_import_args.update({"contig_recoding": {"NC_012920.1": "chrM"}})
@@ -1286,6 +1653,8 @@ def export_simplified_variants(input_ht: hl.Table, output_dir: str) -> None:
     :param output_dir: Output directory to which results should be output
     :return: None
     """
+    import hail as hl
+
     reduced_ht = (
         input_ht.key_by(
             chromosome=input_ht.locus.contig,
@@ -1353,6 +1722,8 @@ def report_stats(
     :param min_hom_threshold: Minimum heteroplasmy level to define a variant as homoplasmic
     :return: None
     """
+    import hail as hl
+
     if pass_only:
         suffix = "_pass"
         input_mt = input_mt.filter_rows(hl.len(input_mt.filters) == 0)
@@ -1509,6 +1880,8 @@ def change_to_grch38_chrm(input_mt: hl.MatrixTable) -> None:
     :param input_mt: MatrixTable
     :return: MatrixTable with GRCh38 reference genome subsetted to just chrM (so that extraneous contigs will be excluded from VCF output)
     """
+    import hail as hl
+
     ref = hl.get_reference("GRCh38")
     my_ref = hl.ReferenceGenome(
         "GRCh38_chrM", contigs=["chrM"], lengths={"chrM": ref.lengths["chrM"]}
@@ -1540,16 +1913,32 @@ def format_vcf(
     :param output_dir: Output directory to which appended header info should be written
     :return: MatrixTable with VCF annotations in the info field and dictionary of filter, info, and format fields to be output in the VCF header; path of VCF headers to append
     """
+    import hail as hl
+
     input_mt = change_to_grch38_chrm(input_mt)
 
-    haplogroup_order = hl.eval(input_mt.hap_order)
-    population_order = hl.eval(input_mt.pop_order)
+    # Header metadata is read from the globals in one evaluation (no rows are scanned)
+    header_globals = hl.eval(
+        input_mt.globals.select(
+            "hap_order",
+            "pop_order",
+            "hist_bin_edges",
+            "dbsnp_version",
+            "age_hist_all_samples_bin_edges",
+            "age_hist_all_samples_bin_freq",
+            "age_hist_all_samples_n_smaller",
+            "age_hist_all_samples_n_larger",
+            **({} if skip_vep else {"vep_version": input_mt.vep_version}),
+        )
+    )
+    haplogroup_order = header_globals.hap_order
+    population_order = header_globals.pop_order
 
-    age_hist_hom_bin_edges = input_mt.age_hist_hom.bin_edges.take(1)[0]
-    age_hist_het_bin_edges = input_mt.age_hist_het.bin_edges.take(1)[0]
-    hl_hist_bin_edges = input_mt.hl_hist.bin_edges.take(1)[0]
-    dp_hist_all_bin_edges = input_mt.dp_hist_all.bin_edges.take(1)[0]
-    dp_hist_alt_bin_edges = input_mt.dp_hist_alt.bin_edges.take(1)[0]
+    age_hist_hom_bin_edges = header_globals.hist_bin_edges.age_hist_hom
+    age_hist_het_bin_edges = header_globals.hist_bin_edges.age_hist_het
+    hl_hist_bin_edges = header_globals.hist_bin_edges.hl_hist
+    dp_hist_all_bin_edges = header_globals.hist_bin_edges.dp_hist_all
+    dp_hist_alt_bin_edges = header_globals.hist_bin_edges.dp_hist_alt
 
     input_mt = input_mt.annotate_rows(
         hl_hist=input_mt.hl_hist.bin_freq,
@@ -1566,28 +1955,30 @@ def format_vcf(
     )
 
     if not skip_vep:
+        from gnomad.utils.vep import vep_struct_to_csq
+
         input_mt = input_mt.annotate_rows(vep=vep_struct_to_csq(input_mt.vep))
 
-    # Get length of annotations to use in Number fields in the VCF where necessary
-    len_hap_hl_hist = len(input_mt.hap_hl_hist.take(1)[0])
-    len_pop_hl_hist = len(input_mt.pop_hl_hist.take(1)[0])
+    # Get length of annotations to use in Number fields in the VCF where necessary (one histogram per haplogroup or population)
+    len_hap_hl_hist = len(haplogroup_order)
+    len_pop_hl_hist = len(population_order)
 
     # Output appended header info to file
     vcf_header_file = output_dir + "/extra_fields_for_header.tsv"
     if not skip_vep:
         appended_vcf_header = dedent(
             f"""
-        ##VEP version={hl.eval(input_mt.vep_version)}
-        ##dbSNP version={hl.eval(input_mt.dbsnp_version)}
-        ##age distributions=bin_edges:{hl.eval(input_mt.age_hist_all_samples_bin_edges)}, bin_freq:{hl.eval(input_mt.age_hist_all_samples_bin_freq)}, n_smaller:{hl.eval(input_mt.age_hist_all_samples_n_smaller)}, n_larger:{hl.eval(input_mt.age_hist_all_samples_n_larger)}
+        ##VEP version={header_globals.vep_version}
+        ##dbSNP version={header_globals.dbsnp_version}
+        ##age distributions=bin_edges:{header_globals.age_hist_all_samples_bin_edges}, bin_freq:{header_globals.age_hist_all_samples_bin_freq}, n_smaller:{header_globals.age_hist_all_samples_n_smaller}, n_larger:{header_globals.age_hist_all_samples_n_larger}
 
         """
         )
     else:
         appended_vcf_header = dedent(
             f"""
-        ##dbSNP version={hl.eval(input_mt.dbsnp_version)}
-        ##age distributions=bin_edges:{hl.eval(input_mt.age_hist_all_samples_bin_edges)}, bin_freq:{hl.eval(input_mt.age_hist_all_samples_bin_freq)}, n_smaller:{hl.eval(input_mt.age_hist_all_samples_n_smaller)}, n_larger:{hl.eval(input_mt.age_hist_all_samples_n_larger)}
+        ##dbSNP version={header_globals.dbsnp_version}
+        ##age distributions=bin_edges:{header_globals.age_hist_all_samples_bin_edges}, bin_freq:{header_globals.age_hist_all_samples_bin_freq}, n_smaller:{header_globals.age_hist_all_samples_n_smaller}, n_larger:{header_globals.age_hist_all_samples_n_larger}
 
         """
         )
@@ -1952,6 +2343,8 @@ def format_vcf(
 
 
 def modify_ft_liftover(mt):
+    import hail as hl
+
     these_f = hl.literal(CUSTOMLIFTOVERFILTERS.union(LIFTOVERFILTERS))
     mt = mt.annotate_entries(FT_LIFT = mt.FT.intersection(these_f))
     mt = mt.annotate_entries(FT = mt.FT.difference(these_f))    
@@ -1961,10 +2354,12 @@ def modify_ft_liftover(mt):
 
 
 def make_comma_delim(expr):
+    import hail as hl
+
     return hl.literal(',').join(hl.map(hl.str, expr))
 
 
-def process_mt_for_flat_file_analysis(mt, skip_vep, allow_gt_fail):
+def process_mt_for_flat_file_analysis(mt, skip_vep, allow_gt_fail, sort_by_position=False):
     """ 
     Function to format the MT into high-yield fields used for downstream analysis.
     
@@ -1972,7 +2367,12 @@ def process_mt_for_flat_file_analysis(mt, skip_vep, allow_gt_fail):
     with HL = 0. The sites with missing HL are uncertain - these sites have either low coverage 
     or have a variant that was filtered. This way the set of true zeros can be obtained
     efficiently as the set of samples not present in this dataset.
+
+    If sort_by_position is set, chrom and integer position columns lead the key (for the tabix-indexed export),
+    otherwise the Table is keyed by the string locus, alleles, and s.
     """
+    import hail as hl
+
     base_row_set = ['rsid', 'common_low_heteroplasmy', 'filters', 
                     'hap_defining_variant', 'pon_mt_trna_prediction',
                     'pon_ml_probability_of_pathogenicity','mitotip_score',
@@ -2034,12 +2434,43 @@ def process_mt_for_flat_file_analysis(mt, skip_vep, allow_gt_fail):
         raise ValueError('All samples where "GT_PASS" is not found should be missing a heteroplasmy call.')
 
     ht = ht.annotate(**{x: make_comma_delim(ht[x]) for x in ['FT','FT_LIFT','OriginalSelfRefAlleles','alleles','rsid']})
+    if sort_by_position:
+        # chrom and integer position lead the key so that the export is sorted by genomic position (a string locus sorts chrM:10 before chrM:2)
+        # and can be tabix indexed on the first two columns
+        ht = ht.annotate(chrom = ht.locus.contig.replace('MT','chrM'), position = ht.locus.position)
+        ht = ht.annotate(locus = ht.chrom + ':' + hl.str(ht.position))
+        ht = ht.annotate(variant = ht.locus + ':' + ht.alleles)
+        return ht.key_by('chrom', 'position', 'alleles', 's')
     ht = ht.annotate(locus = ht.locus.contig.replace('MT','chrM') + ':' + hl.str(ht.locus.position))
-    ht = ht.annotate(variant = ht.locus + ':' + ht.alleles).key_by('locus','alleles','s')
+    ht = ht.annotate(variant = ht.locus + ':' + ht.alleles)
     return ht.key_by('locus', 'alleles', 's')
 
 
+def export_sharded_vcf_to_output_dir(
+    mt: hl.MatrixTable, path: str, output_dir: str, n_threads: int, **kwargs
+) -> None:
+    """
+    Export a VCF with export_sharded_vcf, writing its shards to the output directory.
+
+    :param mt: MatrixTable to export
+    :param path: Path of the bgzipped VCF to write
+    :param output_dir: Output directory to which the shards are written (as <VCF name>_shards)
+    :param n_threads: Number of shards to read concurrently when concatenating
+    :param kwargs: Other arguments of export_sharded_vcf (as for hl.export_vcf)
+    :return: None
+    """
+    export_sharded_vcf(
+        mt,
+        path,
+        n_threads=n_threads,
+        shard_dir=f"{output_dir}/{path.split('/')[-1]}_shards",
+        **kwargs,
+    )
+
+
 def main(args):  # noqa: D103
+    import hail as hl
+
     mt_path = args.mt_path
     output_dir = args.output_dir
     participant_data = args.participant_data
@@ -2051,6 +2482,12 @@ def main(args):  # noqa: D103
     keep_all_samples = args.keep_all_samples
     run_vep = args.run_vep
     max_cn = args.max_cn
+    init_hail()
+    report = RunReport(
+        "add_annotations",
+        diagnostics=args.diagnose_query_plans,
+        ir_node_threshold=args.ir_node_threshold,
+    )
 
     logger.info("Cutoff for homoplasmic variants is set to %.2f...", min_hom_threshold)
 
@@ -2070,6 +2507,9 @@ def main(args):  # noqa: D103
     sites_vcf_path = generate_output_paths(
         output_dir, "combined_sites_only", subset_name, "vcf.bgz"
     )
+    sites_globals_path = generate_output_paths(
+        output_dir, "combined_sites_only", subset_name, "globals.json"
+    )
     samples_txt_path = generate_output_paths(
         output_dir, "sample_annotations", subset_name, "txt"
     )
@@ -2102,197 +2542,284 @@ def main(args):  # noqa: D103
             logger.info("INTERMEDIATE MT NOT FOUND.")
 
     if run_full:
-        logger.info("Adding genotype annotation...")
-        # NOTE: on import, there are no instances of hl.len(FT) == 0. Missing FT implies no HL measured with confidence.
-        mt = add_genotype(mt_path, min_hom_threshold)
+        with report.stage("add_sample_and_variant_annotations"):
+            logger.info("Adding genotype annotation...")
+            # NOTE: on import, there are no instances of hl.len(FT) == 0. Missing FT implies no HL measured with confidence.
+            mt = add_genotype(mt_path, min_hom_threshold)
 
-        logger.info("Moving Liftover FT fields to a new entry...")
-        mt = modify_ft_liftover(mt)
+            logger.info("Moving Liftover FT fields to a new entry...")
+            mt = modify_ft_liftover(mt)
 
-        logger.info("Adding annotations from Terra...")
-        mt = add_terra_metadata(mt, participant_data)
+            logger.info("Adding annotations from Terra...")
+            mt = add_terra_metadata(mt, participant_data)
 
-        logger.info("Annotating haplogroup-defining variants...")
-        mt = add_hap_defining(mt)
+            logger.info("Annotating haplogroup-defining variants...")
+            mt = add_hap_defining(mt)
 
-        logger.info("Annotating tRNA predictions...")
-        mt = add_trna_predictions(mt)
+            logger.info("Annotating tRNA predictions...")
+            mt = add_trna_predictions(mt)
 
-        # If 'subset-to-gnomad-release' is set, 'age' and 'pop' are added by the add_gnomad_metadata function.
-        # If 'subset-to-gnomad-release' is not set, the user should include an 'age' and 'pop' column in the file supplied to `participant-data`.
-        if gnomad_subset:
-            logger.info("Adding gnomAD metadata sample annotations...")
-            mt = add_gnomad_metadata(mt)
-        else:
-            logger.info("Checking for and adding age and pop annotations...")
-            mt = add_age_and_pop(mt, participant_data)
+            # If 'subset-to-gnomad-release' is set, 'age' and 'pop' are added by the add_gnomad_metadata function.
+            # If 'subset-to-gnomad-release' is not set, the user should include an 'age' and 'pop' column in the file supplied to `participant-data`.
+            if gnomad_subset:
+                logger.info("Adding gnomAD metadata sample annotations...")
+                mt = add_gnomad_metadata(mt)
+            else:
+                logger.info("Checking for and adding age and pop annotations...")
+                mt = add_age_and_pop(mt, participant_data)
 
-        logger.info("Adding variant context annotations...")
-        mt = add_variant_context(mt)
+            logger.info("Adding variant context annotations...")
+            mt = add_variant_context(mt)
 
-        # If specified, subet to only the gnomAD samples in the current release
-        if gnomad_subset:
-            logger.warning("Subsetting results to gnomAD release samples...")
+            # If specified, subet to only the gnomAD samples in the current release
+            if gnomad_subset:
+                logger.warning("Subsetting results to gnomAD release samples...")
 
-            # Subset to release samples and filter out rows that no longer have at least one alt call
-            mt = mt.filter_cols(mt.release)  # Filter to cols where release is true
-            mt = mt.filter_rows(hl.agg.any(mt.HL > 0))
+                # Subset to release samples and filter out rows that no longer have at least one alt call
+                mt = mt.filter_cols(mt.release)  # Filter to cols where release is true
+                mt = mt.filter_rows(hl.agg.any(mt.HL > 0))
 
-        logger.info('Removing samples which show overlapping homoplasmies in self-reference construction...')
-        mt, n_removed_overlap = filter_by_hom_overlap(
-            mt, keep_all_samples, args.sample_stats
-        )
+        with report.stage("filter_by_hom_overlap"):
+            logger.info('Removing samples which show overlapping homoplasmies in self-reference construction...')
+            mt, n_removed_overlap = filter_by_hom_overlap(
+                mt, keep_all_samples, args.sample_stats
+            )
 
-        logger.info("Checking for samples with low/high mitochondrial copy number...")
-        mt, n_removed_below_cn, n_removed_above_cn = filter_by_copy_number(
-            mt, keep_all_samples, max_cn
-        )
+        with report.stage("filter_by_copy_number"):
+            logger.info("Checking for samples with low/high mitochondrial copy number...")
+            mt, n_removed_below_cn, n_removed_above_cn = filter_by_copy_number(
+                mt, keep_all_samples, max_cn
+            )
 
-        logger.info("Checking for contaminated samples...")
-        mt, n_contaminated = filter_by_contamination(mt, output_dir, keep_all_samples)
+        with report.stage("filter_by_contamination"):
+            logger.info("Checking for contaminated samples...")
+            mt, n_contaminated = filter_by_contamination(mt, output_dir, keep_all_samples)
 
-        logger.info("Switch build and checkpoint...")
-        # Switch build 37 to build 38
-        mt = mt.key_rows_by(
-            locus=hl.locus("chrM", mt.locus.position, reference_genome="GRCh38"),
-            alleles=mt.alleles,
-        )
-        # NOTE: at this stage there should still be no instances of hl.len(FT) == 0. Missing FT implies HL not called.
-        # NOTE: all missing HL entries have missing FT. These are entries with low DP so cannot be called hom ref.
-        mt = mt.checkpoint(f"{output_dir}/prior_to_vep.mt", overwrite=args.overwrite)
+        with report.stage("checkpoint_prior_to_vep"):
+            logger.info("Switch build and checkpoint...")
+            # Switch build 37 to build 38
+            mt = mt.key_rows_by(
+                locus=hl.locus("chrM", mt.locus.position, reference_genome="GRCh38"),
+                alleles=mt.alleles,
+            )
+            # NOTE: at this stage there should still be no instances of hl.len(FT) == 0. Missing FT implies HL not called.
+            # NOTE: all missing HL entries have missing FT. These are entries with low DP so cannot be called hom ref.
+            mt = report.checkpoint(mt, f"{output_dir}/prior_to_vep.mt", overwrite=args.overwrite)
 
         if not args.fully_skip_vep:
-            logger.info("Adding vep annotations...")
-            mt = add_vep(mt, run_vep, vep_results)
-
-        logger.info("Adding dbsnp annotations...")
-        mt = add_rsids(mt, args.band_aid_dbsnp_path_fix)
-
-        logger.info("Annotating MT...")
-        mt, n_het_below_min_het_threshold = add_filter_annotations(
-            mt, vaf_filter_threshold, min_het_threshold
-        )
-        mt = mt.checkpoint(
-            f"{output_dir}/prior_to_filter_genotypes.mt", overwrite=args.overwrite
-        )
+            with report.stage("add_vep"):
+                logger.info("Adding vep annotations...")
+                mt = add_vep(mt, run_vep, vep_results)
+
+        with report.stage("add_rsids"):
+            logger.info("Adding dbsnp annotations...")
+            mt = add_rsids(mt, args.band_aid_dbsnp_path_fix)
+
+        with report.stage("add_filter_annotations"):
+            logger.info("Annotating MT...")
+            mt, n_het_below_min_het_threshold = add_filter_annotations(
+                mt, vaf_filter_threshold, min_het_threshold
+            )
+            mt = report.checkpoint(
+                mt, f"{output_dir}/prior_to_filter_genotypes.mt", overwrite=args.overwrite
+            )
 
-        # Some checks
-        # NOTE: at this stage there should still be no instances of hl.len(FT) == 0. Missing FT implies HL not called.
-        if mt.aggregate_entries(hl.agg.count_where(hl.len(mt.FT) == 0)) > 0:
-            raise ValueError('Before filtering genotypes, there should be no entries with FT of length 0.')
-        # NOTE: anything with HL == 0 should have no genotype filters
-        mtf = mt.filter_entries(mt.HL == 0)
-        if mtf.aggregate_entries(hl.agg.count_where(mtf.FT != {'PASS'})) > 0:
-            raise ValueError('No entries with HL = 0 should have failed a genotype filter.')
-        # NOTE: all missing HL entries have missing FT. These are entries with low DP so cannot be called hom ref.
-        mtf = mt.filter_entries(hl.is_missing(mt.FT))
-        if mtf.aggregate_entries(hl.agg.count_where(hl.is_defined(mtf.HL))) > 0:
-            raise ValueError('No entries with missing FT should have defined HL.')
-        mtf = mt.filter_entries(hl.is_missing(mt.HL))
-        if mtf.aggregate_entries(hl.agg.count_where(hl.is_defined(mtf.FT))) > 0:
-            raise ValueError('No entries with missing HL should have defined FT.')
-        # NOTE: at this stage, there should be no missing filters and no filters of length 0
-        if mt.filter_rows(hl.is_missing(mt.filters)).count_rows() > 0:
-            raise ValueError('There should be no rows with missing variant-level filters.')
-        if mt.filter_rows(hl.len(mt.filters) == 0).count_rows() > 0:
-            raise ValueError('There should be no rows with variant-level filters of length 0.')
-
-
-        # After this, passing GTs have "GT_PASS" rather than PASS in FT. Failing GTs have a reason for failure.
-        # FT_LIFT also no longer has "PASS" and can have length 0.
-        pass_set_filter_genotypes = {'strand_bias'} if args.allow_strand_bias else {}
-        mt = filter_genotypes(mt, pass_set=pass_set_filter_genotypes)
-        # Add variant annotations such as AC, AF, and AN
-        mt = mt.annotate_rows(**dict(generate_expressions(mt, min_hom_threshold)))
-        # Checkpoint to help avoid Hail errors from large queries
-        mt = mt.checkpoint(f"{output_dir}/temp.mt", overwrite=args.overwrite)
+        with report.stage("check_genotype_filters"):
+            # Some checks
+            # NOTE: at this stage there should still be no instances of hl.len(FT) == 0. Missing FT implies HL not called.
+            if mt.aggregate_entries(hl.agg.count_where(hl.len(mt.FT) == 0)) > 0:
+                raise ValueError('Before filtering genotypes, there should be no entries with FT of length 0.')
+            # NOTE: anything with HL == 0 should have no genotype filters
+            mtf = mt.filter_entries(mt.HL == 0)
+            if mtf.aggregate_entries(hl.agg.count_where(mtf.FT != {'PASS'})) > 0:
+                raise ValueError('No entries with HL = 0 should have failed a genotype filter.')
+            # NOTE: all missing HL entries have missing FT. These are entries with low DP so cannot be called hom ref.
+            mtf = mt.filter_entries(hl.is_missing(mt.FT))
+            if mtf.aggregate_entries(hl.agg.count_where(hl.is_defined(mtf.HL))) > 0:
+                raise ValueError('No entries with missing FT should have defined HL.')
+            mtf = mt.filter_entries(hl.is_missing(mt.HL))
+            if mtf.aggregate_entries(hl.agg.count_where(hl.is_defined(mtf.FT))) > 0:
+                raise ValueError('No entries with missing HL should have defined FT.')
+            # NOTE: at this stage, there should be no missing filters and no filters of length 0
+            if mt.filter_rows(hl.is_missing(mt.filters)).count_rows() > 0:
+                raise ValueError('There should be no rows with missing variant-level filters.')
+            if mt.filter_rows(hl.len(mt.filters) == 0).count_rows() > 0:
+                raise ValueError('There should be no rows with variant-level filters of length 0.')
+
+
+        with report.stage("generate_expressions"):
+            # After this, passing GTs have "GT_PASS" rather than PASS in FT. Failing GTs have a reason for failure.
+            # FT_LIFT also no longer has "PASS" and can have length 0.
+            pass_set_filter_genotypes = {'strand_bias'} if args.allow_strand_bias else {}
+            mt = filter_genotypes(mt, pass_set=pass_set_filter_genotypes)
+            # Add variant annotations such as AC, AF, and AN
+            mt = mt.annotate_rows(**dict(generate_expressions(mt, min_hom_threshold)))
+            if args.aggregate_state_dir:
+                # Computed in the same pass as generate_expressions so that batches can later be merged without the genotypes
+                mt = mt.annotate_rows(
+                    aggregate_state=generate_aggregate_state_expr(mt, min_hom_threshold)
+                )
+            # Checkpoint to help avoid Hail errors from large queries
+            mt = report.checkpoint(mt, f"{output_dir}/temp.mt", overwrite=args.overwrite)
+        if args.aggregate_state_dir:
+            with report.stage("write_aggregate_state"):
+                logger.info("Writing mergeable aggregate state...")
+                write_aggregate_state(
+                    mt,
+                    args.aggregate_state_dir,
+                    args.coverage_mt_path,
+                    min_hom_threshold,
+                    args.minimum_homref_coverage,
+                    args.overwrite,
+                )
+                mt = mt.drop("aggregate_state")
         
-        mt = add_quality_histograms(mt)
-        mt = mt.checkpoint(f"{output_dir}/temp2.mt", overwrite=args.overwrite)
+        with report.stage("add_quality_histograms"):
+            mt = add_quality_histograms(mt)
+            mt = report.checkpoint(mt, f"{output_dir}/temp2.mt", overwrite=args.overwrite)
         
-        # After this, filters no longer contain "PASS"
-        # FT and FT_LIFT do not contain PASS as of filter_genotypes
-        # FT instead contains "GT_PASS"; FT_LIFT can be empty
-        mt = add_annotations_by_hap_and_pop(mt, output_dir=output_dir, overwrite=args.overwrite)
+        with report.stage("add_annotations_by_hap_and_pop"):
+            # After this, filters no longer contain "PASS"
+            # FT and FT_LIFT do not contain PASS as of filter_genotypes
+            # FT instead contains "GT_PASS"; FT_LIFT can be empty
+            mt = add_annotations_by_hap_and_pop(mt, output_dir=output_dir, overwrite=args.overwrite)
         
-        mt = add_descriptions(
-            mt, min_hom_threshold, vaf_filter_threshold, min_het_threshold
-        )
+            mt = add_descriptions(
+                mt, min_hom_threshold, vaf_filter_threshold, min_het_threshold
+            )
 
-        mt = mt.checkpoint(
-            annotated_mt_path, overwrite=args.overwrite
-        )  # Full matrix table for internal use
-
-        logger.info("Generating summary statistics reports...")
-        report_stats(
-            mt,
-            output_dir,
-            False,
-            n_removed_below_cn,
-            n_removed_above_cn,
-            n_contaminated,
-            n_het_below_min_het_threshold,
-            n_removed_overlap,
-            max_cn=max_cn
-        )
-        report_stats(
-            mt,
-            output_dir,
-            True,
-            n_removed_below_cn,
-            n_removed_above_cn,
-            n_contaminated,
-            n_het_below_min_het_threshold,
-            n_removed_overlap,
-            max_cn=max_cn
+            mt = report.checkpoint(
+                mt, annotated_mt_path, overwrite=args.overwrite
+            )  # Full matrix table for internal use
+
+        with report.stage("report_stats"):
+            logger.info("Generating summary statistics reports...")
+            report_stats(
+                mt,
+                output_dir,
+                False,
+                n_removed_below_cn,
+                n_removed_above_cn,
+                n_contaminated,
+                n_het_below_min_het_threshold,
+                n_removed_overlap,
+                max_cn=max_cn
+            )
+            report_stats(
+                mt,
+                output_dir,
+                True,
+                n_removed_below_cn,
+                n_removed_above_cn,
+                n_contaminated,
+                n_het_below_min_het_threshold,
+                n_removed_overlap,
+                max_cn=max_cn
+            )
+
+    with report.stage("export_flat_file"):
+        logger.info('Writing variants flat file for internal use...')
+        ht_for_output = process_mt_for_flat_file_analysis(
+            mt, args.fully_skip_vep, args.allow_strand_bias, sort_by_position=args.indexed_flat_file
         )
+        if args.indexed_flat_file:
+            # Shards are concatenated into one BGZF file and tabix indexed so positions can be queried with query_flat_file
+            export_indexed_flat_file(
+                ht_for_output,
+                annotated_mt_path.replace('.mt','_processed_flat.tsv.bgz'),
+                n_threads=args.vcf_export_threads,
+                shard_dir=f"{output_dir}/processed_flat_shards",
+            )
+        else:
+            ht_for_output.export(annotated_mt_path.replace('.mt','_processed_flat.tsv.bgz'))
+        if args.flat_file_parquet:
+            logger.info('Writing variants flat file as Parquet partitioned by position...')
+            export_flat_file_parquet(
+                ht_for_output,
+                annotated_mt_path.replace('.mt','_processed_flat.parquet'),
+                args.parquet_position_bin_size,
+                args.overwrite,
+            )
 
-    logger.info('Writing variants flat file for internal use...')
-    ht_for_output = process_mt_for_flat_file_analysis(mt, args.fully_skip_vep, args.allow_strand_bias)
-    ht_for_output.export(annotated_mt_path.replace('.mt','_processed_flat.tsv.bgz'))
-
-    logger.info("Writing ht...")
-    variant_ht = mt.rows()
-    variant_ht = variant_ht.drop("region", "variant_context")
-    variant_ht = adjust_descriptions(variant_ht)
-    variant_ht.export(sites_txt_path)  # Sites-only txt file for external use
-    variant_ht.write(
-        sites_ht_path, overwrite=args.overwrite
-    )  # Sites-only ht for external use
-
-    logger.info("Writing sample annotations...")
-    mt = add_sample_annotations(mt, min_hom_threshold)
-    sample_ht = mt.cols()
-    sample_ht.group_by(sample_ht.hap).aggregate(n=hl.agg.count()).export(
-        f"{output_dir}/haplogroup_counts.txt"
-    )  # Counts of top level haplogroups
-    sample_ht.export(samples_txt_path)  # Sample annotations txt file for internal use
-
-    logger.info("Formatting and writing VCF...")
-    rows_ht = mt.rows()
-    export_simplified_variants(rows_ht, output_dir)
-    vcf_mt, vcf_meta, vcf_header_file = format_vcf(mt, output_dir, min_hom_threshold, skip_vep=args.fully_skip_vep)
-    hl.export_vcf(
-        vcf_mt,
-        samples_vcf_path,
-        metadata=vcf_meta,
-        append_to_header=vcf_header_file,
-        tabix=True,
-    )  # Full VCF for internal use
-    vcf_variant_ht = vcf_mt.rows()
-    rows_mt = hl.MatrixTable.from_rows_table(vcf_variant_ht).key_cols_by(s="foo")
-    hl.export_vcf(
-        rows_mt,
-        sites_vcf_path,
-        metadata=vcf_meta,
-        append_to_header=vcf_header_file,
-        tabix=True,
-    )  # Sites-only VCF for external use
+    with report.stage("export_sites"):
+        logger.info("Writing ht...")
+        variant_ht = mt.rows()
+        variant_ht = variant_ht.drop("region", "variant_context")
+        variant_ht = adjust_descriptions(variant_ht)
+        variant_ht.export(sites_txt_path)  # Sites-only txt file for external use
+        variant_ht.write(
+            sites_ht_path, overwrite=args.overwrite
+        )  # Sites-only ht for external use
+        with hl.hadoop_open(sites_globals_path, "w") as out:
+            # Haplogroup and population orders of the hap_ and pop_ arrays, which are not included in the sites-only txt file
+            out.write(json.dumps(dict(hl.eval(variant_ht.globals.select("hap_order", "pop_order")))))
+
+    with report.stage("export_sample_annotations"):
+        logger.info("Writing sample annotations...")
+        mt = add_sample_annotations(mt, min_hom_threshold)
+        sample_ht = mt.cols()
+        sample_ht.group_by(sample_ht.hap).aggregate(n=hl.agg.count()).export(
+            f"{output_dir}/haplogroup_counts.txt"
+        )  # Counts of top level haplogroups
+        sample_ht.export(samples_txt_path)  # Sample annotations txt file for internal use
+
+    with report.stage("export_vcfs"):
+        logger.info("Formatting and writing VCF...")
+        rows_ht = mt.rows()
+        export_simplified_variants(rows_ht, output_dir)
+        vcf_mt, vcf_meta, vcf_header_file = format_vcf(mt, output_dir, min_hom_threshold, skip_vep=args.fully_skip_vep)
+        if args.sharded_vcf_export:
+            # Shards are written in parallel, then streamed into the output and tabix indexed as they are written
+            export_vcf = functools.partial(
+                export_sharded_vcf_to_output_dir,
+                output_dir=output_dir,
+                n_threads=args.vcf_export_threads,
+            )
+        else:
+            export_vcf = hl.export_vcf
+        export_vcf(
+            vcf_mt,
+            samples_vcf_path,
+            metadata=vcf_meta,
+            append_to_header=vcf_header_file,
+            tabix=True,
+        )  # Full VCF for internal use
+        vcf_variant_ht = vcf_mt.rows()
+        if args.direct_sites_vcf:
+            # VCF lines are written from the rows in parallel, without a placeholder column for hl.export_vcf
+            export_sites_vcf(
+                vcf_variant_ht,
+                sites_vcf_path,
+                metadata=vcf_meta,
+                append_to_header=vcf_header_file,
+                tabix=True,
+                n_threads=args.vcf_export_threads,
+                shard_dir=f"{output_dir}/{sites_vcf_path.split('/')[-1]}_shards",
+            )
+        else:
+            rows_mt = hl.MatrixTable.from_rows_table(vcf_variant_ht).key_cols_by(s="foo")
+            export_vcf(
+                rows_mt,
+                sites_vcf_path,
+                metadata=vcf_meta,
+                append_to_header=vcf_header_file,
+                tabix=True,
+            )  # Sites-only VCF for external use
 
+    report.write(f"{output_dir}/run_report.json")
+    logger.info("Time spent in each stage:\n%s", report.summary())
     logger.info("All annotation steps are completed")
 
 
-if __name__ == "__main__":
+def parse_arguments(argv: Optional[list] = None, check_inputs: bool = True) -> argparse.Namespace:
+    """
+    Parse and validate the arguments of this script.
+
+    :param argv: Command line arguments, defaults to those of the running process
+    :param check_inputs: Whether to check that local input paths exist. run_pipeline_dag.py checks the inputs of its
+        stages itself, since some of them are only written by earlier stages
+    :return: Parsed arguments
+    """
     parser = argparse.ArgumentParser(
         description="This script adds variant annotations to the mitochondria VCF/MT"
     )
@@ -2372,10 +2899,84 @@ if __name__ == "__main__":
         '--allow-strand-bias', action='store_true', help='In some cases, one may want to allow strand bias calls to persist in the final callset.'
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--aggregate-state-dir",
+        help="Optional directory to which the mergeable aggregate state of this batch should be written (see merge_aggregate_states.py)",
+    )
+    parser.add_argument(
+        "--coverage-mt-path",
+        help="Coverage table of sample level coverage at each position (written by annotate_coverage.py as <output>_coverage_table.mt; locus-keyed coverage MatrixTables are also accepted), required with --aggregate-state-dir",
+    )
+    parser.add_argument(
+        "--minimum-homref-coverage",
+        help="Minimum depth of coverage required to call a genotype homoplasmic reference rather than missing (should match the value used in combine_vcfs.py)",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--indexed-flat-file",
+        help="Write the variants flat file as a single BGZF file with a tabix index (on the chrom and position columns) for random access",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--flat-file-parquet",
+        help="Also export the variants flat file as Parquet partitioned by position range (can be read with gnomad_mitochondria.utils.flat_files.read_flat_file_parquet)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--parquet-position-bin-size",
+        help="Number of bases per position range partition of the Parquet flat file",
+        type=int,
+        default=500,
+    )
+    parser.add_argument(
+        "--sharded-vcf-export",
+        help="Export VCFs as shards written in parallel that are concatenated into a single bgzipped VCF and tabix indexed, rather than through a single writer",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--direct-sites-vcf",
+        help="Write the VCF lines of the sites-only VCF directly from the variant rows (without converting them to a MatrixTable for hl.export_vcf), as shards written in parallel that are concatenated into a single bgzipped VCF and tabix indexed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--vcf-export-threads",
+        help="Number of shards to read concurrently when concatenating shards (only used with --sharded-vcf-export, --direct-sites-vcf, or --indexed-flat-file)",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--diagnose-query-plans",
+        help="Record the IR node count and the compilation and execution time of every query in each stage of the run report, warning about stages whose query plans exceed --ir-node-threshold",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--ir-node-threshold",
+        help="Number of IR nodes in a query above which a warning is logged (only used with --diagnose-query-plans)",
+        type=int,
+        default=DEFAULT_IR_NODE_THRESHOLD,
+    )
+
+    args = parser.parse_args(argv)
+    if args.aggregate_state_dir and not args.coverage_mt_path:
+        parser.error("--coverage-mt-path is required with --aggregate-state-dir")
+    if check_inputs:
+        check_local_inputs(
+            parser,
+            args,
+            ["mt_path", "participant_data", "sample_stats", "coverage_mt_path"],
+        )
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
 
     # Both a slack token and slack channel must be supplied to receive notifications on slack
     if args.slack_channel and args.slack_token:
+        from gnomad.utils.slack import slack_notifications
+
         with slack_notifications(args.slack_token, args.slack_channel):
             main(args)
     else:
@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import argparse
 import logging
 import math
@@ -5,11 +7,27 @@ import os
 import re
 import sys
 
-import hail as hl
-
 from os.path import dirname
-from gnomad.utils.slack import slack_notifications
-from hail.utils.java import info
+from typing import TYPE_CHECKING, Optional
+from gnomad_mitochondria.utils.coverage_table import (
+    CHRM_LENGTH,
+    key_rows_by_locus,
+    read_coverage_table,
+    write_coverage_table,
+)
+from gnomad_mitochondria.utils.partitioning import get_n_partitions, repartition_to_target
+from gnomad_mitochondria.utils.preflight import (
+    DEFAULT_PREFLIGHT_THREADS,
+    is_coverage_header,
+    preflight_check,
+    read_manifest,
+)
+from gnomad_mitochondria.utils.startup import check_local_inputs, init_hail
+from gnomad_mitochondria.utils.storage import requires_hail
+
+if TYPE_CHECKING:
+    import hail as hl
+
 
 logging.basicConfig(
     format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
@@ -19,15 +37,20 @@ logger = logging.getLogger("Annotate coverage")
 logger.setLevel(logging.INFO)
 
 
-def multi_way_union_mts(mts: list, temp_dir: str, chunk_size: int, min_partitions: int, check_from_disk: bool, prefix: str) -> hl.MatrixTable:
+def multi_way_union_mts(mts: list, temp_dir: str, chunk_size: int, min_partitions: int, check_from_disk: bool, prefix: str, final_path: Optional[str] = None) -> hl.MatrixTable:
     """
     Hierarchically join together MatrixTables in the provided list.
 
     :param mts: List of MatrixTables to join together
     :param temp_dir: Path to temporary directory for intermediate results
     :param chunk_size: Number of MatrixTables to join per chunk (the number of individual VCFs that should be combined at a time)
+    :param final_path: Optional path to which the joined Table is written, so that the size of the joined data can be
+        read from it
     :return: Joined MatrixTable
     """
+    import hail as hl
+    from hail.utils.java import info
+
     # Convert the MatrixTables to tables where entries are an array of structs
     if check_from_disk:
         staging = [x for x in mts]
@@ -35,6 +58,7 @@ def multi_way_union_mts(mts: list, temp_dir: str, chunk_size: int, min_partition
         staging = [mt.localize_entries("__entries", "__cols") for mt in mts]
     
     stage = 0
+    written_final = False
     while len(staging) > 1:
         # Calculate the number of jobs to run based on the chunk size
         n_jobs = int(math.ceil(len(staging) / chunk_size))
@@ -96,16 +120,20 @@ def multi_way_union_mts(mts: list, temp_dir: str, chunk_size: int, min_partition
                 __cols=hl.flatten(merged.__cols.map(lambda x: x.__cols))
             )
 
-            next_stage.append(
-                merged.checkpoint(
-                    os.path.join(temp_dir, f"{prefix}stage_{stage}_job_{i}.ht"), overwrite=True
-                )
-            )
+            stage_path = os.path.join(temp_dir, f"{prefix}stage_{stage}_job_{i}.ht")
+            if n_jobs == 1 and final_path is not None:
+                stage_path = final_path
+                written_final = True
+            next_stage.append(merged.checkpoint(stage_path, overwrite=True))
         info(f"Completed stage {stage}")
         stage += 1
         staging.clear()
         staging.extend(next_stage)
 
+    # A single input (or a last stage read from disk) is still written to final_path
+    if final_path is not None and not written_final:
+        staging[0] = staging[0].checkpoint(final_path, overwrite=True)
+
     # Unlocalize the entries, and unfilter the filtered entries and populate fields with missing values
     return (
         staging[0]
@@ -194,36 +222,103 @@ def chunks(items, binsize):
         yield lst
 
 
-def main(args):  # noqa: D103
-    input_tsv = args.input_tsv
+def import_coverage_file(path: str, n_read_partitions: int, keep_targets: bool = False) -> hl.MatrixTable:
+    """
+    Import the per-base coverage file of one sample as a MatrixTable with one column and a coverage entry.
+
+    Rows are keyed by pos first (then chrom, and target if kept), so that the coverage table can drop the rest of the
+    key without a shuffle (see to_coverage_table).
+
+    :param path: Path of the coverage file (chrom, pos, target, and coverage columns)
+    :param n_read_partitions: Minimum number of partitions to read the file into
+    :param keep_targets: Whether to keep the target of each position (as a row field of the coverage table)
+    :return: MatrixTable of the file, with the coverage as the x entry
+    """
+    import hail as hl
+
+    mt = hl.import_matrix_table(
+        path,
+        delimiter="\t",
+        row_fields={"chrom": hl.tstr, "pos": hl.tint, "target": hl.tstr},
+        row_key=["pos", "chrom", "target"] if keep_targets else ["pos", "chrom"],
+        min_partitions=n_read_partitions,
+    )
+    if not keep_targets:
+        mt = mt.drop("target")
+
+    return mt
+
+
+def collect_coverage_paths(args: argparse.Namespace) -> list:
+    """
+    Read the coverage paths from the input tsv and validate them before merging (unless --skip-preflight is set).
+
+    Hail is only started here if the input tsv or the coverage files are on a Hadoop filesystem, otherwise the paths are
+    validated before Hail starts.
+
+    :param args: Parsed arguments of this script
+    :return: List of (sample, coverage path) tuples
+    """
+    import hail as hl
+
+    # Paths on Hadoop filesystems (such as hdfs:// or dnax://) are read through Hail, so Hail is started with the
+    # settings of this script before they are touched rather than implicitly with its defaults
+    if requires_hail(args.input_tsv):
+        init_hail(tmp_dir=args.temp_dir)
+        paths = hl.import_table(args.input_tsv)
+        pairs_for_coverage = paths.annotate(pairs=(paths.s, paths.coverage)).pairs.collect()
+    else:
+        pairs_for_coverage = [(x["s"], x["coverage"]) for x in read_manifest(args.input_tsv)]
+    if not args.skip_preflight:
+        checked_paths = [x for _, x in pairs_for_coverage]
+        if args.preflight_cache is not None:
+            checked_paths.append(args.preflight_cache)
+        if any(requires_hail(x) for x in checked_paths):
+            init_hail(tmp_dir=args.temp_dir)
+        logger.info("Validating coverage paths before merging...")
+        preflight_check(
+            [x for _, x in pairs_for_coverage],
+            header_check=is_coverage_header if args.check_headers else None,
+            n_threads=args.preflight_threads,
+            cache_path=args.preflight_cache,
+        )
+
+    return pairs_for_coverage
+
+
+def combine_coverage(pairs_for_coverage: list, args: argparse.Namespace) -> hl.MatrixTable:
+    """
+    Combine individual coverage files into a MatrixTable, add per-base coverage annotations, and write the outputs.
+
+    Hail must already be initialized.
+
+    :param pairs_for_coverage: List of (sample, coverage path) tuples returned by collect_coverage_paths
+    :param args: Parsed arguments of this script
+    :return: Coverage table written next to the output Table (see read_coverage_table)
+    """
+    import hail as hl
+
     output_ht = args.output_ht
     temp_dir = args.temp_dir
     chunk_size = args.chunk_size
     overwrite = args.overwrite
     keep_targets = args.keep_targets
     num_merges = args.split_merging
-    hl.init(tmp_dir=temp_dir)
-    hl._set_flags(no_whole_stage_codegen='1')
+    target_partition_bytes = args.target_partition_mb * 1024 * 1024
 
     if args.overwrite == False and hl.hadoop_exists(output_ht):
         logger.warning(
             "Overwrite is set to False but file already exists at %s, script will run but output will not be written",
             output_ht,
         )
-    # Ensure that user supplied ht extension for output_ht
-    if not output_ht.endswith(".ht"):
-        sys.exit("Path supplied as output_ht must end with .ht extension")
-
     logger.info(
         "Reading in individual coverage files as matrix tables and adding to a list of matrix tables..."
     )
 
-    paths = hl.import_table(input_tsv)
-    pairs_for_coverage = paths.annotate(pairs = (paths.s, paths.coverage)).pairs.collect()
-
     if num_merges > 1:
         merged_prefix = f'coverage_merging_final_{str(num_merges)}subsets/'
         this_merged_mt = os.path.join(temp_dir, f"{merged_prefix}final_merged.mt")
+        union_path = this_merged_mt
         if hl.hadoop_is_file(this_merged_mt + '/_SUCCESS'):
             cov_mt = hl.read_matrix_table(this_merged_mt)
         else:
@@ -241,17 +336,7 @@ def main(args):  # noqa: D103
                     idx = 0
                     for s, base_level_coverage_metrics in subset:
                         idx+=1
-                        mt = hl.import_matrix_table(
-                            base_level_coverage_metrics,
-                            delimiter="\t",
-                            row_fields={"chrom": hl.tstr, "pos": hl.tint, "target": hl.tstr},
-                            row_key=["chrom", "pos"],
-                            min_partitions=args.n_read_partitions,
-                        )
-                        if not keep_targets:
-                            mt = mt.drop("target")
-                        else:
-                            mt = mt.key_rows_by(*["chrom", "pos", "target"])
+                        mt = import_coverage_file(base_level_coverage_metrics, args.n_read_partitions, keep_targets)
                         mt = mt.key_cols_by().annotate_cols(col_id = s)
                         mt = mt.rename({"x": "coverage", 'col_id':'s'}).key_cols_by('s')
 
@@ -260,28 +345,28 @@ def main(args):  # noqa: D103
                             logger.info(f"Imported batch {str(idx)}, subset {str(subset_number)}...")
 
                     logger.info(f"Joining individual coverage mts for subset {str(subset_number)}...")
-                    cov_mt_this = multi_way_union_mts(mt_list, temp_dir, chunk_size, min_partitions=args.n_read_partitions, check_from_disk=False, prefix=this_prefix)
-                    cov_mt_this = cov_mt_this.repartition(args.n_final_partitions // num_merges).checkpoint(this_subset_mt, overwrite=True)
+                    union_path = os.path.join(temp_dir, f"{this_prefix}union.ht")
+                    cov_mt_this = multi_way_union_mts(mt_list, temp_dir, chunk_size, min_partitions=args.n_read_partitions, check_from_disk=False, prefix=this_prefix, final_path=union_path)
+                    # Sized from the written union of the subset
+                    cov_mt_this = repartition_to_target(
+                        cov_mt_this,
+                        None if args.n_final_partitions is None else args.n_final_partitions // num_merges,
+                        path=union_path,
+                        target_partition_bytes=target_partition_bytes,
+                    ).checkpoint(this_subset_mt, overwrite=True)
                     mt_list_subsets.append(cov_mt_this)
-            cov_mt = multi_way_union_mts(mt_list_subsets, temp_dir, chunk_size, min_partitions=args.n_read_partitions, check_from_disk=False, prefix=merged_prefix)
-            cov_mt = cov_mt.repartition(args.n_final_partitions).checkpoint(this_merged_mt, overwrite=True)
+            union_path = os.path.join(temp_dir, f"{merged_prefix}union.ht")
+            cov_mt = multi_way_union_mts(mt_list_subsets, temp_dir, chunk_size, min_partitions=args.n_read_partitions, check_from_disk=False, prefix=merged_prefix, final_path=union_path)
+            cov_mt = repartition_to_target(
+                cov_mt, args.n_final_partitions, path=union_path, target_partition_bytes=target_partition_bytes
+            ).checkpoint(this_merged_mt, overwrite=True)
     else:
         mt_list = []
         idx = 0
         
         for s, base_level_coverage_metrics in pairs_for_coverage:
             idx+=1
-            mt = hl.import_matrix_table(
-                base_level_coverage_metrics,
-                delimiter="\t",
-                row_fields={"chrom": hl.tstr, "pos": hl.tint, "target": hl.tstr},
-                row_key=["chrom", "pos"],
-                min_partitions=args.n_read_partitions,
-            )
-            if not keep_targets:
-                mt = mt.drop("target")
-            else:
-                mt = mt.key_rows_by(*["chrom", "pos", "target"])
+            mt = import_coverage_file(base_level_coverage_metrics, args.n_read_partitions, keep_targets)
             mt = mt.key_cols_by().annotate_cols(col_id = s)
             mt = mt.rename({"x": "coverage", 'col_id':'s'}).key_cols_by('s')
 
@@ -290,14 +375,26 @@ def main(args):  # noqa: D103
                 logger.info(f"Imported batch {str(idx)}...")
 
         logger.info("Joining individual coverage mts...")
-        cov_mt = multi_way_union_mts(mt_list, temp_dir, chunk_size, min_partitions=args.n_read_partitions, check_from_disk=False, prefix='')
-    
+        union_path = os.path.join(temp_dir, "union.ht")
+        cov_mt = multi_way_union_mts(mt_list, temp_dir, chunk_size, min_partitions=args.n_read_partitions, check_from_disk=False, prefix='', final_path=union_path)
+
+    # The coverage table is written once here and read by the later stages (and below) instead of the coverage files
+    coverage_table = re.sub(r"\.ht$", "_coverage_table.mt", output_ht)
+    # Sized from the written union of the coverage files
+    n_partitions = get_n_partitions(
+        n_partitions=args.n_final_partitions,
+        path=union_path,
+        target_partition_bytes=target_partition_bytes,
+        max_partitions=CHRM_LENGTH,
+    )
+    write_coverage_table(cov_mt, coverage_table, n_partitions, overwrite=overwrite)
+    coverage_mt = read_coverage_table(coverage_table)
+    cov_mt = coverage_mt
     n_samples = cov_mt.count_cols()
 
     logger.info("Adding coverage annotations...")
     # Calculate the mean and median coverage as well the fraction of samples above 100x or 1000x coverage at each base
     cov_mt = cov_mt.annotate_rows(
-        locus=hl.locus(cov_mt.chrom, cov_mt.pos, reference_genome="GRCh38"),
         mean=hl.float(hl.agg.mean(cov_mt.coverage)),
         median=hl.median(hl.agg.collect(cov_mt.coverage)),
         over_100=hl.float((hl.agg.count_where(cov_mt.coverage > 100) / n_samples)),
@@ -305,26 +402,42 @@ def main(args):  # noqa: D103
     )
     cov_mt.show()
 
-    cov_mt = cov_mt.key_rows_by("locus").drop("chrom", "pos")
-
     output_mt = re.sub(r"\.ht$", ".mt", output_ht)
     output_tsv = re.sub(r"\.ht$", ".tsv", output_ht)
     output_samples = re.sub(r"\.ht$", "_sample_level.txt", output_ht)
 
     if not args.hail_only:
         logger.info("Writing sample level coverage...")
-        sample_mt = cov_mt.key_rows_by(pos=cov_mt.locus.position)
-        sample_mt.coverage.export(output_samples)
+        cov_mt.coverage.export(output_samples)
 
     logger.info("Writing coverage mt and ht...")
-    cov_mt.repartition(args.n_final_partitions).write(output_mt, overwrite=overwrite)
+    # The coverage table is already partitioned by position, which orders the rows like their loci, so the locus-keyed
+    # mt is written without a repartition and the ht is read from it rather than aggregating the entries again
+    cov_mt = key_rows_by_locus(cov_mt)
+    cov_mt = cov_mt.checkpoint(output_mt, overwrite=overwrite)
     cov_ht = cov_mt.rows()
     cov_ht = cov_ht.checkpoint(output_ht, overwrite=overwrite)
     if not args.hail_only:
         cov_ht.export(output_tsv)
 
+    return coverage_mt
 
-if __name__ == "__main__":
+
+def main(args):  # noqa: D103
+    pairs_for_coverage = collect_coverage_paths(args)
+    init_hail(tmp_dir=args.temp_dir)
+    combine_coverage(pairs_for_coverage, args)
+
+
+def parse_arguments(argv: Optional[list] = None, check_inputs: bool = True) -> argparse.Namespace:
+    """
+    Parse and validate the arguments of this script.
+
+    :param argv: Command line arguments, defaults to those of the running process
+    :param check_inputs: Whether to check that local input paths exist. run_pipeline_dag.py checks the inputs of its
+        stages itself, since some of them are only written by earlier stages
+    :return: Parsed arguments
+    """
     parser = argparse.ArgumentParser(
         description="This script combines individual mitochondria coverage files and outputs a hail table with coverage annotations"
     )
@@ -335,7 +448,10 @@ if __name__ == "__main__":
         required=True,
     )
     parser.add_argument(
-        "-o", "--output-ht", help="Name of ht to write output", required=True
+        "-o",
+        "--output-ht",
+        help="Name of ht to write output (the sample-level coverage table read by combine_vcfs.py, add_annotations.py, and subset_cov_to_release.py is written next to it as <name>_coverage_table.mt)",
+        required=True,
     )
     parser.add_argument(
         "-t",
@@ -362,11 +478,45 @@ if __name__ == "__main__":
         "--hail-only", action='store_true', help='Skip generating flat files.'
     )    
     parser.add_argument(
-        "--n-final-partitions", type=int, default=1000, help='Number of partitions for final mt.'
-    )    
+        "--n-final-partitions", type=int, help='Number of partitions for final mt (and for the merged mt, split evenly between the subsets of --split-merging). Overrides the number chosen from the size of the written data (see --target-partition-mb).'
+    )
+    parser.add_argument(
+        "--target-partition-mb", type=int, default=128, help='Target size in MB of each partition. The number of partitions of the merged mt and of the coverage table is chosen from the size of the written union of the coverage files.'
+    )
     parser.add_argument(
         '--split-merging', type=int, default=1, help='Will split the merging into this many jobs which will be merged at the end. Uses the same order each time such that if it fails we can read from previous files.'
     )
+    parser.add_argument(
+        "--skip-preflight",
+        help="Skip checking that every coverage path exists and is non-empty before merging",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--check-headers",
+        help="Also check that every coverage file starts with the chrom, pos, and target columns during the pre-flight check",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--preflight-threads",
+        help="Number of paths to check concurrently during the pre-flight check",
+        type=int,
+        default=DEFAULT_PREFLIGHT_THREADS,
+    )
+    parser.add_argument(
+        "--preflight-cache",
+        help="Path of a JSON file caching pre-flight results, so that header checks are skipped for files unchanged since they last passed",
+    )
+
+    args = parser.parse_args(argv)
+    # Ensure that user supplied ht extension for output_ht
+    if not args.output_ht.endswith(".ht"):
+        parser.error("Path supplied as output_ht must end with .ht extension")
+    if check_inputs:
+        check_local_inputs(parser, args, ["input_tsv"])
+
+    return args
 
-    args = parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
     main(args)
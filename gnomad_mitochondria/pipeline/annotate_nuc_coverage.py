@@ -8,7 +8,11 @@ import sys
 import hail as hl
 
 from os.path import dirname
-from gnomad.utils.slack import slack_notifications
+from gnomad_mitochondria.utils.coverage_table import (
+    key_rows_by_locus,
+    read_coverage_table,
+    write_coverage_table,
+)
 from hail.utils.java import info
 
 logging.basicConfig(
@@ -123,13 +127,12 @@ def main(args):  # noqa: D103
                 base_level_coverage_metrics,
                 delimiter="\t",
                 types=typedict,
-                key=["chrom", "pos"],
+                # Keyed by pos first, so that the coverage table drops the rest of the key without a shuffle
+                key=["pos", "chrom", "target"] if keep_targets else ["pos", "chrom"],
                 min_partitions=args.n_read_partitions
             )
             if not keep_targets:
                 ht = ht.drop("target")
-            else:
-                ht = ht.key_by(*["chrom", "pos", "target"])
             mt1 = ht.select('coverage_original').to_matrix_table_row_major(columns = ['coverage_original'], entry_field_name = 'coverage_original', col_field_name='s')
             mt2 = ht.select('coverage_remapped_self').to_matrix_table_row_major(columns = ['coverage_remapped_self'], entry_field_name = 'coverage_remapped_self', col_field_name='s')
             mt1 = mt1.key_cols_by(s=sample)
@@ -145,12 +148,17 @@ def main(args):  # noqa: D103
     out_dir = dirname(output_ht)
 
     cov_mt = multi_way_union_mts(mt_list, temp_dir, chunk_size, min_partitions=args.n_read_partitions)
+
+    # The coverage table is written once here and the annotations below are computed from it
+    coverage_table = re.sub(r"\.ht$", "_coverage_table.mt", output_ht)
+    # Each coverage file holds one sample, so the number of columns is known without counting
+    write_coverage_table(cov_mt, coverage_table, overwrite=overwrite, n_cols=len(mt_list))
+    cov_mt = read_coverage_table(coverage_table)
     n_samples = cov_mt.count_cols()
 
     logger.info("Adding coverage annotations...")
     # Calculate the mean and median coverage as well the fraction of samples above 100x or 1000x coverage at each base
     cov_mt = cov_mt.annotate_rows(
-        locus=hl.locus(cov_mt.chrom, cov_mt.pos, reference_genome="GRCh38"),
         mean_original=hl.float(hl.agg.mean(cov_mt.coverage_original)),
         mean_remapped=hl.float(hl.agg.mean(cov_mt.coverage_remapped_self)),
         median_original=hl.median(hl.agg.collect(cov_mt.coverage_original)),
@@ -163,8 +171,6 @@ def main(args):  # noqa: D103
         )
     cov_mt.show()
 
-    cov_mt = cov_mt.key_rows_by("locus").drop("chrom", "pos")
-
     output_mt = re.sub(r"\.ht$", ".mt", output_ht)
     output_tsv = re.sub(r"\.ht$", ".tsv", output_ht)
     output_samples_orig = re.sub(r"\.ht$", "_original_sample_level.txt", output_ht)
@@ -172,14 +178,15 @@ def main(args):  # noqa: D103
 
     if not args.hail_only:
         logger.info("Writing sample level coverage...")
-        sample_mt = cov_mt.key_rows_by(pos=cov_mt.locus.position)
-        sample_mt.coverage_original.export(output_samples_orig)
-        sample_mt.coverage_remapped_self.export(output_samples_remap)
+        cov_mt.coverage_original.export(output_samples_orig)
+        cov_mt.coverage_remapped_self.export(output_samples_remap)
         if expect_shifted:
-            sample_mt.coverage_remapped_self_shifted.export(re.sub(r"\.ht$", "_remapped_shifted_sample_level.txt", output_ht))
+            cov_mt.coverage_remapped_self_shifted.export(re.sub(r"\.ht$", "_remapped_shifted_sample_level.txt", output_ht))
 
     logger.info("Writing coverage mt and ht...")
-    cov_mt.write(output_mt, overwrite=overwrite)
+    # Positions are ordered like their loci, so the coverage table is re-keyed by locus without a shuffle
+    cov_mt = key_rows_by_locus(cov_mt)
+    cov_mt = cov_mt.checkpoint(output_mt, overwrite=overwrite)
     cov_ht = cov_mt.rows()
     cov_ht = cov_ht.checkpoint(output_ht, overwrite=overwrite)
     cov_ht.export(output_tsv)
@@ -236,6 +243,8 @@ if __name__ == "__main__":
 
     # Both a slack token and slack channel must be supplied to receive notifications on slack
     if args.slack_channel and args.slack_token:
+        from gnomad.utils.slack import slack_notifications
+
         with slack_notifications(args.slack_token, args.slack_channel):
             main(args)
     else:
@@ -1,4 +1,9 @@
-import hail as hl
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import hail as hl
 
 
 def add_descriptions(
@@ -17,10 +22,16 @@ def add_descriptions(
     :rtype: MatrixTable
 
     """
+    import hail as hl
+
     # pull out variables that are needed in description dictionaries
-    hap_order = hl.eval(input_mt.hap_order)
-    population_order = hl.eval(input_mt.pop_order)
-    hl_hist_bin_edges = input_mt.hl_hist.bin_edges.take(1)[0]
+    # These are read from the globals in one evaluation (no rows are scanned)
+    description_globals = hl.eval(
+        input_mt.globals.select("hap_order", "pop_order", "hist_bin_edges")
+    )
+    hap_order = description_globals.hap_order
+    population_order = description_globals.pop_order
+    hl_hist_bin_edges = description_globals.hist_bin_edges.hl_hist
 
     global_annotation_dict = hl.struct(
         vep_version=hl.struct(Description="VEP version"),
@@ -70,6 +81,9 @@ def add_descriptions(
         pop_order=hl.struct(
             Description="The order in which populations are reported for population-related annotations"
         ),
+        hist_bin_edges=hl.struct(
+            Description="Values of bin edges for the per-variant histograms (hl_hist, dp_hist_all, dp_hist_alt, age_hist_hom, and age_hist_het)"
+        ),
     )
 
     col_annotation_dict = hl.struct(
@@ -137,8 +151,8 @@ def add_descriptions(
         contam_high_het=hl.struct(
             Description="Internal estimate of contamination. It is defined for each sample as one minus the mean heteroplasmy of any haplogroup-defining variants observed with heteroplasmy 85-99.8 percent alternate alleles if at least 3 such variants are present; otherwise estimated contamination is defined as one minus the mean heteroplasmy of haplogroup-defining variants with heteroplasmy 85-100 percent"
         ),
-        indel_pos_counter=hl.struct(
-            Description="Dictionary containing the count of the number of indels at each position that contains at least one indel for the sample"
+        indel_positions=hl.struct(
+            Description="Sorted array of the positions of the indels for the sample (a position is repeated once for each indel at that position)"
         ),
     )
 
@@ -266,7 +266,7 @@ echo ""
 echo "Run the following command to track the progress of the various runs:"
 echo ""
 export success_file_pref="${outputFold}_prog_$(date +'%T' | sed 's|:|.|g')"
-echo "python gnomad-mitochondria/gnomad_mitochondria/pipeline/cromwell_run_monitor.py --run-folder ${outputFold} --sub-ids ordered_batch_ids.txt --sample-lists ${outputFold}/sample_list{}.txt --check-success --output ${success_file_pref}" | tee check_workflow_status.sh
+echo "PYTHONPATH=gnomad-mitochondria python gnomad-mitochondria/gnomad_mitochondria/pipeline/cromwell_run_monitor.py --run-folder ${outputFold} --sub-ids ordered_batch_ids.txt --sample-lists ${outputFold}/sample_list{}.txt --check-success --output ${success_file_pref}" | tee check_workflow_status.sh
 echo ""
 echo "We have outputted this command in check_workflow_status.sh."
 echo ""
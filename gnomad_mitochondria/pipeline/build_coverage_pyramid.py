@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+import argparse
+import logging
+
+from gnomad_mitochondria.utils.coverage_pyramid import (
+    DEFAULT_COVERAGE_THRESHOLDS,
+    PYRAMID_RESOLUTIONS,
+    annotate_per_base_strata,
+    build_coverage_pyramid,
+    export_coverage_pyramid,
+    read_sample_strata,
+)
+from gnomad_mitochondria.utils.coverage_table import read_coverage_table
+from gnomad_mitochondria.utils.startup import check_local_inputs, init_hail
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("build coverage pyramid")
+logger.setLevel(logging.INFO)
+
+
+def main(args):  # noqa: D103
+    init_hail(tmp_dir=args.temp_dir)
+
+    cov_mt = read_coverage_table(args.coverage_mt_path)
+    samples_ht = read_sample_strata(args.samples_path)
+
+    logger.info(
+        "Summarizing coverage per base for all samples, haplogroups, and populations..."
+    )
+    strata_ht = annotate_per_base_strata(cov_mt, samples_ht, args.thresholds)
+    strata_ht = strata_ht.checkpoint(
+        f"{args.temp_dir}/coverage_pyramid_per_base.ht", overwrite=True
+    )
+
+    logger.info("Binning coverage at resolutions %s...", args.resolutions)
+    pyramid_ht = build_coverage_pyramid(strata_ht, args.thresholds, args.resolutions)
+    export_coverage_pyramid(
+        pyramid_ht, args.output_path, args.thresholds, args.resolutions, args.overwrite
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script precomputes binned coverage summaries (mean, median, and fraction of samples over coverage thresholds) for all samples and per haplogroup and population at several resolutions, and writes them as Parquet for browser display"
+    )
+    parser.add_argument(
+        "-c",
+        "--coverage-mt-path",
+        help="Path to the coverage table of sample-level coverage (written by annotate_coverage.py as <output>_coverage_table.mt; locus-keyed coverage MatrixTables are also accepted)",
+        required=True,
+    )
+    parser.add_argument(
+        "-s",
+        "--samples-path",
+        help="Path to a Table keyed by sample with hap and pop fields (such as the samples.ht of an aggregate state), or to a MatrixTable with hap and pop column fields (such as the output of add_annotations.py)",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output-path",
+        help="Path of the Parquet dataset to write (can be read with gnomad_mitochondria.utils.coverage_pyramid.read_coverage_pyramid)",
+        required=True,
+    )
+    parser.add_argument(
+        "-t",
+        "--temp-dir",
+        help="Temporary directory to use for intermediate outputs",
+        required=True,
+    )
+    parser.add_argument(
+        "--thresholds",
+        help="Coverage thresholds for which the fraction of samples above the threshold is summarized",
+        type=int,
+        nargs="+",
+        default=DEFAULT_COVERAGE_THRESHOLDS,
+    )
+    parser.add_argument(
+        "--resolutions",
+        help="Bin sizes of the levels of the pyramid",
+        type=int,
+        nargs="+",
+        default=PYRAMID_RESOLUTIONS,
+    )
+    parser.add_argument(
+        "--overwrite", help="Overwrites existing files", action="store_true"
+    )
+
+    args = parser.parse_args()
+    check_local_inputs(parser, args, ["coverage_mt_path", "samples_path"])
+    main(args)
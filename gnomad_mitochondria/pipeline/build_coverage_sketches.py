@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import argparse
+import logging
+
+from gnomad_mitochondria.utils.coverage_pyramid import (
+    DEFAULT_COVERAGE_THRESHOLDS,
+    read_sample_strata,
+)
+from gnomad_mitochondria.utils.coverage_sketches import (
+    DEFAULT_RELATIVE_ACCURACY,
+    annotate_coverage_sketches,
+)
+from gnomad_mitochondria.utils.coverage_table import read_coverage_table
+from gnomad_mitochondria.utils.startup import check_local_inputs, init_hail
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("build coverage sketches")
+logger.setLevel(logging.INFO)
+
+
+def main(args):  # noqa: D103
+    init_hail(tmp_dir=args.temp_dir)
+
+    cov_mt = read_coverage_table(args.coverage_mt_path)
+    samples_ht = read_sample_strata(args.samples_path)
+
+    logger.info("Building coverage sketches per haplogroup and population...")
+    sketch_ht = annotate_coverage_sketches(
+        cov_mt, samples_ht, args.thresholds, args.relative_accuracy
+    )
+    sketch_ht.write(args.output_ht_path, overwrite=args.overwrite)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script builds mergeable coverage sketches for each haplogroup and population at each position, from which coverage quantiles and fractions over thresholds for any stratum or union of strata can be queried with gnomad_mitochondria.utils.coverage_sketches.query_coverage_sketches"
+    )
+    parser.add_argument(
+        "-c",
+        "--coverage-mt-path",
+        help="Path to the coverage table of sample-level coverage (written by annotate_coverage.py as <output>_coverage_table.mt; locus-keyed coverage MatrixTables are also accepted)",
+        required=True,
+    )
+    parser.add_argument(
+        "-s",
+        "--samples-path",
+        help="Path to a Table keyed by sample with hap and pop fields (such as the samples.ht of an aggregate state), or to a MatrixTable with hap and pop column fields (such as the output of add_annotations.py)",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output-ht-path",
+        help="Path of the sketch Table to write",
+        required=True,
+    )
+    parser.add_argument(
+        "-t",
+        "--temp-dir",
+        help="Temporary directory to use for intermediate outputs",
+        required=True,
+    )
+    parser.add_argument(
+        "--thresholds",
+        help="Coverage thresholds for which the number of samples above the threshold is counted exactly",
+        type=int,
+        nargs="+",
+        default=DEFAULT_COVERAGE_THRESHOLDS,
+    )
+    parser.add_argument(
+        "--relative-accuracy",
+        help="Relative accuracy of the coverage quantiles returned by the sketches",
+        type=float,
+        default=DEFAULT_RELATIVE_ACCURACY,
+    )
+    parser.add_argument(
+        "--overwrite", help="Overwrites existing files", action="store_true"
+    )
+
+    args = parser.parse_args()
+    if not 0 < args.relative_accuracy < 1:
+        parser.error("--relative-accuracy must be between 0 and 1")
+    check_local_inputs(parser, args, ["coverage_mt_path", "samples_path"])
+    main(args)
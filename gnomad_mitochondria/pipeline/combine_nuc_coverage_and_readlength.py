@@ -8,7 +8,6 @@ import sys
 import hail as hl
 
 from os.path import dirname
-from gnomad.utils.slack import slack_notifications
 from hail.utils.java import info
 
 logging.basicConfig(
@@ -257,6 +256,8 @@ if __name__ == "__main__":
 
     # Both a slack token and slack channel must be supplied to receive notifications on slack
     if args.slack_channel and args.slack_token:
+        from gnomad.utils.slack import slack_notifications
+
         with slack_notifications(args.slack_token, args.slack_channel):
             main(args)
     else:
@@ -1,11 +1,32 @@
+from __future__ import annotations
+
 import argparse
-from curses import pair_content
 import logging
 import math
 import os
 
-import hail as hl
-from typing import Dict
+from typing import TYPE_CHECKING, Dict, Optional
+
+from gnomad_mitochondria.pipeline.sample_major_callset import write_sample_major_callset
+from gnomad_mitochondria.utils.coverage_table import key_rows_by_locus, read_coverage_table
+from gnomad_mitochondria.utils.partitioning import (
+    DEFAULT_TARGET_PARTITION_BYTES,
+    get_n_partitions,
+    repartition_to_target,
+)
+from gnomad_mitochondria.utils.preflight import (
+    DEFAULT_PREFLIGHT_THREADS,
+    is_vcf_header,
+    preflight_check,
+    read_manifest,
+)
+from gnomad_mitochondria.utils.startup import check_local_inputs, init_hail
+from gnomad_mitochondria.utils.storage import requires_hail
+from gnomad_mitochondria.utils.vcf_export import export_sharded_tsv, export_sharded_vcf
+
+if TYPE_CHECKING:
+    import hail as hl
+
 
 META_DICT = {
     "filter": {
@@ -52,47 +73,48 @@ def collect_vcf_paths(
         - 's': sample name
         - path to the Mutect2 VCF output, where name of this column is supplied to the `vcf_col_name` parameter
 
-    :param participant_data: Participant data (a ht)
+    The manifest is read directly rather than through Hail, so that the paths can be validated before Hail starts.
+
+    :param participant_data: Path to the participant data (a tsv)
     :param vcf_col_name: Name of column that contains VCF output
     :param participants_to_subset: Path to file of participant_ids to which the data should be subset
     :return: Dictionary with sample name as key and path to VCF as value
     """
-    vcf_paths = {}
     # Load in data
-    participant_ht = hl.import_table(participant_data)
+    participants = read_manifest(participant_data)
 
-    # Remove participants that don't have VCF output
-    participant_ht.filter(participant_ht[vcf_col_name] != "")
+    # Remove participants that don't have VCF output (missing values are empty or NA, as read by hl.import_table)
+    participants = [x for x in participants if x[vcf_col_name] not in ("", "NA")]
 
     # Subset participants if specified
     if participants_to_subset:
-        participants_of_interest = hl.import_table(
-            participants_to_subset
-        ).participant.collect()
-        participant_ht = participant_ht.filter(
-            hl.literal(participants_of_interest).contains(
-                participant_ht["entity:participant_id"]
-            )
+        participants_of_interest = set(
+            x["participant"] for x in read_manifest(participants_to_subset)
         )
+        participants = [
+            x for x in participants if x["entity:participant_id"] in participants_of_interest
+        ]
 
     # Add the vcf path to a dictionary with sample name as key
-    df = participant_ht.to_pandas()
+    return {x["s"]: x[vcf_col_name] for x in participants}
 
-    for _, row in df.iterrows():
-        vcf_paths[row["s"]] = row[vcf_col_name]
-
-    return vcf_paths
 
-
-def multi_way_union_mts(mts: list, temp_dir: str, chunk_size: int, prefix: str) -> hl.MatrixTable:
+def multi_way_union_mts(
+    mts: list, temp_dir: str, chunk_size: int, prefix: str, final_path: Optional[str] = None
+) -> hl.MatrixTable:
     """
     Hierarchically join together MatrixTables in the provided list.
 
     :param mts: List of MatrixTables to join together
     :param temp_dir: Path to temporary directory for intermediate results
     :param chunk_size: Number of MatrixTables to join per chunk (the number of individual VCFs that should be combined at a time)
+    :param prefix: Prefix of the intermediate results in temp_dir
+    :param final_path: Optional path to which the joined Table of the last stage is written instead of temp_dir, so that
+        the size of the joined data can be read from it
     :return: Joined MatrixTable
     """
+    import hail as hl
+
     # Convert the MatrixTables to tables where entries are an array of structs
     staging = [mt.localize_entries("__entries", "__cols") for mt in mts]
     stage = 0
@@ -133,16 +155,19 @@ def multi_way_union_mts(mts: list, temp_dir: str, chunk_size: int, prefix: str)
                 __cols=hl.flatten(merged.__cols.map(lambda x: x.__cols))
             )
 
-            next_stage.append(
-                merged.checkpoint(
-                    os.path.join(temp_dir, f"{prefix}stage_{stage}_job_{i}.ht"), overwrite=True
-                )
-            )
+            stage_path = os.path.join(temp_dir, f"{prefix}stage_{stage}_job_{i}.ht")
+            if n_jobs == 1 and final_path is not None:
+                stage_path = final_path
+            next_stage.append(merged.checkpoint(stage_path, overwrite=True))
         hl.utils.java.info(f"Completed stage {stage}")
         stage += 1
         staging.clear()
         staging.extend(next_stage)
 
+    # A single input is not joined, but is still written to final_path
+    if stage == 0 and final_path is not None:
+        staging[0] = staging[0].checkpoint(final_path, overwrite=True)
+
     # Unlocalize the entries, and unfilter the filtered entries and populate fields with missing values
     return (
         staging[0]
@@ -151,8 +176,71 @@ def multi_way_union_mts(mts: list, temp_dir: str, chunk_size: int, prefix: str)
     )
 
 
+def import_mitochondria_vcf(
+    vcf_path: str, s: str, include_extra_v2_fields: bool = False
+) -> hl.MatrixTable:
+    """
+    Import and reformat the single-sample mitochondrial VCF of one sample.
+
+    :param vcf_path: Path to the Mutect2 VCF of the sample
+    :param s: Sample name
+    :param include_extra_v2_fields: Includes extra fields important for analysis of v2.1 source MTs
+    :return: MatrixTable with one column keyed by s and DP, HL, MQ, TLOD, FT, and AS_SB_TABLE entries
+    """
+    import hail as hl
+
+    try:
+        mt = hl.import_vcf(vcf_path, reference_genome="GRCh38")
+    except Exception as e:
+        raise ValueError(
+            f"vcf path {vcf_path} does not exist for sample {s}"
+        ) from e
+
+    # Because the vcfs are split, there is only one AF value, although misinterpreted as an array because Number=A in VCF header
+    # Second value of MMQ is the value of the mapping quality for the alternate allele
+    # Add FT annotation for sample genotype filters (pull these from filters annotations of the single-sample VCFs)
+    if include_extra_v2_fields:
+        fields_of_interest = {'OriginalSelfRefAlleles':'array<str>', 'SwappedFieldIDs':'str',
+                              'F2R1':'array<int32>', 'F1R2':'array<int32>'}
+        if 'GT' in mt.entry:
+            mt = mt.drop('GT')
+        for x, item_type in fields_of_interest.items():
+            if x not in mt.entry:
+                mt = mt.annotate_entries(**{x: hl.missing(item_type)})
+        mt = mt.select_entries("DP", "AD", *list(fields_of_interest.keys()), HL=mt.AF[0])
+        META_DICT['format'].update({'AD': {"Description": "Allelic depth of REF and ALT", "Number": "R", "Type": "Integer"},
+                                    'F2R1': {"Description": "Count of reads in F2R1 pair orientation supporting each allele", "Number": "R", "Type": "Integer"},
+                                    'F1R2': {"Description": "Count of reads in F1R2 pair orientation supporting each allele", "Number": "R", "Type": "Integer"},
+                                    'OriginalSelfRefAlleles': {'Description':'Original self-reference alleles (only if alleles were changed in Liftover repair pipeline)', 'Number':'R', 'Type':'String'},
+                                    'SwappedFieldIDs': {'Description':'Fields remapped during liftover (only if alleles were changed in Liftover repair pipeline)', 'Number':'1', 'Type':'String'}})
+    else:
+        mt = mt.select_entries("DP", HL=mt.AF[0])
+    # Use GRCh37 reference as most external resources added in downstream scripts use GRCh37 contig names
+    # (although note that the actual sequences of the mitochondria in both GRCh37 and GRCh38 are the same)
+    mt = mt.annotate_entries(
+        MQ=hl.float(mt.info["MMQ"][1]),
+        TLOD=mt.info["TLOD"][0],
+        FT=hl.if_else(hl.len(mt.filters) == 0, {"PASS"}, mt.filters),
+        AS_SB_TABLE=mt.info.AS_SB_TABLE.split('\\|'),
+    )
+    mt = mt.key_rows_by(
+        locus=hl.locus("MT", mt.locus.position, reference_genome="GRCh37"),
+        alleles=mt.alleles,
+    )
+    mt = mt.key_cols_by(s=s)
+    mt = mt.select_rows()
+
+    return mt
+
+
 def join_mitochondria_vcfs_into_mt(
-    vcf_paths: Dict[str, str], temp_dir: str, chunk_size: int = 100, include_extra_v2_fields: bool = False, num_merges: int = 1
+    vcf_paths: Dict[str, str],
+    temp_dir: str,
+    chunk_size: int = 100,
+    include_extra_v2_fields: bool = False,
+    num_merges: int = 1,
+    n_final_partitions: Optional[int] = None,
+    target_partition_bytes: int = DEFAULT_TARGET_PARTITION_BYTES,
 ) -> hl.MatrixTable:
     """
     Reformat and join individual mitochondrial VCFs into one MatrixTable.
@@ -161,8 +249,14 @@ def join_mitochondria_vcfs_into_mt(
     :param temp_dir: Path to temporary directory for intermediate results
     :param chunk_size: Number of MatrixTables to join per chunk (the number of individual VCFs that should be combined at a time)
     :param include_extra_v2_fields: Includes extra fields important for analysis of v2.1 source MTs
+    :param num_merges: Number of subsets that are joined separately and then merged
+    :param n_final_partitions: Number of partitions of the joined MatrixTable (split evenly between the subsets), chosen
+        from the size of the written joined data if not supplied
+    :param target_partition_bytes: Target number of bytes per partition if n_final_partitions is not supplied
     :return: Joined MatrixTable of samples given in vcf_paths dictionary
     """
+    import hail as hl
+
     list_paths = list(vcf_paths.items())
     list_paths.sort(key=lambda y: y[0])
     if num_merges == 1:
@@ -182,60 +276,31 @@ def join_mitochondria_vcfs_into_mt(
             idx = 0
             for s, vcf_path in subset:
                 idx+=1
-                try:
-                    mt = hl.import_vcf(vcf_path, reference_genome="GRCh38")
-                except Exception as e:
-                    raise ValueError(
-                        f"vcf path {vcf_path} does not exist for sample {s}"
-                    ) from e
-
-                # Because the vcfs are split, there is only one AF value, although misinterpreted as an array because Number=A in VCF header
-                # Second value of MMQ is the value of the mapping quality for the alternate allele
-                # Add FT annotation for sample genotype filters (pull these from filters annotations of the single-sample VCFs)
-                if include_extra_v2_fields:
-                    fields_of_interest = {'OriginalSelfRefAlleles':'array<str>', 'SwappedFieldIDs':'str',
-                                          'F2R1':'array<int32>', 'F1R2':'array<int32>'}
-                    if 'GT' in mt.entry:
-                        mt = mt.drop('GT')
-                    for x, item_type in fields_of_interest.items():
-                        if x not in mt.entry:
-                            mt = mt.annotate_entries(**{x: hl.missing(item_type)})
-                    mt = mt.select_entries("DP", "AD", *list(fields_of_interest.keys()), HL=mt.AF[0])
-                    META_DICT['format'].update({'AD': {"Description": "Allelic depth of REF and ALT", "Number": "R", "Type": "Integer"},
-                                                'F2R1': {"Description": "Count of reads in F2R1 pair orientation supporting each allele", "Number": "R", "Type": "Integer"},
-                                                'F1R2': {"Description": "Count of reads in F1R2 pair orientation supporting each allele", "Number": "R", "Type": "Integer"},
-                                                'OriginalSelfRefAlleles': {'Description':'Original self-reference alleles (only if alleles were changed in Liftover repair pipeline)', 'Number':'R', 'Type':'String'},
-                                                'SwappedFieldIDs': {'Description':'Fields remapped during liftover (only if alleles were changed in Liftover repair pipeline)', 'Number':'1', 'Type':'String'}})
-                else:
-                    mt = mt.select_entries("DP", HL=mt.AF[0])
-                # Use GRCh37 reference as most external resources added in downstream scripts use GRCh37 contig names
-                # (although note that the actual sequences of the mitochondria in both GRCh37 and GRCh38 are the same)
-                mt = mt.annotate_entries(
-                    MQ=hl.float(mt.info["MMQ"][1]),
-                    TLOD=mt.info["TLOD"][0],
-                    FT=hl.if_else(hl.len(mt.filters) == 0, {"PASS"}, mt.filters),
-                    AS_SB_TABLE=mt.info.AS_SB_TABLE.split('\\|'),
-                )
-                mt = mt.key_rows_by(
-                    locus=hl.locus("MT", mt.locus.position, reference_genome="GRCh37"),
-                    alleles=mt.alleles,
-                )
-                mt = mt.key_cols_by(s=s)
-                mt = mt.select_rows()
-                #mt.entries().show()
+                mt = import_mitochondria_vcf(vcf_path, s, include_extra_v2_fields)
                 mt_list.append(mt)
                 if idx % 20 == 0:
                     logger.info(f"Imported sample {str(idx)}...")
 
-            combined_mt_this = multi_way_union_mts(mt_list, temp_dir, chunk_size, prefix=this_prefix)
-            combined_mt_this = combined_mt_this.repartition(args.n_final_partitions // num_merges).checkpoint(this_subset_mt, overwrite=True)
+            union_path = os.path.join(temp_dir, f"{this_prefix}union.ht")
+            combined_mt_this = multi_way_union_mts(mt_list, temp_dir, chunk_size, prefix=this_prefix, final_path=union_path)
+            # Sized from the written union of the subset
+            combined_mt_this = repartition_to_target(
+                combined_mt_this,
+                None if n_final_partitions is None else n_final_partitions // num_merges,
+                path=union_path,
+                target_partition_bytes=target_partition_bytes,
+            ).checkpoint(this_subset_mt, overwrite=True)
             mt_list_subsets.append(combined_mt_this)
     
     if num_merges == 1:
         combined_mt = mt_list_subsets[0]
     else:
         merged_prefix = f'variant_merging_final_{str(num_merges)}subsets/'
-        combined_mt = multi_way_union_mts(mt_list_subsets, temp_dir, chunk_size, prefix=merged_prefix)
+        union_path = os.path.join(temp_dir, f"{merged_prefix}union.ht")
+        combined_mt = multi_way_union_mts(mt_list_subsets, temp_dir, chunk_size, prefix=merged_prefix, final_path=union_path)
+        combined_mt = repartition_to_target(
+            combined_mt, n_final_partitions, path=union_path, target_partition_bytes=target_partition_bytes
+        )
 
     return combined_mt
 
@@ -259,6 +324,8 @@ def remove_genotype_filters(
     :param filters_to_remove: List of genptype filters (in FT field of VCF) that should be removed from the entries
     :return: MatrixTable with specific genotype filters (in FT field of VCF) removed
     """
+    import hail as hl
+
     mt = mt.annotate_entries(FT=mt.FT.difference(filters_to_remove))
 
     # If no filters exist after removing those specified above, set the FT field to PASS
@@ -268,22 +335,29 @@ def remove_genotype_filters(
 
 
 def determine_hom_refs(
-    mt: hl.MatrixTable, coverage_mt_path: str, minimum_homref_coverage: int = 100
+    mt: hl.MatrixTable,
+    coverage_mt_path: str,
+    minimum_homref_coverage: int = 100,
+    coverage_mt: Optional[hl.MatrixTable] = None,
 ) -> hl.MatrixTable:
     """
     Use coverage to distinguish between homref and missing sites.
 
     :param mt: MatrixTable from initial multi-sample merging, without homref sites determined
-    :param coverage_mt_path: MatrixTable of sample level coverage at each position (per-sample and per-base; can be generated by running annotate_coverage.py)
+    :param coverage_mt_path: Coverage table of sample level coverage at each position (per-sample and per-base; can be generated by running annotate_coverage.py)
     :param minimum_homref_coverage: Minimum depth of coverage required to call a genotype homoplasmic reference rather than missing
+    :param coverage_mt: Optional coverage table already read from coverage_mt_path (see read_coverage_table), such as the one returned by annotate_coverage.combine_coverage
     :return: MatrixTable with missing genotypes converted to homref depending on coverage
     """
-    # Convert coverage to build GRCh37 to match contig names
+    import hail as hl
+
+    if coverage_mt is None:
+        coverage_mt = read_coverage_table(coverage_mt_path)
+
+    # Coverage is keyed by locus on the mitochondrial contig of the callset (GRCh37 MT or GRCh38 chrM), so the join is on
+    # the first row key field of the callset and needs no shuffle
     # Note: the mitochondrial reference genome is the same for GRCh38 and GRCh37
-    coverages = hl.read_matrix_table(coverage_mt_path)
-    coverages = coverages.key_rows_by(
-        locus=hl.locus("MT", coverages.locus.position, reference_genome="GRCh37")
-    )
+    coverages = key_rows_by_locus(coverage_mt, mt.locus.dtype.reference_genome.name)
 
     mt = mt.annotate_entries(
         DP=hl.if_else(hl.is_missing(mt.HL), coverages[mt.locus, mt.s].coverage, mt.DP)
@@ -314,6 +388,8 @@ def apply_mito_artifact_filter(
     :param artifact_prone_sites_path: Path to BED file of artifact_prone_sites to flag in the filters column
     :return: MatrixTable with artifact_prone_sites filter
     """
+    import hail as hl
+
     # Apply "artifact_prone_site" filter to any SNP or deletion that spans a known problematic site
     if artifact_prone_sites_reference is not None:
         bed = hl.import_bed(artifact_prone_sites_path, reference_genome=artifact_prone_sites_reference)
@@ -384,6 +460,57 @@ def apply_mito_artifact_filter(
     return mt
 
 
+def export_final_outputs(
+    mt: hl.MatrixTable,
+    out_mt: str,
+    out_tsv: str,
+    out_vcf: str,
+    n_partitions: int,
+    shard_dir: str,
+    n_threads: int = 8,
+    overwrite: bool = False,
+) -> hl.MatrixTable:
+    """
+    Write the final MatrixTable, entries TSV, and VCF using one shared partitioning.
+
+    The MatrixTable is repartitioned once and written; the TSV and VCF are then exported from the written partitions
+    as one shard per partition (no further shuffles) and each is concatenated into a single bgzipped file.
+
+    :param mt: Combined MatrixTable
+    :param out_mt: Path of the MatrixTable to write
+    :param out_tsv: Path of the entries TSV to write (entries with HL missing or above 0)
+    :param out_vcf: Path of the VCF to write
+    :param n_partitions: Number of partitions shared by all outputs
+    :param shard_dir: Directory to which the TSV and VCF shards should be written
+    :param n_threads: Number of shards to read concurrently when concatenating
+    :param overwrite: Whether or not to overwrite an existing MatrixTable
+    :return: Written MatrixTable
+    """
+    import hail as hl
+
+    mt = repartition_to_target(mt, n_partitions).checkpoint(out_mt, overwrite=overwrite)
+
+    logger.info("Writing trimmed variants table...")
+    ht_for_tsv = mt.entries()
+    ht_for_tsv = ht_for_tsv.filter(hl.is_missing(ht_for_tsv.HL) | (ht_for_tsv.HL > 0))
+    export_sharded_tsv(
+        ht_for_tsv, out_tsv, n_threads=n_threads, shard_dir=f"{shard_dir}/tsv_shards"
+    )
+
+    logger.info("Writing combined VCF...")
+    # For the VCF output, join FT values by semicolon
+    vcf_mt = mt.annotate_entries(FT=hl.str(";").join(hl.array(mt.FT)))
+    export_sharded_vcf(
+        vcf_mt,
+        out_vcf,
+        metadata=META_DICT,
+        n_threads=n_threads,
+        shard_dir=f"{shard_dir}/vcf_shards",
+    )
+
+    return mt
+
+
 def chunks(items, binsize):
     lst = []
     for item in items:
@@ -395,31 +522,73 @@ def chunks(items, binsize):
         yield lst
 
 
-def main(args):  # noqa: D103
-    # start SQL session and initialize constants
-    participant_data = args.input_tsv
-    coverage_mt_path = args.coverage_mt_path
-    output_bucket = args.output_bucket
-    temp_dir = args.temp_dir
+def get_output_paths(args: argparse.Namespace) -> Dict[str, str]:
+    """
+    Get the paths of the intermediate and final outputs of this script.
+
+    :param args: Parsed arguments of this script
+    :return: Dictionary with raw_mt (the merged VCFs), raw_mt_2 (after determining homoplasmic reference sites), mt, tsv, and vcf
+    """
+    return {
+        "raw_mt": f"{args.output_bucket}/raw_combined.mt",
+        "raw_mt_2": f"{args.output_bucket}/raw_combined_2.mt",
+        "mt": f"{args.output_bucket}/{args.file_name}.mt",
+        "tsv": f"{args.output_bucket}/{args.file_name}.tsv.bgz",
+        "vcf": f"{args.output_bucket}/{args.file_name}.vcf.bgz",
+    }
+
+
+def prepare_vcf_paths(args: argparse.Namespace) -> Dict[str, str]:
+    """
+    Collect the VCF paths of the samples to combine and validate them before merging (unless --skip-preflight is set).
+
+    Hail is only started here if the manifest or the VCFs are on a Hadoop filesystem, otherwise the paths are validated
+    before Hail starts.
+
+    :param args: Parsed arguments of this script
+    :return: Dictionary with sample name as key and path to VCF as value
+    """
     participants_to_subset = None if args.participants_to_subset is None else f'gs://{args.participants_to_subset}'
-    chunk_size = args.chunk_size
-    artifact_prone_sites_path = args.artifact_prone_sites_path
-    artifact_prone_sites_reference = args.artifact_prone_sites_reference
-    include_extra_v2_fields = args.include_extra_v2_fields
-    file_name = args.file_name
-    minimum_homref_coverage = args.minimum_homref_coverage
-    num_merges = args.split_merging
-    vcf_col_name = args.vcf_col_name#'vcf'
-    hl.init(tmp_dir=temp_dir)
 
-    if int(hl.version().split('-')[0].split('.')[2]) >= 75: # only use this if using hail 0.2.75 or greater
-        logger.info("Setting hail flag to avoid array index out of bounds error...")
-        # Setting this flag isn't generally recommended, but is needed (since at least Hail version 0.2.75) to avoid an array index out of bounds error until changes are made in future versions of Hail
-        # TODO: reassess if this flag is still needed for future versions of Hail
-        hl._set_flags(no_whole_stage_codegen="1")
+    # Paths on Hadoop filesystems (such as hdfs:// or dnax://) are read through Hail, so Hail is started with the
+    # settings of this script before they are touched rather than implicitly with its defaults
+    if requires_hail(args.input_tsv):
+        init_hail(tmp_dir=args.temp_dir)
+
+    logger.info("Collecting VCF paths for samples to subset...")
+    vcf_paths = collect_vcf_paths(
+        args.input_tsv, args.vcf_col_name, participants_to_subset
+    )
+    if not args.skip_preflight:
+        checked_paths = list(vcf_paths.values())
+        if args.preflight_cache is not None:
+            checked_paths.append(args.preflight_cache)
+        if any(requires_hail(x) for x in checked_paths):
+            init_hail(tmp_dir=args.temp_dir)
+        logger.info("Validating VCF paths before merging...")
+        preflight_check(
+            list(vcf_paths.values()),
+            header_check=is_vcf_header if args.check_headers else None,
+            n_threads=args.preflight_threads,
+            cache_path=args.preflight_cache,
+        )
+
+    return vcf_paths
+
 
-    output_path_mt = f"{output_bucket}/raw_combined.mt"
-    output_path_mt_2 = f"{output_bucket}/raw_combined_2.mt"
+def merge_vcfs(vcf_paths: Dict[str, str], args: argparse.Namespace) -> hl.MatrixTable:
+    """
+    Merge the VCFs into one MatrixTable and checkpoint it (to the raw_mt output path).
+
+    This does not depend on the coverage MatrixTable, so it can run while coverage is being combined.
+
+    :param vcf_paths: Dictionary with sample name as key and path to VCF as value
+    :param args: Parsed arguments of this script
+    :return: Merged MatrixTable
+    """
+    import hail as hl
+
+    output_path_mt = get_output_paths(args)["raw_mt"]
 
     if args.overwrite == False and hl.hadoop_exists(output_path_mt):
         logger.warning(
@@ -427,50 +596,147 @@ def main(args):  # noqa: D103
             output_path_mt,
         )
 
-    logger.info("Collecting VCF paths for samples to subset...")
-    vcf_paths = collect_vcf_paths(
-        participant_data, vcf_col_name, participants_to_subset
+    logger.info("Combining VCFs...")
+    combined_mt = join_mitochondria_vcfs_into_mt(
+        vcf_paths,
+        args.temp_dir,
+        args.chunk_size,
+        args.include_extra_v2_fields,
+        args.split_merging,
+        args.n_final_partitions,
+        args.target_partition_mb * 1024 * 1024,
     )
 
-    logger.info("Combining VCFs...")
-    combined_mt = join_mitochondria_vcfs_into_mt(vcf_paths, temp_dir, chunk_size, include_extra_v2_fields, num_merges)
-    combined_mt = combined_mt.repartition(100).checkpoint(output_path_mt, overwrite=args.overwrite)
+    # The joined MatrixTable is already partitioned by the size of the written union (see join_mitochondria_vcfs_into_mt)
+    return combined_mt.checkpoint(output_path_mt, overwrite=args.overwrite)
+
+
+def finish_combined_mt(
+    combined_mt: hl.MatrixTable, args: argparse.Namespace, coverage_mt: Optional[hl.MatrixTable] = None
+) -> hl.MatrixTable:
+    """
+    Determine homoplasmic reference sites, apply the artifact_prone_site filter, and write the final outputs.
+
+    :param combined_mt: Merged MatrixTable returned by merge_vcfs
+    :param args: Parsed arguments of this script
+    :param coverage_mt: Optional coverage table already read from --coverage-mt-path (see determine_hom_refs)
+    :return: Final combined MatrixTable, as written to the mt output path
+    """
+    import hail as hl
+
+    coverage_mt_path = args.coverage_mt_path
+    output_bucket = args.output_bucket
+    temp_dir = args.temp_dir
+    artifact_prone_sites_path = args.artifact_prone_sites_path
+    artifact_prone_sites_reference = args.artifact_prone_sites_reference
+    file_name = args.file_name
+    minimum_homref_coverage = args.minimum_homref_coverage
+    target_partition_bytes = args.target_partition_mb * 1024 * 1024
+    output_paths = get_output_paths(args)
 
     logger.info("Removing select sample-level filters...")
     combined_mt = remove_genotype_filters(combined_mt)
 
     logger.info("Determining homoplasmic reference sites...")
-    combined_mt = determine_hom_refs(combined_mt, coverage_mt_path, minimum_homref_coverage)
-    combined_mt = combined_mt.checkpoint(output_path_mt_2, overwrite=args.overwrite)
+    combined_mt = determine_hom_refs(
+        combined_mt, coverage_mt_path, minimum_homref_coverage, coverage_mt=coverage_mt
+    )
+    combined_mt = combined_mt.checkpoint(output_paths["raw_mt_2"], overwrite=args.overwrite)
+    # The final outputs are sized from the written MatrixTable with the homoplasmic reference sites
+    n_final_partitions = get_n_partitions(
+        n_partitions=args.n_final_partitions,
+        path=output_paths["raw_mt_2"],
+        target_partition_bytes=target_partition_bytes,
+    )
 
     logger.info("Applying artifact_prone_site fiter...")
     combined_mt = apply_mito_artifact_filter(combined_mt, artifact_prone_sites_path, artifact_prone_sites_reference)
 
     logger.info("Writing combined MT...")
     # Set the file names for output files
-    out_vcf = f"{output_bucket}/{file_name}.vcf.bgz"
-    out_mt = f"{output_bucket}/{file_name}.mt"
-    out_tsv = f"{output_bucket}/{file_name}.tsv.bgz"
+    out_vcf = output_paths["vcf"]
+    out_mt = output_paths["mt"]
+    out_tsv = output_paths["tsv"]
+
+    if args.multi_sink_export:
+        combined_mt = export_final_outputs(
+            combined_mt,
+            out_mt,
+            out_tsv,
+            out_vcf,
+            n_final_partitions,
+            shard_dir=f"{temp_dir}/{file_name}_shards",
+            n_threads=args.vcf_export_threads,
+            overwrite=args.overwrite,
+        )
+    else:
+        combined_mt = repartition_to_target(combined_mt, n_final_partitions).checkpoint(out_mt, overwrite=args.overwrite)
+
+    if args.sample_major_output:
+        logger.info("Writing sample-major calls and coverage...")
+        write_sample_major_callset(
+            combined_mt,
+            f"{output_bucket}/{file_name}_sample_major.ht",
+            coverage_mt_path=coverage_mt_path,
+            n_partitions=args.n_final_partitions,
+            overwrite=args.overwrite,
+            mt_path=out_mt,
+            target_partition_bytes=target_partition_bytes,
+        )
 
-    combined_mt = combined_mt.repartition(args.n_final_partitions).checkpoint(out_mt, overwrite=args.overwrite)
+    if not args.multi_sink_export:
+        logger.info("Writing trimmed variants table...")
+        ht_for_tsv = combined_mt.entries()
+        #ht_for_tsv = ht_for_tsv.annotate(HL=hl.if_else(hl.is_defined(ht_for_tsv['HL']), ht_for_tsv['HL'], 0))
+        #ht_for_tsv = ht_for_tsv.annotate(FT=hl.if_else(ht_for_tsv['HL']==0, hl.missing('set<str>'), ht_for_tsv['FT']))
+        ht_for_tsv = ht_for_tsv.filter(hl.is_missing(ht_for_tsv.HL) | (ht_for_tsv.HL > 0))
+        # The text outputs are sized from the written final MT
+        ht_for_tsv.repartition(
+            get_n_partitions(path=out_mt, target_partition_bytes=target_partition_bytes)
+        ).export(out_tsv)
+
+        logger.info("Writing combined VCF...")
+        # For the VCF output, join FT values by semicolon
+        vcf_mt = combined_mt.annotate_entries(
+            FT=hl.str(";").join(hl.array(combined_mt.FT))
+        )
+        if args.sharded_vcf_export:
+            # Each of the final partitions is written as a separate shard, then the shards are concatenated and indexed
+            export_sharded_vcf(
+                vcf_mt,
+                out_vcf,
+                metadata=META_DICT,
+                n_threads=args.vcf_export_threads,
+                shard_dir=f"{temp_dir}/{file_name}_vcf_shards",
+            )
+        else:
+            hl.export_vcf(
+                vcf_mt.repartition(
+                    get_n_partitions(path=out_mt, target_partition_bytes=target_partition_bytes)
+                ),
+                out_vcf,
+                metadata=META_DICT,
+            )
 
-    logger.info("Writing trimmed variants table...")
-    ht_for_tsv = combined_mt.entries()
-    #ht_for_tsv = ht_for_tsv.annotate(HL=hl.if_else(hl.is_defined(ht_for_tsv['HL']), ht_for_tsv['HL'], 0))
-    #ht_for_tsv = ht_for_tsv.annotate(FT=hl.if_else(ht_for_tsv['HL']==0, hl.missing('set<str>'), ht_for_tsv['FT']))
-    ht_for_tsv = ht_for_tsv.filter(hl.is_missing(ht_for_tsv.HL) | (ht_for_tsv.HL > 0))
-    ht_for_tsv.repartition(50).export(out_tsv)
+    return combined_mt
 
-    logger.info("Writing combined VCF...")
-    # For the VCF output, join FT values by semicolon
-    combined_mt = combined_mt.annotate_entries(
-        FT=hl.str(";").join(hl.array(combined_mt.FT))
-    )
-    hl.export_vcf(combined_mt.repartition(100), out_vcf, metadata=META_DICT)
 
+def main(args):  # noqa: D103
+    vcf_paths = prepare_vcf_paths(args)
+    init_hail(tmp_dir=args.temp_dir)
+    combined_mt = merge_vcfs(vcf_paths, args)
+    finish_combined_mt(combined_mt, args)
 
 
-if __name__ == "__main__":
+def parse_arguments(argv: Optional[list] = None, check_inputs: bool = True) -> argparse.Namespace:
+    """
+    Parse and validate the arguments of this script.
+
+    :param argv: Command line arguments, defaults to those of the running process
+    :param check_inputs: Whether to check that local input paths exist. run_pipeline_dag.py checks the inputs of its
+        stages itself, since some of them are only written by earlier stages
+    :return: Parsed arguments
+    """
     p = argparse.ArgumentParser(
         description="This script combines individual mitochondria VCF files into one MatrixTable, determines homoplasmic reference sites, and applies an artifact_prone_site filter"
     )
@@ -483,7 +749,7 @@ if __name__ == "__main__":
     p.add_argument(
         "-c",
         "--coverage-mt-path",
-        help="Path to MatrixTable of sample-level coverage (per-sample and per-base, can be generated by running annotate_coverage.py)",
+        help="Path to the coverage table of sample-level coverage (per-sample and per-base, written by annotate_coverage.py as <output>_coverage_table.mt; locus-keyed coverage MatrixTables are also accepted)",
         required=True,
     )
     p.add_argument(
@@ -543,12 +809,66 @@ if __name__ == "__main__":
     p.add_argument("--overwrite", help="Overwrites existing files", action="store_true")
     p.add_argument("--include-extra-v2-fields", help="Loads in exåtra fields from MitochondriaPipeline v2.1, specifically AD, OriginalSelfRefAlleles, and SwappedFieldIDs. If missing will fill with missing.", action="store_true")
     p.add_argument(
-        "--n-final-partitions", type=int, default=1000, help='Number of partitions for final mt.'
+        "--n-final-partitions", type=int, help='Number of partitions for final mt (and for the merged mt, split evenly between the subsets of --split-merging). Overrides the number chosen from the size of the written data (see --target-partition-mb).'
+    )
+    p.add_argument(
+        "--target-partition-mb", type=int, default=128, help='Target size in MB of each partition. The number of partitions of the merged mt is chosen from the size of the written union of the VCFs, that of the final mt from the size of the written mt with homoplasmic reference sites, and that of the TSV and VCF outputs from the size of the written final mt.'
     )
     p.add_argument(
         '--split-merging', type=int, default=1, help='Will split the merging into this many jobs which will be merged at the end. Uses the same order each time such that if it fails we can read from previous files.'
     )
 
-    args = p.parse_args()
+    p.add_argument(
+        "--multi-sink-export",
+        help="Export the entries TSV and VCF from the partitions of the final MT (one shard per partition, concatenated into single bgzipped files) instead of repartitioning for each output",
+        action="store_true",
+    )
+    p.add_argument(
+        "--sample-major-output",
+        help="Also write the calls and per-base coverage keyed and partitioned by sample ID (to <file-name>_sample_major.ht) for per-sample retrieval",
+        action="store_true",
+    )
+    p.add_argument(
+        "--sharded-vcf-export",
+        help="Export the VCF as shards written in parallel that are concatenated into a single bgzipped VCF and tabix indexed, rather than through a single writer",
+        action="store_true",
+    )
+    p.add_argument(
+        "--vcf-export-threads",
+        help="Number of shards to read concurrently when concatenating shards (only used with --sharded-vcf-export or --multi-sink-export)",
+        type=int,
+        default=8,
+    )
+    p.add_argument(
+        "--skip-preflight",
+        help="Skip checking that every VCF path exists and is non-empty before merging",
+        action="store_true",
+    )
+    p.add_argument(
+        "--check-headers",
+        help="Also check that every VCF starts with a VCF header during the pre-flight check (reads the first block of each file)",
+        action="store_true",
+    )
+    p.add_argument(
+        "--preflight-threads",
+        help="Number of paths to check concurrently during the pre-flight check",
+        type=int,
+        default=DEFAULT_PREFLIGHT_THREADS,
+    )
+    p.add_argument(
+        "--preflight-cache",
+        help="Path of a JSON file caching pre-flight results, so that header checks are skipped for files unchanged since they last passed",
+    )
 
+    args = p.parse_args(argv)
+    if check_inputs:
+        check_local_inputs(
+            p, args, ["input_tsv", "coverage_mt_path", "artifact_prone_sites_path"]
+        )
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
     main(args)
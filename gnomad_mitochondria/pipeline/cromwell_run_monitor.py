@@ -1,9 +1,10 @@
-from google.cloud import storage
 from datetime import datetime
 import pandas as pd
 import os, re
 import argparse
 
+from gnomad_mitochondria.utils.storage import get_storage, use_local_standin
+
 
 SHARD_SEARCH = 'shard-[0-9]{1,}'
 NMERGE = 3
@@ -22,18 +23,60 @@ subtasks_order = {'call-AlignAndCallR1':['call-CallNucHCIntegrated', 'call-CallN
 subtasks_map_to_order = {k: {x: idx for idx, x in enumerate(lst)} for k, lst in subtasks_order.items()}
 
 
-def list_gcs_directories(client, bucket, prefix):
-    # from https://github.com/GoogleCloudPlatform/google-cloud-python/issues/920
-    iterator = client.list_blobs(bucket, prefix=prefix, delimiter='/')
-    prefixes = set()
-    for page in iterator.pages:
-        prefixes.update(page.prefixes)
-    return prefixes
+def list_prefix(storage, prefix):
+    """
+    List the entries directly below a prefix.
+
+    A missing prefix lists as empty, as it does on GCS.
+
+    :param storage: Storage backend of the prefix
+    :param prefix: Path of the directory to list
+    :return: List of entries (see StorageBackend.list)
+    """
+    try:
+        return storage.list(prefix)
+    except FileNotFoundError:
+        return []
+
+
+def list_directories(storage, prefix):
+    """
+    List the directories directly below a prefix.
+
+    Directories are returned with a trailing slash, so that paths below them can be appended directly.
+
+    :param storage: Storage backend of the prefix
+    :param prefix: Path of the directory to list
+    :return: Set of directory paths
+    """
+    return set(x['path'] + '/' for x in list_prefix(storage, prefix) if x['is_dir'])
+
+
+def list_files(storage, prefix):
+    """
+    List the files directly below a prefix.
+
+    :param storage: Storage backend of the prefix
+    :param prefix: Path of the directory to list
+    :return: List of file paths
+    """
+    return [x['path'] for x in list_prefix(storage, prefix) if not x['is_dir']]
+
+
+def read_first_line(storage, path):
+    """
+    Read the first line of a text file.
+
+    :param storage: Storage backend of the file
+    :param path: Path of the file
+    :return: First line without the newline
+    """
+    return storage.read_text(path).split('\n')[0]
 
 
-def update_path_for_attempts(client, bucket, path, blobs):
+def update_path_for_attempts(storage, path, files):
     # check for any folders labeled attempt
-    dirs = list_gcs_directories(client, bucket, path)
+    dirs = list_directories(storage, path)
     attempts = [os.path.basename(os.path.dirname(x)) for x in dirs if re.search('attempt-[0-9]{1,}$', os.path.basename(os.path.dirname(x)))]
     
     if len(attempts) > 0:
@@ -43,52 +86,51 @@ def update_path_for_attempts(client, bucket, path, blobs):
         # obtain a new path containing the latest attempt
         path = path + 'attempt-' + str(latest_attempt) + '/'
 
-        # check for new blobs
-        blobs = list(bucket.list_blobs(prefix=path, delimiter='/'))
+        # check for new files
+        files = list_files(storage, path)
     
-    return blobs, path, len(attempts) > 0
+    return files, path, len(attempts) > 0
 
 
-def test_success(client, bucket, path):
+def test_success(storage, path):
     """
     A completed job has an RC file with code 0 and a finished log file.
     If RC is present and the log file has failed that will explain why.
     If RC is missing, then the job likely is in progress and we will allow multiple log blobs. We will still check for failure.
     Added routine to check for preempted runs.
     """
-    blobs = list(bucket.list_blobs(prefix=path, delimiter='/'))
-    rc_found = 'rc' in [os.path.basename(x.name) for x in blobs]
+    files = list_files(storage, path)
+    rc_found = 'rc' in [os.path.basename(x) for x in files]
     if rc_found:
-        rc_blob = [x for x in blobs if os.path.basename(x.name) == 'rc'][0]
-        rc_out = (rc_blob.download_as_string().decode('utf8').split('\n'))[0]
+        rc_out = read_first_line(storage, [x for x in files if os.path.basename(x) == 'rc'][0])
     else:
-        blobs, path, tf_update = update_path_for_attempts(client, bucket, path, blobs)
-        if tf_update and ('rc' in [os.path.basename(x.name) for x in blobs]):
+        files, path, tf_update = update_path_for_attempts(storage, path, files)
+        if tf_update and ('rc' in [os.path.basename(x) for x in files]):
             rc_found = True
-            rc_blob = [x for x in blobs if os.path.basename(x.name) == 'rc'][0]
-            rc_out = (rc_blob.download_as_string().decode('utf8').split('\n'))[0]
+            rc_out = read_first_line(storage, [x for x in files if os.path.basename(x) == 'rc'][0])
         else:
             rc_out = 'NA'
 
-    log_blobs = [(x, x.name) for x in bucket.list_blobs(prefix=path, delimiter='/') if re.search('.log$', os.path.basename(x.name))]
-    if rc_found and (len(log_blobs) != 1):
+    # the listing above is reused, it is already of the latest attempt
+    log_files = [x for x in files if re.search('.log$', os.path.basename(x))]
+    if rc_found and (len(log_files) != 1):
         raise ValueError('ERROR: there should be exactly 1 log file in each folder for testing when rc was returned.')
-    elif len(log_blobs) > 1:
+    elif len(log_files) > 1:
         raise ValueError('ERROR: there should not be >1 log file in the search folder.')
     
-    if (len(log_blobs) == 0):
+    if (len(log_files) == 0):
         log_path = 'NA'
         pass_log = False
         fail_log = False
     else:
-        this_log = log_blobs[0][0].download_as_string().decode('utf8').split('\n')
-        log_path = 'gs://' + bucket.name + '/' + log_blobs[0][0].name
+        this_log = storage.read_text(log_files[0]).split('\n')
+        log_path = log_files[0]
         item_to_check = this_log[len(this_log)-2]
         pass_log = re.search('Done delocalization.$', item_to_check)
         fail_log = re.search('^Required file output.+does not exist.$', item_to_check)
     pass_rc = rc_found and (rc_out == '0')
     if pass_log and pass_rc and not fail_log:
-        return 'PASS', len(list(bucket.list_blobs(prefix=path+'out/', delimiter='/'))), log_path, rc_out
+        return 'PASS', len(list_files(storage, path+'out/')), log_path, rc_out
     elif fail_log and (not pass_log or not pass_rc):
         return 'FAIL', 0, log_path, rc_out
     elif not fail_log and not pass_log:
@@ -98,11 +140,11 @@ def test_success(client, bucket, path):
         raise ValueError('Does not make sense for the localization file to have both PASS and FAIL flags.')
 
 
-def process_single_run(storage_client, bucket, this_folder, run_folder, success_only):
-    run_prefix = f'{run_folder}/MitochondriaPipelineWrapper/{this_folder}/'
+def process_single_run(storage, root, this_folder, run_folder, success_only):
+    run_prefix = f'{root}/{run_folder}/MitochondriaPipelineWrapper/{this_folder}/'
 
     # get all subfolders
-    subfolders = list_gcs_directories(storage_client, bucket, run_prefix)
+    subfolders = list_directories(storage, run_prefix)
     dirnames = [os.path.basename(os.path.dirname(x)) for x in subfolders]
 
     # check for merged files
@@ -115,26 +157,25 @@ def process_single_run(storage_client, bucket, this_folder, run_folder, success_
         merge_items = 0
     else:
         merge_not_run = False
-        merge_res, merge_items, merge_log, _ = test_success(storage_client, bucket, run_prefix + 'call-MergeMitoMultiSampleOutputsInternal/')
+        merge_res, merge_items, merge_log, _ = test_success(storage, run_prefix + 'call-MergeMitoMultiSampleOutputsInternal/')
 
     if success_only:
         shards = [None]
     else:
         # get shard subfolders
         shard_prefix = f'{run_prefix}call-MitochondriaPipeline_v2_5/'
-        shard_subfolders = list_gcs_directories(storage_client, bucket, shard_prefix)
+        shard_subfolders = list_directories(storage, shard_prefix)
         shard_dirnames = [os.path.basename(os.path.dirname(x)) for x in shard_subfolders]
         shards = [path for path, main_dir in zip(shard_subfolders, shard_dirnames) if re.search(SHARD_SEARCH, main_dir)]
 
     return shards, merge_not_run, merge_items, merge_res, merge_log
 
 
-def process_merging_run(bucket, this_folder, merge_items, merge_log):
+def process_merging_run(storage, this_folder, merge_items, merge_log):
     if merge_items != 0:
         raise ValueError(f'ERROR: there should be {str(0)} items in the output folder from merging.')
-    merged_prefix = '/'.join(os.path.dirname(merge_log).split('/')[3:])
-    files_output_merge = [os.path.basename(x.name) for x in bucket.list_blobs(prefix=merged_prefix+'/', delimiter='/')]
-    gs_prefix = f'gs://{bucket.name}'
+    merged_prefix = os.path.dirname(merge_log)
+    files_output_merge = [os.path.basename(x) for x in list_files(storage, merged_prefix+'/')]
     
     if len([x for x in files_output_merge if re.search('^batch_', x)]) != NMERGE:
         raise ValueError(f'ERROR: there should be {str(NMERGE)} items with the batch_ prefix as products from merging.')
@@ -145,24 +186,24 @@ def process_merging_run(bucket, this_folder, merge_items, merge_log):
     if 'batch_analysis_statistics.tsv' not in files_output_merge:
         raise ValueError(f'ERROR: run statistics file not found in batch {this_folder}')
     
-    df = pd.DataFrame({'merging_log': [merge_log], 'merged_calls': f'{gs_prefix}/{merged_prefix}/batch_merged_mt_calls.vcf.bgz', 
-                        'merged_coverage': f'{gs_prefix}/{merged_prefix}/batch_merged_mt_coverage.tsv.bgz', 
-                        'merged_statistics': f'{gs_prefix}/{merged_prefix}/batch_analysis_statistics.tsv'})
+    df = pd.DataFrame({'merging_log': [merge_log], 'merged_calls': f'{merged_prefix}/batch_merged_mt_calls.vcf.bgz', 
+                        'merged_coverage': f'{merged_prefix}/batch_merged_mt_coverage.tsv.bgz', 
+                        'merged_statistics': f'{merged_prefix}/batch_analysis_statistics.tsv'})
 
     return df
 
 
-def obtain_latest_shard_run(storage_client, bucket, shards):
+def obtain_latest_shard_run(storage, shards):
 
     # round 1: make sure there are the same number of elements per shard
     prefixes1 = {os.path.basename(os.path.dirname(x)): x+'MitochondriaPipeline/' for x in list(shards)}
-    subpaths1 = {k: list(list_gcs_directories(storage_client, bucket, v)) for k,v in prefixes1.items()}
+    subpaths1 = {k: list(list_directories(storage, v)) for k,v in prefixes1.items()}
     if not all([len(v) == 1 for _, v in subpaths1.items()]):
         raise ValueError('ERROR: all sub-shards should have only 1 path.')
 
     # round 2: check tasks completed per shard
     prefixes2 = {k: v[0] for k,v in subpaths1.items()}
-    subpaths2 = {k: list(list_gcs_directories(storage_client, bucket, v)) for k,v in prefixes2.items()}
+    subpaths2 = {k: list(list_directories(storage, v)) for k,v in prefixes2.items()}
     tasks_run = {k: [os.path.basename(os.path.dirname(x)) for x in v] for k,v in subpaths2.items()}
     latest_run = {x: known_order[max([map_task_to_order[spec_task] for spec_task in tasks])] for x, tasks in tasks_run.items()}
 
@@ -173,27 +214,27 @@ def obtain_latest_shard_run(storage_client, bucket, shards):
             this_path = prefixes2[shard_id] + latest_task + '/' + subtask_folders[latest_task] + '/'
             this_order_mapping = subtasks_map_to_order[latest_task]
             this_ordering = subtasks_order[latest_task]
-            subpaths_subtask = list(list_gcs_directories(storage_client, bucket, this_path))
+            subpaths_subtask = list(list_directories(storage, this_path))
             if len(subpaths_subtask) != 1:
                 raise ValueError('ERROR: all sub-shards should have only 1 path.')
     
-            subtasks_paths = list(list_gcs_directories(storage_client, bucket, subpaths_subtask[0]))
+            subtasks_paths = list(list_directories(storage, subpaths_subtask[0]))
             subtasks = {os.path.basename(os.path.dirname(x)):x for x in subtasks_paths}
             subtask_latest_run = this_ordering[max([this_order_mapping[spec_task] for spec_task, _ in subtasks.items()])]
-            dct_success_test.update({shard_id: {subtask_latest_run: test_success(storage_client, bucket, subpaths_subtask[0] + subtask_latest_run + '/')}})
+            dct_success_test.update({shard_id: {subtask_latest_run: test_success(storage, subpaths_subtask[0] + subtask_latest_run + '/')}})
 
         else:
-            dct_success_test.update({shard_id: {latest_task: test_success(storage_client, bucket, prefixes2[shard_id] + latest_task + '/')}})
+            dct_success_test.update({shard_id: {latest_task: test_success(storage, prefixes2[shard_id] + latest_task + '/')}})
     
     return dct_success_test
 
 
-def check_success_single(storage_client, bucket, this_folder, run_folder, success_only):
-    shards, merge_not_run, merge_items, merge_res, merge_log = process_single_run(storage_client, bucket, this_folder, run_folder, success_only)
+def check_success_single(storage, root, this_folder, run_folder, success_only):
+    shards, merge_not_run, merge_items, merge_res, merge_log = process_single_run(storage, root, this_folder, run_folder, success_only)
 
     if (not merge_not_run) and (merge_res == 'PASS'):
         failed = False       
-        df = process_merging_run(bucket, this_folder, merge_items, merge_log)
+        df = process_merging_run(storage, this_folder, merge_items, merge_log)
     elif (not merge_not_run) and (merge_res == 'FAIL'):
         failed = True
         df = pd.DataFrame({'shard': ['NA'], 'latest_task': ['call-MergeMitoMultiSampleOutputsInternal'], 'status': ['FAIL'], 'log_file': [merge_log]})
@@ -206,7 +247,7 @@ def check_success_single(storage_client, bucket, this_folder, run_folder, succes
             df = pd.DataFrame({'shard': ['NA'], 'status': ['NOT YET MERGING'], 'log_file': ['NA']})
         else:
             failed = True
-            dct_success_test = obtain_latest_shard_run(storage_client, bucket, shards)
+            dct_success_test = obtain_latest_shard_run(storage, shards)
 
             # filter to in progress
             in_progress = [(k, call, item[2]) for k, v in dct_success_test.items() for call, item in v.items() if item[0] == 'IN PROGRESS']
@@ -233,8 +274,8 @@ def check_success_single(storage_client, bucket, this_folder, run_folder, succes
     return df, not failed
 
 
-def count_shards_single(storage_client, bucket, this_folder, run_folder):
-    shards, _, _, _, _ = process_single_run(storage_client, bucket, this_folder, run_folder)
+def count_shards_single(storage, root, this_folder, run_folder):
+    shards, _, _, _, _ = process_single_run(storage, root, this_folder, run_folder, success_only=False)
     return len(shards)
 
 
@@ -281,6 +322,7 @@ parser.add_argument('--subfolder', type=str, default=None, help='Run path. If pr
 parser.add_argument('--sub-ids', type=str, help='Path to workflow IDs. Assumes this has the correct count and is ordered by the workflow number.')
 parser.add_argument('--sample-lists', type=str, help='Path to sample lists for analysis. Place {} where the workflow ID is.')
 parser.add_argument('--output', type=str, help='Prefix for output files. Only used if --check-success is enabled.')
+parser.add_argument('--storage-standin', type=str, default=None, help='Local directory standing in for cloud storage (the workspace bucket is read from <dir>/gs/<bucket>). For testing and benchmarking without cloud access.')
 
 
 if __name__ == '__main__':
@@ -291,12 +333,13 @@ if __name__ == '__main__':
     if args.success_only and args.hide_pass:
         raise argparse.ArgumentError('ERROR: cannot enable both --success-only and --hide-pass.')
     
-    bucket_id = os.path.basename(os.getenv("WORKSPACE_BUCKET"))
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_id)
+    if args.storage_standin is not None:
+        use_local_standin(args.storage_standin)
+    root = f'gs://{os.path.basename(os.getenv("WORKSPACE_BUCKET"))}'
+    storage = get_storage(root)
 
     if args.subfolder is None:
-        subfolders_to_test = [os.path.basename(os.path.dirname(x)) for x in list_gcs_directories(storage_client, bucket, f'{args.run_folder}/MitochondriaPipelineWrapper/')]
+        subfolders_to_test = [os.path.basename(os.path.dirname(x)) for x in list_directories(storage, f'{root}/{args.run_folder}/MitochondriaPipelineWrapper/')]
     else:
         subfolders_to_test = [args.subfolder]
 
@@ -308,7 +351,7 @@ if __name__ == '__main__':
             if os.path.exists(f'{args.output}.{suffix}.tsv'):
                 os.remove(f'{args.output}.{suffix}.tsv')
 
-        res = [check_success_single(storage_client, bucket, x, args.run_folder, args.success_only) for x in subfolders_to_test]
+        res = [check_success_single(storage, root, x, args.run_folder, args.success_only) for x in subfolders_to_test]
         print(f'Of {str(len(res))} runs, {str(sum([success for _, success in res]))} are finished.')
         if sum([success for _, success in res]) > 0:
             for batch, this_res in zip(subfolders_to_test, res):
@@ -350,7 +393,7 @@ if __name__ == '__main__':
                             print(df_stalled[['subpath_id', 'shard', 'latest_task']].to_string())
 
     if args.get_shard_count:
-        ct = {x: count_shards_single(storage_client, bucket, x, args.run_folder) for x in subfolders_to_test}
+        ct = {x: count_shards_single(storage, root, x, args.run_folder) for x in subfolders_to_test}
         for fold, shardcount in ct.items():
             print(f'For batch {fold}:')
             print(f'Shard count: {str(shardcount)}')
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+from __future__ import annotations
+
+import argparse
+import logging
+
+from typing import TYPE_CHECKING
+
+from gnomad_mitochondria.pipeline.add_annotations import (
+    AGE_HIST_PARAMS,
+    DP_HIST_PARAMS,
+    DP_MEAN_HIST_PARAMS,
+    HL_HIST_PARAMS,
+    MQ_MEAN_HIST_PARAMS,
+    TLOD_MEAN_HIST_PARAMS,
+    hist_bin_edges_expr,
+    memoized_faf_exprs,
+)
+from gnomad_mitochondria.utils.startup import init_hail
+
+if TYPE_CHECKING:
+    import hail as hl
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("merge aggregate states")
+logger.setLevel(logging.INFO)
+
+# Fields of the aggregate state (see generate_aggregate_state_expr in add_annotations.py) and how they are merged
+STRATUM_SUM_FIELDS = ["AN", "AC", "AC_hom", "AC_het"]
+STRATUM_HIST_FIELDS = {"hl_hist": HL_HIST_PARAMS}
+STATE_SUM_FIELDS = STRATUM_SUM_FIELDS + [
+    "dp_sum",
+    "dp_n",
+    "mq_sum",
+    "mq_n",
+    "tlod_sum",
+    "tlod_n",
+]
+STATE_HIST_FIELDS = {
+    **STRATUM_HIST_FIELDS,
+    "dp_hist_all": DP_HIST_PARAMS,
+    "dp_hist_alt": DP_HIST_PARAMS,
+    "age_hist_hom": AGE_HIST_PARAMS,
+    "age_hist_het": AGE_HIST_PARAMS,
+}
+STATE_MAX_FIELDS = ["max_hl"]
+STRATA = ["hap", "pop"]
+
+
+def merge_hist_states(
+    hists: hl.expr.ArrayExpression, hist_params: tuple
+) -> hl.expr.StructExpression:
+    """
+    Merge histogram states by summing the counts in each bin.
+
+    :param hists: Array of structs of bin_freq, n_smaller, and n_larger
+    :param hist_params: Tuple of start, end, and number of bins of the histogram
+    :return: Struct of the merged bin_freq, n_smaller, and n_larger
+    """
+    import hail as hl
+
+    return hl.struct(
+        bin_freq=hl.range(hist_params[2]).map(
+            lambda i: hl.sum(hists.map(lambda h: h.bin_freq[i]))
+        ),
+        n_smaller=hl.sum(hists.map(lambda h: h.n_smaller)),
+        n_larger=hl.sum(hists.map(lambda h: h.n_larger)),
+    )
+
+
+def _merge_structs(
+    states: hl.expr.ArrayExpression,
+    sum_fields: list,
+    hist_fields: dict,
+    max_fields: list = None,
+) -> dict:
+    """
+    Merge an array of state structs field by field.
+
+    :param states: Array of state structs (missing elements are ignored)
+    :param sum_fields: Fields that are merged by summation
+    :param hist_fields: Dictionary of histogram fields and their histogram parameters
+    :param max_fields: Fields that are merged by taking the maximum
+    :return: Dictionary of merged field expressions
+    """
+    import hail as hl
+
+    states = states.filter(lambda x: hl.is_defined(x))
+    merged = {f: hl.sum(states.map(lambda x: x[f])) for f in sum_fields}
+    merged.update(
+        {
+            f: merge_hist_states(states.map(lambda x: x[f]), hist_params)
+            for f, hist_params in hist_fields.items()
+        }
+    )
+    if max_fields:
+        merged.update({f: hl.max(states.map(lambda x: x[f])) for f in max_fields})
+
+    return merged
+
+
+def _merge_stratum_dicts(dicts: hl.expr.ArrayExpression) -> hl.expr.DictExpression:
+    """
+    Merge dictionaries of per-stratum (haplogroup or population) states.
+
+    :param dicts: Array of dictionaries keyed by stratum (missing elements are ignored)
+    :return: Dictionary containing the merged state of every stratum found in any of the input dictionaries
+    """
+    import hail as hl
+
+    dicts = dicts.filter(lambda x: hl.is_defined(x))
+    keys = hl.array(hl.set(hl.flatten(dicts.map(lambda x: x.keys()))))
+
+    return hl.dict(
+        keys.map(
+            lambda k: (
+                k,
+                hl.struct(
+                    **_merge_structs(
+                        dicts.filter(lambda x: x.contains(k)).map(lambda x: x[k]),
+                        STRATUM_SUM_FIELDS,
+                        STRATUM_HIST_FIELDS,
+                    )
+                ),
+            )
+        )
+    )
+
+
+def merge_state_exprs(states: hl.expr.ArrayExpression) -> dict:
+    """
+    Merge an array of site (or reference) states into a single state.
+
+    :param states: Array of aggregate state structs
+    :return: Dictionary of merged field expressions, in the same layout as the input states
+    """
+    merged = _merge_structs(
+        states, STATE_SUM_FIELDS, STATE_HIST_FIELDS, STATE_MAX_FIELDS
+    )
+    merged.update(
+        {
+            stratum: _merge_stratum_dicts(states.map(lambda x: x[stratum]))
+            for stratum in STRATA
+        }
+    )
+
+    return merged
+
+
+def check_state_compatibility(sites: list) -> None:
+    """
+    Check that aggregate states were generated with the same thresholds and histogram parameters.
+
+    :param sites: List of sites Tables of aggregate states
+    :return: None
+    """
+    import hail as hl
+
+    state_params = [hl.eval(ht.state_params) for ht in sites]
+    for i, params in enumerate(state_params[1:], start=1):
+        if params != state_params[0]:
+            raise ValueError(
+                f"Aggregate state {i} was generated with parameters {params}, which do not match {state_params[0]}"
+            )
+
+
+def merge_aggregate_states(
+    state_dirs: list, output_dir: str, overwrite: bool = False
+) -> None:
+    """
+    Merge the aggregate states of several batches into a single state.
+
+    For every batch, a site that was not observed in the batch is given the batch's reference state at that position,
+    so the merged AN and DP histograms account for the homoplasmic reference samples of every batch.
+    The merged state has the same layout as the per-batch states, so a previously merged release can be merged with new batches.
+
+    NOTE: Genotype and variant filters are not part of the state and are not recomputed by merging.
+
+    :param state_dirs: List of directories containing aggregate states (written by add_annotations.py or by this function)
+    :param output_dir: Directory to which the merged state should be written
+    :param overwrite: Whether or not to overwrite existing files
+    :return: None
+    """
+    import hail as hl
+
+    logger.info("Merging aggregate states of %i batches...", len(state_dirs))
+    sites = [hl.read_table(f"{state_dir}/sites.ht") for state_dir in state_dirs]
+    references = [
+        hl.read_table(f"{state_dir}/reference.ht") for state_dir in state_dirs
+    ]
+    check_state_compatibility(sites)
+
+    batch_references = hl.Table.multi_way_zip_join(
+        references, "states", "batch_globals"
+    )
+    batch_references = batch_references.checkpoint(
+        f"{output_dir}/batch_references.ht", overwrite=overwrite
+    )
+    reference_ht = batch_references.select(**merge_state_exprs(batch_references.states))
+    reference_ht = reference_ht.select_globals()
+    reference_ht.write(f"{output_dir}/reference.ht", overwrite=overwrite)
+
+    # Sites absent from a batch are missing in the zipped array and are replaced by that batch's reference state
+    sites_ht = hl.Table.multi_way_zip_join(sites, "states", "batch_globals")
+    sites_ht = sites_ht.annotate(
+        states=hl.zip(sites_ht.states, batch_references[sites_ht.locus].states).map(
+            lambda x: hl.coalesce(x[0], x[1])
+        )
+    )
+    sites_ht = sites_ht.select(**merge_state_exprs(sites_ht.states))
+    sites_ht = sites_ht.select_globals(
+        state_params=sites_ht.batch_globals[0].state_params,
+        n_samples=hl.sum(sites_ht.batch_globals.map(lambda x: x.n_samples)),
+        age_hist_all_samples=merge_hist_states(
+            sites_ht.batch_globals.map(lambda x: x.age_hist_all_samples),
+            AGE_HIST_PARAMS,
+        ),
+    )
+    sites_ht.write(f"{output_dir}/sites.ht", overwrite=overwrite)
+
+    samples_ht = hl.Table.union(
+        *[hl.read_table(f"{state_dir}/samples.ht") for state_dir in state_dirs]
+    )
+    samples_ht.write(f"{output_dir}/samples.ht", overwrite=overwrite)
+
+
+def _finalize_hist(
+    hist_state: hl.expr.StructExpression, hist_params: tuple
+) -> hl.expr.StructExpression:
+    """
+    Add bin edges back to a histogram state.
+
+    :param hist_state: Struct of bin_freq, n_smaller, and n_larger
+    :param hist_params: Tuple of start, end, and number of bins of the histogram
+    :return: Struct in the format output by hl.agg.hist
+    """
+    import hail as hl
+
+    return hl.struct(
+        bin_edges=hist_bin_edges_expr(hist_params),
+        bin_freq=hist_state.bin_freq,
+        n_smaller=hist_state.n_smaller,
+        n_larger=hist_state.n_larger,
+    )
+
+
+def finalize_aggregate_state(state_dir: str) -> hl.Table:
+    """
+    Re-derive the sites-level annotations of add_annotations.py from an aggregate state.
+
+    AF, means, haplogroup and population arrays, filtering allele frequencies, hapmax, and the global histograms
+    are recomputed from the merged counts. The field names and layout match the rows and globals written by
+    add_quality_histograms and add_annotations_by_hap_and_pop.
+
+    :param state_dir: Directory containing an aggregate state
+    :return: Table keyed by locus and alleles with the re-derived annotations
+    """
+    import hail as hl
+
+    ht = hl.read_table(f"{state_dir}/sites.ht")
+    samples_ht = hl.read_table(f"{state_dir}/samples.ht")
+    hap_order = sorted(samples_ht.aggregate(hl.agg.collect_as_set(samples_ht.hap)))
+    pop_order = sorted(samples_ht.aggregate(hl.agg.collect_as_set(samples_ht.pop)))
+
+    def _stratum_array(stratum, field):
+        order = hap_order if stratum == "hap" else pop_order
+        return [ht[stratum].get(x)[field] for x in order]
+
+    ht = ht.annotate(
+        AF=ht.AC / ht.AN,
+        AF_hom=ht.AC_hom / ht.AN,
+        AF_het=ht.AC_het / ht.AN,
+        hl_hist=_finalize_hist(ht.hl_hist, HL_HIST_PARAMS),
+        dp_hist_all=_finalize_hist(ht.dp_hist_all, DP_HIST_PARAMS),
+        dp_hist_alt=_finalize_hist(ht.dp_hist_alt, DP_HIST_PARAMS),
+        dp_mean=ht.dp_sum / ht.dp_n,
+        mq_mean=ht.mq_sum / ht.mq_n,
+        tlod_mean=ht.tlod_sum / ht.tlod_n,
+        age_hist_hom=_finalize_hist(ht.age_hist_hom, AGE_HIST_PARAMS),
+        age_hist_het=_finalize_hist(ht.age_hist_het, AGE_HIST_PARAMS),
+    )
+    for stratum in STRATA:
+        ht = ht.annotate(
+            **{
+                f"{stratum}_{field}": _stratum_array(stratum, field)
+                for field in STRATUM_SUM_FIELDS
+            },
+            **{f"{stratum}_hl_hist": _stratum_array(stratum, "hl_hist")},
+        )
+        ht = ht.annotate(
+            **{
+                f"{stratum}_hl_hist": ht[f"{stratum}_hl_hist"].map(
+                    lambda x: x.bin_freq
+                ),
+                f"{stratum}_AF": hl.zip(ht[f"{stratum}_AC"], ht[f"{stratum}_AN"]).map(
+                    lambda x: x[0] / x[1]
+                ),
+                f"{stratum}_AF_hom": hl.zip(
+                    ht[f"{stratum}_AC_hom"], ht[f"{stratum}_AN"]
+                ).map(lambda x: x[0] / x[1]),
+                f"{stratum}_AF_het": hl.zip(
+                    ht[f"{stratum}_AC_het"], ht[f"{stratum}_AN"]
+                ).map(lambda x: x[0] / x[1]),
+            }
+        )
+
+    ht = ht.annotate(
+        **memoized_faf_exprs(
+            ht,
+            {
+                "hap_faf": (ht.hap_AC, ht.hap_AN),
+                "hap_faf_hom": (ht.hap_AC_hom, ht.hap_AN),
+            },
+        )
+    )
+    ht = ht.annotate_globals(hap_order=hap_order, pop_order=pop_order)
+    ht = ht.annotate(
+        hapmax_AF_hom=ht.hap_order[(hl.argmax(ht.hap_AF_hom, unique=True))],
+        hapmax_AF_het=ht.hap_order[(hl.argmax(ht.hap_AF_het, unique=True))],
+        faf_hapmax_hom=hl.max(ht.hap_faf_hom),
+    )
+
+    # Drop the state fields and the annotations that are also dropped by add_annotations_by_hap_and_pop
+    ht = ht.drop(
+        "hap",
+        "pop",
+        "dp_sum",
+        "dp_n",
+        "mq_sum",
+        "mq_n",
+        "tlod_sum",
+        "tlod_n",
+        "AC",
+        "AF",
+        "hap_AC",
+        "hap_AF",
+        "hap_faf",
+        "pop_AC",
+        "pop_AF",
+    )
+
+    # Global histograms of site quality metrics, as in add_quality_histograms
+    for metric, hist_params in [
+        ("dp", DP_MEAN_HIST_PARAMS),
+        ("mq", MQ_MEAN_HIST_PARAMS),
+        ("tlod", TLOD_MEAN_HIST_PARAMS),
+    ]:
+        metric_hist = ht.aggregate(
+            hl.agg.hist(ht[f"{metric}_mean"], *hist_params), _localize=False
+        )
+        ht = ht.annotate_globals(
+            **{
+                f"{metric}_hist_all_variants_bin_freq": metric_hist.bin_freq,
+                f"{metric}_hist_all_variants_n_larger": metric_hist.n_larger,
+                f"{metric}_hist_all_variants_bin_edges": metric_hist.bin_edges,
+            }
+        )
+    ht = ht.annotate_globals(
+        age_hist_all_samples_bin_freq=ht.age_hist_all_samples.bin_freq,
+        age_hist_all_samples_n_larger=ht.age_hist_all_samples.n_larger,
+        age_hist_all_samples_n_smaller=ht.age_hist_all_samples.n_smaller,
+        age_hist_all_samples_bin_edges=hist_bin_edges_expr(AGE_HIST_PARAMS),
+    )
+    ht = ht.annotate_globals(
+        hist_bin_edges=hl.struct(
+            hl_hist=hist_bin_edges_expr(HL_HIST_PARAMS),
+            dp_hist_all=hist_bin_edges_expr(DP_HIST_PARAMS),
+            dp_hist_alt=hist_bin_edges_expr(DP_HIST_PARAMS),
+            age_hist_hom=hist_bin_edges_expr(AGE_HIST_PARAMS),
+            age_hist_het=hist_bin_edges_expr(AGE_HIST_PARAMS),
+        )
+    )
+    ht = ht.drop("age_hist_all_samples", "state_params")
+
+    return ht
+
+
+def main(args):  # noqa: D103
+    init_hail()
+    state_dirs = args.state_dirs.split(",")
+
+    merge_aggregate_states(state_dirs, args.output_dir, args.overwrite)
+
+    if args.finalized_ht:
+        logger.info("Re-deriving sites-level annotations from the merged state...")
+        ht = finalize_aggregate_state(args.output_dir)
+        ht.write(args.finalized_ht, overwrite=args.overwrite)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script merges the aggregate states written by add_annotations.py with --aggregate-state-dir"
+    )
+    parser.add_argument(
+        "--state-dirs",
+        help="Comma-separated list of aggregate state directories to merge (a previously merged state can be included)",
+        required=True,
+    )
+    parser.add_argument(
+        "-d",
+        "--output-dir",
+        help="Directory to which the merged aggregate state should be written",
+        required=True,
+    )
+    parser.add_argument(
+        "--finalized-ht",
+        help="Optional path to which a sites Table with AF, FAF, hapmax, and histograms re-derived from the merged state should be written",
+    )
+    parser.add_argument(
+        "--slack-token", help="Slack token that allows integration with slack",
+    )
+    parser.add_argument(
+        "--slack-channel", help="Slack channel to post results and notifications to",
+    )
+    parser.add_argument(
+        "--overwrite", help="Overwrites existing files", action="store_true"
+    )
+
+    args = parser.parse_args()
+
+    # Both a slack token and slack channel must be supplied to receive notifications on slack
+    if args.slack_channel and args.slack_token:
+        from gnomad.utils.slack import slack_notifications
+
+        with slack_notifications(args.slack_token, args.slack_channel):
+            main(args)
+    else:
+        main(args)
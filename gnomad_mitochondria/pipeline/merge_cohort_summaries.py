@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+from __future__ import annotations
+
+import argparse
+import logging
+
+from typing import TYPE_CHECKING
+
+from gnomad_mitochondria.pipeline.merge_aggregate_states import (
+    finalize_aggregate_state,
+    merge_aggregate_states,
+)
+
+if TYPE_CHECKING:
+    import hail as hl
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("merge cohort summaries")
+logger.setLevel(logging.INFO)
+
+
+def parse_cohorts(cohort_args: list) -> dict:
+    """
+    Parse the cohort arguments into a dictionary of cohort names and aggregate state directories.
+
+    :param cohort_args: List of strings in the format "name=state_dir"
+    :return: Dictionary with cohort names as keys and aggregate state directories as values
+    """
+    cohorts = {}
+    for cohort_arg in cohort_args:
+        if "=" not in cohort_arg:
+            raise ValueError(
+                f"Cohort {cohort_arg} should be supplied in the format name=state_dir"
+            )
+        name, state_dir = cohort_arg.split("=", 1)
+        if name in cohorts:
+            raise ValueError(f"Cohort {name} was supplied more than once")
+        cohorts[name] = state_dir
+
+    return cohorts
+
+
+def check_sample_overlap(cohorts: dict, allow_sample_overlap: bool = False) -> int:
+    """
+    Check for sample IDs that are present in more than one cohort.
+
+    Samples present in several cohorts would be counted once per cohort in the merged summary.
+
+    :param cohorts: Dictionary with cohort names as keys and aggregate state directories as values
+    :param allow_sample_overlap: If True, only log a warning when overlapping samples are found
+    :return: Number of samples present in more than one cohort
+    """
+    import hail as hl
+
+    samples_ht = hl.Table.union(
+        *[
+            hl.read_table(f"{state_dir}/samples.ht").select()
+            for state_dir in cohorts.values()
+        ]
+    )
+    sample_counts = samples_ht.group_by(samples_ht.s).aggregate(n=hl.agg.count())
+    n_overlap = sample_counts.aggregate(hl.agg.count_where(sample_counts.n > 1))
+    if n_overlap > 0:
+        if not allow_sample_overlap:
+            raise ValueError(
+                f"{n_overlap} samples are present in more than one cohort, rerun with --allow-sample-overlap to merge anyway"
+            )
+        logger.warning("%i samples are present in more than one cohort", n_overlap)
+
+    return n_overlap
+
+
+def add_cohort_counts(input_ht: hl.Table, cohorts: dict) -> hl.Table:
+    """
+    Add per-cohort AN, AC_hom, and AC_het arrays to the merged summary.
+
+    Sites that were not observed in a cohort are given the AN of the cohort's reference state at that position.
+
+    :param input_ht: Merged summary Table keyed by locus and alleles
+    :param cohorts: Dictionary with cohort names as keys and aggregate state directories as values
+    :return: Table annotated with cohort_AN, cohort_AC_hom, and cohort_AC_het (in the order of the cohort_order global)
+    """
+    import hail as hl
+
+    cohort_counts = []
+    cohort_n_samples = []
+    for state_dir in cohorts.values():
+        sites_ht = hl.read_table(f"{state_dir}/sites.ht")
+        reference_ht = hl.read_table(f"{state_dir}/reference.ht")
+        cohort_counts.append(
+            hl.coalesce(
+                sites_ht[input_ht.key].select("AN", "AC_hom", "AC_het"),
+                reference_ht[input_ht.locus].select("AN", "AC_hom", "AC_het"),
+            )
+        )
+        cohort_n_samples.append(hl.eval(sites_ht.n_samples))
+
+    input_ht = input_ht.annotate(
+        cohort_AN=[x.AN for x in cohort_counts],
+        cohort_AC_hom=[x.AC_hom for x in cohort_counts],
+        cohort_AC_het=[x.AC_het for x in cohort_counts],
+    )
+    input_ht = input_ht.annotate_globals(
+        cohort_order=list(cohorts), cohort_n_samples=cohort_n_samples
+    )
+
+    return input_ht
+
+
+def main(args):  # noqa: D103
+    output_dir = args.output_dir
+    cohorts = parse_cohorts(args.cohort)
+    logger.info("Merging summaries of cohorts: %s", ", ".join(cohorts))
+
+    logger.info("Checking for samples present in more than one cohort...")
+    check_sample_overlap(cohorts, args.allow_sample_overlap)
+
+    merged_state_dir = f"{output_dir}/merged_state"
+    merge_aggregate_states(list(cohorts.values()), merged_state_dir, args.overwrite)
+
+    logger.info("Re-deriving AF, FAF, hapmax, and histograms from the merged counts...")
+    ht = finalize_aggregate_state(merged_state_dir)
+    ht = add_cohort_counts(ht, cohorts)
+    ht = ht.checkpoint(
+        f"{output_dir}/combined_cohorts_sites_only.ht", overwrite=args.overwrite
+    )
+    ht.export(f"{output_dir}/combined_cohorts_sites_only.txt")
+
+    logger.info("Merged summary contains %i sites", ht.count())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script merges the per-cohort aggregate states written by add_annotations.py into a combined sites-level summary without using genotypes"
+    )
+    parser.add_argument(
+        "-c",
+        "--cohort",
+        help="Cohort name and aggregate state directory in the format name=state_dir (supply once per cohort)",
+        action="append",
+        required=True,
+    )
+    parser.add_argument(
+        "-d",
+        "--output-dir",
+        help="Path to directory to which output should be written",
+        required=True,
+    )
+    parser.add_argument(
+        "--allow-sample-overlap",
+        help="Merge cohorts even if some sample IDs are present in more than one cohort (those samples will be counted more than once)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--slack-token", help="Slack token that allows integration with slack",
+    )
+    parser.add_argument(
+        "--slack-channel", help="Slack channel to post results and notifications to",
+    )
+    parser.add_argument(
+        "--overwrite", help="Overwrites existing files", action="store_true"
+    )
+
+    args = parser.parse_args()
+
+    # Both a slack token and slack channel must be supplied to receive notifications on slack
+    if args.slack_channel and args.slack_token:
+        from gnomad.utils.slack import slack_notifications
+
+        with slack_notifications(args.slack_token, args.slack_channel):
+            main(args)
+    else:
+        main(args)
@@ -0,0 +1,471 @@
+import argparse
+import json
+import logging
+import re
+import sys
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+from gnomad_mitochondria.utils.startup import init_hail
+from gnomad_mitochondria.utils.storage import get_storage
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("run pipeline dag")
+logger.setLevel(logging.INFO)
+
+# Scripts that can be run as stages, in pipeline order
+SCRIPTS = ["annotate_coverage", "combine_vcfs", "add_annotations"]
+# Width in characters of the bars of the Gantt chart
+GANTT_WIDTH = 60
+
+
+class Stage:
+    """
+    A step of the pipeline, with the paths it reads and writes.
+
+    Stages are connected by their paths: a stage depends on every stage that writes one of its inputs.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[Dict[str, object]], object],
+        inputs: List[str],
+        outputs: List[str],
+        exclusive: bool = False,
+    ):
+        """
+        Declare a stage.
+
+        :param name: Name of the stage
+        :param run: Function running the stage (Hail is already initialized when it is called). It is passed a
+            dictionary with the names of the stages it depends on as keys and what their run functions returned as
+            values (None for stages that were skipped), and its return value is passed on to the stages depending on it
+        :param inputs: Paths read by the stage
+        :param outputs: Paths written by the stage, used to decide whether the stage needs to run
+        :param exclusive: Whether no other stage may run at the same time as this one
+        """
+        self.name = name
+        self.run = run
+        self.inputs = [x.rstrip("/") for x in inputs if x is not None]
+        self.outputs = [x.rstrip("/") for x in outputs]
+        self.exclusive = exclusive
+
+
+def build_stages(config: Dict[str, List[str]]) -> List[Stage]:
+    """
+    Declare the stages of the scripts in a run configuration.
+
+    combine_vcfs.py is split into merging the VCFs, which is independent of coverage, and the steps from determining
+    homoplasmic reference sites onward, which read the coverage MatrixTable. Merging the VCFs can therefore run
+    concurrently with combining coverage.
+
+    The stages run in the current Hail session. The MatrixTables a stage writes are passed on to the stages depending on
+    it as returned by their checkpoint, so they are not read again from their paths unless the stage writing them was
+    skipped.
+
+    :param config: Dictionary with script names (see SCRIPTS) as keys and their command line arguments as values
+    :return: List of stages
+    """
+    import hail as hl
+
+    # Imported here so that the runner's own arguments are validated without loading the pipeline modules
+    from gnomad_mitochondria.pipeline import (
+        add_annotations,
+        annotate_coverage,
+        combine_vcfs,
+    )
+
+    unknown = set(config) - set(SCRIPTS)
+    if unknown:
+        raise ValueError(
+            f"Unknown scripts in the configuration: {', '.join(sorted(unknown))}"
+        )
+
+    stages = []
+    if "annotate_coverage" in config:
+        coverage_args = annotate_coverage.parse_arguments(
+            config["annotate_coverage"], check_inputs=False
+        )
+        stages.append(
+            Stage(
+                "combine_coverage",
+                lambda results: annotate_coverage.combine_coverage(
+                    annotate_coverage.collect_coverage_paths(coverage_args),
+                    coverage_args,
+                ),
+                inputs=[coverage_args.input_tsv],
+                outputs=[
+                    re.sub(r"\.ht$", ".mt", coverage_args.output_ht),
+                    re.sub(r"\.ht$", "_coverage_table.mt", coverage_args.output_ht),
+                    coverage_args.output_ht,
+                ],
+            )
+        )
+
+    if "combine_vcfs" in config:
+        vcf_args = combine_vcfs.parse_arguments(
+            config["combine_vcfs"], check_inputs=False
+        )
+        output_paths = combine_vcfs.get_output_paths(vcf_args)
+        stages.append(
+            Stage(
+                "merge_vcfs",
+                lambda results: combine_vcfs.merge_vcfs(
+                    combine_vcfs.prepare_vcf_paths(vcf_args), vcf_args
+                ),
+                inputs=[vcf_args.input_tsv],
+                outputs=[output_paths["raw_mt"]],
+            )
+        )
+        stages.append(
+            Stage(
+                "finish_combined_mt",
+                lambda results: combine_vcfs.finish_combined_mt(
+                    results["merge_vcfs"]
+                    if results.get("merge_vcfs") is not None
+                    else hl.read_matrix_table(output_paths["raw_mt"]),
+                    vcf_args,
+                    coverage_mt=results.get("combine_coverage"),
+                ),
+                inputs=[
+                    output_paths["raw_mt"],
+                    vcf_args.coverage_mt_path,
+                    vcf_args.artifact_prone_sites_path,
+                ],
+                outputs=[output_paths["mt"]],
+            )
+        )
+
+    if "add_annotations" in config:
+        annotation_args = add_annotations.parse_arguments(
+            config["add_annotations"], check_inputs=False
+        )
+        stages.append(
+            Stage(
+                "add_annotations",
+                lambda results: add_annotations.main(annotation_args),
+                inputs=[
+                    annotation_args.mt_path,
+                    annotation_args.participant_data,
+                    annotation_args.sample_stats,
+                    annotation_args.coverage_mt_path,
+                ],
+                # The run report is written once all outputs have been written
+                outputs=[f"{annotation_args.output_dir}/run_report.json"],
+                # The query plan diagnostics time every query of the session, which must then all be queries of this
+                # stage
+                exclusive=annotation_args.diagnose_query_plans,
+            )
+        )
+
+    return stages
+
+
+def get_dependencies(stages: List[Stage]) -> Dict[str, set]:
+    """
+    Connect stages through their inputs and outputs, and check that the result is a DAG.
+
+    :param stages: List of stages
+    :return: Dictionary with stage names as keys and the set of names of the stages they depend on as values
+    """
+    producers = {}
+    for stage in stages:
+        for path in stage.outputs:
+            if path in producers:
+                raise ValueError(
+                    f"{path} is written by both {producers[path]} and {stage.name}"
+                )
+            producers[path] = stage.name
+
+    dependencies = {
+        stage.name: set(producers[x] for x in stage.inputs if x in producers)
+        - {stage.name}
+        for stage in stages
+    }
+
+    # Kahn's algorithm: a cycle leaves stages that never become ready
+    remaining = {k: set(v) for k, v in dependencies.items()}
+    while remaining:
+        ready = [k for k, v in remaining.items() if not v]
+        if not ready:
+            raise ValueError(
+                f"Stages depend on each other in a cycle: {', '.join(sorted(remaining))}"
+            )
+        for name in ready:
+            del remaining[name]
+        for v in remaining.values():
+            v.difference_update(ready)
+
+    return dependencies
+
+
+def get_modification_time(path: str) -> Optional[float]:
+    """
+    Get the time a path was last written.
+
+    For directories (such as Tables and MatrixTables) this is the time of their _SUCCESS file, so that partially written
+    outputs count as missing.
+
+    :param path: Path
+    :return: Modification time in seconds since the epoch, or None if the path (or the _SUCCESS file) does not exist
+    """
+    storage = get_storage(path)
+    try:
+        info = storage.stat(path)
+        if info["is_dir"]:
+            info = storage.stat(f"{path}/_SUCCESS")
+    except FileNotFoundError:
+        return None
+
+    return info["modification_time"]
+
+
+def is_current(stage: Stage) -> bool:
+    """
+    Check whether the outputs of a stage exist and were written after all of its inputs.
+
+    :param stage: Stage
+    :return: True if the stage does not need to run
+    """
+    output_times = [get_modification_time(x) for x in stage.outputs]
+    if any(x is None for x in output_times):
+        return False
+    input_times = [
+        x for x in (get_modification_time(x) for x in stage.inputs) if x is not None
+    ]
+
+    return not input_times or min(output_times) >= max(input_times)
+
+
+def check_inputs(stages: List[Stage]) -> None:
+    """
+    Check that every input not written by another stage already exists.
+
+    This is checked before any stage starts, so that a misconfigured run fails early.
+
+    :param stages: List of stages
+    :return: None
+    """
+    produced = set(x for stage in stages for x in stage.outputs)
+    missing = [
+        (stage.name, x)
+        for stage in stages
+        for x in stage.inputs
+        if x not in produced and get_modification_time(x) is None
+    ]
+    for name, path in missing:
+        logger.error(
+            "Input %s of stage %s does not exist and is not written by any stage",
+            path,
+            name,
+        )
+    if missing:
+        raise ValueError(f"ERROR: {len(missing)} stage inputs are missing.")
+
+
+def run_dag(
+    stages: List[Stage], max_concurrent_stages: int = 2, force: bool = False
+) -> List[dict]:
+    """
+    Run stages as soon as the stages they depend on have finished, running independent stages concurrently.
+
+    Each stage is run from a thread of this process, so stages that run concurrently submit their queries to the same
+    Hail session, and what a stage returns is passed on to the stages depending on it (see Stage). Whether a stage can
+    be skipped is decided here before it is started: a stage is skipped if its outputs are current and none of the
+    stages it depends on ran. If a stage fails, the stages depending on it are not run.
+
+    :param stages: List of stages
+    :param max_concurrent_stages: Maximum number of stages running at the same time
+    :param force: Whether to run every stage, even if its outputs are current
+    :return: List of dictionaries with the stage, status (ran, skipped, failed, or blocked), and start and end times
+        in seconds from the start of the run, in the order stages finished
+    """
+    dependencies = get_dependencies(stages)
+    check_inputs(stages)
+
+    start = time.time()
+    status = {}
+    results = {}
+    records = []
+
+    def run_stage(stage):
+        record = {"stage": stage.name, "start_s": time.time() - start}
+        logger.info("Starting %s...", stage.name)
+        result = None
+        try:
+            result = stage.run({x: results.get(x) for x in dependencies[stage.name]})
+            record["status"] = "ran"
+        except Exception:
+            logger.exception("Stage %s failed", stage.name)
+            record["status"] = "failed"
+        record["end_s"] = time.time() - start
+        logger.info(
+            "Stage %s %s (%.1fs)",
+            stage.name,
+            record["status"],
+            record["end_s"] - record["start_s"],
+        )
+
+        return record, result
+
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_concurrent_stages) as executor:
+        while pending or running:
+            for stage in list(pending):
+                deps = dependencies[stage.name]
+                if any(status.get(x) in ("failed", "blocked") for x in deps):
+                    logger.warning(
+                        "Not running %s, a stage it depends on failed", stage.name
+                    )
+                    status[stage.name] = "blocked"
+                    records.append(
+                        {
+                            "stage": stage.name,
+                            "status": "blocked",
+                            "start_s": None,
+                            "end_s": None,
+                        }
+                    )
+                    pending.remove(stage)
+                elif all(x in status for x in deps):
+                    # Exclusive stages wait for the running stages to finish, and no stage starts next to one
+                    if any(x.exclusive for x in running.values()) or (
+                        stage.exclusive and running
+                    ):
+                        continue
+                    pending.remove(stage)
+                    if (
+                        not force
+                        and all(status[x] == "skipped" for x in deps)
+                        and is_current(stage)
+                    ):
+                        logger.info("Skipping %s, its outputs are current", stage.name)
+                        now = time.time() - start
+                        status[stage.name] = "skipped"
+                        records.append(
+                            {
+                                "stage": stage.name,
+                                "status": "skipped",
+                                "start_s": now,
+                                "end_s": now,
+                            }
+                        )
+                    else:
+                        running[executor.submit(run_stage, stage)] = stage
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                record, results[stage.name] = future.result()
+                status[stage.name] = record["status"]
+                records.append(record)
+
+    return records
+
+
+def format_gantt(records: List[dict], width: int = GANTT_WIDTH) -> str:
+    """
+    Format the stages of a run as a Gantt chart, one bar per stage on a shared time axis.
+
+    Stages that ran are drawn with #, failed stages with x, and skipped or blocked stages have no bar.
+
+    :param records: Records returned by run_dag
+    :param width: Width in characters of the time axis
+    :return: Gantt chart
+    """
+    timed = [x for x in records if x["start_s"] is not None]
+    total = max((x["end_s"] for x in timed), default=0) or 1
+    axis_end = f"{total:.0f}s"
+    lines = [
+        f"{'stage':<20} {'status':<8} {'start (s)':>10} {'time (s)':>10} |{'0'.ljust(width - len(axis_end))}{axis_end}|"
+    ]
+    for x in sorted(
+        records, key=lambda x: float("inf") if x["start_s"] is None else x["start_s"]
+    ):
+        if x["status"] in ("blocked", "skipped"):
+            lines.append(
+                f"{x['stage']:<20} {x['status']:<8} {'-':>10} {'-':>10} |{'':<{width}}|"
+            )
+            continue
+        offset = int(x["start_s"] / total * width)
+        length = max(1, int(round((x["end_s"] - x["start_s"]) / total * width)))
+        bar = " " * offset + ("#" if x["status"] == "ran" else "x") * length
+        lines.append(
+            f"{x['stage']:<20} {x['status']:<8} {x['start_s']:>10.1f} {x['end_s'] - x['start_s']:>10.1f} |{bar[:width]:<{width}}|"
+        )
+
+    return "\n".join(lines)
+
+
+def main(args):  # noqa: D103
+    config = json.loads(get_storage(args.config).read_text(args.config))
+    stages = build_stages(config)
+    logger.info("Stages: %s", ", ".join(x.name for x in stages))
+
+    # Every stage runs in this Hail session, which is also used to check paths on Hadoop filesystems
+    init_hail(tmp_dir=args.temp_dir)
+
+    records = run_dag(stages, args.max_concurrent_stages, args.force)
+    logger.info("Timeline of the run:\n%s", format_gantt(records))
+
+    if args.report_json:
+        report = {
+            "total_wall_time_s": max(
+                (x["end_s"] for x in records if x["end_s"] is not None), default=0
+            ),
+            "max_concurrent_stages": args.max_concurrent_stages,
+            "stages": records,
+        }
+        get_storage(args.report_json).write_atomic(
+            args.report_json, json.dumps(report, indent=2).encode("utf8")
+        )
+
+    failed = [x["stage"] for x in records if x["status"] in ("failed", "blocked")]
+    if failed:
+        logger.error("Stages not completed: %s", ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script runs annotate_coverage.py, combine_vcfs.py, and add_annotations.py as one DAG of stages in one Hail session, running independent stages (combining coverage and merging VCFs) concurrently and skipping stages whose outputs are current"
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="JSON file with the scripts to run (annotate_coverage, combine_vcfs, add_annotations) as keys and lists of their command line arguments as values. Stages are connected by matching paths, for example the --coverage-mt-path of combine_vcfs should be the coverage table written next to the --output-ht of annotate_coverage (<output>_coverage_table.mt)",
+        required=True,
+    )
+    parser.add_argument(
+        "-t",
+        "--temp-dir",
+        help="Temporary directory of the Hail session",
+        required=True,
+    )
+    parser.add_argument(
+        "--max-concurrent-stages",
+        help="Maximum number of stages running at the same time",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--force",
+        help="Run every stage, even if its outputs are current",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--report-json",
+        help="Path to write the start and end time and status of each stage as JSON",
+    )
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+from __future__ import annotations
+
+import argparse
+import logging
+
+from typing import TYPE_CHECKING, Optional
+
+from gnomad_mitochondria.utils.coverage_table import read_coverage_table
+from gnomad_mitochondria.utils.partitioning import (
+    DEFAULT_TARGET_PARTITION_BYTES,
+    get_n_partitions,
+)
+
+if TYPE_CHECKING:
+    import hail as hl
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("sample major callset")
+logger.setLevel(logging.INFO)
+
+
+def generate_sample_calls(mt: hl.MatrixTable, n_partitions: int) -> hl.Table:
+    """
+    Collect the variant calls (entries with a heteroplasmy level above 0) of each sample into one row per sample.
+
+    Homoplasmic reference and missing genotypes are not stored, they can be recovered from the per-base coverage.
+
+    :param mt: MatrixTable of variant calls (output of combine_vcfs.py or add_annotations.py)
+    :param n_partitions: Number of partitions of the output Table
+    :return: Table keyed by s with a calls array sorted by locus and alleles
+    """
+    import hail as hl
+
+    entry_fields = list(mt.entry)
+    ht = mt.select_rows("filters").entries()
+    ht = ht.filter(ht.HL > 0)
+    ht = ht.select(
+        call=hl.struct(
+            locus=ht.locus,
+            alleles=ht.alleles,
+            filters=ht.filters,
+            **{x: ht[x] for x in entry_fields},
+        )
+    )
+    calls_ht = (
+        ht.group_by(ht.s)
+        .partition_hint(n_partitions)
+        .aggregate(
+            calls=hl.sorted(hl.agg.collect(ht.call), key=lambda x: (x.locus, x.alleles))
+        )
+    )
+
+    return calls_ht
+
+
+def generate_sample_coverage(coverage_mt_path: str, n_partitions: int) -> hl.Table:
+    """
+    Collect the per-base coverage of each sample into one array per sample.
+
+    The coverage arrays are ordered by position, the positions are stored once in the coverage_positions global.
+
+    :param coverage_mt_path: Coverage table of sample level coverage at each position (per-sample and per-base; can be generated by running annotate_coverage.py)
+    :param n_partitions: Number of partitions of the output Table
+    :return: Table keyed by s with a coverage array
+    """
+    import hail as hl
+
+    coverage_mt = read_coverage_table(coverage_mt_path)
+    coverage_positions = coverage_mt.aggregate_rows(
+        hl.sorted(hl.agg.collect(coverage_mt.pos))
+    )
+
+    ht = coverage_mt.entries()
+    coverage_ht = (
+        ht.group_by(ht.s)
+        .partition_hint(n_partitions)
+        .aggregate(
+            coverage=hl.sorted(hl.agg.collect(hl.tuple([ht.pos, ht.coverage]))).map(
+                lambda x: x[1]
+            )
+        )
+    )
+    coverage_ht = coverage_ht.annotate_globals(coverage_positions=coverage_positions)
+
+    return coverage_ht
+
+
+def write_sample_major_callset(
+    mt: hl.MatrixTable,
+    output_path: str,
+    coverage_mt_path: Optional[str] = None,
+    n_partitions: Optional[int] = None,
+    overwrite: bool = False,
+    mt_path: Optional[str] = None,
+    target_partition_bytes: int = DEFAULT_TARGET_PARTITION_BYTES,
+) -> hl.Table:
+    """
+    Write the calls (and optionally the per-base coverage) of each sample as one row of a Table keyed by sample ID.
+
+    Because the Table is keyed and partitioned by s, looking up a sample only reads the partition containing it.
+
+    :param mt: MatrixTable of variant calls (output of combine_vcfs.py or add_annotations.py)
+    :param output_path: Path of the sample-major Table to write
+    :param coverage_mt_path: Optional MatrixTable of sample level coverage at each position
+    :param n_partitions: Number of partitions of the output Table, chosen from the size of the written inputs (mt_path
+        and coverage_mt_path) if not supplied
+    :param overwrite: Whether or not to overwrite an existing Table
+    :param mt_path: Path of the written mt, needed if n_partitions is not supplied
+    :param target_partition_bytes: Target number of bytes per partition if n_partitions is not supplied
+    :return: Sample-major Table
+    """
+    import hail as hl
+
+    if n_partitions is None:
+        if mt_path is None:
+            raise ValueError("Either n_partitions or mt_path must be supplied")
+        n_partitions = get_n_partitions(
+            path=[x for x in [mt_path, coverage_mt_path] if x is not None],
+            target_partition_bytes=target_partition_bytes,
+        )
+
+    logger.info("Collecting calls by sample...")
+    ht = generate_sample_calls(mt, n_partitions)
+    # Samples without any variant calls still get a row
+    samples_ht = mt.cols().select()
+    ht = samples_ht.annotate(
+        calls=hl.coalesce(
+            ht[samples_ht.s].calls, hl.empty_array(ht.calls.dtype.element_type)
+        )
+    )
+
+    if coverage_mt_path is not None:
+        logger.info("Collecting per-base coverage by sample...")
+        coverage_ht = generate_sample_coverage(coverage_mt_path, n_partitions)
+        ht = ht.annotate(coverage=coverage_ht[ht.s].coverage)
+        ht = ht.annotate_globals(
+            coverage_positions=coverage_ht.index_globals().coverage_positions
+        )
+
+    ht = ht.repartition(n_partitions)
+
+    return ht.checkpoint(output_path, overwrite=overwrite)
+
+
+def read_sample_major_callset(path: str, sample_ids: list) -> hl.Table:
+    """
+    Read the rows of the sample-major Table for a list of samples.
+
+    The filter is on the key, so only the partitions containing these samples are read.
+
+    :param path: Path of the sample-major Table written by write_sample_major_callset
+    :param sample_ids: List of sample IDs
+    :return: Sample-major Table filtered to the samples
+    """
+    import hail as hl
+
+    ht = hl.read_table(path)
+    ht = ht.filter(hl.literal(set(sample_ids)).contains(ht.s))
+
+    return ht
+
+
+def lookup_sample(path: str, s: str) -> Optional[hl.Struct]:
+    """
+    Fetch the calls and per-base coverage of one sample.
+
+    :param path: Path of the sample-major Table written by write_sample_major_callset
+    :param s: Sample ID
+    :return: Struct with the calls of the sample, and its coverage as a dictionary of position to coverage (if coverage was written), or None if the sample is not present
+    """
+    import hail as hl
+
+    ht = read_sample_major_callset(path, [s])
+    rows = ht.collect()
+    if len(rows) == 0:
+        return None
+
+    row = rows[0]
+    if "coverage" not in row:
+        return hl.Struct(s=row.s, calls=row.calls)
+    coverage_positions = hl.eval(ht.coverage_positions)
+
+    return hl.Struct(
+        s=row.s, calls=row.calls, coverage=dict(zip(coverage_positions, row.coverage)),
+    )
+
+
+def main(args):  # noqa: D103
+    import hail as hl
+
+    mt = hl.read_matrix_table(args.mt_path)
+    ht = write_sample_major_callset(
+        mt,
+        args.output_path,
+        coverage_mt_path=args.coverage_mt_path,
+        n_partitions=args.n_partitions,
+        overwrite=args.overwrite,
+        mt_path=args.mt_path,
+        target_partition_bytes=args.target_partition_mb * 1024 * 1024,
+    )
+    logger.info("Wrote calls for %i samples to %s", ht.count(), args.output_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script writes a sample-major copy of the callset (and optionally per-base coverage), keyed and partitioned by sample ID, for per-sample retrieval"
+    )
+    parser.add_argument(
+        "-m",
+        "--mt-path",
+        help="Path to MatrixTable of variant calls (output of combine_vcfs.py or add_annotations.py)",
+        required=True,
+    )
+    parser.add_argument(
+        "-c",
+        "--coverage-mt-path",
+        help="Optional path to MatrixTable of sample-level coverage (per-sample and per-base, can be generated by running annotate_coverage.py)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-path",
+        help="Path of the sample-major Table to write",
+        required=True,
+    )
+    parser.add_argument(
+        "--n-partitions",
+        help="Number of partitions of the sample-major Table. Overrides the number chosen from the size of the input mt and coverage (see --target-partition-mb)",
+        type=int,
+    )
+    parser.add_argument(
+        "--target-partition-mb",
+        help="Target size in MB of each partition of the sample-major Table",
+        type=int,
+        default=128,
+    )
+    parser.add_argument(
+        "--slack-token", help="Slack token that allows integration with slack",
+    )
+    parser.add_argument(
+        "--slack-channel", help="Slack channel to post results and notifications to",
+    )
+    parser.add_argument(
+        "--overwrite", help="Overwrites existing files", action="store_true"
+    )
+
+    args = parser.parse_args()
+
+    # Both a slack token and slack channel must be supplied to receive notifications on slack
+    if args.slack_channel and args.slack_token:
+        from gnomad.utils.slack import slack_notifications
+
+        with slack_notifications(args.slack_token, args.slack_channel):
+            main(args)
+    else:
+        main(args)
@@ -3,10 +3,7 @@ import argparse
 import logging
 import re
 
-import hail as hl
-
-from gnomad.utils.slack import slack_notifications
-
+from gnomad_mitochondria.utils.coverage_table import read_coverage_table
 
 logging.basicConfig(
     format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
@@ -17,13 +14,15 @@ logger.setLevel(logging.INFO)
 
 
 def main(args):  # noqa: D103
+    import hail as hl
+
     input_mt_path = args.input_mt_path
     cov_mt_path = args.cov_mt_path
     out_tsv_path = args.out_tsv_path
 
     logger.info("Subsetting coverage mt to samples in the input mt...")
     input_mt = hl.read_matrix_table(input_mt_path)
-    cov_mt = hl.read_matrix_table(cov_mt_path)
+    cov_mt = read_coverage_table(cov_mt_path)
     samples_to_subset = hl.literal(input_mt.s.collect())
     cov_mt = cov_mt.filter_cols(samples_to_subset.contains(cov_mt["s"]))
 
@@ -44,7 +43,11 @@ def main(args):  # noqa: D103
             (hl.agg.count_where(cov_mt.coverage > 1000) / n_samples_cov)
         ),
     )
+    # The summary has one row per position, so re-keying it by locus is cheap
     cov_ht = cov_mt.rows()
+    cov_ht = cov_ht.key_by(
+        locus=hl.locus("chrM", cov_ht.pos, reference_genome="GRCh38")
+    ).drop("pos")
 
     output_ht = re.sub(r"\.tsv$", ".ht", out_tsv_path)
     cov_ht = cov_ht.checkpoint(output_ht, overwrite=True)
@@ -66,7 +69,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "-c",
         "--cov-mt-path",
-        help="Path to MatrixTable of per base coverages for all samples (per sample and per variant",
+        help="Path to the coverage table of per base coverages for all samples (written by annotate_coverage.py; locus-keyed coverage MatrixTables are also accepted)",
         required=True,
     )
     parser.add_argument(
@@ -86,6 +89,8 @@ if __name__ == "__main__":
 
     # Both a slack token and slack channel must be supplied to receive notifications on slack
     if args.slack_channel and args.slack_token:
+        from gnomad.utils.slack import slack_notifications
+
         with slack_notifications(args.slack_token, args.slack_channel):
             main(args)
     else:
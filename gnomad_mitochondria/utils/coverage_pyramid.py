@@ -0,0 +1,308 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+
+from typing import TYPE_CHECKING, List, Optional
+
+from gnomad_mitochondria.utils.storage import get_scheme, get_storage
+
+if TYPE_CHECKING:
+    import hail as hl
+
+
+try:
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+except ImportError:
+    ds = pafs = None
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("coverage pyramid")
+logger.setLevel(logging.INFO)
+
+# Bin sizes of the levels of the pyramid, finest first
+PYRAMID_RESOLUTIONS = [1, 10, 100, 1000]
+# Coverage thresholds for which the fraction of samples above the threshold is summarized (as in annotate_coverage.py)
+DEFAULT_COVERAGE_THRESHOLDS = [100, 1000]
+# Sample annotations by which coverage is stratified, in addition to all samples
+STRATUM_TYPES = ["hap", "pop"]
+ALL_SAMPLES_STRATUM = "all"
+PYRAMID_METADATA = "_coverage_pyramid_metadata.json"
+
+
+def read_sample_strata(samples_path: str) -> hl.Table:
+    """
+    Read the haplogroup and population of each sample.
+
+    :param samples_path: Path to a Table keyed by sample (such as the samples.ht of an aggregate state) or to a
+        MatrixTable with sample annotations (such as the output of add_annotations.py), with hap and pop fields
+    :return: Table keyed by s with hap and pop
+    """
+    import hail as hl
+
+    if samples_path.rstrip("/").endswith(".mt"):
+        samples_ht = hl.read_matrix_table(samples_path).cols()
+    else:
+        samples_ht = hl.read_table(samples_path)
+
+    return samples_ht.select(*STRATUM_TYPES)
+
+
+def annotate_sample_strata(
+    cov_mt: hl.MatrixTable, samples_ht: hl.Table
+) -> hl.MatrixTable:
+    """
+    Annotate the columns of the coverage MatrixTable with the haplogroup and population of each sample.
+
+    Samples without a haplogroup or population are assigned to the "NA" stratum, as in add_annotations.py.
+
+    :param cov_mt: MatrixTable of sample level coverage at each position (output by annotate_coverage.py)
+    :param samples_ht: Table keyed by sample with hap and pop annotations (see read_sample_strata)
+    :return: MatrixTable with hap and pop column annotations
+    """
+    import hail as hl
+
+    return cov_mt.annotate_cols(
+        **{x: hl.or_else(samples_ht[cov_mt.s][x], "NA") for x in STRATUM_TYPES}
+    )
+
+
+def annotate_per_base_strata(
+    cov_mt: hl.MatrixTable,
+    samples_ht: hl.Table,
+    thresholds: Optional[List[int]] = None,
+) -> hl.Table:
+    """
+    Summarize coverage at each base for all samples and for each haplogroup and population, in one pass over the entries.
+
+    :param cov_mt: Coverage table of sample level coverage at each position (see read_coverage_table)
+    :param samples_ht: Table keyed by sample with hap and pop annotations (for example the samples.ht of an aggregate state)
+    :param thresholds: Coverage thresholds for which the fraction of samples above the threshold is computed, defaults
+        to DEFAULT_COVERAGE_THRESHOLDS
+    :return: Table keyed by pos with a strata array of structs of stratum_type, stratum, n_samples, mean, median
+        (approximate, see hl.agg.approx_median), and over_<threshold> for each threshold
+    """
+    import hail as hl
+
+    if thresholds is None:
+        thresholds = DEFAULT_COVERAGE_THRESHOLDS
+    cov_mt = annotate_sample_strata(cov_mt, samples_ht)
+
+    def _stratum_stats():
+        return hl.struct(
+            n_samples=hl.agg.count(),
+            mean=hl.float(hl.agg.mean(cov_mt.coverage)),
+            # A quantile sketch per stratum, rather than collecting the coverage of every sample at each base
+            median=hl.float(hl.agg.approx_median(cov_mt.coverage)),
+            **{f"over_{x}": hl.agg.fraction(cov_mt.coverage > x) for x in thresholds},
+        )
+
+    # The row fields cannot share the names of the hap and pop column fields
+    cov_ht = cov_mt.select_rows(
+        all_samples=_stratum_stats(),
+        **{
+            f"{x}_stats": hl.agg.group_by(cov_mt[x], _stratum_stats())
+            for x in STRATUM_TYPES
+        },
+    ).rows()
+
+    strata = hl.array(
+        [
+            cov_ht.all_samples.annotate(
+                stratum_type=ALL_SAMPLES_STRATUM, stratum=ALL_SAMPLES_STRATUM
+            )
+        ]
+    )
+    for x in STRATUM_TYPES:
+        strata = strata.extend(
+            hl.array(cov_ht[f"{x}_stats"]).map(
+                lambda kv, stratum_type=x: kv[1].annotate(
+                    stratum_type=stratum_type, stratum=kv[0]
+                )
+            )
+        )
+
+    return cov_ht.select(strata=strata)
+
+
+def build_coverage_pyramid(
+    strata_ht: hl.Table,
+    thresholds: Optional[List[int]] = None,
+    resolutions: Optional[List[int]] = None,
+) -> hl.Table:
+    """
+    Bin the per-base summaries of each stratum at each resolution of the pyramid.
+
+    The summaries of a bin are averages of the per-base summaries over the bases of the bin (the mean of the per-base
+    medians for the median), as used for zoomed-out coverage tracks. Bins start at 1, 1 + resolution, 1 + 2 x resolution...
+
+    :param strata_ht: Table returned by annotate_per_base_strata
+    :param thresholds: Coverage thresholds summarized in strata_ht, defaults to DEFAULT_COVERAGE_THRESHOLDS
+    :param resolutions: Bin sizes of the levels of the pyramid, defaults to PYRAMID_RESOLUTIONS
+    :return: Unkeyed Table with resolution, stratum_type, stratum, start, end, n_samples, mean, median, and
+        over_<threshold> for each threshold
+    """
+    import hail as hl
+
+    if thresholds is None:
+        thresholds = DEFAULT_COVERAGE_THRESHOLDS
+    if resolutions is None:
+        resolutions = PYRAMID_RESOLUTIONS
+
+    ht = strata_ht.select(position=strata_ht.pos, strata=strata_ht.strata)
+    ht = ht.key_by().explode("strata")
+    ht = ht.select("position", **ht.strata)
+    stat_fields = ["mean", "median"] + [f"over_{x}" for x in thresholds]
+
+    levels = []
+    for resolution in resolutions:
+        level_ht = ht.group_by(
+            "stratum_type",
+            "stratum",
+            start=((ht.position - 1) // resolution) * resolution + 1,
+        ).aggregate(
+            end=hl.agg.max(ht.position),
+            n_samples=hl.agg.max(ht.n_samples),
+            **{x: hl.float32(hl.agg.mean(ht[x])) for x in stat_fields},
+        )
+        levels.append(level_ht.key_by().annotate(resolution=resolution))
+
+    return levels[0].union(*levels[1:])
+
+
+def export_coverage_pyramid(
+    pyramid_ht: hl.Table,
+    output_path: str,
+    thresholds: Optional[List[int]] = None,
+    resolutions: Optional[List[int]] = None,
+    overwrite: bool = False,
+) -> None:
+    """
+    Export the pyramid as Parquet partitioned by resolution.
+
+    Each resolution is a single file sorted by stratum and start, so that reading one resolution for a few strata only
+    reads the matching row groups (kilobytes for the coarser levels).
+
+    :param pyramid_ht: Table returned by build_coverage_pyramid
+    :param output_path: Path of the Parquet dataset directory
+    :param thresholds: Coverage thresholds summarized in the pyramid, defaults to DEFAULT_COVERAGE_THRESHOLDS
+    :param resolutions: Bin sizes of the levels of the pyramid, defaults to PYRAMID_RESOLUTIONS
+    :param overwrite: Whether or not to overwrite an existing dataset
+    :return: None
+    """
+    if thresholds is None:
+        thresholds = DEFAULT_COVERAGE_THRESHOLDS
+    if resolutions is None:
+        resolutions = PYRAMID_RESOLUTIONS
+    logger.info("Writing coverage pyramid as Parquet to %s...", output_path)
+    df = pyramid_ht.to_spark()
+    (
+        df.repartition("resolution")
+        .sortWithinPartitions("stratum_type", "stratum", "start")
+        .write.mode("overwrite" if overwrite else "errorifexists")
+        .option("parquet.enable.dictionary", "true")
+        .partitionBy("resolution")
+        .parquet(output_path)
+    )
+
+    metadata_path = f"{output_path}/{PYRAMID_METADATA}"
+    get_storage(metadata_path).write_atomic(
+        metadata_path,
+        json.dumps({"resolutions": resolutions, "thresholds": thresholds}).encode(
+            "utf8"
+        ),
+    )
+
+
+def choose_resolution(
+    start: int, end: int, max_bins: int = 2000, resolutions: Optional[List[int]] = None
+) -> int:
+    """
+    Choose the finest resolution at which a region is covered by at most max_bins bins.
+
+    :param start: Start of the region (inclusive)
+    :param end: End of the region (inclusive)
+    :param max_bins: Maximum number of bins to display
+    :param resolutions: Bin sizes of the levels of the pyramid, defaults to PYRAMID_RESOLUTIONS
+    :return: Bin size
+    """
+    if resolutions is None:
+        resolutions = PYRAMID_RESOLUTIONS
+    for resolution in sorted(resolutions):
+        if (end - start + 1) / resolution <= max_bins:
+            return resolution
+
+    return max(resolutions)
+
+
+def read_coverage_pyramid(
+    path: str,
+    resolution: int,
+    strata: Optional[List[tuple]] = None,
+    stratum_types: Optional[List[str]] = None,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    columns: Optional[list] = None,
+):
+    """
+    Read one level of the coverage pyramid into a pandas DataFrame, reading only the matching partition and rows.
+
+    :param path: Path of the Parquet dataset directory (written by export_coverage_pyramid)
+    :param resolution: Bin size of the level to read (see choose_resolution)
+    :param strata: (stratum_type, stratum) tuples to read, for example [("all", "all"), ("hap", "H")], defaults to all strata
+    :param stratum_types: Stratum types to read (all, hap, or pop), as an alternative to listing strata
+    :param start: Minimum position (bins overlapping it are included)
+    :param end: Maximum position (bins overlapping it are included)
+    :param columns: Columns to read, defaults to all columns
+    :return: pandas DataFrame
+    """
+    if ds is None:
+        raise ImportError("pyarrow is required to read the coverage pyramid")
+
+    # pyarrow only accepts absolute local paths
+    if get_scheme(path) == "file" and not path.startswith("file://"):
+        path = os.path.abspath(path)
+    filesystem, root = pafs.FileSystem.from_uri(path)
+    with filesystem.open_input_stream(f"{root}/{PYRAMID_METADATA}") as f:
+        resolutions = json.loads(f.read().decode())["resolutions"]
+    if resolution not in resolutions:
+        raise ValueError(
+            f"Resolution {resolution} is not in the pyramid ({resolutions})"
+        )
+
+    dataset = ds.dataset(
+        root,
+        filesystem=filesystem,
+        format=ds.ParquetFileFormat(
+            read_options=ds.ParquetReadOptions(
+                dictionary_columns=["stratum_type", "stratum"]
+            )
+        ),
+        partitioning="hive",
+    )
+
+    row_filter = ds.field("resolution") == resolution
+    if stratum_types is not None:
+        row_filter &= ds.field("stratum_type").isin(stratum_types)
+    if strata is not None:
+        strata_filter = None
+        for stratum_type, stratum in strata:
+            predicate = (ds.field("stratum_type") == stratum_type) & (
+                ds.field("stratum") == stratum
+            )
+            strata_filter = (
+                predicate if strata_filter is None else strata_filter | predicate
+            )
+        row_filter &= strata_filter
+    if start is not None:
+        row_filter &= ds.field("end") >= start
+    if end is not None:
+        row_filter &= ds.field("start") <= end
+
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
@@ -0,0 +1,265 @@
+from __future__ import annotations
+
+import logging
+import math
+
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple
+
+from gnomad_mitochondria.utils.coverage_pyramid import (
+    DEFAULT_COVERAGE_THRESHOLDS,
+    STRATUM_TYPES,
+    annotate_sample_strata,
+)
+
+if TYPE_CHECKING:
+    import hail as hl
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("coverage sketches")
+logger.setLevel(logging.INFO)
+
+# Relative accuracy of the quantiles returned by the sketches (1% of the true coverage value)
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+
+def get_gamma(relative_accuracy: float) -> float:
+    """
+    Get the ratio between the bounds of consecutive sketch buckets for a given relative accuracy.
+
+    :param relative_accuracy: Relative accuracy of the quantiles returned by the sketches
+    :return: Bucket ratio
+    """
+    return (1 + relative_accuracy) / (1 - relative_accuracy)
+
+
+def coverage_bucket(
+    coverage: hl.expr.NumericExpression, gamma: float
+) -> hl.expr.Int32Expression:
+    """
+    Get the sketch bucket of a coverage value.
+
+    Bucket 0 holds zero coverage, and bucket i > 0 holds coverage in (gamma^(i - 2), gamma^(i - 1)], so that every value
+    in a bucket is within the relative accuracy of the value representing the bucket (see bucket_value).
+
+    :param coverage: Coverage expression
+    :param gamma: Bucket ratio (see get_gamma)
+    :return: Bucket index
+    """
+    import hail as hl
+
+    return hl.if_else(
+        coverage <= 0,
+        0,
+        hl.int32(hl.ceil(hl.log(hl.float64(coverage)) / math.log(gamma))) + 1,
+    )
+
+
+def bucket_value(
+    bucket: hl.expr.Int32Expression, gamma: float
+) -> hl.expr.Float64Expression:
+    """
+    Get the coverage value representing a sketch bucket.
+
+    :param bucket: Bucket index
+    :param gamma: Bucket ratio (see get_gamma)
+    :return: Coverage value
+    """
+    import hail as hl
+
+    return hl.if_else(
+        bucket == 0, 0.0, 2 * hl.float64(gamma) ** hl.float64(bucket - 1) / (gamma + 1)
+    )
+
+
+def annotate_coverage_sketches(
+    cov_mt: hl.MatrixTable,
+    samples_ht: hl.Table,
+    thresholds: Optional[List[int]] = None,
+    relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+) -> hl.Table:
+    """
+    Build a coverage sketch for each haplogroup and population at each position, in one pass over the entries.
+
+    A sketch holds the number of samples, the sum of their coverage, the number of samples above each threshold, and a
+    sparse histogram of coverage over logarithmically spaced buckets. Sketches are merged by summing them, so the
+    sketch of any union of strata (including all samples, as the union of every haplogroup) is exact to the bucket
+    resolution. Samples without a haplogroup or population are kept in the "NA" stratum.
+
+    :param cov_mt: Coverage table of sample level coverage at each position (see read_coverage_table)
+    :param samples_ht: Table keyed by sample with hap and pop annotations (see read_sample_strata)
+    :param thresholds: Coverage thresholds for which the number of samples above the threshold is counted exactly,
+        defaults to DEFAULT_COVERAGE_THRESHOLDS
+    :param relative_accuracy: Relative accuracy of the quantiles returned by the sketches
+    :return: Table keyed by pos with a dictionary of sketches by stratum for each stratum type (hap and pop), and the
+        thresholds and relative_accuracy as globals
+    """
+    import hail as hl
+
+    if thresholds is None:
+        thresholds = DEFAULT_COVERAGE_THRESHOLDS
+    gamma = get_gamma(relative_accuracy)
+    cov_mt = annotate_sample_strata(cov_mt, samples_ht)
+    bucket = coverage_bucket(cov_mt.coverage, gamma)
+
+    def _sketch():
+        return hl.struct(
+            n_samples=hl.int32(hl.agg.count()),
+            sum=hl.agg.sum(hl.int64(cov_mt.coverage)),
+            over=[
+                hl.int32(hl.agg.count_where(cov_mt.coverage > x)) for x in thresholds
+            ],
+            counts=hl.agg.counter(bucket).map_values(hl.int32),
+        )
+
+    # The row fields cannot share the names of the hap and pop column fields until they are moved to the rows Table
+    sketch_ht = cov_mt.select_rows(
+        **{
+            f"{x}_sketches": hl.agg.group_by(cov_mt[x], _sketch())
+            for x in STRATUM_TYPES
+        }
+    ).rows()
+    sketch_ht = sketch_ht.rename({f"{x}_sketches": x for x in STRATUM_TYPES})
+
+    return sketch_ht.select_globals(
+        thresholds=thresholds, relative_accuracy=relative_accuracy
+    )
+
+
+def merge_sketches(
+    sketches: hl.expr.ArrayExpression, n_thresholds: int
+) -> hl.expr.StructExpression:
+    """
+    Merge an array of coverage sketches into the sketch of the union of their samples.
+
+    :param sketches: Array of sketches (missing sketches, for strata without samples at a position, are ignored)
+    :param n_thresholds: Number of thresholds counted exactly in the sketches
+    :return: Merged sketch
+    """
+    import hail as hl
+
+    sketches = sketches.filter(hl.is_defined)
+    pairs = sketches.flatmap(lambda x: hl.array(x.counts))
+
+    return hl.struct(
+        n_samples=hl.sum(sketches.map(lambda x: hl.int64(x.n_samples))),
+        sum=hl.sum(sketches.map(lambda x: x.sum)),
+        over=[
+            hl.sum(sketches.map(lambda x: hl.int64(x.over[i])))
+            for i in range(n_thresholds)
+        ],
+        counts=hl.group_by(lambda x: x[0], pairs).map_values(
+            lambda x: hl.sum(x.map(lambda y: hl.int64(y[1])))
+        ),
+    )
+
+
+def sketch_quantile(
+    sketch: hl.expr.StructExpression, q: float, gamma: float
+) -> hl.expr.Float64Expression:
+    """
+    Get a quantile of coverage from a sketch.
+
+    :param sketch: Coverage sketch
+    :param q: Quantile (0.5 for the median)
+    :param gamma: Bucket ratio (see get_gamma)
+    :return: Coverage at the quantile, within the relative accuracy of the sketch (missing if the sketch has no samples)
+    """
+    import hail as hl
+
+    buckets = hl.sorted(hl.array(sketch.counts), key=lambda x: x[0])
+    cumulative = hl.array_scan(
+        lambda total, x: total + hl.int64(x[1]), hl.int64(0), buckets
+    )[1:]
+    rank = q * (sketch.n_samples - 1)
+    index = hl.enumerate(cumulative).find(lambda x: x[1] > rank)[0]
+
+    return hl.or_missing(sketch.n_samples > 0, bucket_value(buckets[index][0], gamma))
+
+
+def sketch_fraction_over(
+    sketch: hl.expr.StructExpression,
+    threshold: int,
+    thresholds: List[int],
+    gamma: float,
+) -> hl.expr.Float64Expression:
+    """
+    Get the fraction of samples with coverage above a threshold from a sketch.
+
+    The fraction is exact for the thresholds counted when the sketches were built, and within the bucket resolution
+    otherwise.
+
+    :param sketch: Coverage sketch
+    :param threshold: Coverage threshold
+    :param thresholds: Thresholds counted exactly in the sketch (stored as a global of the sketch Table)
+    :param gamma: Bucket ratio (see get_gamma)
+    :return: Fraction of samples above the threshold (missing if the sketch has no samples)
+    """
+    import hail as hl
+
+    if threshold in thresholds:
+        n_over = sketch.over[thresholds.index(threshold)]
+    else:
+        n_over = hl.sum(
+            hl.array(sketch.counts)
+            .filter(lambda x: bucket_value(x[0], gamma) > threshold)
+            .map(lambda x: x[1])
+        )
+
+    return hl.or_missing(sketch.n_samples > 0, n_over / sketch.n_samples)
+
+
+def query_coverage_sketches(
+    sketch_ht: hl.Table,
+    strata: Optional[List[Tuple[str, str]]] = None,
+    quantiles: Sequence[float] = (0.5,),
+    thresholds: Optional[List[int]] = None,
+) -> hl.Table:
+    """
+    Summarize coverage at each position for a stratum or union of strata from the sketches, without the coverage table.
+
+    :param sketch_ht: Table returned by annotate_coverage_sketches
+    :param strata: (stratum_type, stratum) tuples whose samples are summarized, for example [("hap", "H"), ("hap", "V")],
+        defaults to all samples (the union of every haplogroup)
+    :param quantiles: Quantiles of coverage to compute (0.5 for the median)
+    :param thresholds: Coverage thresholds for which the fraction of samples above the threshold is computed, defaults
+        to the thresholds counted in the sketches
+    :return: Table keyed by pos with n_samples, mean, an array of coverage at each of the quantiles, and
+        over_<threshold> for each threshold
+    """
+    import hail as hl
+
+    sketch_thresholds = hl.eval(sketch_ht.thresholds)
+    gamma = get_gamma(hl.eval(sketch_ht.relative_accuracy))
+    if thresholds is None:
+        thresholds = sketch_thresholds
+
+    if strata is None:
+        sketches = hl.array(sketch_ht[STRATUM_TYPES[0]].values())
+    else:
+        for stratum_type, _ in strata:
+            if stratum_type not in STRATUM_TYPES:
+                raise ValueError(
+                    f"Stratum type {stratum_type} is not one of {', '.join(STRATUM_TYPES)}"
+                )
+        sketches = hl.array(
+            [sketch_ht[stratum_type].get(stratum) for stratum_type, stratum in strata]
+        )
+
+    sketch_ht = sketch_ht.select(
+        sketch=merge_sketches(sketches, len(sketch_thresholds))
+    )
+    sketch = sketch_ht.sketch
+
+    return sketch_ht.select(
+        n_samples=sketch.n_samples,
+        mean=hl.or_missing(sketch.n_samples > 0, sketch.sum / sketch.n_samples),
+        quantiles=[sketch_quantile(sketch, q, gamma) for q in quantiles],
+        **{
+            f"over_{x}": sketch_fraction_over(sketch, x, sketch_thresholds, gamma)
+            for x in thresholds
+        },
+    )
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import logging
+
+from typing import TYPE_CHECKING, List, Optional
+
+from gnomad_mitochondria.utils.partitioning import get_n_partitions
+
+if TYPE_CHECKING:
+    import hail as hl
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("coverage table")
+logger.setLevel(logging.INFO)
+
+# Length of the mitochondrial genome (rCRS)
+CHRM_LENGTH = 16569
+# Contig of the mitochondrial genome in GRCh38, the only contig a coverage table holds
+CHRM_CONTIG = "chrM"
+# Version of the coverage table format, stored in the coverage_table global
+COVERAGE_TABLE_FORMAT_VERSION = 1
+# Row fields of the imported coverage files that are dropped in the coverage table (the position is the only key)
+DROPPED_ROW_FIELDS = ["chrom", "locus"]
+
+
+def get_position_intervals(n_partitions: int) -> List[hl.Interval]:
+    """
+    Split the mitochondrial genome into n_partitions contiguous ranges of positions of about the same length.
+
+    Reading coverage tables with the same intervals gives them identical row partitioning, so joins between them do
+    not need a shuffle.
+
+    :param n_partitions: Number of partitions
+    :return: List of intervals over the pos key
+    """
+    import hail as hl
+
+    bounds = [1 + (CHRM_LENGTH * i) // n_partitions for i in range(n_partitions)]
+    # The last interval is left open so that no row is dropped on read
+    bounds.append(2 ** 31 - 1)
+
+    return [
+        hl.Interval(
+            hl.Struct(pos=bounds[i]),
+            hl.Struct(pos=bounds[i + 1]),
+            includes_start=True,
+            includes_end=i == n_partitions - 1,
+        )
+        for i in range(n_partitions)
+    ]
+
+
+def to_coverage_table(cov_mt: hl.MatrixTable) -> hl.MatrixTable:
+    """
+    Convert a coverage MatrixTable to the layout of the coverage table: rows keyed by an int32 position and int32 entries.
+
+    Accepts the MatrixTable of imported coverage files (keyed by pos and chrom, and target with --keep-targets, which is
+    kept as a row field) and the locus-keyed MatrixTable written by annotate_coverage.py. Since chrom is dropped, rows
+    on any contig other than chrM fail the query that evaluates the result (for example the write in
+    write_coverage_table).
+
+    :param cov_mt: Coverage MatrixTable with numeric entries and columns keyed by s
+    :return: MatrixTable keyed by pos (rows) and s (columns)
+    """
+    import hail as hl
+
+    entries = {x: hl.int32(cov_mt[x]) for x in cov_mt.entry}
+    if "chrom" in cov_mt.row:
+        # The contig is checked in the entries, which are always written, rather than in a row field, which would be
+        # pruned once chrom is dropped
+        entries = {
+            x: hl.case()
+            .when(cov_mt.chrom == CHRM_CONTIG, expr)
+            .or_error(
+                f"Coverage tables only hold {CHRM_CONTIG}, found a row on "
+                + cov_mt.chrom
+                + ":"
+                + hl.str(cov_mt.pos)
+            )
+            for x, expr in entries.items()
+        }
+    cov_mt = cov_mt.select_entries(**entries)
+
+    if list(cov_mt.row_key)[0] == "pos":
+        # Rows of the imported coverage files are keyed by pos first, so dropping the rest of the key needs no shuffle
+        cov_mt = cov_mt._key_rows_by_assert_sorted("pos")
+    elif "pos" in cov_mt.row:
+        cov_mt = cov_mt.key_rows_by("pos")
+    else:
+        cov_mt = cov_mt.key_rows_by(pos=cov_mt.locus.position)
+
+    return cov_mt.drop(*[x for x in DROPPED_ROW_FIELDS if x in cov_mt.row])
+
+
+def key_rows_by_locus(
+    cov_mt: hl.MatrixTable, reference_genome: str = "GRCh38"
+) -> hl.MatrixTable:
+    """
+    Key the rows of a coverage table by locus on the mitochondrial contig of a reference genome.
+
+    Positions on a single contig are ordered like their loci, so Hail finds the rows already sorted and re-keys them
+    without a shuffle. Joins on the locus of a locus-keyed MatrixTable (such as a callset) then need no shuffle either.
+
+    :param cov_mt: Coverage table (see read_coverage_table)
+    :param reference_genome: Reference genome of the loci, whose mitochondrial contig is used (chrM for GRCh38, MT for
+        GRCh37)
+    :return: Coverage table keyed by locus (rows) and s (columns), without pos
+    """
+    import hail as hl
+
+    reference_genome = hl.get_reference(reference_genome)
+    cov_mt = cov_mt.key_rows_by(
+        locus=hl.locus(
+            reference_genome.mt_contigs[0],
+            cov_mt.pos,
+            reference_genome=reference_genome,
+        )
+    )
+
+    return cov_mt.drop("pos")
+
+
+def write_coverage_table(
+    cov_mt: hl.MatrixTable,
+    path: str,
+    n_partitions: Optional[int] = None,
+    overwrite: bool = False,
+    **kwargs,
+) -> None:
+    """
+    Write a coverage MatrixTable as a coverage table.
+
+    The number of partitions that readers split the table into (see read_coverage_table) is stored in the
+    coverage_table global along with the format version.
+
+    :param cov_mt: Coverage MatrixTable (see to_coverage_table)
+    :param path: Path of the coverage table
+    :param n_partitions: Number of partitions, chosen from the number of samples (n_cols) if not supplied
+    :param overwrite: Whether or not to overwrite an existing table
+    :param kwargs: Additional arguments passed to get_n_partitions (n_cols is needed if n_partitions is not supplied)
+    :return: None
+    """
+    import hail as hl
+
+    cov_mt = to_coverage_table(cov_mt)
+    n_partitions = get_n_partitions(
+        cov_mt, n_partitions, n_rows=CHRM_LENGTH, max_partitions=CHRM_LENGTH, **kwargs
+    )
+    cov_mt = cov_mt.annotate_globals(
+        coverage_table=hl.struct(
+            format_version=COVERAGE_TABLE_FORMAT_VERSION, n_partitions=n_partitions
+        )
+    )
+
+    logger.info(
+        "Writing coverage table with %i partitions to %s...", n_partitions, path
+    )
+    cov_mt.write(path, overwrite=overwrite)
+
+
+def read_coverage_table(
+    path: str, n_partitions: Optional[int] = None
+) -> hl.MatrixTable:
+    """
+    Read a coverage table, split into the position intervals shared by all coverage tables.
+
+    Locus-keyed coverage MatrixTables written by earlier versions of annotate_coverage.py are also accepted, and are
+    converted on read (which re-keys every row, so rewriting them with write_coverage_table is faster for repeated use).
+
+    :param path: Path of the coverage table
+    :param n_partitions: Number of partitions, defaults to the number stored when the table was written
+    :return: MatrixTable keyed by pos (rows) and s (columns)
+    """
+    import hail as hl
+
+    cov_mt = hl.read_matrix_table(path)
+    if "coverage_table" not in cov_mt.globals:
+        logger.info("%s is not a coverage table, converting it on read...", path)
+        return to_coverage_table(cov_mt)
+
+    if n_partitions is None:
+        n_partitions = hl.eval(cov_mt.coverage_table.n_partitions)
+
+    return hl.read_matrix_table(path, _intervals=get_position_intervals(n_partitions))
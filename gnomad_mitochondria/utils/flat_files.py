@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import json
+import logging
+import subprocess
+import zlib
+
+from typing import TYPE_CHECKING, Optional
+
+from gnomad_mitochondria.utils.storage import get_storage
+from gnomad_mitochondria.utils.vcf_export import export_sharded_tsv
+
+if TYPE_CHECKING:
+    import hail as hl
+
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+try:
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+except ImportError:
+    pc = ds = pafs = None
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("flat files")
+logger.setLevel(logging.INFO)
+
+# Low-cardinality or highly repeated string columns of the flat file that are read back as dictionaries (pandas categoricals)
+DICTIONARY_COLUMNS = [
+    "s",
+    "hap",
+    "major_haplogroup",
+    "pop",
+    "batch",
+    "FT",
+    "FT_LIFT",
+    "region",
+    "variant_context",
+    "variant",
+]
+FLAT_FILE_METADATA = "_flat_file_metadata.json"
+# Column layout of the indexed flat file for tabix (chrom and position as the first two columns and a one-line header),
+# as for tabix -s 1 -b 2 -e 2 -S 1
+FLAT_FILE_TABIX_PRESET = {
+    "format": 0,
+    "col_seq": 1,
+    "col_beg": 2,
+    "col_end": 2,
+    "meta_char": "#",
+    "line_skip": 1,
+}
+
+
+def export_flat_file_parquet(
+    ht: hl.Table,
+    output_path: str,
+    position_bin_size: int = 500,
+    overwrite: bool = False,
+) -> None:
+    """
+    Export the flat variant-by-sample Table (output of process_mt_for_flat_file_analysis) as Parquet partitioned by position range.
+
+    The files are partitioned by position_bin (the start of the position range),
+    with rows sorted by position within each file so that row-group statistics allow skipping on position and HL.
+    String columns are dictionary encoded, and numeric and boolean columns keep their Hail types.
+
+    :param ht: Table output by process_mt_for_flat_file_analysis
+    :param output_path: Path of the Parquet dataset directory
+    :param position_bin_size: Number of bases per position range partition
+    :param overwrite: Whether or not to overwrite an existing dataset
+    :return: None
+    """
+    import hail as hl
+
+    ht = ht.key_by()
+    if "position" not in ht.row:
+        # Only the flat file sorted for the indexed export has an integer position, otherwise it is parsed from the locus
+        ht = ht.annotate(position=hl.int32(ht.locus.split(":")[1]))
+    ht = ht.annotate(
+        position_bin=(ht.position // position_bin_size) * position_bin_size
+    )
+
+    logger.info("Writing flat file as Parquet to %s...", output_path)
+    df = ht.to_spark()
+    (
+        df.repartition("position_bin")
+        .sortWithinPartitions("position", "alleles", "s")
+        .write.mode("overwrite" if overwrite else "errorifexists")
+        .option("parquet.enable.dictionary", "true")
+        # Allow dictionaries large enough for sample IDs, so they are not written as plain strings
+        .option("parquet.dictionary.page.size", str(16 * 1024 * 1024))
+        .partitionBy("position_bin")
+        .parquet(output_path)
+    )
+
+    metadata_path = f"{output_path}/{FLAT_FILE_METADATA}"
+    get_storage(metadata_path).write_atomic(
+        metadata_path,
+        json.dumps({"position_bin_size": position_bin_size}).encode("utf8"),
+    )
+
+
+def read_flat_file_parquet(
+    path: str,
+    columns: Optional[list] = None,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    min_hl: Optional[float] = None,
+    max_hl: Optional[float] = None,
+    exclude_filters: Optional[list] = None,
+    column_values: Optional[dict] = None,
+    dictionary_columns: Optional[list] = None,
+):
+    """
+    Read the Parquet flat file into a pandas DataFrame, reading only the requested columns and matching rows.
+
+    Position predicates prune position_bin partitions and row groups, HL predicates use row-group statistics,
+    and the remaining predicates are applied while scanning so that non-matching rows are never materialized.
+
+    :param path: Path of the Parquet dataset directory (written by export_flat_file_parquet)
+    :param columns: Columns to read, defaults to all columns
+    :param start: Minimum position (inclusive)
+    :param end: Maximum position (inclusive)
+    :param min_hl: Minimum heteroplasmy level (inclusive), rows with missing HL are excluded
+    :param max_hl: Maximum heteroplasmy level (exclusive), rows with missing HL are excluded
+    :param exclude_filters: Rows whose FT contains any of these filters are excluded
+    :param column_values: Dictionary of column names and lists of allowed values (for example {"variant": [...]} or {"common_low_heteroplasmy": [True]})
+    :param dictionary_columns: String columns to read as pandas categoricals, defaults to DICTIONARY_COLUMNS
+    :return: pandas DataFrame
+    """
+    if ds is None:
+        raise ImportError("pyarrow is required to read the Parquet flat file")
+
+    filesystem, root = pafs.FileSystem.from_uri(path)
+    with filesystem.open_input_stream(f"{root}/{FLAT_FILE_METADATA}") as f:
+        position_bin_size = json.loads(f.read().decode())["position_bin_size"]
+
+    dictionary_columns = (
+        DICTIONARY_COLUMNS if dictionary_columns is None else dictionary_columns
+    )
+    dataset = ds.dataset(
+        root,
+        filesystem=filesystem,
+        format=ds.ParquetFileFormat(
+            read_options=ds.ParquetReadOptions(dictionary_columns=dictionary_columns)
+        ),
+        partitioning="hive",
+    )
+
+    predicates = []
+    if start is not None:
+        predicates.append(
+            ds.field("position_bin") >= (start // position_bin_size) * position_bin_size
+        )
+        predicates.append(ds.field("position") >= start)
+    if end is not None:
+        predicates.append(ds.field("position_bin") <= end)
+        predicates.append(ds.field("position") <= end)
+    if min_hl is not None:
+        predicates.append(ds.field("HL") >= min_hl)
+    if max_hl is not None:
+        predicates.append(ds.field("HL") < max_hl)
+    for filter_name in exclude_filters or []:
+        predicates.append(
+            ~pc.fill_null(pc.match_substring(ds.field("FT"), filter_name), False)
+        )
+    for column, values in (column_values or {}).items():
+        predicates.append(ds.field(column).isin(values))
+
+    row_filter = None
+    for predicate in predicates:
+        row_filter = predicate if row_filter is None else row_filter & predicate
+
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+
+
+def export_indexed_flat_file(
+    ht: hl.Table, output_path: str, n_threads: int = 8, shard_dir: Optional[str] = None,
+) -> None:
+    """
+    Export the flat variant-by-sample Table as a single locus-sorted BGZF file with a tabix index.
+
+    The Table (keyed by chrom, position, alleles, and s, as returned by process_mt_for_flat_file_analysis) is exported
+    in parallel as block-compressed shards, which are streamed into the output in key order without decompressing them
+    and indexed as they are written.
+
+    :param ht: Table output by process_mt_for_flat_file_analysis
+    :param output_path: Path of the bgzipped flat file to write
+    :param n_threads: Number of shards to read concurrently when concatenating
+    :param shard_dir: Directory to which the shards should be written, defaults to output_path with a ".shards" suffix
+    :return: None
+    """
+    if list(ht.key)[:2] != ["chrom", "position"]:
+        raise ValueError(
+            "Flat file must be keyed by chrom and position to be tabix indexed"
+        )
+    export_sharded_tsv(
+        ht,
+        output_path,
+        n_threads=n_threads,
+        shard_dir=shard_dir,
+        tabix_preset=FLAT_FILE_TABIX_PRESET,
+    )
+
+
+def read_bgzf_first_line(path: str, chunk_size: int = 65536) -> str:
+    """
+    Read the first line of a bgzipped file, reading only the blocks that hold it.
+
+    :param path: Path of the bgzipped file (any path supported by get_storage)
+    :param chunk_size: Number of compressed bytes to read at a time
+    :return: First line without its newline
+    """
+    storage = get_storage(path)
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    offset = 0
+    text = b""
+    while b"\n" not in text:
+        data = storage.read_range(path, offset, chunk_size)
+        if not data:
+            break
+        offset += len(data)
+        # Each BGZF block is a separate gzip member
+        while data:
+            text += decompressor.decompress(data)
+            if not decompressor.eof:
+                break
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+    return text.split(b"\n", 1)[0].decode("utf8")
+
+
+def query_flat_file(
+    path: str,
+    start: int,
+    end: Optional[int] = None,
+    contig: str = "chrM",
+    carriers_only: bool = True,
+) -> list:
+    """
+    Fetch the rows of the tabix-indexed flat file at a position or in a region.
+
+    :param path: Path of the bgzipped flat file written by export_indexed_flat_file (local, or a URL supported by htslib;
+        the header is read through get_storage)
+    :param start: Start position (1-based, inclusive)
+    :param end: End position (1-based, inclusive), defaults to start
+    :param contig: Contig name
+    :param carriers_only: If True, only return rows with a defined heteroplasmy level above 0 (excluding missing calls)
+    :return: List of dictionaries, one per row, keyed by the flat file column names
+    """
+    end = start if end is None else end
+    columns = read_bgzf_first_line(path).split("\t")
+
+    if pysam is not None:
+        with pysam.TabixFile(path) as tbx:
+            lines = list(tbx.fetch(contig, start - 1, end))
+    else:
+        lines = subprocess.run(
+            ["tabix", path, f"{contig}:{start}-{end}"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.splitlines()
+
+    rows = [dict(zip(columns, line.split("\t"))) for line in lines]
+    if carriers_only:
+        rows = [x for x in rows if x["HL"] not in ("", "NA") and float(x["HL"]) > 0]
+
+    return rows
@@ -0,0 +1,368 @@
+from __future__ import annotations
+
+import functools
+import json
+import logging
+import resource
+import time
+
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Optional, Union
+
+from gnomad_mitochondria.utils.partitioning import get_path_bytes
+from gnomad_mitochondria.utils.storage import get_storage
+
+if TYPE_CHECKING:
+    import hail as hl
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("instrumentation")
+logger.setLevel(logging.INFO)
+
+# Largest query plan (number of IR nodes) a stage can execute in diagnostic mode before a warning is logged
+DEFAULT_IR_NODE_THRESHOLD = 50000
+
+
+def get_last_spark_job_id() -> Optional[int]:
+    """
+    Get the ID of the most recent Spark job, which increases by one with every job submitted.
+
+    :return: Job ID (-1 if no job has run), or None if Hail is not running on the Spark backend
+    """
+    import hail as hl
+
+    try:
+        tracker = hl.spark_context().statusTracker()
+    except Exception:
+        return None
+
+    return max(tracker.getJobIdsForGroup(), default=-1)
+
+
+def get_driver_jvm_heap_bytes() -> Optional[int]:
+    """
+    Get the heap memory in use by the driver JVM.
+
+    :return: Number of bytes, or None if the JVM cannot be reached
+    """
+    import hail as hl
+
+    try:
+        runtime = hl.utils.java.Env.jvm().java.lang.Runtime.getRuntime()
+    except Exception:
+        return None
+
+    return runtime.totalMemory() - runtime.freeMemory()
+
+
+def get_driver_python_peak_rss_bytes() -> int:
+    """
+    Get the peak resident set size of the Python driver process (ru_maxrss is in kilobytes on Linux).
+
+    :return: Number of bytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def count_ir_nodes(ir) -> int:
+    """
+    Count the nodes of a Hail IR tree (for example the IR of a query or of a MatrixTable).
+
+    Subtrees referenced more than once are counted at every reference.
+
+    :param ir: Hail IR node
+    :return: Number of nodes
+    """
+    n_nodes = 0
+    stack = [ir]
+    while stack:
+        node = stack.pop()
+        n_nodes += 1
+        stack.extend(node.children)
+
+    return n_nodes
+
+
+def iter_timings(timings):
+    """
+    Iterate over the named phases of the timings returned by the Hail backend for one query.
+
+    Each phase is a dictionary with a name (context) and a total_time in nanoseconds, and may have nested children.
+
+    :param timings: Timings returned by the Hail backend
+    :return: Generator of (name, total time in nanoseconds, children) tuples of the top-level phases
+    """
+    if isinstance(timings, list):
+        for x in timings:
+            yield from iter_timings(x)
+    elif isinstance(timings, dict):
+        name = timings.get("context", timings.get("name"))
+        if name is not None and "total_time" in timings:
+            yield name, timings["total_time"], timings.get("children", [])
+        else:
+            for x in timings.values():
+                yield from iter_timings(x)
+
+
+def split_compile_time(timings) -> tuple:
+    """
+    Split the time of one query into compilation (lowering, optimization, and code generation) and execution.
+
+    Phases whose name starts with "Run" are execution (for example RunCompiledFunction), everything else is compilation.
+
+    :param timings: Timings returned by the Hail backend
+    :return: Tuple of compilation and execution time in seconds
+    """
+    compile_time = 0
+    execute_time = 0
+    stack = list(iter_timings(timings))
+    while stack:
+        name, total_time, children = stack.pop()
+        if name.startswith("Run"):
+            execute_time += total_time
+        elif children:
+            # Time of a phase not covered by its children is attributed to the phase itself
+            child_phases = list(iter_timings(children))
+            compile_time += total_time - sum(x[1] for x in child_phases)
+            stack.extend(child_phases)
+        else:
+            compile_time += total_time
+
+    return compile_time / 1e9, execute_time / 1e9
+
+
+class RunReport:
+    """
+    Per-stage wall time, Spark job count, checkpoint I/O, and driver memory of a pipeline run.
+
+    Stages are delimited with the stage context manager (or the instrument decorator) and checkpoints are written
+    through the checkpoint method so that their size is attributed to the running stage.
+
+    In diagnostic mode every query executed by the Hail backend during a stage is also timed by phase, and the size of
+    its IR is counted, so that stages whose query plans blow up can be found before they reach production runs.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        diagnostics: bool = False,
+        ir_node_threshold: int = DEFAULT_IR_NODE_THRESHOLD,
+    ):
+        """
+        Start an empty report.
+
+        :param name: Name of the run (for example the script name)
+        :param diagnostics: Whether to record the IR node count and compilation and execution time of each query
+        :param ir_node_threshold: Number of IR nodes in a query above which a warning is logged (in diagnostic mode)
+        """
+        self.name = name
+        self.diagnostics = diagnostics
+        self.ir_node_threshold = ir_node_threshold
+        self.stages = []
+        self._current_stage = None
+        self._last_checkpoint_bytes = 0
+        self._start = time.time()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Record the metrics of the code run inside the context as one stage.
+
+        Checkpoint bytes read are the size of the most recent checkpoint when the stage starts, since each stage reads
+        its input from the last checkpoint. Work triggered lazily by a later stage is attributed to that later stage.
+
+        :param name: Name of the stage
+        """
+        record = {
+            "stage": name,
+            "checkpoint_bytes_read": self._last_checkpoint_bytes,
+            "checkpoint_bytes_written": 0,
+            "checkpoints": [],
+        }
+        if self.diagnostics:
+            record.update(
+                {
+                    "n_queries": 0,
+                    "max_ir_nodes": 0,
+                    "total_ir_nodes": 0,
+                    "compile_time_s": 0.0,
+                    "execute_time_s": 0.0,
+                }
+            )
+        previous_stage = self._current_stage
+        self._current_stage = record
+        first_job_id = get_last_spark_job_id()
+        start = time.time()
+        try:
+            if self.diagnostics:
+                with self._trace_queries(record):
+                    yield record
+            else:
+                yield record
+        finally:
+            record["wall_time_s"] = time.time() - start
+            last_job_id = get_last_spark_job_id()
+            record["n_spark_jobs"] = (
+                None if first_job_id is None else last_job_id - first_job_id
+            )
+            record["driver_jvm_heap_bytes"] = get_driver_jvm_heap_bytes()
+            record["driver_python_peak_rss_bytes"] = get_driver_python_peak_rss_bytes()
+            self._current_stage = previous_stage
+            self.stages.append(record)
+            logger.info(
+                "Stage %s took %.1fs (%s Spark jobs)",
+                name,
+                record["wall_time_s"],
+                record["n_spark_jobs"],
+            )
+            if self.diagnostics:
+                logger.info(
+                    "Stage %s ran %i queries (largest %i IR nodes): %.1fs compiling, %.1fs executing",
+                    name,
+                    record["n_queries"],
+                    record["max_ir_nodes"],
+                    record["compile_time_s"],
+                    record["execute_time_s"],
+                )
+                if record["max_ir_nodes"] > self.ir_node_threshold:
+                    logger.warning(
+                        "Stage %s executed a query of %i IR nodes, above the threshold of %i",
+                        name,
+                        record["max_ir_nodes"],
+                        self.ir_node_threshold,
+                    )
+
+    @contextmanager
+    def _trace_queries(self, record: dict):
+        """
+        Time and count the IR nodes of every query executed by the Hail backend inside the context.
+
+        :param record: Stage record to which the query metrics are added
+        """
+        import hail as hl
+
+        backend = hl.current_backend()
+        execute = backend.execute
+        # An enclosing stage may already have replaced execute on the instance
+        previous_execute = backend.__dict__.get("execute")
+
+        def traced_execute(ir, timed=False):
+            n_nodes = count_ir_nodes(ir)
+            result, timings = execute(ir, timed=True)
+            compile_time, execute_time = split_compile_time(timings)
+            record["n_queries"] += 1
+            record["max_ir_nodes"] = max(record["max_ir_nodes"], n_nodes)
+            record["total_ir_nodes"] += n_nodes
+            record["compile_time_s"] += compile_time
+            record["execute_time_s"] += execute_time
+
+            return (result, timings) if timed else result
+
+        # The instance attribute shadows the backend's method until the stage ends
+        backend.execute = traced_execute
+        try:
+            yield
+        finally:
+            if previous_execute is None:
+                del backend.execute
+            else:
+                backend.execute = previous_execute
+
+    def instrument(self, name: Optional[str] = None):
+        """
+        Decorate a function so that each call is recorded as a stage.
+
+        :param name: Name of the stage, defaults to the name of the function
+        :return: Decorator
+        """
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or function.__name__):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def checkpoint(
+        self, data: Union[hl.MatrixTable, hl.Table], path: str, **kwargs
+    ) -> Union[hl.MatrixTable, hl.Table]:
+        """
+        Checkpoint a MatrixTable or Table and attribute the bytes written to the running stage.
+
+        :param data: MatrixTable or Table
+        :param path: Path of the checkpoint
+        :param kwargs: Additional arguments passed to checkpoint (such as overwrite)
+        :return: Checkpointed MatrixTable or Table
+        """
+        data = data.checkpoint(path, **kwargs)
+        n_bytes = get_path_bytes(path)
+        self._last_checkpoint_bytes = n_bytes
+        if self._current_stage is not None:
+            self._current_stage["checkpoint_bytes_written"] += n_bytes
+            self._current_stage["checkpoints"].append(path)
+
+        return data
+
+    def to_dict(self) -> dict:
+        """
+        Get the report as a dictionary.
+
+        :return: Dictionary with the run name, total wall time, and list of stages in the order they finished
+        """
+        import hail as hl
+
+        return {
+            "name": self.name,
+            "hail_version": hl.version(),
+            "total_wall_time_s": time.time() - self._start,
+            "diagnostics": self.diagnostics,
+            "stages": self.stages,
+        }
+
+    def write(self, path: str) -> None:
+        """
+        Write the report as JSON.
+
+        :param path: Output path (local or cloud)
+        """
+        get_storage(path).write_atomic(
+            path, json.dumps(self.to_dict(), indent=2).encode("utf8")
+        )
+
+    def summary(self) -> str:
+        """
+        Format the stages as a table sorted by wall time, longest first.
+
+        :return: Summary table
+        """
+        total = sum(x["wall_time_s"] for x in self.stages) or 1
+        header = f"{'stage':<40} {'time (s)':>10} {'%':>6} {'jobs':>6} {'read (MB)':>10} {'written (MB)':>12} {'heap (MB)':>10}"
+        if self.diagnostics:
+            header += f" {'IR nodes':>10} {'compile (s)':>12} {'execute (s)':>12}"
+        lines = [header]
+        for x in sorted(self.stages, key=lambda x: x["wall_time_s"], reverse=True):
+            line = "{:<40} {:>10.1f} {:>6.1f} {:>6} {:>10.1f} {:>12.1f} {:>10}".format(
+                x["stage"],
+                x["wall_time_s"],
+                100 * x["wall_time_s"] / total,
+                "-" if x["n_spark_jobs"] is None else x["n_spark_jobs"],
+                x["checkpoint_bytes_read"] / 1e6,
+                x["checkpoint_bytes_written"] / 1e6,
+                "-"
+                if x["driver_jvm_heap_bytes"] is None
+                else f"{x['driver_jvm_heap_bytes'] / 1e6:.1f}",
+            )
+            if self.diagnostics:
+                line += " {:>10} {:>12.1f} {:>12.1f}".format(
+                    x["max_ir_nodes"], x["compile_time_s"], x["execute_time_s"]
+                )
+            lines.append(line)
+
+        return "\n".join(lines)
@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import logging
+import math
+
+from typing import TYPE_CHECKING, List, Optional, Union
+
+from gnomad_mitochondria.utils.storage import get_storage
+
+if TYPE_CHECKING:
+    import hail as hl
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("partitioning")
+logger.setLevel(logging.INFO)
+
+# Target amount of data per partition (large enough to amortize task overhead, small enough to avoid spilling)
+DEFAULT_TARGET_PARTITION_BYTES = 128 * 1024 * 1024
+# Assumed sizes of variable-length values when estimating the size of a row or entry from its type
+STRING_BYTES = 16
+CONTAINER_LENGTH = 4
+# Keyed by the string form of the Hail type so that hail is not imported when this module is loaded
+FIXED_TYPE_BYTES = {
+    "bool": 1,
+    "int32": 4,
+    "int64": 8,
+    "float32": 4,
+    "float64": 8,
+    "call": 4,
+}
+
+
+def estimate_value_bytes(dtype: hl.HailType) -> int:
+    """
+    Estimate the number of bytes of a value of a Hail type.
+
+    Strings are assumed to be STRING_BYTES long and arrays, sets, and dictionaries to have CONTAINER_LENGTH elements.
+
+    :param dtype: Hail type
+    :return: Estimated number of bytes
+    """
+    import hail as hl
+
+    if str(dtype) in FIXED_TYPE_BYTES:
+        return FIXED_TYPE_BYTES[str(dtype)]
+    if isinstance(dtype, hl.tlocus):
+        return 8
+    if dtype == hl.tstr:
+        return STRING_BYTES
+    if isinstance(dtype, (hl.tstruct, hl.ttuple)):
+        return sum(estimate_value_bytes(x) for x in dtype.types)
+    if isinstance(dtype, (hl.tarray, hl.tset)):
+        return CONTAINER_LENGTH * estimate_value_bytes(dtype.element_type)
+    if isinstance(dtype, hl.tdict):
+        return CONTAINER_LENGTH * (
+            estimate_value_bytes(dtype.key_type)
+            + estimate_value_bytes(dtype.value_type)
+        )
+    if isinstance(dtype, hl.tinterval):
+        return 2 * estimate_value_bytes(dtype.point_type)
+
+    return 8
+
+
+def get_path_bytes(path: str) -> int:
+    """
+    Sum the sizes of all files under a path (for example a written Table or MatrixTable).
+
+    On object stores this is a single recursive listing rather than one listing per directory.
+
+    :param path: Path of a file or directory
+    :return: Total number of bytes
+    """
+    storage = get_storage(path)
+    info = storage.stat(path)
+    if not info["is_dir"]:
+        return info["size_bytes"]
+
+    return sum(x["size_bytes"] for x in storage.list(path, recursive=True))
+
+
+def estimate_mt_bytes(mt: hl.MatrixTable, n_rows: int, n_cols: int) -> int:
+    """
+    Estimate the size of a MatrixTable as rows x (row bytes + columns x entry bytes).
+
+    The counts are not computed here, because counting a MatrixTable that has not been written runs its whole pipeline.
+
+    :param mt: MatrixTable
+    :param n_rows: Number of rows
+    :param n_cols: Number of columns
+    :return: Estimated number of bytes
+    """
+    return n_rows * (
+        estimate_value_bytes(mt.row.dtype)
+        + n_cols * estimate_value_bytes(mt.entry.dtype)
+    )
+
+
+def estimate_table_bytes(ht: hl.Table, n_rows: int) -> int:
+    """
+    Estimate the size of a Table as rows x row bytes.
+
+    :param ht: Table
+    :param n_rows: Number of rows
+    :return: Estimated number of bytes
+    """
+    return n_rows * estimate_value_bytes(ht.row.dtype)
+
+
+def choose_n_partitions(
+    n_bytes: int,
+    target_partition_bytes: int = DEFAULT_TARGET_PARTITION_BYTES,
+    min_partitions: int = 1,
+    max_partitions: Optional[int] = None,
+) -> int:
+    """
+    Choose the number of partitions that gives about target_partition_bytes per partition.
+
+    :param n_bytes: Total number of bytes
+    :param target_partition_bytes: Target number of bytes per partition
+    :param min_partitions: Minimum number of partitions
+    :param max_partitions: Optional maximum number of partitions
+    :return: Number of partitions
+    """
+    n_partitions = max(min_partitions, int(math.ceil(n_bytes / target_partition_bytes)))
+    if max_partitions is not None:
+        n_partitions = min(n_partitions, max_partitions)
+
+    return n_partitions
+
+
+def get_n_partitions(
+    data: Union[hl.MatrixTable, hl.Table, None] = None,
+    n_partitions: Optional[int] = None,
+    target_partition_bytes: int = DEFAULT_TARGET_PARTITION_BYTES,
+    path: Union[str, List[str], None] = None,
+    n_rows: Optional[int] = None,
+    n_cols: Optional[int] = None,
+    min_partitions: int = 1,
+    max_partitions: Optional[int] = None,
+) -> int:
+    """
+    Get the number of partitions to use for a repartition or coalesce.
+
+    An explicitly supplied n_partitions is returned unchanged. Otherwise the size is taken from the files under path
+    if supplied (for data that has been written, for example by a checkpoint), or estimated from known row and column
+    counts and the types of data. Nothing is ever counted here: counting data that has not been written would run its
+    whole pipeline one extra time just to choose a partition count.
+
+    :param data: MatrixTable or Table to be repartitioned (not needed if path is supplied)
+    :param n_partitions: Explicit number of partitions, which overrides the estimate if not None
+    :param target_partition_bytes: Target number of bytes per partition
+    :param path: Optional path (or list of paths) of the written data to size from file metadata
+    :param n_rows: Known number of rows (needed if path is not supplied)
+    :param n_cols: Known number of columns (needed for a MatrixTable if path is not supplied)
+    :param min_partitions: Minimum number of partitions
+    :param max_partitions: Optional maximum number of partitions
+    :return: Number of partitions
+    """
+    import hail as hl
+
+    if n_partitions is not None:
+        return n_partitions
+
+    if path is not None:
+        n_bytes = sum(
+            get_path_bytes(x) for x in ([path] if isinstance(path, str) else path)
+        )
+    elif isinstance(data, hl.MatrixTable) and n_rows is not None and n_cols is not None:
+        n_bytes = estimate_mt_bytes(data, n_rows, n_cols)
+    elif isinstance(data, hl.Table) and n_rows is not None:
+        n_bytes = estimate_table_bytes(data, n_rows)
+    else:
+        raise ValueError(
+            "Either n_partitions, the path of the written data, or data with its row (and column) counts must be "
+            "supplied to choose the number of partitions"
+        )
+
+    n_partitions = choose_n_partitions(
+        n_bytes, target_partition_bytes, min_partitions, max_partitions
+    )
+    logger.info(
+        "Using %i partitions for an estimated %.1f MB (target %.1f MB per partition)",
+        n_partitions,
+        n_bytes / 1e6,
+        target_partition_bytes / 1e6,
+    )
+
+    return n_partitions
+
+
+def repartition_to_target(
+    data: Union[hl.MatrixTable, hl.Table], n_partitions: Optional[int] = None, **kwargs
+) -> Union[hl.MatrixTable, hl.Table]:
+    """
+    Repartition a MatrixTable or Table to the number of partitions chosen by get_n_partitions.
+
+    The data is returned unchanged (without a shuffle) if it already has that number of partitions.
+
+    :param data: MatrixTable or Table to repartition
+    :param n_partitions: Explicit number of partitions, which overrides the estimate if not None
+    :param kwargs: Arguments passed to get_n_partitions to choose the number of partitions (such as the path of the
+        written input of data)
+    :return: Repartitioned data
+    """
+    n_partitions = get_n_partitions(data, n_partitions, **kwargs)
+    if data.n_partitions() == n_partitions:
+        return data
+
+    return data.repartition(n_partitions)
+
+
+def naive_coalesce_to_target(
+    data: Union[hl.MatrixTable, hl.Table], n_partitions: Optional[int] = None, **kwargs
+) -> Union[hl.MatrixTable, hl.Table]:
+    """
+    Coalesce a MatrixTable or Table without a shuffle to the number of partitions chosen by get_n_partitions.
+
+    A coalesce only merges neighbouring partitions, so data that already has at most that number of partitions is
+    returned unchanged. This suits filtered data sized from its written input, whose size is an upper bound.
+
+    :param data: MatrixTable or Table to coalesce
+    :param n_partitions: Explicit number of partitions, which overrides the estimate if not None
+    :param kwargs: Arguments passed to get_n_partitions to choose the number of partitions (such as the path of the
+        written input of data)
+    :return: Coalesced data
+    """
+    n_partitions = get_n_partitions(data, n_partitions, **kwargs)
+
+    return data.naive_coalesce(n_partitions)
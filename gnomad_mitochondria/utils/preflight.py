@@ -0,0 +1,213 @@
+import csv
+import gzip
+import io
+import json
+import logging
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from gnomad_mitochondria.utils.storage import get_storage
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("preflight")
+logger.setLevel(logging.INFO)
+
+# Number of paths checked concurrently (checks are dominated by request latency, not CPU)
+DEFAULT_PREFLIGHT_THREADS = 32
+# Number of bytes read from the start of a file to check its header (the first BGZF block is at most 64KB)
+HEADER_BYTES = 65536
+# Number of failing paths listed in the log before the run is aborted
+MAX_LOGGED_FAILURES = 20
+# Leading columns of the per-base coverage files output by the mtDNA pipeline
+COVERAGE_COLUMNS = ["chrom", "pos", "target"]
+
+
+def read_manifest(path: str) -> List[Dict[str, str]]:
+    """
+    Read a tab-delimited manifest (such as the participant data of combine_vcfs.py) without starting Hail.
+
+    :param path: Path of the manifest (optionally gzip or bgzip compressed)
+    :return: List of rows as dictionaries keyed by column name
+    """
+    data = get_storage(path).read(path)
+    if path.endswith((".gz", ".bgz")):
+        data = gzip.decompress(data)
+
+    return list(csv.DictReader(io.StringIO(data.decode("utf8")), delimiter="\t"))
+
+
+def read_first_line(path: str) -> str:
+    """
+    Read the first line of a file, decompressing it if it is gzip or BGZF compressed.
+
+    Only the first HEADER_BYTES bytes are read, so this is cheap for large files.
+
+    :param path: Path of the file
+    :return: First line of the file
+    """
+    data = get_storage(path).read_range(path, 0, HEADER_BYTES)
+    if data[:2] == b"\x1f\x8b":
+        # Decompresses as much of the first gzip member as was read
+        data = zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(data)
+
+    return data.split(b"\n", 1)[0].decode("utf8", errors="replace")
+
+
+def is_vcf_header(line: str) -> bool:
+    """
+    Check that the first line of a file is a VCF header.
+
+    :param line: First line of the file
+    :return: True if the file declares a VCF format version
+    """
+    return line.startswith("##fileformat=VCF")
+
+
+def is_coverage_header(line: str) -> bool:
+    """
+    Check that the first line of a file is the header of a per-base coverage file.
+
+    :param line: First line of the file
+    :return: True if the file starts with the chrom, pos, and target columns
+    """
+    return line.rstrip("\r").split("\t")[: len(COVERAGE_COLUMNS)] == COVERAGE_COLUMNS
+
+
+def check_path(
+    path: str,
+    header_check: Optional[Callable[[str], bool]] = None,
+    cached: Optional[dict] = None,
+) -> dict:
+    """
+    Check that a path exists, is a non-empty file, and (optionally) has a valid header.
+
+    :param path: Path to check
+    :param header_check: Function of the first line of the file returning whether the header is valid, or None to skip
+        the header check
+    :param cached: Result of a previous check of the path; its header check is reused if the file has not changed
+    :return: Dictionary with the path, size_bytes, modification_time, header_checked, and error (None if the path is valid)
+    """
+    result = {
+        "path": path,
+        "size_bytes": None,
+        "modification_time": None,
+        "header_checked": False,
+        "error": None,
+    }
+    try:
+        info = get_storage(path).stat(path)
+        result["size_bytes"] = info["size_bytes"]
+        result["modification_time"] = info["modification_time"]
+        if info["is_dir"]:
+            result["error"] = "is a directory"
+        elif info["size_bytes"] == 0:
+            result["error"] = "is empty"
+        elif header_check is not None:
+            unchanged = (
+                cached is not None
+                and cached["header_checked"]
+                and cached["modification_time"] is not None
+                and cached["modification_time"] == info["modification_time"]
+                and cached["size_bytes"] == info["size_bytes"]
+            )
+            if not unchanged and not header_check(read_first_line(path)):
+                result["error"] = "does not have a valid header"
+            result["header_checked"] = True
+    except FileNotFoundError:
+        result["error"] = "does not exist"
+    except Exception as e:
+        result["error"] = f"could not be checked ({type(e).__name__}: {e})"
+
+    return result
+
+
+def read_preflight_cache(cache_path: str) -> dict:
+    """
+    Read the results of earlier pre-flight checks.
+
+    :param cache_path: Path of the cache
+    :return: Dictionary with paths as keys and the results of check_path as values (empty if there is no cache yet)
+    """
+    storage = get_storage(cache_path)
+    if not storage.exists(cache_path):
+        return {}
+
+    return json.loads(storage.read_text(cache_path))
+
+
+def validate_paths(
+    paths: List[str],
+    header_check: Optional[Callable[[str], bool]] = None,
+    n_threads: int = DEFAULT_PREFLIGHT_THREADS,
+    cache_path: Optional[str] = None,
+) -> List[dict]:
+    """
+    Check every path concurrently with check_path.
+
+    With a cache, header checks are skipped for files whose size and modification time have not changed since they last
+    passed, and the results of the passing paths are written back to the cache.
+
+    :param paths: Paths to check
+    :param header_check: Function of the first line of a file returning whether its header is valid, or None to skip
+        header checks
+    :param n_threads: Number of paths to check concurrently
+    :param cache_path: Path of a JSON file caching the results of earlier checks
+    :return: List of the results of the paths that failed
+    """
+    cache = {} if cache_path is None else read_preflight_cache(cache_path)
+    unique_paths = list(dict.fromkeys(paths))
+    logger.info(
+        "Checking %i paths with %i threads%s...",
+        len(unique_paths),
+        n_threads,
+        " (including headers)" if header_check is not None else "",
+    )
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        results = list(
+            executor.map(
+                lambda x: check_path(x, header_check, cache.get(x)), unique_paths
+            )
+        )
+
+    if cache_path is not None:
+        cache.update({x["path"]: x for x in results if x["error"] is None})
+        get_storage(cache_path).write_atomic(
+            cache_path, json.dumps(cache).encode("utf8")
+        )
+
+    return [x for x in results if x["error"] is not None]
+
+
+def preflight_check(
+    paths: List[str],
+    header_check: Optional[Callable[[str], bool]] = None,
+    n_threads: int = DEFAULT_PREFLIGHT_THREADS,
+    cache_path: Optional[str] = None,
+) -> None:
+    """
+    Validate the input paths of a run and abort it before any merging starts if any of them is missing or invalid.
+
+    :param paths: Paths to check
+    :param header_check: Function of the first line of a file returning whether its header is valid, or None to skip
+        header checks
+    :param n_threads: Number of paths to check concurrently
+    :param cache_path: Path of a JSON file caching the results of earlier checks
+    :return: None
+    """
+    failures = validate_paths(paths, header_check, n_threads, cache_path)
+    for x in failures[:MAX_LOGGED_FAILURES]:
+        logger.error("%s %s", x["path"], x["error"])
+    if len(failures) > MAX_LOGGED_FAILURES:
+        logger.error("... and %i more", len(failures) - MAX_LOGGED_FAILURES)
+    if failures:
+        raise ValueError(
+            f"ERROR: {len(failures)} of {len(set(paths))} input paths failed pre-flight validation."
+        )
+    logger.info("All %i input paths passed pre-flight validation.", len(set(paths)))
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+import argparse
+import bisect
+import gzip
+import json
+import logging
+import re
+import time
+
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("sites query server")
+logger.setLevel(logging.INFO)
+
+# Accepted variant notations: A3243G, m.3243A>G, 3243A>G, chrM:3243:A:G, and chrM-3243-A-G
+VARIANT_NOTATION_PATTERNS = [
+    re.compile(r"^(?P<ref>[ACGTN]+)(?P<position>\d+)(?P<alt>[ACGTN]+)$"),
+    re.compile(r"^(?:m\.)?(?P<position>\d+)(?P<ref>[ACGTN]+)>(?P<alt>[ACGTN]+)$"),
+    re.compile(
+        r"^(?:chrM|MT)[:-](?P<position>\d+)[:-](?P<ref>[ACGTN]+)[:-](?P<alt>[ACGTN]+)$"
+    ),
+]
+DEFAULT_REGION_LIMIT = 1000
+
+
+def parse_value(value: str):
+    """
+    Parse a value of a Hail-exported text file (numbers, booleans, and arrays/sets/structs are JSON, missing values are NA).
+
+    NaN and infinite values are parsed as None, since they cannot be written back as valid JSON.
+
+    :param value: Value as written by Table.export
+    :return: Parsed value (None if missing)
+    """
+    if value == "NA" or value == "":
+        return None
+    try:
+        return json.loads(value, parse_constant=lambda x: None)
+    except ValueError:
+        return value
+
+
+def parse_variant_notation(notation: str) -> Optional[tuple]:
+    """
+    Parse a variant written in one of the accepted notations.
+
+    :param notation: Variant notation, for example A3243G or chrM:3243:A:G
+    :return: Tuple of position, ref, and alt, or None if the notation is not recognized
+    """
+    notation = notation.strip()
+    for pattern in VARIANT_NOTATION_PATTERNS:
+        match = pattern.match(notation)
+        if match:
+            return int(match.group("position")), match.group("ref"), match.group("alt")
+
+    return None
+
+
+class SitesIndex:
+    """
+    In-memory index of the sites-only output of add_annotations.py, keyed by position/alleles, position, and rsID.
+
+    Haplogroup arrays (fields starting with hap_ that have one value per haplogroup) are converted to dictionaries keyed by haplogroup.
+    """
+
+    def __init__(self, variants: list, hap_order: Optional[list] = None):
+        """
+        Build the lookup tables of the index.
+
+        :param variants: List of variant dictionaries with position, ref, alt, and the annotations to serve
+        :param hap_order: Haplogroups in the order of the values of the haplogroup arrays
+        """
+        self.hap_order = hap_order or []
+        self.variants = sorted(
+            variants, key=lambda x: (x["position"], x["ref"], x["alt"])
+        )
+        self.positions = [x["position"] for x in self.variants]
+        self.by_variant = {
+            (x["position"], x["ref"], x["alt"]): x for x in self.variants
+        }
+        self.by_rsid = defaultdict(list)
+        self.by_hap = defaultdict(list)
+        for variant in self.variants:
+            for rsid in variant.get("rsid") or []:
+                self.by_rsid[rsid].append(variant)
+            if self.hap_order:
+                for hap, ac in zip(self.hap_order, self._hap_acs(variant)):
+                    if ac:
+                        self.by_hap[hap].append(variant)
+
+    @staticmethod
+    def _hap_acs(variant: dict) -> list:
+        ac_hom = variant.get("hap_AC_hom") or []
+        ac_het = variant.get("hap_AC_het") or []
+        return [(x or 0) + (y or 0) for x, y in zip(ac_hom, ac_het)]
+
+    @classmethod
+    def from_sites_txt(cls, sites_txt_path: str, globals_path: Optional[str] = None):
+        """
+        Load the sites-only text file written by add_annotations.py.
+
+        :param sites_txt_path: Path of the sites-only text file (optionally gzip/bgzip compressed)
+        :param globals_path: Path of the JSON file of sites globals (hap_order and pop_order) written by add_annotations.py
+        :return: SitesIndex
+        """
+        hap_order = None
+        if globals_path is not None:
+            with open(globals_path) as f:
+                hap_order = json.load(f)["hap_order"]
+
+        open_function = gzip.open if sites_txt_path.endswith((".gz", ".bgz")) else open
+        variants = []
+        with open_function(sites_txt_path, "rt") as f:
+            header = f.readline().rstrip("\n").split("\t")
+            for line in f:
+                row = dict(zip(header, line.rstrip("\n").split("\t")))
+                variant = {
+                    x: parse_value(y)
+                    for x, y in row.items()
+                    if x not in ("locus", "alleles")
+                }
+                contig, position = row["locus"].split(":")
+                alleles = json.loads(row["alleles"])
+                variant.update(
+                    contig=contig,
+                    position=int(position),
+                    ref=alleles[0],
+                    alt=alleles[1],
+                )
+                variants.append(variant)
+
+        return cls(variants, hap_order)
+
+    def format_variant(self, variant: dict) -> dict:
+        """
+        Format a variant for output, converting haplogroup arrays to dictionaries keyed by haplogroup.
+
+        :param variant: Indexed variant
+        :return: Variant as a JSON-serializable dictionary
+        """
+        n_haps = len(self.hap_order)
+        return {
+            x: dict(zip(self.hap_order, y))
+            if x.startswith("hap_")
+            and isinstance(y, list)
+            and len(y) == n_haps
+            and n_haps > 0
+            else y
+            for x, y in variant.items()
+        }
+
+    def lookup_variant(self, query: str) -> list:
+        """
+        Find variants by notation (for example A3243G) or rsID.
+
+        :param query: Variant notation or rsID
+        :return: List of matching variants
+        """
+        if query.startswith("rs"):
+            return [self.format_variant(x) for x in self.by_rsid.get(query, [])]
+        parsed = parse_variant_notation(query)
+        if parsed is None:
+            raise ValueError(f"Variant {query} is not in a recognized notation")
+        variant = self.by_variant.get(parsed)
+
+        return [] if variant is None else [self.format_variant(variant)]
+
+    def lookup_region(
+        self, start: int, end: int, limit: int = DEFAULT_REGION_LIMIT
+    ) -> list:
+        """
+        Find variants between two positions (inclusive).
+
+        :param start: Start position
+        :param end: End position
+        :param limit: Maximum number of variants to return
+        :return: List of variants
+        """
+        first = bisect.bisect_left(self.positions, start)
+        last = min(bisect.bisect_right(self.positions, end), first + limit)
+
+        return [self.format_variant(x) for x in self.variants[first:last]]
+
+    def lookup_haplogroup(
+        self, hap: str, variant: Optional[str] = None, limit: int = DEFAULT_REGION_LIMIT
+    ) -> list:
+        """
+        Return haplogroup-specific counts and frequencies, either for one variant or for all variants observed in the haplogroup.
+
+        :param hap: Haplogroup
+        :param variant: Optional variant notation or rsID
+        :param limit: Maximum number of variants to return
+        :return: List of dictionaries with the variant and the values of the haplogroup fields for this haplogroup
+        """
+        if hap not in self.hap_order:
+            raise LookupError(f"Haplogroup {hap} is not present")
+        hap_index = self.hap_order.index(hap)
+        if variant is None:
+            variants = self.by_hap.get(hap, [])[:limit]
+        else:
+            variants = [
+                self.by_variant[(x["position"], x["ref"], x["alt"])]
+                for x in self.lookup_variant(variant)
+            ]
+
+        return [
+            {
+                "variant": f"{x['ref']}{x['position']}{x['alt']}",
+                "hap": hap,
+                **{
+                    y: z[hap_index]
+                    for y, z in x.items()
+                    if y.startswith("hap_")
+                    and isinstance(z, list)
+                    and len(z) == len(self.hap_order)
+                },
+            }
+            for x in variants
+        ]
+
+
+class SitesQueryHandler(BaseHTTPRequestHandler):
+    """Handler for the /variant, /region, /haplogroup, and /health endpoints, answering with JSON."""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, so Nagle's algorithm would delay each keep-alive response by ~40ms
+    disable_nagle_algorithm = True
+    index = None
+
+    def log_message(self, format, *args):  # noqa: D102
+        logger.debug(format, *args)
+
+    def _send_json(self, status: int, body, query_time: float) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        # Time spent answering the query (excluding HTTP handling), reported by the load test
+        self.send_header("X-Query-Time-Us", f"{query_time * 1e6:.1f}")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):  # noqa: D102
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        params = {x: y[0] for x, y in parse_qs(url.query).items()}
+        try:
+            limit = int(params.get("limit", DEFAULT_REGION_LIMIT))
+            if url.path == "/variant":
+                body = self.index.lookup_variant(params["id"])
+            elif url.path == "/region":
+                body = self.index.lookup_region(
+                    int(params["start"]), int(params["end"]), limit
+                )
+            elif url.path == "/haplogroup":
+                body = self.index.lookup_haplogroup(
+                    params["hap"], params.get("variant"), limit
+                )
+            elif url.path == "/health":
+                body = {
+                    "n_variants": len(self.index.variants),
+                    "n_haplogroups": len(self.index.hap_order),
+                }
+            else:
+                self._send_json(
+                    404,
+                    {"error": f"Unknown endpoint {url.path}"},
+                    time.perf_counter() - start,
+                )
+                return
+        except KeyError as e:
+            self._send_json(
+                400, {"error": f"Missing parameter {e}"}, time.perf_counter() - start
+            )
+            return
+        except LookupError as e:
+            self._send_json(404, {"error": str(e)}, time.perf_counter() - start)
+            return
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)}, time.perf_counter() - start)
+            return
+
+        self._send_json(200, body, time.perf_counter() - start)
+
+
+def serve(
+    index: SitesIndex, host: str = "127.0.0.1", port: int = 8000
+) -> ThreadingHTTPServer:
+    """
+    Create the query server over an index (call serve_forever on the result to start serving).
+
+    :param index: SitesIndex to query
+    :param host: Host to bind to
+    :param port: Port to bind to (0 picks a free port)
+    :return: ThreadingHTTPServer
+    """
+    handler = type("BoundSitesQueryHandler", (SitesQueryHandler,), {"index": index})
+
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(args):  # noqa: D103
+    logger.info("Loading sites from %s...", args.sites_txt)
+    start = time.perf_counter()
+    index = SitesIndex.from_sites_txt(args.sites_txt, args.sites_globals)
+    logger.info(
+        "Indexed %i variants and %i haplogroups in %.1fs",
+        len(index.variants),
+        len(index.hap_order),
+        time.perf_counter() - start,
+    )
+
+    server = serve(index, args.host, args.port)
+    logger.info("Serving on http://%s:%i", *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script serves variant (A3243G, chrM:3243:A:G, or rsID), region, and haplogroup-frequency queries over the sites-only output of add_annotations.py as JSON over HTTP"
+    )
+    parser.add_argument(
+        "-s",
+        "--sites-txt",
+        help="Local path of the sites-only text file written by add_annotations.py (combined_sites_only.txt)",
+        required=True,
+    )
+    parser.add_argument(
+        "-g",
+        "--sites-globals",
+        help="Local path of the sites globals JSON written by add_annotations.py (combined_sites_only.globals.json), needed for haplogroup queries",
+    )
+    parser.add_argument("--host", help="Host to bind to", default="127.0.0.1")
+    parser.add_argument("--port", help="Port to bind to", type=int, default=8000)
+
+    args = parser.parse_args()
+    main(args)
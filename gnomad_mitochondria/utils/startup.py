@@ -0,0 +1,60 @@
+import argparse
+import logging
+import os
+
+from typing import List
+
+from gnomad_mitochondria.utils.vcf_export import is_local_path
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("startup")
+logger.setLevel(logging.INFO)
+
+
+def check_local_inputs(
+    parser: argparse.ArgumentParser, args: argparse.Namespace, arg_names: List[str]
+) -> None:
+    """
+    Exit through the argument parser if any local input path among the given arguments does not exist.
+
+    Cloud paths are not checked here, since checking them needs a filesystem client; they are read after Hail starts.
+    This lets misconfigured runs fail before the JVM and Spark are started.
+
+    :param parser: Argument parser of the script
+    :param args: Parsed arguments
+    :param arg_names: Names of the arguments (as attributes of args) holding input paths
+    """
+    for arg_name in arg_names:
+        path = getattr(args, arg_name)
+        if path is None or not is_local_path(path):
+            continue
+        local_path = path[len("file://") :] if path.startswith("file://") else path
+        if not os.path.exists(local_path):
+            parser.error(f"--{arg_name.replace('_', '-')}: {path} does not exist")
+
+
+def init_hail(**kwargs) -> None:
+    """
+    Initialize Hail and set the flags the pipeline needs.
+
+    Scripts call this at the start of main, after their arguments have been validated, rather than at import time.
+    Calling it again once Hail is running has no effect, so that scripts can also be run as stages of
+    run_pipeline_dag.py, which starts Hail before running a stage.
+
+    :param kwargs: Arguments passed to hl.init
+    """
+    import hail as hl
+
+    hl.init(idempotent=True, **kwargs)
+
+    if (
+        int(hl.version().split("-")[0].split(".")[2]) >= 75
+    ):  # only use this if using hail 0.2.75 or greater
+        logger.info("Setting hail flag to avoid array index out of bounds error...")
+        # Setting this flag isn't generally recommended, but is needed (since at least Hail version 0.2.75) to avoid an array index out of bounds error until changes are made in future versions of Hail
+        # TODO: reassess if this flag is still needed for future versions of Hail
+        hl._set_flags(no_whole_stage_codegen="1")
@@ -0,0 +1,739 @@
+import logging
+import os
+import re
+import sys
+import tempfile
+
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+try:
+    from google.cloud import storage as gcs
+except ImportError:
+    gcs = None
+
+try:
+    import dxpy
+except ImportError:
+    dxpy = None
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("storage")
+logger.setLevel(logging.INFO)
+
+# Mount point of the DNAnexus project on DNAnexus workers (read-only)
+FUSE_PREFIX = "/mnt/project"
+
+# Storage backends registered in place of the defaults, keyed by scheme ("file" for local paths)
+_REGISTERED_STORAGE = {}
+# Default storage backends already created, keyed by scheme, so clients are only set up once per process
+_DEFAULT_STORAGE = {}
+
+
+def get_scheme(path: str) -> str:
+    """
+    Get the scheme of a path.
+
+    :param path: Path
+    :return: Scheme (for example gs or dx), or "file" for local paths
+    """
+    match = re.match(r"^([A-Za-z][A-Za-z0-9+.-]*)://", path)
+
+    return match.group(1) if match else "file"
+
+
+def file_info(
+    path: str, size_bytes: int, is_dir: bool, modification_time: Optional[float] = None
+) -> Dict:
+    """
+    Describe a file or directory with the same fields as the entries returned by hl.hadoop_ls.
+
+    :param path: Full path (including the scheme of the backend)
+    :param size_bytes: Size in bytes (0 for directories)
+    :param is_dir: Whether or not the path is a directory (or a prefix, on object stores)
+    :param modification_time: Modification time in seconds since the epoch, if known
+    :return: Dictionary with path, size_bytes, is_dir, and modification_time
+    """
+    return {
+        "path": path,
+        "size_bytes": size_bytes,
+        "is_dir": is_dir,
+        "modification_time": modification_time,
+    }
+
+
+class StorageBackend(ABC):
+    """
+    Minimal filesystem interface used by the listing- and small-file-heavy code paths of the pipeline.
+
+    Paths are always full paths including the scheme of the backend, so that code written against this interface can be
+    pointed at a local directory standing in for a bucket without changing the paths it builds.
+    """
+
+    @abstractmethod
+    def list(self, path: str, recursive: bool = False) -> List[Dict]:
+        """
+        List a directory.
+
+        :param path: Path of the directory
+        :param recursive: If True, list all files under the directory (without the directories themselves), otherwise
+            list the files and directories directly in it
+        :return: List of dictionaries as returned by file_info
+        """
+
+    @abstractmethod
+    def stat(self, path: str) -> Dict:
+        """
+        Describe a file or directory.
+
+        :param path: Path
+        :return: Dictionary as returned by file_info
+        :raises FileNotFoundError: If the path does not exist
+        """
+
+    def exists(self, path: str) -> bool:
+        """
+        Check whether a file or directory exists.
+
+        :param path: Path
+        :return: True if the path exists
+        """
+        try:
+            self.stat(path)
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    @abstractmethod
+    def read_range(
+        self, path: str, start: int = 0, length: Optional[int] = None
+    ) -> bytes:
+        """
+        Read part of a file.
+
+        :param path: Path of the file
+        :param start: Offset of the first byte to read
+        :param length: Number of bytes to read, or None to read to the end of the file
+        :return: Bytes read (fewer than length if the end of the file is reached)
+        """
+
+    def read(self, path: str) -> bytes:
+        """
+        Read a whole file.
+
+        :param path: Path of the file
+        :return: Contents of the file
+        """
+        return self.read_range(path)
+
+    def read_text(self, path: str) -> str:
+        """
+        Read a whole file as UTF-8 text.
+
+        :param path: Path of the file
+        :return: Contents of the file
+        """
+        return self.read(path).decode("utf8")
+
+    @abstractmethod
+    def write_atomic(self, path: str, data: bytes) -> None:
+        """
+        Write a file so that readers see either the previous contents or the new contents, never a partial file.
+
+        :param path: Path of the file
+        :param data: Contents of the file
+        :return: None
+        """
+
+    @abstractmethod
+    def open_write(self, path: str):
+        """
+        Open a file for streaming binary writes, for files too large to be held in memory.
+
+        Used as a context manager. The file is complete at the path once the context exits without an error.
+
+        :param path: Path of the file
+        :return: Context manager returning a writable binary file object
+        """
+
+
+class LocalStorage(StorageBackend):
+    """
+    Storage on the local filesystem, optionally standing in for another scheme.
+
+    With a scheme, paths such as gs://bucket/run/file are served from root/bucket/run/file, so that code written for a
+    bucket can be run and benchmarked against a local copy of it. Without a scheme, paths are local paths (optionally
+    prefixed with file://) and root is ignored.
+    """
+
+    def __init__(self, root: Optional[str] = None, scheme: Optional[str] = None):
+        """
+        Set up local storage.
+
+        :param root: Local directory standing in for the scheme
+        :param scheme: Scheme whose paths are mapped to root (for example gs)
+        """
+        if scheme is not None and root is None:
+            raise ValueError(
+                "A root directory is needed to stand in for another scheme"
+            )
+        self.root = None if root is None else os.path.abspath(root)
+        self.scheme = scheme
+
+    def _to_local(self, path: str) -> str:
+        """
+        Map a path to the local filesystem.
+
+        :param path: Path (with the scheme of the backend)
+        :return: Local path
+        """
+        if self.scheme is None:
+            return path[len("file://") :] if path.startswith("file://") else path
+        prefix = f"{self.scheme}://"
+        if not path.startswith(prefix):
+            raise ValueError(f"{path} does not use the {self.scheme}:// scheme")
+
+        return os.path.join(self.root, path[len(prefix) :])
+
+    def _from_local(self, local_path: str, like: str) -> str:
+        """
+        Map a local path back to the form of the paths given to the backend.
+
+        :param local_path: Local path
+        :param like: Path given to the backend, whose form (scheme or file:// prefix) is kept
+        :return: Path
+        """
+        if self.scheme is not None:
+            return f"{self.scheme}://{os.path.relpath(local_path, self.root)}"
+
+        return f"file://{local_path}" if like.startswith("file://") else local_path
+
+    def list(self, path: str, recursive: bool = False) -> List[Dict]:  # noqa: D102
+        local_dir = self._to_local(path).rstrip("/") or "/"
+        entries = []
+        if recursive:
+            for directory, _, files in os.walk(local_dir):
+                for name in files:
+                    local_path = os.path.join(directory, name)
+                    st = os.stat(local_path)
+                    entries.append(
+                        file_info(
+                            self._from_local(local_path, path),
+                            st.st_size,
+                            False,
+                            st.st_mtime,
+                        )
+                    )
+        else:
+            with os.scandir(local_dir) as it:
+                for entry in it:
+                    st = entry.stat()
+                    is_dir = entry.is_dir()
+                    entries.append(
+                        file_info(
+                            self._from_local(entry.path, path),
+                            0 if is_dir else st.st_size,
+                            is_dir,
+                            st.st_mtime,
+                        )
+                    )
+
+        return entries
+
+    def stat(self, path: str) -> Dict:  # noqa: D102
+        local_path = self._to_local(path)
+        st = os.stat(local_path)
+        is_dir = os.path.isdir(local_path)
+
+        return file_info(
+            path.rstrip("/"), 0 if is_dir else st.st_size, is_dir, st.st_mtime
+        )
+
+    def exists(self, path: str) -> bool:  # noqa: D102
+        return os.path.exists(self._to_local(path))
+
+    def read_range(
+        self, path: str, start: int = 0, length: Optional[int] = None
+    ) -> bytes:  # noqa: D102
+        with open(self._to_local(path), "rb") as f:
+            f.seek(start)
+            return f.read(-1 if length is None else length)
+
+    def write_atomic(self, path: str, data: bytes) -> None:  # noqa: D102
+        local_path = self._to_local(path)
+        directory = os.path.dirname(local_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        # Written next to the destination so the rename stays on one filesystem, which makes it atomic
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, local_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @contextmanager
+    def open_write(self, path: str):  # noqa: D102
+        local_path = self._to_local(path)
+        directory = os.path.dirname(local_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield f
+            os.replace(tmp_path, local_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+class FuseStorage(LocalStorage):
+    """
+    The DNAnexus project mounted with dxfuse at /mnt/project on DNAnexus workers.
+
+    The mount is read-only, so writes are rejected here rather than failing part way through.
+    """
+
+    def write_atomic(self, path: str, data: bytes) -> None:  # noqa: D102
+        raise PermissionError(
+            f"{FUSE_PREFIX} is mounted read-only, cannot write {path}"
+        )
+
+    def open_write(self, path: str):  # noqa: D102
+        raise PermissionError(
+            f"{FUSE_PREFIX} is mounted read-only, cannot write {path}"
+        )
+
+
+class GCSStorage(StorageBackend):
+    """
+    Storage on Google Cloud Storage (gs://bucket/name paths).
+
+    Directories are prefixes ending in /, so listing a directory is one paginated request rather than a walk.
+    """
+
+    def __init__(self, client=None):
+        """
+        Set up Google Cloud Storage.
+
+        :param client: google.cloud.storage Client, created with the default credentials if not supplied
+        """
+        if client is None:
+            if gcs is None:
+                raise ImportError(
+                    "google-cloud-storage is required to access gs:// paths"
+                )
+            client = gcs.Client()
+        self.client = client
+
+    @staticmethod
+    def _split(path: str) -> tuple:
+        """
+        Split a gs:// path into its bucket and object name.
+
+        :param path: gs:// path
+        :return: Tuple of bucket and object name
+        """
+        if not path.startswith("gs://"):
+            raise ValueError(f"{path} does not use the gs:// scheme")
+        bucket, _, name = path[len("gs://") :].partition("/")
+
+        return bucket, name
+
+    def list(self, path: str, recursive: bool = False) -> List[Dict]:  # noqa: D102
+        bucket, name = self._split(path)
+        prefix = name.rstrip("/") + "/" if name.rstrip("/") else ""
+        iterator = self.client.list_blobs(
+            bucket, prefix=prefix, delimiter=None if recursive else "/"
+        )
+        entries = []
+        for page in iterator.pages:
+            for blob in page:
+                # Skip the placeholder objects some tools create for directories
+                if blob.name.endswith("/"):
+                    continue
+                entries.append(
+                    file_info(
+                        f"gs://{bucket}/{blob.name}",
+                        blob.size,
+                        False,
+                        None if blob.updated is None else blob.updated.timestamp(),
+                    )
+                )
+            entries.extend(
+                file_info(f"gs://{bucket}/{x.rstrip('/')}", 0, True)
+                for x in page.prefixes
+            )
+
+        return entries
+
+    def stat(self, path: str) -> Dict:  # noqa: D102
+        bucket, name = self._split(path)
+        name = name.rstrip("/")
+        if name:
+            blob = self.client.bucket(bucket).get_blob(name)
+            if blob is not None:
+                return file_info(
+                    f"gs://{bucket}/{name}",
+                    blob.size,
+                    False,
+                    None if blob.updated is None else blob.updated.timestamp(),
+                )
+        prefix = name + "/" if name else ""
+        if any(
+            True for _ in self.client.list_blobs(bucket, prefix=prefix, max_results=1)
+        ):
+            return file_info(f"gs://{bucket}/{name}".rstrip("/"), 0, True)
+
+        raise FileNotFoundError(path)
+
+    def read_range(
+        self, path: str, start: int = 0, length: Optional[int] = None
+    ) -> bytes:  # noqa: D102
+        if length == 0:
+            return b""
+        bucket, name = self._split(path)
+        blob = self.client.bucket(bucket).blob(name)
+
+        # The end offset is inclusive
+        return blob.download_as_bytes(
+            start=start, end=None if length is None else start + length - 1
+        )
+
+    def write_atomic(self, path: str, data: bytes) -> None:  # noqa: D102
+        # A single upload either creates the whole object or nothing
+        bucket, name = self._split(path)
+        self.client.bucket(bucket).blob(name).upload_from_string(data)
+
+    @contextmanager
+    def open_write(self, path: str):  # noqa: D102
+        # Resumable upload in chunks, the object is only created when the upload is finalized on close
+        bucket, name = self._split(path)
+        with self.client.bucket(bucket).blob(name).open("wb") as f:
+            yield f
+
+
+class DNAnexusStorage(StorageBackend):
+    """
+    Storage on a DNAnexus project through the API (dx://project-xxxx/folder/name paths).
+
+    This is for files in projects; dnax:// database paths are read and written through Hail (see HadoopStorage).
+    """
+
+    def __init__(self):
+        """Set up DNAnexus storage with the credentials of the dxpy environment."""
+        if dxpy is None:
+            raise ImportError("dxpy is required to access dx:// paths")
+
+    @staticmethod
+    def _split(path: str) -> tuple:
+        """
+        Split a dx:// path into its project, folder, and name.
+
+        :param path: dx:// path
+        :return: Tuple of project ID, folder (starting with /), and name (empty for the project root)
+        """
+        if not path.startswith("dx://"):
+            raise ValueError(f"{path} does not use the dx:// scheme")
+        project, _, rest = path[len("dx://") :].partition("/")
+        rest = "/" + rest.strip("/")
+        folder, name = os.path.split(rest)
+
+        return project, folder, name
+
+    @staticmethod
+    def _describe_fields() -> dict:
+        """
+        Get the describe options requesting only the fields needed by file_info.
+
+        :return: Describe options
+        """
+        return {
+            "fields": {"name": True, "folder": True, "size": True, "modified": True}
+        }
+
+    def _file_info(self, project: str, describe: dict) -> Dict:
+        """
+        Convert the describe output of a file to the fields returned by file_info.
+
+        :param project: Project ID
+        :param describe: Describe output of the file
+        :return: Dictionary as returned by file_info
+        """
+        return file_info(
+            f"dx://{project}{describe['folder'].rstrip('/')}/{describe['name']}",
+            describe.get("size", 0),
+            False,
+            describe["modified"] / 1000 if "modified" in describe else None,
+        )
+
+    def list(self, path: str, recursive: bool = False) -> List[Dict]:  # noqa: D102
+        project, folder, name = self._split(path)
+        folder = os.path.join(folder, name).rstrip("/") or "/"
+        if recursive:
+            results = dxpy.find_data_objects(
+                classname="file",
+                project=project,
+                folder=folder,
+                recurse=True,
+                describe=self._describe_fields(),
+            )
+            return [self._file_info(project, x["describe"]) for x in results]
+
+        contents = dxpy.DXProject(project).list_folder(
+            folder=folder, describe=self._describe_fields(), only="all"
+        )
+        entries = [
+            self._file_info(project, x["describe"])
+            for x in contents["objects"]
+            if x["id"].startswith("file-")
+        ]
+        entries.extend(
+            file_info(f"dx://{project}{x}", 0, True) for x in contents["folders"]
+        )
+
+        return entries
+
+    def _find_file(self, path: str) -> Optional[dict]:
+        """
+        Find the file at a path.
+
+        :param path: dx:// path
+        :return: Dictionary with the project, ID, and describe output of the file, or None if there is no file there
+        """
+        project, folder, name = self._split(path)
+        if not name:
+            return None
+
+        return dxpy.find_one_data_object(
+            classname="file",
+            project=project,
+            folder=folder,
+            name=name,
+            recurse=False,
+            describe=self._describe_fields(),
+            zero_ok=True,
+            more_ok=False,
+        )
+
+    def stat(self, path: str) -> Dict:  # noqa: D102
+        result = self._find_file(path)
+        if result is not None:
+            return self._file_info(result["project"], result["describe"])
+        project, folder, name = self._split(path)
+        folder = os.path.join(folder, name).rstrip("/") or "/"
+        parent, folder_name = os.path.split(folder)
+        if (
+            not folder_name
+            or folder
+            in dxpy.DXProject(project).list_folder(folder=parent, only="folders")[
+                "folders"
+            ]
+        ):
+            return file_info(f"dx://{project}{folder}".rstrip("/"), 0, True)
+
+        raise FileNotFoundError(path)
+
+    def read_range(
+        self, path: str, start: int = 0, length: Optional[int] = None
+    ) -> bytes:  # noqa: D102
+        result = self._find_file(path)
+        if result is None:
+            raise FileNotFoundError(path)
+        with dxpy.DXFile(result["id"], project=result["project"], mode="rb") as f:
+            f.seek(start)
+            return f.read() if length is None else f.read(length)
+
+    def write_atomic(self, path: str, data: bytes) -> None:  # noqa: D102
+        # Files are immutable once closed, so the new file is uploaded and closed before the old one is removed
+        previous = self._find_file(path)
+        project, folder, name = self._split(path)
+        dxpy.upload_string(
+            data,
+            project=project,
+            folder=folder,
+            name=name,
+            parents=True,
+            wait_on_close=True,
+        )
+        if previous is not None:
+            dxpy.DXProject(project).remove_objects([previous["id"]])
+
+    @contextmanager
+    def open_write(self, path: str):  # noqa: D102
+        previous = self._find_file(path)
+        project, folder, name = self._split(path)
+        f = dxpy.new_dxfile(
+            mode="w", project=project, folder=folder, name=name, parents=True
+        )
+        try:
+            yield f
+            f.close(block=True)
+        except BaseException:
+            dxpy.DXProject(project).remove_objects([f.get_id()])
+            raise
+        if previous is not None:
+            dxpy.DXProject(project).remove_objects([previous["id"]])
+
+
+class HadoopStorage(StorageBackend):
+    """
+    Storage through the Hadoop filesystems of the running Hail session (for example hdfs:// or dnax:// paths).
+
+    Files are opened through the filesystem of the Hail backend rather than hl.hadoop_open, which compresses and
+    decompresses .gz and .bgz paths on the fly. Writes are not atomic.
+    """
+
+    @staticmethod
+    def _fs():
+        """
+        Get the filesystem of the running Hail session.
+
+        :return: Hail filesystem
+        """
+        import hail as hl
+
+        return hl.current_backend().fs
+
+    def list(self, path: str, recursive: bool = False) -> List[Dict]:  # noqa: D102
+        import hail as hl
+
+        entries = []
+        for entry in hl.hadoop_ls(path):
+            if entry["is_dir"] and recursive:
+                entries.extend(self.list(entry["path"], recursive=True))
+            else:
+                entries.append(entry)
+
+        return entries
+
+    def stat(self, path: str) -> Dict:  # noqa: D102
+        import hail as hl
+
+        if not hl.hadoop_exists(path):
+            raise FileNotFoundError(path)
+
+        return hl.hadoop_stat(path)
+
+    def exists(self, path: str) -> bool:  # noqa: D102
+        import hail as hl
+
+        return hl.hadoop_exists(path)
+
+    def read_range(
+        self, path: str, start: int = 0, length: Optional[int] = None
+    ) -> bytes:  # noqa: D102
+        with self._fs().open(path, "rb") as f:
+            f.seek(start)
+            return f.read(-1 if length is None else length)
+
+    def write_atomic(self, path: str, data: bytes) -> None:  # noqa: D102
+        with self._fs().open(path, "wb") as f:
+            f.write(data)
+
+    @contextmanager
+    def open_write(self, path: str):  # noqa: D102
+        with self._fs().open(path, "wb") as f:
+            yield f
+
+
+def register_storage(scheme: str, storage: StorageBackend) -> None:
+    """
+    Use a storage backend for all paths of a scheme, in place of the default backend.
+
+    :param scheme: Scheme (for example gs), or "file" for local paths
+    :param storage: Storage backend
+    :return: None
+    """
+    _REGISTERED_STORAGE[scheme] = storage
+
+
+def use_local_standin(root: str, schemes: tuple = ("gs", "dx")) -> None:
+    """
+    Serve cloud paths from a local directory, so that code reading and listing them can be run and benchmarked offline.
+
+    For example, with root /data/standin, gs://bucket/run/rc is read from /data/standin/gs/bucket/run/rc.
+
+    :param root: Local directory holding one subdirectory per scheme
+    :param schemes: Schemes to serve from the directory
+    :return: None
+    """
+    for scheme in schemes:
+        register_storage(
+            scheme, LocalStorage(os.path.join(root, scheme), scheme=scheme)
+        )
+    logger.info("Serving %s paths from %s", ", ".join(f"{x}://" for x in schemes), root)
+
+
+def hail_is_initialized() -> bool:
+    """
+    Check whether a Hail session is running in this process, without importing or initializing Hail.
+
+    :return: True if Hail has been initialized
+    """
+    hail = sys.modules.get("hail")
+    if hail is None:
+        return False
+    env = getattr(getattr(getattr(hail, "utils", None), "java", None), "Env", None)
+
+    return getattr(env, "_hc", None) is not None
+
+
+def get_storage(path: str) -> StorageBackend:
+    """
+    Get the storage backend for a path.
+
+    Registered backends take precedence; otherwise gs:// paths use Google Cloud Storage (or the Hadoop filesystems of
+    the Hail session if google-cloud-storage is not installed), dx:// paths the DNAnexus API, paths under /mnt/project
+    the read-only DNAnexus FUSE mount, file:// paths the local filesystem, and any other scheme the Hadoop filesystems
+    of the running Hail session. Paths without a scheme are local paths unless a Hail session is running, in which case
+    they go through its Hadoop filesystems, which resolve them against fs.defaultFS (HDFS on Dataproc) as Hail does.
+
+    :param path: Path
+    :return: Storage backend
+    """
+    scheme = get_scheme(path)
+    if scheme in _REGISTERED_STORAGE:
+        return _REGISTERED_STORAGE[scheme]
+
+    if scheme == "file":
+        local_path = path[len("file://") :] if path.startswith("file://") else path
+        if local_path == FUSE_PREFIX or local_path.startswith(FUSE_PREFIX + "/"):
+            scheme = "fuse"
+        elif not path.startswith("file://") and hail_is_initialized():
+            scheme = "default_fs"
+
+    if scheme not in _DEFAULT_STORAGE:
+        if scheme == "gs" and gcs is not None:
+            _DEFAULT_STORAGE[scheme] = GCSStorage()
+        elif scheme == "dx":
+            _DEFAULT_STORAGE[scheme] = DNAnexusStorage()
+        elif scheme == "fuse":
+            _DEFAULT_STORAGE[scheme] = FuseStorage()
+        elif scheme == "file":
+            _DEFAULT_STORAGE[scheme] = LocalStorage()
+        else:
+            _DEFAULT_STORAGE[scheme] = HadoopStorage()
+
+    return _DEFAULT_STORAGE[scheme]
+
+
+def requires_hail(path: str) -> bool:
+    """
+    Check whether a path is read and written through Hail.
+
+    Hail initializes itself with its default settings when such a path is accessed before it is running. Scripts that
+    touch their inputs before starting Hail use this to start Hail first for such paths, so that their own settings
+    (such as the temporary directory) are applied.
+
+    :param path: Path
+    :return: True if the path uses the Hadoop filesystems of the Hail session
+    """
+    return isinstance(get_storage(path), HadoopStorage)
@@ -0,0 +1,365 @@
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import zlib
+
+from gnomad_mitochondria.utils.storage import get_storage
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("tabix")
+logger.setLevel(logging.INFO)
+
+# Column layout of a VCF, as for tabix -p vcf (the end of a record is computed from REF and the END INFO field)
+VCF_TABIX_PRESET = {
+    "format": 2,
+    "col_seq": 1,
+    "col_beg": 2,
+    "col_end": 0,
+    "meta_char": "#",
+    "line_skip": 0,
+}
+# Size of the windows of the linear index (16kb) and number of levels of the binning index, as used by tabix
+TABIX_MIN_SHIFT = 14
+TABIX_DEPTH = 5
+# Number of tab-separated columns needed to index a VCF record (up to and including INFO)
+VCF_INDEXED_COLUMNS = 8
+# Maximum amount of uncompressed data per BGZF block, as used by bgzip
+BGZF_BLOCK_DATA_SIZE = 0xFF00
+
+
+def reg2bin(beg: int, end: int) -> int:
+    """
+    Get the smallest bin of the tabix binning index containing an interval (as hts_reg2bin in htslib).
+
+    :param beg: 0-based start of the interval
+    :param end: 0-based end of the interval (exclusive)
+    :return: Bin number
+    """
+    end -= 1
+    shift = TABIX_MIN_SHIFT
+    for level in range(TABIX_DEPTH, 0, -1):
+        if beg >> shift == end >> shift:
+            return ((1 << (3 * level)) - 1) // 7 + (beg >> shift)
+        shift += 3
+
+    return 0
+
+
+def iter_bgzf_blocks(data: bytes):
+    """
+    Iterate over the BGZF blocks of compressed data.
+
+    :param data: Whole BGZF blocks
+    :return: Generator of tuples of the offset of each block in data, its compressed size, and its uncompressed data
+    """
+    pos = 0
+    while pos < len(data):
+        if data[pos : pos + 4] != b"\x1f\x8b\x08\x04":
+            raise ValueError(f"Invalid BGZF block at offset {pos}")
+        (xlen,) = struct.unpack_from("<H", data, pos + 10)
+        block_size = None
+        extra = pos + 12
+        while extra < pos + 12 + xlen:
+            si1, si2, slen = struct.unpack_from("<BBH", data, extra)
+            if si1 == 66 and si2 == 67:
+                block_size = struct.unpack_from("<H", data, extra + 4)[0] + 1
+            extra += 4 + slen
+        if block_size is None:
+            raise ValueError(f"Missing BGZF block size at offset {pos}")
+
+        yield pos, block_size, zlib.decompress(
+            data[pos + 12 + xlen : pos + block_size - 8], -15
+        )
+        pos += block_size
+
+
+def compress_bgzf(data: bytes, level: int = 6) -> bytes:
+    """
+    Compress data into BGZF blocks, without the EOF block (as for the shards of a parallel Hail export).
+
+    :param data: Uncompressed data
+    :param level: zlib compression level
+    :return: BGZF blocks
+    """
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCK_DATA_SIZE):
+        block = data[start : start + BGZF_BLOCK_DATA_SIZE]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(block) + compressor.flush()
+        # gzip header with the BC extra field holding the size of the whole block minus one
+        blocks.append(
+            struct.pack(
+                "<4BI2BH2BHH",
+                31,
+                139,
+                8,
+                4,
+                0,
+                0,
+                255,
+                6,
+                66,
+                67,
+                2,
+                len(compressed) + 25,
+            )
+            + compressed
+            + struct.pack("<II", zlib.crc32(block), len(block))
+        )
+
+    return b"".join(blocks)
+
+
+class TabixIndexer:
+    """
+    Build a tabix index from the BGZF blocks of a sorted file as they are written, without reading the file back.
+
+    Blocks must be added in the order in which they are written, with their offset in the output. Only the columns
+    needed for indexing are kept from each line, so long lines (such as VCF lines with genotypes) are not buffered.
+    """
+
+    def __init__(
+        self,
+        format: int,
+        col_seq: int,
+        col_beg: int,
+        col_end: int = 0,
+        meta_char: str = "#",
+        line_skip: int = 0,
+    ):
+        """
+        Set up the index, with the same column layout as the tabix command line options.
+
+        :param format: Tabix format (0 for generic files, 2 for VCF)
+        :param col_seq: 1-based column of the sequence name
+        :param col_beg: 1-based column of the 1-based start position
+        :param col_end: 1-based column of the 1-based end position (inclusive), or 0 if the end is the start (or, for
+            VCF, computed from REF and END)
+        :param meta_char: Lines starting with this character are skipped
+        :param line_skip: Number of lines to skip at the beginning of the file
+        """
+        self.format = format
+        self.col_seq = col_seq
+        self.col_beg = col_beg
+        self.col_end = col_end
+        self.meta_char = meta_char.encode()
+        self.line_skip = line_skip
+        self._n_tabs = (
+            VCF_INDEXED_COLUMNS if format == 2 else max(col_seq, col_beg, col_end)
+        )
+
+        self._names = []
+        self._indices = []
+        self._bins = None
+        self._linear = None
+        self._last_beg = -1
+        self._n_lines = 0
+        self._line = bytearray()
+        self._line_complete = False
+        self._line_start = None
+
+    def add_bgzf(self, offset: int, data: bytes) -> None:
+        """
+        Add whole BGZF blocks written to the output.
+
+        :param offset: Offset of the first block in the output
+        :param data: BGZF blocks
+        :return: None
+        """
+        for pos, block_size, block in iter_bgzf_blocks(data):
+            self._add_block(offset + pos, block_size, block)
+
+    def _add_block(self, offset: int, block_size: int, block: bytes) -> None:
+        """
+        Add the uncompressed data of one BGZF block.
+
+        :param offset: Offset of the block in the output
+        :param block_size: Compressed size of the block
+        :param block: Uncompressed data of the block
+        :return: None
+        """
+        pos = 0
+        while pos < len(block):
+            if self._line_start is None:
+                self._line_start = (offset << 16) | pos
+            newline = block.find(b"\n", pos)
+            if newline == -1:
+                self._extend_line(block[pos:])
+                return
+            self._extend_line(block[pos:newline])
+            pos = newline + 1
+            # A line ending at the end of a block ends where the next block starts
+            end = (
+                ((offset + block_size) << 16)
+                if pos == len(block)
+                else (offset << 16) | pos
+            )
+            self._add_line(bytes(self._line), self._line_start, end)
+            self._line = bytearray()
+            self._line_complete = False
+            self._line_start = None
+
+    def _extend_line(self, data: bytes) -> None:
+        """
+        Add data to the current line, until it holds every column needed for indexing.
+
+        :param data: Part of the line
+        :return: None
+        """
+        if not self._line_complete:
+            self._line.extend(data)
+            self._line_complete = self._line.count(b"\t") >= self._n_tabs
+
+    def _add_line(self, line: bytes, start: int, end: int) -> None:
+        """
+        Index one line.
+
+        :param line: Line without its newline (possibly truncated after the columns needed for indexing)
+        :param start: Virtual offset of the start of the line
+        :param end: Virtual offset of the end of the line
+        :return: None
+        """
+        self._n_lines += 1
+        if (
+            self._n_lines <= self.line_skip
+            or not line
+            or line.startswith(self.meta_char)
+        ):
+            return
+
+        fields = line.split(b"\t")
+        name = fields[self.col_seq - 1].decode()
+        beg = int(fields[self.col_beg - 1]) - 1
+        if self.format == 2:
+            rec_end = beg + len(fields[3])
+            for entry in fields[7].split(b";"):
+                if entry.startswith(b"END="):
+                    rec_end = int(entry[4:])
+        elif self.col_end:
+            rec_end = int(fields[self.col_end - 1])
+        else:
+            rec_end = beg + 1
+        rec_end = max(rec_end, beg + 1)
+
+        if not self._names or name != self._names[-1]:
+            if name in self._names:
+                raise ValueError(
+                    f"Records of {name} are not contiguous, the file is not sorted"
+                )
+            self._finish_reference()
+            self._names.append(name)
+            self._bins = {}
+            self._linear = []
+            self._last_beg = -1
+        if beg < self._last_beg:
+            raise ValueError(f"Positions of {name} are not sorted at {beg + 1}")
+        self._last_beg = beg
+
+        chunks = self._bins.setdefault(reg2bin(beg, rec_end), [])
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+
+        first_window = beg >> TABIX_MIN_SHIFT
+        last_window = (rec_end - 1) >> TABIX_MIN_SHIFT
+        if len(self._linear) <= last_window:
+            self._linear.extend([None] * (last_window + 1 - len(self._linear)))
+        for window in range(first_window, last_window + 1):
+            if self._linear[window] is None:
+                self._linear[window] = start
+
+    def _finish_reference(self) -> None:
+        """
+        Store the index of the current sequence, filling the windows of the linear index without records.
+
+        Windows before the first record get the offset of the first record, and later windows the offset of the previous
+        window.
+
+        :return: None
+        """
+        if self._bins is None:
+            return
+        linear = []
+        previous = next(x for x in self._linear if x is not None)
+        for x in self._linear:
+            previous = previous if x is None else x
+            linear.append(previous)
+        self._indices.append((self._bins, linear))
+        self._bins = self._linear = None
+
+    def finish(self) -> bytes:
+        """
+        Serialize the index.
+
+        :return: Uncompressed tabix index (to be BGZF-compressed, see write_tabix_index)
+        """
+        if self._line:
+            raise ValueError("The indexed file does not end with a newline")
+        self._finish_reference()
+        names = b"".join(x.encode() + b"\0" for x in self._names)
+
+        out = [
+            b"TBI\1",
+            struct.pack(
+                "<8i",
+                len(self._names),
+                self.format,
+                self.col_seq,
+                self.col_beg,
+                self.col_end,
+                ord(self.meta_char),
+                self.line_skip,
+                len(names),
+            ),
+            names,
+        ]
+        for bins, linear in self._indices:
+            out.append(struct.pack("<i", len(bins)))
+            for bin_number in sorted(bins):
+                chunks = bins[bin_number]
+                out.append(struct.pack("<Ii", bin_number, len(chunks)))
+                out.extend(struct.pack("<QQ", start, end) for start, end in chunks)
+            out.append(struct.pack("<i", len(linear)))
+            out.append(struct.pack(f"<{len(linear)}Q", *linear))
+
+        return b"".join(out)
+
+
+def write_tabix_index(index: bytes, index_path: str) -> None:
+    """
+    BGZF-compress a tabix index and write it.
+
+    The index is small (a few kilobytes per megabase of records), so it is compressed through a local temporary file
+    with pysam if it is installed, otherwise with the bgzip command line tool.
+
+    :param index: Uncompressed index returned by TabixIndexer.finish
+    :param index_path: Path of the index to write
+    :return: None
+    """
+    local_dir = tempfile.mkdtemp()
+    try:
+        raw_path = os.path.join(local_dir, "index")
+        with open(raw_path, "wb") as out:
+            out.write(index)
+        if pysam is not None:
+            pysam.tabix_compress(raw_path, f"{raw_path}.gz", force=True)
+        else:
+            with open(f"{raw_path}.gz", "wb") as out:
+                subprocess.run(["bgzip", "-c", raw_path], stdout=out, check=True)
+        with open(f"{raw_path}.gz", "rb") as f:
+            get_storage(index_path).write_atomic(index_path, f.read())
+    finally:
+        shutil.rmtree(local_dir)
@@ -0,0 +1,415 @@
+from __future__ import annotations
+
+import logging
+import os
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional
+
+from gnomad_mitochondria.utils.storage import get_storage
+from gnomad_mitochondria.utils.tabix import (
+    VCF_TABIX_PRESET,
+    TabixIndexer,
+    compress_bgzf,
+    write_tabix_index,
+)
+
+if TYPE_CHECKING:
+    import hail as hl
+
+
+logging.basicConfig(
+    format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+)
+logger = logging.getLogger("vcf export")
+logger.setLevel(logging.INFO)
+
+# Empty BGZF block that marks the end of a BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# VCF types of the Hail types of INFO fields (and of the elements of array and set INFO fields), as for hl.export_vcf
+VCF_INFO_TYPES = {
+    "bool": "Flag",
+    "int32": "Integer",
+    "int64": "Integer",
+    "float32": "Float",
+    "float64": "Float",
+    "str": "String",
+}
+
+
+def is_local_path(path: str) -> bool:
+    """
+    Check if a path is on the local filesystem.
+
+    :param path: Path to check
+    :return: True if the path has no scheme or uses the file:// scheme
+    """
+    return "://" not in path or path.startswith("file://")
+
+
+def list_shards(shard_dir: str) -> list:
+    """
+    List the ordered shards written by a parallel Hail export.
+
+    If Hail wrote a shard manifest, it is used for the shard order, otherwise the part files are sorted by name.
+
+    :param shard_dir: Directory output by hl.export_vcf or Table.export with the parallel option
+    :return: List of the paths of the shards in order
+    """
+    storage = get_storage(shard_dir)
+    manifest = f"{shard_dir}/shard-manifest.txt"
+    if storage.exists(manifest):
+        lines = storage.read_text(manifest).splitlines()
+        return [f"{shard_dir}/{line.strip()}" for line in lines if line.strip()]
+
+    files = [x["path"] for x in storage.list(shard_dir) if not x["is_dir"]]
+
+    return sorted(x for x in files if os.path.basename(x).startswith("part-"))
+
+
+def list_vcf_shards(shard_dir: str) -> tuple:
+    """
+    List the header and the ordered shards written by hl.export_vcf with parallel="separate_header".
+
+    :param shard_dir: Directory output by hl.export_vcf
+    :return: Tuple of the path of the header file and a list of the paths of the shards in order
+    """
+    files = [
+        x["path"] for x in get_storage(shard_dir).list(shard_dir) if not x["is_dir"]
+    ]
+    header = [x for x in files if os.path.basename(x).startswith("header")]
+    if len(header) != 1:
+        raise ValueError(
+            f"Expected one header file in {shard_dir}, found {len(header)}"
+        )
+
+    return header[0], list_shards(shard_dir)
+
+
+def _read_bgzf_without_eof(path: str) -> bytes:
+    """
+    Read a BGZF file and remove its trailing EOF block.
+
+    :param path: Path to the BGZF file
+    :return: Compressed contents of the file without the EOF block
+    """
+    data = get_storage(path).read(path)
+    if data.endswith(BGZF_EOF):
+        data = data[: -len(BGZF_EOF)]
+
+    return data
+
+
+def concatenate_bgzf(
+    paths: list,
+    output_path: str,
+    n_threads: int = 8,
+    indexer: Optional[TabixIndexer] = None,
+) -> None:
+    """
+    Concatenate BGZF files into a single BGZF file without decompressing them.
+
+    BGZF files are series of independent gzip blocks, so removing the EOF block of each file and appending a single EOF block
+    at the end produces a valid BGZF file. Files are read concurrently (at most n_threads at a time) and streamed to the
+    output in order, so the concatenated file is never staged on the driver.
+
+    :param paths: Paths of the BGZF files to concatenate, in order
+    :param output_path: Path of the concatenated file
+    :param n_threads: Number of files to read concurrently
+    :param indexer: Optional tabix indexer to which the blocks are fed as they are written
+    :return: None
+    """
+    storage = get_storage(output_path)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor, storage.open_write(
+        output_path
+    ) as out:
+        offset = 0
+
+        def _write(data: bytes) -> None:
+            nonlocal offset
+            if indexer is not None:
+                indexer.add_bgzf(offset, data)
+            out.write(data)
+            offset += len(data)
+
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(_read_bgzf_without_eof, path))
+            if len(pending) >= n_threads:
+                _write(pending.popleft().result())
+        while pending:
+            _write(pending.popleft().result())
+        out.write(BGZF_EOF)
+
+
+def export_sharded_vcf(
+    mt: hl.MatrixTable,
+    output_path: str,
+    metadata: Optional[dict] = None,
+    append_to_header: Optional[str] = None,
+    tabix: bool = True,
+    n_threads: int = 8,
+    shard_dir: Optional[str] = None,
+) -> None:
+    """
+    Export a VCF as shards written in parallel, then stream the shards into a single bgzipped VCF and index it.
+
+    Every partition is written by a separate task, the compressed shards are concatenated without decompressing them,
+    and the tabix index is built from the blocks as they are written. The output is equivalent to hl.export_vcf with
+    tabix=True.
+
+    :param mt: MatrixTable to export (can be a sites-only MatrixTable)
+    :param output_path: Path of the bgzipped VCF to write
+    :param metadata: Dictionary of VCF header metadata (as for hl.export_vcf)
+    :param append_to_header: Path of a file to append to the VCF header (as for hl.export_vcf)
+    :param tabix: Whether or not to build a tabix index
+    :param n_threads: Number of shards to read concurrently when concatenating
+    :param shard_dir: Directory to which the shards should be written, defaults to output_path with a ".shards" suffix
+    :return: None
+    """
+    import hail as hl
+
+    if shard_dir is None:
+        shard_dir = f"{output_path}.shards"
+    # The .bgz extension of the shard directory makes Hail block-compress the header and every shard
+    shard_dir = shard_dir if shard_dir.endswith(".bgz") else f"{shard_dir}.bgz"
+
+    logger.info("Exporting VCF shards to %s...", shard_dir)
+    hl.export_vcf(
+        mt,
+        shard_dir,
+        metadata=metadata,
+        append_to_header=append_to_header,
+        parallel="separate_header",
+    )
+    header, shards = list_vcf_shards(shard_dir)
+
+    logger.info(
+        "Concatenating header and %i shards into %s...", len(shards), output_path
+    )
+    indexer = TabixIndexer(**VCF_TABIX_PRESET) if tabix else None
+    concatenate_bgzf([header] + shards, output_path, n_threads, indexer)
+
+    if tabix:
+        logger.info("Writing tabix index...")
+        write_tabix_index(indexer.finish(), f"{output_path}.tbi")
+
+
+def export_sharded_tsv(
+    ht: hl.Table,
+    output_path: str,
+    n_threads: int = 8,
+    shard_dir: Optional[str] = None,
+    tabix_preset: Optional[dict] = None,
+    header: Optional[str] = None,
+) -> None:
+    """
+    Export a Table as a single bgzipped TSV from shards written in parallel, one per partition and without repartitioning.
+
+    The output is equivalent to Table.export to a .bgz path, but every partition is written by a separate task
+    and the compressed shards are streamed into the output without decompressing them.
+
+    :param ht: Table to export
+    :param output_path: Path of the bgzipped TSV to write
+    :param n_threads: Number of shards to read concurrently when concatenating
+    :param shard_dir: Directory to which the shards should be written, defaults to output_path with a ".shards" suffix
+    :param tabix_preset: Optional column layout (keyword arguments of TabixIndexer) with which to build a tabix index
+        from the blocks as they are written
+    :param header: Optional text to write before the rows instead of the line of column names (such as a VCF header)
+    :return: None
+    """
+    if shard_dir is None:
+        shard_dir = f"{output_path}.shards"
+    shard_dir = shard_dir if shard_dir.endswith(".bgz") else f"{shard_dir}.bgz"
+
+    logger.info("Exporting TSV shards to %s...", shard_dir)
+    if header is None:
+        ht.export(shard_dir, parallel="separate_header")
+        header, shards = list_vcf_shards(shard_dir)
+    else:
+        ht.export(shard_dir, header=False, parallel="separate_header")
+        shards = list_shards(shard_dir)
+        header_path = f"{shard_dir}/header.bgz"
+        get_storage(header_path).write_atomic(
+            header_path, compress_bgzf(header.encode())
+        )
+        header = header_path
+
+    logger.info(
+        "Concatenating header and %i shards into %s...", len(shards), output_path
+    )
+    indexer = None if tabix_preset is None else TabixIndexer(**tabix_preset)
+    concatenate_bgzf([header] + shards, output_path, n_threads, indexer)
+
+    if indexer is not None:
+        logger.info("Writing tabix index...")
+        write_tabix_index(indexer.finish(), f"{output_path}.tbi")
+
+
+def sites_vcf_header(
+    ht: hl.Table,
+    metadata: Optional[dict] = None,
+    append_to_header: Optional[str] = None,
+) -> str:
+    """
+    Build the header of a sites-only VCF of a Table, with the same lines as hl.export_vcf.
+
+    :param ht: Table keyed by locus and alleles with an info row field (see export_sites_vcf)
+    :param metadata: Dictionary of VCF header metadata (as for hl.export_vcf)
+    :param append_to_header: Path of a file to append to the VCF header (as for hl.export_vcf)
+    :return: VCF header, including the #CHROM line
+    """
+    import hail as hl
+
+    metadata = metadata or {}
+    lines = ["##fileformat=VCFv4.2", f"##hailversion={hl.version()}"]
+    for name, attributes in sorted(metadata.get("filter", {}).items()):
+        description = attributes.get("Description", "").replace('"', '\\"')
+        lines.append(f'##FILTER=<ID={name},Description="{description}">')
+    if "info" in ht.row:
+        for name, dtype in ht.info.dtype.items():
+            if isinstance(dtype, (hl.tarray, hl.tset)):
+                number, vcf_type = ".", VCF_INFO_TYPES[str(dtype.element_type)]
+            else:
+                number, vcf_type = (
+                    "0" if dtype == hl.tbool else "1",
+                    VCF_INFO_TYPES[str(dtype)],
+                )
+            attributes = metadata.get("info", {}).get(name, {})
+            description = attributes.get("Description", "").replace('"', '\\"')
+            lines.append(
+                f"##INFO=<ID={name},Number={attributes.get('Number', number)},"
+                f'Type={attributes.get("Type", vcf_type)},Description="{description}">'
+            )
+    if append_to_header is not None:
+        lines.extend(
+            get_storage(append_to_header).read_text(append_to_header).splitlines()
+        )
+    reference_genome = ht.locus.dtype.reference_genome
+    for contig in reference_genome.contigs:
+        lines.append(
+            f"##contig=<ID={contig},length={reference_genome.lengths[contig]},assembly={reference_genome.name}>"
+        )
+    lines.append(
+        "\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO"])
+    )
+
+    return "\n".join(lines) + "\n"
+
+
+def _vcf_value_expr(value: hl.Expression) -> hl.StringExpression:
+    """
+    Format a value of an INFO field as hl.export_vcf does, with "." for missing values and NaN.
+
+    :param value: Value of a numeric or string type
+    :return: Formatted value
+    """
+    import hail as hl
+
+    if value.dtype in (hl.tfloat32, hl.tfloat64):
+        formatted = hl.or_missing(~hl.is_nan(value), hl.format("%.6g", value))
+    elif value.dtype == hl.tstr:
+        formatted = value
+    else:
+        formatted = hl.str(value)
+
+    return hl.or_else(formatted, ".")
+
+
+def sites_vcf_line_expr(ht: hl.Table) -> hl.StringExpression:
+    """
+    Build the VCF line of each row of a Table, as written by hl.export_vcf for a sites-only VCF.
+
+    Missing, false, and empty INFO fields are left out, and missing values inside arrays and sets are written as ".".
+
+    :param ht: Table keyed by locus and alleles with optional rsid, qual, filters, and info row fields
+    :return: Tab-separated VCF line without the newline
+    """
+    import hail as hl
+
+    info_fields = []
+    if "info" in ht.row:
+        for name, value in ht.info.items():
+            if value.dtype == hl.tbool:
+                info_fields.append(hl.or_missing(hl.or_else(value, False), name))
+            elif isinstance(value.dtype, (hl.tarray, hl.tset)):
+                info_fields.append(
+                    hl.or_missing(
+                        hl.len(value) > 0,
+                        name
+                        + "="
+                        + hl.delimit(hl.array(value).map(_vcf_value_expr), ","),
+                    )
+                )
+            else:
+                info_fields.append(
+                    hl.or_missing(
+                        hl.is_defined(value), name + "=" + _vcf_value_expr(value)
+                    )
+                )
+    info = (
+        hl.delimit(hl.array(info_fields).filter(hl.is_defined), ";")
+        if info_fields
+        else hl.str("")
+    )
+
+    filters = "."
+    if "filters" in ht.row:
+        filters = (
+            hl.case()
+            .when(hl.is_missing(ht.filters), ".")
+            .when(hl.len(ht.filters) == 0, "PASS")
+            .default(hl.delimit(hl.sorted(hl.array(ht.filters)), ";"))
+        )
+
+    return hl.delimit(
+        [
+            ht.locus.contig,
+            hl.str(ht.locus.position),
+            hl.or_else(ht.rsid, ".") if "rsid" in ht.row else ".",
+            ht.alleles[0],
+            hl.if_else(hl.len(ht.alleles) > 1, hl.delimit(ht.alleles[1:], ","), "."),
+            hl.or_else(hl.format("%.2f", ht.qual), ".") if "qual" in ht.row else ".",
+            filters,
+            hl.if_else(info == "", ".", info),
+        ],
+        "\t",
+    )
+
+
+def export_sites_vcf(
+    ht: hl.Table,
+    output_path: str,
+    metadata: Optional[dict] = None,
+    append_to_header: Optional[str] = None,
+    tabix: bool = True,
+    n_threads: int = 8,
+    shard_dir: Optional[str] = None,
+) -> None:
+    """
+    Export a sites-only VCF directly from a Table, writing the VCF line of each row in parallel (see export_sharded_tsv).
+
+    The rows are not converted to a MatrixTable with a placeholder column for hl.export_vcf, so the Table is exported as
+    it is partitioned, and the header and lines are the same as those written by hl.export_vcf.
+
+    :param ht: Table keyed by locus and alleles with rsid, filters, and info row fields (such as the rows of the MatrixTable returned by format_vcf)
+    :param output_path: Path of the bgzipped VCF to write
+    :param metadata: Dictionary of VCF header metadata (as returned by format_vcf)
+    :param append_to_header: Path of a file to append to the VCF header
+    :param tabix: Whether or not to build a tabix index
+    :param n_threads: Number of shards to read concurrently when concatenating
+    :param shard_dir: Directory to which the shards should be written, defaults to output_path with a ".shards" suffix
+    :return: None
+    """
+    header = sites_vcf_header(ht, metadata, append_to_header)
+    lines_ht = ht.select(line=sites_vcf_line_expr(ht))
+    export_sharded_tsv(
+        lines_ht.key_by().select("line"),
+        output_path,
+        n_threads=n_threads,
+        shard_dir=shard_dir,
+        tabix_preset=VCF_TABIX_PRESET if tabix else None,
+        header=header,
+    )
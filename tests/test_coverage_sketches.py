@@ -0,0 +1,138 @@
+import pytest
+
+hl = pytest.importorskip("hail")
+np = pytest.importorskip("numpy")
+
+from gnomad_mitochondria.utils.coverage_sketches import (
+    annotate_coverage_sketches,
+    query_coverage_sketches,
+)
+
+
+RELATIVE_ACCURACY = 0.01
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+THRESHOLDS = [100, 1000]
+HAPS = ["H", "V", "L3"]
+POPS = ["afr", "eur"]
+N_POSITIONS = 20
+N_SAMPLES = 300
+
+
+@pytest.fixture(scope="module")
+def coverage():
+    """Simulate coverage, haplogroups, and populations of the samples."""
+    rng = np.random.default_rng(0)
+    cov = rng.lognormal(mean=6, sigma=1, size=(N_POSITIONS, N_SAMPLES)).astype(int)
+    # Some samples without coverage at each position
+    cov[rng.random(cov.shape) < 0.05] = 0
+    haps = [HAPS[i % len(HAPS)] for i in range(N_SAMPLES)]
+    pops = [POPS[i % len(POPS)] for i in range(N_SAMPLES)]
+
+    return cov, haps, pops
+
+
+@pytest.fixture(scope="module")
+def hail_session():
+    """Start a local Hail session shared by the tests."""
+    hl.init(master="local[2]", quiet=True, idempotent=True)
+
+
+def make_coverage_mt(cov):
+    """Build a coverage table (keyed by pos and s) from an array of positions x samples."""
+    mt = hl.utils.range_matrix_table(cov.shape[0], cov.shape[1], n_partitions=2)
+    mt = mt.annotate_entries(coverage=hl.literal(cov.tolist())[mt.row_idx][mt.col_idx])
+    mt = mt.key_rows_by(pos=mt.row_idx + 1)
+    mt = mt.key_cols_by(s=hl.str(mt.col_idx))
+
+    return mt.select_rows().select_cols()
+
+
+def make_samples_ht(haps, pops):
+    """Build a Table keyed by sample with hap and pop."""
+    ht = hl.Table.parallelize(
+        [
+            {"s": str(i), "hap": hap, "pop": pop}
+            for i, (hap, pop) in enumerate(zip(haps, pops))
+        ],
+        hl.tstruct(s=hl.tstr, hap=hl.tstr, pop=hl.tstr),
+    )
+
+    return ht.key_by("s")
+
+
+def build_sketches(cov, haps, pops):
+    """Build the coverage sketches of the simulated samples."""
+    return annotate_coverage_sketches(
+        make_coverage_mt(cov),
+        make_samples_ht(haps, pops),
+        THRESHOLDS,
+        RELATIVE_ACCURACY,
+    )
+
+
+def check_summary(row, values):
+    """Check a summary returned by query_coverage_sketches against the coverage values of its samples."""
+    assert row.n_samples == len(values)
+    assert row.mean == pytest.approx(np.mean(values))
+    for q, estimate in zip(QUANTILES, row.quantiles):
+        # The sketch returns the value at rank q * (n - 1), rounded down, to within the relative accuracy
+        expected = np.quantile(values, q, method="lower")
+        assert abs(estimate - expected) <= RELATIVE_ACCURACY * expected + 1e-9
+    for x in THRESHOLDS:
+        assert row[f"over_{x}"] == pytest.approx(np.mean(values > x))
+
+
+def test_quantiles_within_relative_accuracy(hail_session, coverage):
+    """Test that the quantiles of all samples are within the relative accuracy of the numpy quantiles."""
+    cov, haps, pops = coverage
+    result = query_coverage_sketches(
+        build_sketches(cov, haps, pops), quantiles=QUANTILES
+    )
+
+    rows = result.collect()
+    assert [x.pos for x in rows] == list(range(1, N_POSITIONS + 1))
+    for row in rows:
+        check_summary(row, cov[row.pos - 1])
+
+
+def test_quantiles_of_stratum(hail_session, coverage):
+    """Test the summaries of a single population."""
+    cov, haps, pops = coverage
+    result = query_coverage_sketches(
+        build_sketches(cov, haps, pops), strata=[("pop", "afr")], quantiles=QUANTILES
+    )
+
+    in_stratum = np.array([x == "afr" for x in pops])
+    for row in result.collect():
+        check_summary(row, cov[row.pos - 1][in_stratum])
+
+
+def test_merged_sketches_equal_sketch_of_union(hail_session, coverage):
+    """Test that merging the sketches of haplogroups gives the sketch of the union of their samples."""
+    cov, haps, pops = coverage
+    union = ["H", "V"]
+    merged = query_coverage_sketches(
+        build_sketches(cov, haps, pops),
+        strata=[("hap", x) for x in union],
+        quantiles=QUANTILES,
+    )
+
+    in_union = np.array([x in union for x in haps])
+    union_sketches = build_sketches(
+        cov[:, in_union],
+        [x for x in haps if x in union],
+        [x for x, keep in zip(pops, in_union) if keep],
+    )
+    direct = query_coverage_sketches(union_sketches, quantiles=QUANTILES)
+
+    assert merged.collect() == direct.collect()
+    for row in merged.collect():
+        check_summary(row, cov[row.pos - 1][in_union])
+
+
+def test_unknown_stratum_type(hail_session, coverage):
+    """Test that an unknown stratum type is rejected."""
+    cov, haps, pops = coverage
+
+    with pytest.raises(ValueError):
+        query_coverage_sketches(build_sketches(cov, haps, pops), strata=[("sex", "XX")])
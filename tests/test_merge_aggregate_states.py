@@ -0,0 +1,240 @@
+import pytest
+
+hl = pytest.importorskip("hail")
+
+from gnomad_mitochondria.pipeline.add_annotations import (
+    generate_aggregate_state_expr,
+    generate_expressions,
+    write_aggregate_state,
+)
+from gnomad_mitochondria.pipeline.combine_vcfs import determine_hom_refs
+from gnomad_mitochondria.pipeline.merge_aggregate_states import (
+    finalize_aggregate_state,
+    merge_aggregate_states,
+)
+from gnomad_mitochondria.utils.coverage_table import write_coverage_table
+
+
+MIN_HOM_THRESHOLD = 0.95
+MINIMUM_HOMREF_COVERAGE = 100
+N_POSITIONS = 10
+SAMPLES = [
+    {"s": "S0", "hap": "H", "pop": "afr", "age": 30},
+    {"s": "S1", "hap": "L3", "pop": "nfe", "age": 45},
+    {"s": "S2", "hap": "H", "pop": "nfe", "age": 60},
+    {"s": "S3", "hap": "L3", "pop": "afr", "age": 35},
+    {"s": "S4", "hap": "H", "pop": "afr", "age": 50},
+    {"s": "S5", "hap": "L3", "pop": "nfe", "age": 70},
+]
+BATCHES = [["S0", "S1", "S2"], ["S3", "S4", "S5"]]
+# Calls as (position, ref, alt, sample, HL)
+CALLS = [
+    # Called in both batches
+    (2, "A", "G", "S0", 0.99),
+    (2, "A", "G", "S4", 0.3),
+    # Only called in the second batch, where S1 of the first batch has exactly the minimum homref coverage
+    (3, "C", "T", "S4", 1.0),
+    # Only called in the first batch
+    (5, "G", "A", "S1", 0.5),
+    # Two alleles at one position, only called in the second batch
+    (7, "T", "C", "S3", 0.97),
+    (7, "T", "C", "S5", 0.2),
+    (7, "T", "TA", "S3", 0.1),
+]
+
+
+def get_coverage(pos, s):
+    """Coverage of a sample at a position, with values on both sides of the minimum homref coverage."""
+    if (pos, s) == (3, "S1"):
+        return MINIMUM_HOMREF_COVERAGE
+    i = [x["s"] for x in SAMPLES].index(s)
+
+    return (pos * 37 + i * 53) % 250
+
+
+@pytest.fixture(scope="module")
+def hail_session():
+    """Start a local Hail session shared by the tests."""
+    hl.init(master="local[2]", quiet=True, idempotent=True)
+
+
+@pytest.fixture(scope="module")
+def coverage_path(hail_session, tmp_path_factory):
+    """Write the coverage table of all samples."""
+    path = str(tmp_path_factory.mktemp("coverage") / "coverage_table.mt")
+    coverage = [
+        [get_coverage(pos, x["s"]) for x in SAMPLES]
+        for pos in range(1, N_POSITIONS + 1)
+    ]
+    mt = hl.utils.range_matrix_table(N_POSITIONS, len(SAMPLES), n_partitions=2)
+    mt = mt.annotate_entries(coverage=hl.literal(coverage)[mt.row_idx][mt.col_idx])
+    mt = mt.key_rows_by(pos=mt.row_idx + 1)
+    mt = mt.key_cols_by(s=hl.literal([x["s"] for x in SAMPLES])[mt.col_idx])
+    write_coverage_table(mt.select_rows().select_cols(), path, n_partitions=2)
+
+    return path
+
+
+def make_callset(samples, coverage_path):
+    """
+    Build the callset of a batch of samples as add_annotations.py receives it.
+
+    Only variants called in at least one sample of the batch are rows, and homoplasmic reference sites are determined
+    from coverage by determine_hom_refs.
+    """
+    calls = {
+        (pos, ref, alt, s): hl_value
+        for pos, ref, alt, s, hl_value in CALLS
+        if s in samples
+    }
+    variants = sorted({x[:3] for x in calls})
+    sample_annotations = [x for x in SAMPLES if x["s"] in samples]
+
+    mt = hl.utils.range_matrix_table(
+        len(variants), len(sample_annotations), n_partitions=2
+    )
+    variant = hl.literal(variants)[mt.row_idx]
+    mt = mt.key_rows_by(
+        locus=hl.locus("MT", variant[0], reference_genome="GRCh37"),
+        alleles=[variant[1], variant[2]],
+    )
+    mt = mt.annotate_cols(**hl.literal(sample_annotations)[mt.col_idx])
+    mt = mt.key_cols_by("s")
+
+    hl_expr = hl.literal(calls).get(
+        hl.tuple([mt.locus.position, mt.alleles[0], mt.alleles[1], mt.s])
+    )
+    mt = mt.select_entries(
+        HL=hl_expr,
+        DP=hl.or_missing(
+            hl.is_defined(hl_expr),
+            hl.literal(
+                {
+                    (pos, x["s"]): get_coverage(pos, x["s"])
+                    for pos, _, _ in variants
+                    for x in SAMPLES
+                }
+            )[hl.tuple([mt.locus.position, mt.s])],
+        ),
+        MQ=hl.or_missing(hl.is_defined(hl_expr), 60.0),
+        TLOD=hl.or_missing(hl.is_defined(hl_expr), 100.0),
+        FT=hl.or_missing(hl.is_defined(hl_expr), hl.set(["PASS"])),
+    )
+    mt = mt.select_rows().select_cols("hap", "pop", "age")
+
+    mt = determine_hom_refs(mt, coverage_path, MINIMUM_HOMREF_COVERAGE)
+    mt = mt.key_rows_by(
+        locus=hl.locus("chrM", mt.locus.position, reference_genome="GRCh38"),
+        alleles=mt.alleles,
+    )
+    # As in add_genotype
+    return mt.annotate_entries(
+        GT=hl.case()
+        .when((mt.HL < MIN_HOM_THRESHOLD) & (mt.HL > 0.0), hl.parse_call("0/1"))
+        .when(mt.HL >= MIN_HOM_THRESHOLD, hl.parse_call("1/1"))
+        .when(mt.HL == 0, hl.parse_call("0/0"))
+        .default(hl.missing(hl.tcall))
+    )
+
+
+def get_expected_an(pos, ref, alt, samples):
+    """Count the samples with a call or with more than the minimum homref coverage at a position."""
+    called = {x[3] for x in CALLS if x[:3] == (pos, ref, alt)}
+
+    return sum(
+        1
+        for s in samples
+        if s in called or get_coverage(pos, s) > MINIMUM_HOMREF_COVERAGE
+    )
+
+
+def collect_by_variant(ht, fields):
+    """Collect fields of a Table keyed by locus and alleles into a dictionary keyed by position, ref, and alt."""
+    return {
+        (x.locus.position, x.alleles[0], x.alleles[1]): {
+            field: x[field] for field in fields
+        }
+        for x in ht.collect()
+    }
+
+
+def test_merged_states_match_joint_run(coverage_path, tmp_path):
+    """Test that merging the states of two batches gives the AC, AN, and AF of one run over all samples."""
+    state_dirs = []
+    for i, batch in enumerate(BATCHES):
+        mt = make_callset(batch, coverage_path)
+        mt = mt.annotate_rows(
+            aggregate_state=generate_aggregate_state_expr(mt, MIN_HOM_THRESHOLD)
+        )
+        state_dirs.append(str(tmp_path / f"batch_{i}"))
+        write_aggregate_state(
+            mt,
+            state_dirs[-1],
+            coverage_path,
+            MIN_HOM_THRESHOLD,
+            MINIMUM_HOMREF_COVERAGE,
+        )
+    merge_aggregate_states(state_dirs, str(tmp_path / "merged"))
+
+    joint_mt = make_callset([x["s"] for x in SAMPLES], coverage_path)
+    joint_mt = joint_mt.annotate_rows(
+        **generate_expressions(joint_mt, MIN_HOM_THRESHOLD)
+    )
+    joint = collect_by_variant(
+        joint_mt.rows(),
+        ["AC", "AN", "AF", "AC_hom", "AC_het", "pre_hap_AN", "pre_pop_AN"],
+    )
+
+    merged_ht = hl.read_table(str(tmp_path / "merged" / "sites.ht"))
+    merged = collect_by_variant(
+        merged_ht, ["AC", "AN", "AC_hom", "AC_het", "hap", "pop"]
+    )
+    finalized = collect_by_variant(
+        finalize_aggregate_state(str(tmp_path / "merged")), ["AN", "AF_hom", "AF_het"]
+    )
+
+    assert set(merged) == set(joint) == {x[:3] for x in CALLS}
+    for variant, expected in joint.items():
+        assert expected["AN"] == get_expected_an(*variant, [x["s"] for x in SAMPLES])
+        assert merged[variant]["AN"] == expected["AN"]
+        assert merged[variant]["AC"] == expected["AC"]
+        assert merged[variant]["AC_hom"] == expected["AC_hom"]
+        assert merged[variant]["AC_het"] == expected["AC_het"]
+        assert merged[variant]["AC"] / merged[variant]["AN"] == pytest.approx(
+            expected["AF"]
+        )
+        assert {k: v.AN for k, v in merged[variant]["hap"].items()} == expected[
+            "pre_hap_AN"
+        ]
+        assert {k: v.AN for k, v in merged[variant]["pop"].items()} == expected[
+            "pre_pop_AN"
+        ]
+        assert finalized[variant]["AN"] == expected["AN"]
+        assert finalized[variant]["AF_hom"] == pytest.approx(
+            expected["AC_hom"] / expected["AN"]
+        )
+        assert finalized[variant]["AF_het"] == pytest.approx(
+            expected["AC_het"] / expected["AN"]
+        )
+
+
+def test_reference_an_needs_more_than_minimum_homref_coverage(coverage_path, tmp_path):
+    """Test that samples with exactly the minimum homref coverage are not counted in the reference AN."""
+    mt = make_callset(BATCHES[0], coverage_path)
+    mt = mt.annotate_rows(
+        aggregate_state=generate_aggregate_state_expr(mt, MIN_HOM_THRESHOLD)
+    )
+    write_aggregate_state(
+        mt, str(tmp_path), coverage_path, MIN_HOM_THRESHOLD, MINIMUM_HOMREF_COVERAGE
+    )
+
+    reference_ht = hl.read_table(str(tmp_path / "reference.ht"))
+    reference = {x.locus.position: x for x in reference_ht.collect()}
+
+    # The variant at position 3 is not called in the first batch, where S1 has exactly the minimum homref coverage
+    assert get_coverage(3, "S1") == MINIMUM_HOMREF_COVERAGE
+    assert reference[3].AN == sum(
+        1 for s in BATCHES[0] if get_coverage(3, s) > MINIMUM_HOMREF_COVERAGE
+    )
+    assert reference[3].AC == 0
+    assert reference[3].dp_n == reference[3].AN
@@ -0,0 +1,222 @@
+import os
+import threading
+
+import pytest
+
+from gnomad_mitochondria.pipeline.run_pipeline_dag import (
+    Stage,
+    format_gantt,
+    get_dependencies,
+    is_current,
+    run_dag,
+)
+
+
+def touch(path, mtime):
+    """Write an empty file with the given modification time, creating its parent directories."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w"):
+        pass
+    os.utime(path, (mtime, mtime))
+
+
+def test_get_dependencies():
+    """Test that stages depend on the stages writing their inputs."""
+    stages = [
+        Stage("a", None, inputs=["in.tsv"], outputs=["a.mt"]),
+        Stage("b", None, inputs=["in.tsv"], outputs=["b.mt/"]),
+        Stage("c", None, inputs=["a.mt", "b.mt", None], outputs=["c.mt"]),
+    ]
+
+    assert get_dependencies(stages) == {"a": set(), "b": set(), "c": {"a", "b"}}
+
+
+def test_get_dependencies_rejects_cycles_and_shared_outputs():
+    """Test that cycles and outputs written by several stages are rejected."""
+    with pytest.raises(ValueError, match="cycle"):
+        get_dependencies(
+            [
+                Stage("a", None, inputs=["b.mt"], outputs=["a.mt"]),
+                Stage("b", None, inputs=["a.mt"], outputs=["b.mt"]),
+            ]
+        )
+    with pytest.raises(ValueError, match="written by both"):
+        get_dependencies(
+            [
+                Stage("a", None, inputs=[], outputs=["x.mt"]),
+                Stage("b", None, inputs=[], outputs=["x.mt"]),
+            ]
+        )
+
+
+def test_is_current(tmp_path):
+    """Test that a stage is current once all of its outputs are newer than its inputs."""
+    touch(str(tmp_path / "in.tsv"), 1000)
+    stage = Stage(
+        "a", None, inputs=[str(tmp_path / "in.tsv")], outputs=[str(tmp_path / "out.mt")]
+    )
+    assert not is_current(stage)
+
+    # A MatrixTable directory only counts as written once its _SUCCESS file exists
+    os.makedirs(tmp_path / "out.mt")
+    assert not is_current(stage)
+
+    touch(str(tmp_path / "out.mt" / "_SUCCESS"), 2000)
+    assert is_current(stage)
+
+    touch(str(tmp_path / "in.tsv"), 3000)
+    assert not is_current(stage)
+
+
+def test_run_dag_passes_results_and_runs_independent_stages_concurrently(tmp_path):
+    """Test that independent stages overlap and that results are passed to the stages depending on them."""
+    touch(str(tmp_path / "in.tsv"), 1000)
+    # Each of the independent stages waits for the other to start, so the run only finishes if they overlap
+    barrier = threading.Barrier(2, timeout=10)
+    received = {}
+
+    def independent(name):
+        def run(results):
+            barrier.wait()
+            touch(str(tmp_path / f"{name}.mt"), 2000)
+            return name
+
+        return run
+
+    def join(results):
+        received.update(results)
+        touch(str(tmp_path / "c.mt"), 3000)
+
+    stages = [
+        Stage(
+            "a",
+            independent("a"),
+            inputs=[str(tmp_path / "in.tsv")],
+            outputs=[str(tmp_path / "a.mt")],
+        ),
+        Stage(
+            "b",
+            independent("b"),
+            inputs=[str(tmp_path / "in.tsv")],
+            outputs=[str(tmp_path / "b.mt")],
+        ),
+        Stage(
+            "c",
+            join,
+            inputs=[str(tmp_path / "a.mt"), str(tmp_path / "b.mt")],
+            outputs=[str(tmp_path / "c.mt")],
+        ),
+    ]
+    records = run_dag(stages, max_concurrent_stages=2)
+
+    assert {x["stage"]: x["status"] for x in records} == {
+        "a": "ran",
+        "b": "ran",
+        "c": "ran",
+    }
+    assert [x["stage"] for x in records][-1] == "c"
+    assert received == {"a": "a", "b": "b"}
+    assert "c" in format_gantt(records)
+
+
+def test_run_dag_skips_current_stages(tmp_path):
+    """Test that stages with current outputs are skipped and pass None to the stages depending on them."""
+    touch(str(tmp_path / "in.tsv"), 1000)
+    touch(str(tmp_path / "a.mt"), 2000)
+    received = {}
+
+    def run_b(results):
+        received.update(results)
+
+    stages = [
+        Stage(
+            "a",
+            None,
+            inputs=[str(tmp_path / "in.tsv")],
+            outputs=[str(tmp_path / "a.mt")],
+        ),
+        Stage(
+            "b",
+            run_b,
+            inputs=[str(tmp_path / "a.mt")],
+            outputs=[str(tmp_path / "b.mt")],
+        ),
+    ]
+    records = run_dag(stages)
+
+    assert {x["stage"]: x["status"] for x in records} == {"a": "skipped", "b": "ran"}
+    assert received == {"a": None}
+
+    # Once a stage runs, the stages depending on it run too, even if their outputs are current
+    touch(str(tmp_path / "in.tsv"), 2500)
+    touch(str(tmp_path / "b.mt"), 3000)
+    stages[0].run = lambda results: "a"
+    records = run_dag(stages)
+
+    assert {x["stage"]: x["status"] for x in records} == {"a": "ran", "b": "ran"}
+    assert received == {"a": "a"}
+
+
+def test_run_dag_blocks_stages_after_failures(tmp_path):
+    """Test that the stages depending on a failed stage are not run."""
+    touch(str(tmp_path / "in.tsv"), 1000)
+
+    def fail(results):
+        raise RuntimeError("failed")
+
+    stages = [
+        Stage(
+            "a",
+            fail,
+            inputs=[str(tmp_path / "in.tsv")],
+            outputs=[str(tmp_path / "a.mt")],
+        ),
+        Stage(
+            "b", None, inputs=[str(tmp_path / "a.mt")], outputs=[str(tmp_path / "b.mt")]
+        ),
+        Stage(
+            "c", None, inputs=[str(tmp_path / "b.mt")], outputs=[str(tmp_path / "c.mt")]
+        ),
+    ]
+    records = run_dag(stages)
+
+    assert {x["stage"]: x["status"] for x in records} == {
+        "a": "failed",
+        "b": "blocked",
+        "c": "blocked",
+    }
+
+
+def test_run_dag_exclusive_stages_run_alone(tmp_path):
+    """Test that no stage runs at the same time as an exclusive stage."""
+    touch(str(tmp_path / "in.tsv"), 1000)
+    lock = threading.Lock()
+    running = []
+    overlaps = []
+
+    def run(name):
+        def run_stage(results):
+            with lock:
+                running.append(name)
+                overlaps.append(list(running))
+            threading.Event().wait(0.2)
+            with lock:
+                running.remove(name)
+
+        return run_stage
+
+    stages = [
+        Stage(
+            x,
+            run(x),
+            inputs=[str(tmp_path / "in.tsv")],
+            outputs=[str(tmp_path / f"{x}.mt")],
+            exclusive=x == "b",
+        )
+        for x in ("a", "b", "c")
+    ]
+    records = run_dag(stages, max_concurrent_stages=3)
+
+    assert all(x["status"] == "ran" for x in records)
+    assert ["b"] in overlaps
+    assert not any("b" in x and len(x) > 1 for x in overlaps)
@@ -0,0 +1,230 @@
+import os
+
+import pytest
+
+from gnomad_mitochondria.utils import storage
+from gnomad_mitochondria.utils.storage import (
+    FuseStorage,
+    HadoopStorage,
+    LocalStorage,
+    StorageBackend,
+    get_scheme,
+    get_storage,
+    register_storage,
+    requires_hail,
+    use_local_standin,
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_storage(monkeypatch):
+    """Restore the registered and default backends after each test."""
+    monkeypatch.setattr(storage, "_REGISTERED_STORAGE", {})
+    monkeypatch.setattr(storage, "_DEFAULT_STORAGE", {})
+
+
+def write_file(path, data):
+    """Write bytes to a file, creating its parent directories."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_get_scheme():
+    """Test that schemes are parsed from paths, with local paths as file."""
+    assert get_scheme("gs://bucket/file") == "gs"
+    assert get_scheme("dx://project-xxxx/file") == "dx"
+    assert get_scheme("hdfs://namenode/file") == "hdfs"
+    assert get_scheme("file:///tmp/file") == "file"
+    assert get_scheme("/tmp/file") == "file"
+    assert get_scheme("relative/file") == "file"
+
+
+def test_storage_backend_is_abstract():
+    """Test that the storage interface cannot be instantiated."""
+    with pytest.raises(TypeError):
+        StorageBackend()
+
+
+def test_local_list_and_stat(tmp_path):
+    """Test listing and stat of local directories and files."""
+    write_file(str(tmp_path / "a.txt"), b"abc")
+    write_file(str(tmp_path / "sub" / "b.txt"), b"defgh")
+    local = LocalStorage()
+
+    entries = {x["path"]: x for x in local.list(str(tmp_path))}
+    assert set(entries) == {str(tmp_path / "a.txt"), str(tmp_path / "sub")}
+    assert entries[str(tmp_path / "a.txt")]["size_bytes"] == 3
+    assert entries[str(tmp_path / "sub")]["is_dir"]
+
+    entries = {
+        x["path"]: x["size_bytes"] for x in local.list(str(tmp_path), recursive=True)
+    }
+    assert entries == {str(tmp_path / "a.txt"): 3, str(tmp_path / "sub" / "b.txt"): 5}
+
+    assert local.stat(str(tmp_path / "sub" / "b.txt"))["size_bytes"] == 5
+    assert local.stat(f"file://{tmp_path}/sub/")["is_dir"]
+    assert local.exists(str(tmp_path / "a.txt"))
+    assert not local.exists(str(tmp_path / "missing"))
+    with pytest.raises(FileNotFoundError):
+        local.stat(str(tmp_path / "missing"))
+
+
+def test_local_file_prefix_is_kept_in_listing(tmp_path):
+    """Test that listing a file:// path returns file:// paths."""
+    write_file(str(tmp_path / "a.txt"), b"abc")
+
+    assert [x["path"] for x in LocalStorage().list(f"file://{tmp_path}")] == [
+        f"file://{tmp_path}/a.txt"
+    ]
+
+
+def test_local_read_range(tmp_path):
+    """Test reading whole files and byte ranges of local files."""
+    path = str(tmp_path / "data.bin")
+    write_file(path, b"0123456789")
+    local = LocalStorage()
+
+    assert local.read(path) == b"0123456789"
+    assert local.read_range(path, 2, 3) == b"234"
+    assert local.read_range(path, 8, 10) == b"89"
+    assert local.read_range(path, 4) == b"456789"
+    assert local.read_text(path) == "0123456789"
+
+
+def test_local_write_atomic(tmp_path):
+    """Test that atomic writes replace the file without leaving temporary files."""
+    path = str(tmp_path / "new" / "dir" / "file.txt")
+    local = LocalStorage()
+
+    local.write_atomic(path, b"first")
+    local.write_atomic(path, b"second")
+
+    assert local.read(path) == b"second"
+    assert os.listdir(tmp_path / "new" / "dir") == ["file.txt"]
+
+
+def test_local_open_write(tmp_path):
+    """Test that streamed writes only appear at the path once complete."""
+    path = str(tmp_path / "out" / "file.bin")
+    local = LocalStorage()
+
+    with local.open_write(path) as f:
+        f.write(b"abc")
+        f.write(b"def")
+        # Nothing is visible at the path until the context exits
+        assert not os.path.exists(path)
+
+    assert local.read(path) == b"abcdef"
+    assert os.listdir(tmp_path / "out") == ["file.bin"]
+
+
+def test_local_open_write_failure_keeps_previous_file(tmp_path):
+    """Test that a failed streamed write keeps the previous file."""
+    path = str(tmp_path / "file.bin")
+    local = LocalStorage()
+    local.write_atomic(path, b"previous")
+
+    with pytest.raises(RuntimeError):
+        with local.open_write(path) as f:
+            f.write(b"partial")
+            raise RuntimeError("failed")
+
+    assert local.read(path) == b"previous"
+    assert os.listdir(tmp_path) == ["file.bin"]
+
+
+def test_local_standin_needs_root():
+    """Test that a local stand-in for a remote scheme needs a root directory."""
+    with pytest.raises(ValueError):
+        LocalStorage(scheme="gs")
+
+
+def test_local_standin_mapping(tmp_path):
+    """Test that remote paths map to files under the stand-in root."""
+    use_local_standin(str(tmp_path))
+    write_file(str(tmp_path / "gs" / "bucket" / "run" / "rc"), b"1\n")
+    write_file(str(tmp_path / "dx" / "project-xxxx" / "folder" / "file"), b"2\n")
+
+    gs = get_storage("gs://bucket/run/rc")
+    assert isinstance(gs, LocalStorage)
+    assert gs.read("gs://bucket/run/rc") == b"1\n"
+    assert [x["path"] for x in gs.list("gs://bucket/run")] == ["gs://bucket/run/rc"]
+    assert gs.stat("gs://bucket/run")["path"] == "gs://bucket/run"
+    assert (
+        get_storage("dx://project-xxxx/folder/file").read(
+            "dx://project-xxxx/folder/file"
+        )
+        == b"2\n"
+    )
+
+    gs.write_atomic("gs://bucket/out/file", b"3\n")
+    assert (tmp_path / "gs" / "bucket" / "out" / "file").read_bytes() == b"3\n"
+
+    with pytest.raises(ValueError):
+        gs.read("dx://project-xxxx/folder/file")
+
+
+def test_registered_storage_takes_precedence(tmp_path):
+    """Test that registered backends are used instead of the defaults."""
+    standin = LocalStorage(str(tmp_path), scheme="hdfs")
+    register_storage("hdfs", standin)
+
+    assert get_storage("hdfs://namenode/file") is standin
+
+
+def test_default_storage(monkeypatch):
+    """Test the default backend of each scheme without a Hail session."""
+    monkeypatch.setattr(storage, "hail_is_initialized", lambda: False)
+
+    assert type(get_storage("/tmp/file")) is LocalStorage
+    assert type(get_storage("file:///tmp/file")) is LocalStorage
+    assert get_storage("/tmp/file") is get_storage("/tmp/other")
+    assert isinstance(get_storage("/mnt/project/file"), FuseStorage)
+    assert isinstance(get_storage("hdfs://namenode/file"), HadoopStorage)
+    assert isinstance(get_storage("dnax://database/file"), HadoopStorage)
+
+
+def test_fuse_storage_is_read_only():
+    """Test that writes to the DNAnexus FUSE mount are rejected."""
+    fuse = get_storage("/mnt/project/file")
+
+    with pytest.raises(PermissionError):
+        fuse.write_atomic("/mnt/project/file", b"data")
+    with pytest.raises(PermissionError):
+        fuse.open_write("/mnt/project/file")
+
+
+def test_paths_without_scheme_use_hail_default_fs(monkeypatch):
+    """Test that paths without a scheme go through Hail when it is running."""
+    monkeypatch.setattr(storage, "hail_is_initialized", lambda: True)
+
+    assert isinstance(get_storage("/user/data/file"), HadoopStorage)
+    assert isinstance(get_storage("relative/file"), HadoopStorage)
+    assert type(get_storage("file:///tmp/file")) is LocalStorage
+    assert isinstance(get_storage("/mnt/project/file"), FuseStorage)
+
+
+def test_hail_is_initialized_without_hail(monkeypatch):
+    """Test that Hail is not reported as running when it is not imported."""
+    monkeypatch.delitem(storage.sys.modules, "hail", raising=False)
+
+    assert not storage.hail_is_initialized()
+
+
+def test_requires_hail(monkeypatch):
+    """Test which paths are read and written through Hail."""
+    monkeypatch.setattr(storage, "hail_is_initialized", lambda: False)
+
+    assert requires_hail("hdfs://namenode/file")
+    assert requires_hail("dnax://database/file")
+    assert not requires_hail("/tmp/file")
+    assert not requires_hail("/mnt/project/file")
+
+
+def test_gs_without_google_cloud_storage(monkeypatch):
+    """Test that gs:// paths go through Hail when google-cloud-storage is not installed."""
+    monkeypatch.setattr(storage, "gcs", None)
+
+    assert isinstance(get_storage("gs://bucket/file"), HadoopStorage)
+    assert requires_hail("gs://bucket/file")
@@ -0,0 +1,172 @@
+import pytest
+
+pysam = pytest.importorskip("pysam")
+
+from gnomad_mitochondria.utils.tabix import (
+    VCF_TABIX_PRESET,
+    TabixIndexer,
+    compress_bgzf,
+    write_tabix_index,
+)
+from gnomad_mitochondria.utils.vcf_export import BGZF_EOF
+
+
+# Regions queried with fetch, as (contig, 0-based start, end)
+REGIONS = [
+    ("chrM", 0, 16569),
+    ("chrM", 99, 100),
+    ("chrM", 3000, 3100),
+    ("chrM", 16300, 16569),
+    ("chrM", 20000, 30000),
+    ("chrX", 0, 100000),
+    ("chrX", 16383, 16385),
+    ("chrX", 50000, 50001),
+]
+
+
+def make_vcf_lines():
+    """
+    Make the lines of a sorted VCF with records spanning several BGZF blocks.
+
+    Includes deletions (whose end is given by REF), records with an END INFO field, and records on a second contig
+    with positions in several 16kb windows of the linear index.
+    """
+    lines = [
+        "##fileformat=VCFv4.2",
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS0",
+    ]
+    # Long genotype columns make the file span several BGZF blocks
+    genotypes = "0/1:" + "1," * 200 + "1"
+    for pos in range(1, 16570, 7):
+        ref, info = "A", "DP=100"
+        if pos % 5 == 0:
+            ref = "ACGT"
+        if pos % 11 == 0:
+            info = f"DP=100;END={pos + 40}"
+        lines.append(f"chrM\t{pos}\t.\t{ref}\tG\t.\tPASS\t{info}\tGT:AD\t{genotypes}")
+    for pos in [10, 16384, 16385, 40000, 49990, 120000]:
+        lines.append(
+            f"chrX\t{pos}\t.\tC\tT\t.\tPASS\tEND={pos + 20}\tGT:AD\t{genotypes}"
+        )
+
+    return lines
+
+
+def get_record_interval(line):
+    """Get the contig and 0-based, end-exclusive interval of a VCF record, as tabix computes it."""
+    fields = line.split("\t")
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+    for entry in fields[7].split(";"):
+        if entry.startswith("END="):
+            end = int(entry[4:])
+
+    return fields[0], beg, max(end, beg + 1)
+
+
+def get_expected_rows(lines, contig, start, end):
+    """Get the records overlapping a region."""
+    rows = []
+    for line in lines:
+        if line.startswith("#"):
+            continue
+        name, beg, rec_end = get_record_interval(line)
+        if name == contig and beg < end and rec_end > start:
+            rows.append(line)
+
+    return rows
+
+
+def check_fetch(path, index_path, lines):
+    """Check the records returned by pysam for every region against the expected records."""
+    with pysam.TabixFile(path, index=index_path) as tbx:
+        assert list(tbx.contigs) == ["chrM", "chrX"]
+        for contig, start, end in REGIONS:
+            assert list(tbx.fetch(contig, start, end)) == get_expected_rows(
+                lines, contig, start, end
+            )
+
+
+def test_index_of_bgzipped_file(tmp_path):
+    """Test that an index built from the blocks of a file bgzipped by pysam gives the expected rows."""
+    lines = make_vcf_lines()
+    raw_path = str(tmp_path / "fixture.vcf")
+    with open(raw_path, "w") as out:
+        out.write("\n".join(lines) + "\n")
+    path = str(tmp_path / "fixture.vcf.bgz")
+    pysam.tabix_compress(raw_path, path)
+
+    with open(path, "rb") as f:
+        data = f.read()
+    indexer = TabixIndexer(**VCF_TABIX_PRESET)
+    # The EOF block holds no data
+    indexer.add_bgzf(0, data[: -len(BGZF_EOF)])
+    index_path = f"{path}.tbi"
+    write_tabix_index(indexer.finish(), index_path)
+
+    check_fetch(path, index_path, lines)
+
+
+def test_index_of_streamed_blocks(tmp_path):
+    """Test indexing blocks as they are written, in several calls, with a record split across blocks."""
+    lines = make_vcf_lines()
+    text = ("\n".join(lines) + "\n").encode()
+    # Two parts compressed separately (as two shards of an export), split in the middle of a record
+    split = text.index(b"\n", len(text) // 2) + 6
+    parts = [compress_bgzf(text[:split]), compress_bgzf(text[split:])]
+    assert b"\n" not in text[split - 5 : split]
+
+    indexer = TabixIndexer(**VCF_TABIX_PRESET)
+    offset = 0
+    path = str(tmp_path / "streamed.vcf.bgz")
+    with open(path, "wb") as out:
+        for part in parts:
+            indexer.add_bgzf(offset, part)
+            out.write(part)
+            offset += len(part)
+        out.write(BGZF_EOF)
+    index_path = f"{path}.tbi"
+    write_tabix_index(indexer.finish(), index_path)
+
+    check_fetch(path, index_path, lines)
+
+
+def test_generic_format_with_end_column(tmp_path):
+    """Test the index of a generic tab-separated file with start and end columns and a header line."""
+    lines = ["contig\tstart\tend\tvalue"] + [
+        f"chrM\t{pos}\t{pos + (pos % 13)}\t{pos * 2}" for pos in range(1, 16570, 3)
+    ]
+    text = ("\n".join(lines) + "\n").encode()
+    data = compress_bgzf(text)
+    path = str(tmp_path / "generic.tsv.bgz")
+    with open(path, "wb") as out:
+        out.write(data + BGZF_EOF)
+
+    indexer = TabixIndexer(format=0, col_seq=1, col_beg=2, col_end=3, line_skip=1)
+    indexer.add_bgzf(0, data)
+    index_path = f"{path}.tbi"
+    write_tabix_index(indexer.finish(), index_path)
+
+    with pysam.TabixFile(path, index=index_path) as tbx:
+        for start, end in [(0, 16569), (500, 520), (16560, 16569)]:
+            expected = [
+                x
+                for x in lines[1:]
+                if int(x.split("\t")[1]) - 1 < end and int(x.split("\t")[2]) > start
+            ]
+            assert list(tbx.fetch("chrM", start, end)) == expected
+
+
+def test_unsorted_records_are_rejected():
+    """Test that indexing fails on unsorted positions and non-contiguous contigs."""
+    for lines in [
+        ["chrM\t20\t.\tA\tG\t.\tPASS\t.", "chrM\t10\t.\tA\tG\t.\tPASS\t."],
+        [
+            "chrM\t10\t.\tA\tG\t.\tPASS\t.",
+            "chrX\t10\t.\tA\tG\t.\tPASS\t.",
+            "chrM\t20\t.\tA\tG\t.\tPASS\t.",
+        ],
+    ]:
+        indexer = TabixIndexer(**VCF_TABIX_PRESET)
+        with pytest.raises(ValueError):
+            indexer.add_bgzf(0, compress_bgzf(("\n".join(lines) + "\n").encode()))
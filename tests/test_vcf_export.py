@@ -0,0 +1,114 @@
+import gzip
+
+import pytest
+
+hl = pytest.importorskip("hail")
+
+from gnomad_mitochondria.utils.vcf_export import export_sites_vcf
+
+
+@pytest.fixture(scope="module")
+def hail_session():
+    """Start a local Hail session for the tests of this module."""
+    hl.init(master="local[2]", quiet=True, idempotent=True)
+
+
+def make_sites_ht():
+    """Make a sites Table with the kinds of INFO values that hl.export_vcf formats differently."""
+    info_type = hl.tstruct(
+        AC=hl.tarray(hl.tint32),
+        AN=hl.tint64,
+        AF=hl.tfloat64,
+        AF_hap=hl.tarray(hl.tfloat64),
+        hap=hl.tstr,
+        common=hl.tbool,
+        pops=hl.tset(hl.tstr),
+    )
+    rows = [
+        dict(
+            locus=hl.Locus("chrM", 3, "GRCh38"),
+            alleles=["A", "G"],
+            rsid="rs1",
+            filters=set(),
+            info=dict(
+                AC=[1],
+                AN=10,
+                AF=0.1234567891,
+                AF_hap=[0.5, None, 1e-9],
+                hap="L1",
+                common=True,
+                pops={"nfe", "afr"},
+            ),
+        ),
+        dict(
+            locus=hl.Locus("chrM", 10, "GRCh38"),
+            alleles=["AT", "A", "C"],
+            rsid=None,
+            filters={"npg", "artifact_prone_site"},
+            info=dict(
+                AC=None,
+                AN=None,
+                AF=float("nan"),
+                AF_hap=[],
+                hap=None,
+                common=False,
+                pops=None,
+            ),
+        ),
+        dict(
+            locus=hl.Locus("chrM", 16569, "GRCh38"),
+            alleles=["A", "G"],
+            rsid=None,
+            filters=None,
+            info=dict(
+                AC=[2], AN=5, AF=1e20, AF_hap=None, hap="", common=None, pops=set()
+            ),
+        ),
+    ]
+    row_type = hl.tstruct(
+        locus=hl.tlocus("GRCh38"),
+        alleles=hl.tarray(hl.tstr),
+        rsid=hl.tstr,
+        filters=hl.tset(hl.tstr),
+        info=info_type,
+    )
+
+    return hl.Table.parallelize(
+        rows, row_type, key=["locus", "alleles"], n_partitions=2
+    )
+
+
+def test_export_sites_vcf_matches_export_vcf(hail_session, tmp_path):
+    """Test that the sites VCF written from the Table is the one hl.export_vcf writes from a MatrixTable."""
+    ht = make_sites_ht()
+    metadata = {
+        "filter": {
+            "npg": {"Description": "No pass genotype"},
+            "artifact_prone_site": {"Description": 'Site "flagged"'},
+        },
+        "info": {"AC": {"Description": "Allele count", "Number": "A"}},
+    }
+    header_path = str(tmp_path / "extra_header.txt")
+    with open(header_path, "w") as f:
+        f.write("##extra=value\n")
+
+    expected_path = str(tmp_path / "expected.vcf")
+    hl.export_vcf(
+        hl.MatrixTable.from_rows_table(ht).key_cols_by(s="foo"),
+        expected_path,
+        metadata=metadata,
+        append_to_header=header_path,
+    )
+    output_path = str(tmp_path / "sites.vcf.bgz")
+    export_sites_vcf(ht, output_path, metadata=metadata, append_to_header=header_path)
+
+    with open(expected_path) as f:
+        expected = f.read()
+    with gzip.open(output_path, "rt") as f:
+        assert f.read() == expected
+
+    pysam = pytest.importorskip("pysam")
+    positions = [
+        x.split("\t")[1] for x in pysam.TabixFile(output_path).fetch("chrM", 5, 16569)
+    ]
+    assert positions == ["10", "16569"]